@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import argparse
+from paper_gpu import sum_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the NumPy catcher sum/diff and channel-summing stage",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--nbls", type=int, default=1024, help="number of baselines")
+    parser.add_argument(
+        "--nchan", type=int, default=sum_diff.N_CHAN_TOTAL, help="number of input channels"
+    )
+    parser.add_argument(
+        "-t", "--nthreads", type=int, nargs="+", default=[1, 2, 4],
+        help="thread counts to test",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per thread count")
+    parser.add_argument(
+        "--databuf", default=None,
+        help="time every block of this catcher input databuf dump instead of random data",
+    )
+    args = parser.parse_args()
+
+    if args.databuf is None:
+        results = sum_diff.benchmark_sum_diff(
+            nbl=args.nbls, nchan=args.nchan, nthreads=args.nthreads, repeat=args.repeat
+        )
+        print(f"{'threads':>8} {'time ms':>10} {'GB/s':>8}")
+        for n, res in results.items():
+            print(f"{n:8d} {res['time'] * 1e3:10.2f} {res['GBps']:8.2f}")
+    else:
+        blocks = sum_diff.open_bda_input_databuf(args.databuf)
+        for n in args.nthreads:
+            t0 = time.perf_counter()
+            for block in blocks:
+                sum_diff.sum_diff(block["data"], nthreads=n)
+            elapsed = time.perf_counter() - t0
+            nbytes = blocks.size * blocks.dtype["data"].itemsize
+            print(f"{n} threads: {len(blocks)} blocks in {elapsed:.2f} s, "
+                  f"{nbytes / elapsed / 1e9:.2f} GB/s")
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Convert catcher files into aggregated UVH5 files.
+
+This is an alternative to hera_catcher_convert_uvh5.py: instead of one UVH5
+file per catcher file, consecutive files from the same JD are appended to
+one sum and one diff file, each spanning up to AGGREGATE_SPAN seconds. Run
+one or the other, not both.
+"""
+
+import re
+import os
+import time
+import socket
+import functools
+import redis
+from paper_gpu.file_conversion import (
+    UVH5Aggregator,
+    get_uvh5_header,
+    verify_visdata_checksum,
+)
+from paper_gpu.manifest import make_manifest_entry, record_conversion
+from paper_gpu.mc_records import (
+    MC_PENDING_KEY,
+    HeraMCBackend,
+    MCBatchWriter,
+    make_obs_record,
+    record_from_json,
+)
+from paper_gpu.work_stealing import get_mount
+
+DELETE_TAGS = ('delete', 'junk')
+REDISHOST = 'redishost'
+TEMPLATE = re.compile(r'zen\.(\d+)\.(\d+)\.(sum|diff)\.dat')
+RAW_FILE_KEY = 'corr:files:raw'
+PURG_FILE_KEY = 'corr:files:purgatory'
+CONV_FILE_KEY = 'corr:files:converted'
+FAILED_FILE_KEY = 'corr:files:failed'
+JD_KEY = 'corr:files:jds'
+AGGREGATE_KEY = 'corr:files:aggregates'  # hash of sum/diff -> open aggregate
+AGGREGATE_SPAN = 3600.0  # seconds of data per output file
+CHUNKSIZE = 1000  # baseline-times read at a time
+MC_FLUSH_INTERVAL = 30  # seconds between batched M&C writes
+VERIFY_NPROC = 2  # processes used to re-read the .uvh5 file before deleting the .dat files
+
+def match_up_filenames(f, cwd):
+    path, f_in = os.path.split(f)
+    path = os.path.join(cwd, path)
+    jd_day, jd_frac, sum_diff = TEMPLATE.match(f_in).groups()
+    f_in = os.path.join(path, f_in)
+    f_meta = os.path.join(path, f'zen.{jd_day}.{jd_frac}.meta.hdf5')
+    f_out = os.path.join(path, f'zen.{jd_day}.{jd_frac}.{sum_diff}.uvh5')
+    return f_in, f_meta, f_out, sum_diff
+
+def get_cwd_from_filename(fn):
+    _, f_in = os.path.split(fn)
+    jd_day, _, _ = TEMPLATE.match(f_in).groups()
+    if int(jd_day) % 2 == 1:
+        # odd day
+        return "/data1"
+    else:
+        # even day
+        return "/data2"
+
+@functools.lru_cache(maxsize=4)
+def get_header(f_meta):
+    # the sum and diff files share a metadata file, so compute its header once
+    return get_uvh5_header(f_meta)
+
+def get_prefix(int_jd, hostname):
+    data_dir = "/data1" if int_jd % 2 == 1 else "/data2"
+    mount = get_mount(hostname)
+    if mount is None:
+        print(f'No mount point known for {hostname}; using the local path for M&C')
+        mount = ''
+    return os.path.join(f"{mount}{data_dir}", f"{int_jd:d}")
+
+def finalize(r, agg, raw_files, mc_writer, hostname, t0):
+    # close an aggregate, then record it and delete its raw files
+    info = agg.finalize()
+    f_out = agg.filename
+    cwd = get_cwd_from_filename(raw_files[0][0])
+    print(f'Finished {f_out} from {len(raw_files)} files')
+    # re-read the aggregate before announcing it or deleting anything
+    if not verify_visdata_checksum(f_out, nproc=VERIFY_NPROC):
+        print(f'Checksum mismatch for {f_out}; keeping raw files')
+        for f, f_in in raw_files:
+            r.rpush(FAILED_FILE_KEY, f)
+            r.hdel(PURG_FILE_KEY, f)
+        os.remove(f_out)
+        return
+    raw_bytes = sum(os.path.getsize(f_in) for _, f_in in raw_files)
+    entry = make_manifest_entry(f_out, info, raw_bytes, t0, time.time() - t0)
+    record_conversion(os.path.dirname(f_out), entry)
+    if f_out.endswith('.sum.uvh5') and info['tag'] not in DELETE_TAGS:
+        record = make_obs_record(info['time_array'], info['tag'], os.path.split(f_out)[-1])
+        mc_writer.add(record._replace(prefix=get_prefix(record.jd, hostname)))
+    r.rpush(CONV_FILE_KEY, os.path.relpath(f_out, cwd))
+    for f, f_in in raw_files:
+        r.hdel(PURG_FILE_KEY, f)
+        print(f'Deleting {f_in}')
+        os.remove(f_in)
+
+def flush_mc_records(r, mc_writer):
+    pipe = r.pipeline()
+    pipe.lrange(MC_PENDING_KEY, 0, -1)
+    pipe.delete(MC_PENDING_KEY)
+    pending, _ = pipe.execute()
+    for rec_str in pending:
+        mc_writer.add(record_from_json(rec_str))
+    if len(mc_writer.pending) == 0:
+        return
+    try:
+        result = mc_writer.flush()
+    except Exception as e:
+        # records stay in the writer and are retried on the next flush
+        print(f'M&C write of {len(mc_writer.pending)} records failed: {e}')
+        return
+    for rec in result['new_rtp']:
+        print(f'Inserted {rec.obsid} for file {rec.filename} in M&C and RTP')
+        r.hset(JD_KEY, rec.jd, 0)  # put this jd on a list for later rtp launch
+
+def resume_aggregates(r):
+    # reopen the aggregates that were open when the last run stopped, back to
+    # their last checkpoint, with the raw files they hold
+    aggregates = {'sum': None, 'diff': None}
+    raw_files = {'sum': [], 'diff': []}
+    for kind, f_out in r.hgetall(AGGREGATE_KEY).items():
+        agg = UVH5Aggregator(f_out, span=AGGREGATE_SPAN)
+        if agg.h5f is None:
+            # finished, or never checkpointed; its files are converted again
+            r.hdel(AGGREGATE_KEY, kind)
+            continue
+        print(f'Resuming {f_out} with {agg.nfiles} files')
+        aggregates[kind] = agg
+        raw_files[kind] = [
+            (f, match_up_filenames(f, get_cwd_from_filename(f))[0]) for f in agg.files
+        ]
+    return aggregates, raw_files
+
+def return_purgatory_files(r, aggregates):
+    # files in an open aggregate stay claimed, to be resumed on the next
+    # start; any other output is removed and its file converted again
+    open_files = set()
+    open_outs = set()
+    for agg in aggregates.values():
+        if agg is not None:
+            open_files.update(agg.files)
+            open_outs.add(agg.filename)
+    returned = [f for f in r.hgetall(PURG_FILE_KEY) if f not in open_files]
+    for f in returned:
+        print(f'Returning {f}')
+        f_in, f_meta, f_out, sum_diff = match_up_filenames(f, get_cwd_from_filename(f))
+        if os.path.exists(f_out) and f_out not in open_outs:
+            print(f'Removing {f_out}')
+            os.remove(f_out)
+    # return in the original order, oldest at the head of the queue
+    for f in sorted(returned, reverse=True):
+        r.lpush(RAW_FILE_KEY, f)
+        r.hdel(PURG_FILE_KEY, f)
+
+
+if __name__ == '__main__':
+    r = redis.Redis(REDISHOST, decode_responses=True)
+    hostname = socket.gethostname()
+    print(f'Starting aggregation. Queue length={r.llen(RAW_FILE_KEY)}')
+    # open aggregates, and the raw files in each, for the sum and diff streams
+    aggregates, raw_files = resume_aggregates(r)
+    # files claimed by a run that died without cleaning up
+    return_purgatory_files(r, aggregates)
+    start_times = {kind: time.time() for kind in aggregates}
+    mc_writer = MCBatchWriter(HeraMCBackend())
+    last_mc_flush = time.time()
+    try:
+        while True:
+            if time.time() - last_mc_flush > MC_FLUSH_INTERVAL:
+                flush_mc_records(r, mc_writer)
+                last_mc_flush = time.time()
+            # aggregates need files in time order, so take the oldest first
+            f = r.lpop(RAW_FILE_KEY)
+            if f is None:
+                endofday = int(r.hget('corr:files', 'ENDOFDAY'))
+                now_jd = time.time() / 86400.0 + 2440587.5
+                for kind, agg in aggregates.items():
+                    if agg is None:
+                        continue
+                    span_closed = (now_jd - agg.first_time) * 86400.0 > AGGREGATE_SPAN
+                    if endofday or span_closed:
+                        finalize(r, agg, raw_files[kind], mc_writer, hostname,
+                                 start_times[kind])
+                        r.hdel(AGGREGATE_KEY, kind)
+                        aggregates[kind] = None
+                        raw_files[kind] = []
+                if endofday and all(agg is None for agg in aggregates.values()):
+                    flush_mc_records(r, mc_writer)
+                    last_mc_flush = time.time()
+                    # tag out JDs that we converted files for
+                    for jd, val in r.hgetall(JD_KEY).items():
+                        if int(val) == 0:
+                            r.hset(JD_KEY, jd, int(val) + 1)
+                time.sleep(10)
+                continue
+
+            r.hset(PURG_FILE_KEY, f, 0)
+            f_in, f_meta, f_out, kind = match_up_filenames(f, get_cwd_from_filename(f))
+            header = get_header(f_meta)
+            agg = aggregates[kind]
+            if agg is not None and not agg.accepts(header):
+                finalize(r, agg, raw_files[kind], mc_writer, hostname, start_times[kind])
+                r.hdel(AGGREGATE_KEY, kind)
+                agg = None
+                raw_files[kind] = []
+            if agg is None:
+                # start a new aggregate named after its first file; open
+                # aggregates were resumed at startup, so an existing file is
+                # a leftover
+                if os.path.exists(f_out):
+                    os.remove(f_out)
+                agg = UVH5Aggregator(f_out, span=AGGREGATE_SPAN)
+                aggregates[kind] = agg
+                start_times[kind] = time.time()
+                r.hset(AGGREGATE_KEY, kind, f_out)
+            print(f'Appending {f_in} to {agg.filename}')
+            # the file is recorded in the aggregate's checkpoint, so a
+            # resumed aggregate knows which raw files it holds
+            agg.append(header, f_in, chunksize=CHUNKSIZE, name=f)
+            raw_files[kind].append((f, f_in))
+    finally:
+        print('Cleanup')
+        for agg in aggregates.values():
+            if agg is not None and agg.h5f is not None:
+                agg.h5f.close()
+        flush_mc_records(r, mc_writer)
+        return_purgatory_files(r, aggregates)
@@ -3,11 +3,38 @@
 
 import re
 import os
+import time
 import psutil
-import numpy as np
-from paper_gpu.file_conversion import make_uvh5_file
-from astropy.time import Time
-from hera_mc import mc
+from paper_gpu.file_conversion import (
+    get_checkpoint,
+    make_uvh5_file,
+    make_uvh5_file_pair,
+    verify_visdata_checksum,
+)
+from paper_gpu.manifest import (
+    make_manifest_entry,
+    queue_conversion,
+    record_conversion,
+    record_queued_conversions,
+)
+from paper_gpu.profiling import get_profile_mode, profiled
+from paper_gpu.scheduling import (
+    DrainTracker,
+    SchedulingPolicy,
+    VolumeMonitor,
+    export_metrics,
+    get_metrics,
+    make_queued_file,
+)
+from paper_gpu.work_stealing import CATCHER_MOUNTS, LocalityScheduler, get_mount
+from paper_gpu.mc_records import (
+    MC_PENDING_KEY,
+    HeraMCBackend,
+    MCBatchWriter,
+    make_obs_record,
+    record_from_json,
+    record_to_json,
+)
 
 DELETE_TAGS = ('delete', 'junk')
 REDISHOST = 'redishost'
@@ -17,10 +44,15 @@ RAW_FILE_KEY = 'corr:files:raw'
 PURG_FILE_KEY = 'corr:files:purgatory'
 CONV_FILE_KEY = 'corr:files:converted'
 FAILED_FILE_KEY = 'corr:files:failed'
+DISCARD_FILE_KEY = 'corr:files:discarded'
 JD_KEY = 'corr:files:jds'
 #CPU_AFFINITY = list(range(6))  # the rest are reserved for the catcher
 CPU_AFFINITY = [2, 3, 4, 5]
-MINIMUM_UVH5_RELATIVE_SIZE = 0.1  # if a .uvh5 file is less than 10% the size of the .dat file, don't auto-delete the .dat file
+MC_FLUSH_INTERVAL = 30  # seconds between batched M&C writes
+VISDATA_CODEC = 'auto'  # benchmark codecs on each file and pick the best ratio
+PAIR_SUM_DIFF = True  # convert the sum and diff files of an observation together
+VOLUMES = ('/data1', '/data2')
+VERIFY_NPROC = 2  # processes used to re-read the .uvh5 file before deleting the .dat file
 
 def match_up_filenames(f, cwd=None):
     path, f_in = os.path.split(f)
@@ -33,6 +65,45 @@ def match_up_filenames(f, cwd=None):
     f_out = os.path.join(path, f'zen.{jd_day}.{jd_frac}.{sum_diff}.uvh5')
     return (f_in, f_meta, f_out), is_diff
 
+def get_partner(f):
+    # the diff file of a sum file, or vice versa
+    path, f_in = os.path.split(f)
+    jd_day, jd_frac, sum_diff = TEMPLATE.match(f_in).groups()
+    partner = 'sum' if sum_diff == 'diff' else 'diff'
+    return os.path.join(path, f'zen.{jd_day}.{jd_frac}.{partner}.dat')
+
+def plan_queue(r, policy, monitor, drain, scheduler):
+    # order this host's files by disk pressure, and publish queue metrics
+    monitor.update()
+    local, _ = scheduler.split_queue()
+    files = [make_queued_file(f, get_cwd_from_filename(f)) for f in local]
+    order, nworkers = policy.plan(files, monitor.free_bytes(), monitor.time_to_full())
+    export_metrics(r, get_metrics(len(local), drain, monitor))
+    return order, nworkers
+
+def discard_file(r, qf, scheduler):
+    # files with a tag in DELETE_TAGS are not kept, so free their space
+    # without converting them when a volume is nearly full
+    if r.lrem(RAW_FILE_KEY, 1, qf.name) == 0:
+        return
+    print(f'Discarding {qf.name} ({qf.tag}) to free space on {qf.volume}')
+    f_in = os.path.join(qf.volume, qf.name)
+    if os.path.exists(f_in):
+        os.remove(f_in)
+    r.rpush(DISCARD_FILE_KEY, qf.name)
+    scheduler.forget([qf.name])
+
+def claim_files(r, f, host):
+    # once we get a key, we commit to finish it or return it; no dropping
+    if r.lrem(RAW_FILE_KEY, 1, f) == 0:
+        return ()
+    files = [f]
+    if PAIR_SUM_DIFF and r.lrem(RAW_FILE_KEY, 1, get_partner(f)) == 1:
+        files.append(get_partner(f))
+    for f in files:
+        r.hset(PURG_FILE_KEY, f, host)
+    return tuple(files)
+
 def get_cwd_from_redis(r, default='/data'):
     cwd = r.hget('corr:catcher', 'cwd')
     if cwd is None:
@@ -50,91 +121,174 @@ def get_cwd_from_filename(fn):
         # even day
         return "/data2"
 
-def return_purgatory_files(r):
+def get_file_cwd(scheduler, f):
+    # the volume holding a queued file, through the mount for other hosts
+    loc = scheduler.locate([f], probe_remote=True).get(f)
+    if loc is None:
+        return get_cwd_from_filename(f)
+    return scheduler.volume_dir(loc.volume, loc.host)
+
+def get_files_nbytes(files, cwd):
+    nbytes = 0
+    for f in files:
+        try:
+            nbytes += os.path.getsize(os.path.join(cwd, f))
+        except OSError:
+            pass
+    return nbytes
+
+def remove_partial_output(f_out, keep_checkpoint=False):
+    # keep checkpointed output of a re-queued file so it resumes where it
+    # stopped; failed files are not re-queued, so nothing would resume them
+    print(f'Remove {f_out}?')
+    checkpoint = get_checkpoint(f_out) if keep_checkpoint else None
+    if checkpoint is not None:
+        print(f'Keeping {f_out}; checkpointed at blt {checkpoint}')
+    elif os.path.exists(f_out):
+        print(f'Removing {f_out}')
+        os.remove(f_out)
+
+def return_purgatory_files(r, scheduler):
+    # only return the files this host claimed; the others are still being
+    # converted on their hosts
     purgfiles = r.hgetall(PURG_FILE_KEY)
-    for f in purgfiles:
+    for f, host in purgfiles.items():
+        if host != scheduler.host:
+            continue
         print(f'Returning {f}')
         r.rpush(RAW_FILE_KEY, f)
         r.hdel(PURG_FILE_KEY, f)
-        (f_in, f_meta, f_out), is_diff = match_up_filenames(f, cwd)
-        print(f'Remove {f_out}?')
-        if os.path.exists(f_out):
-            print(f'Removing {f_out}')
-            os.remove(f_out)
+        (f_in, f_meta, f_out), is_diff = match_up_filenames(f, get_file_cwd(scheduler, f))
+        remove_partial_output(f_out, keep_checkpoint=True)
 
-def filter_done(f, thd):
+def filter_done(files, thd, scheduler):
     is_alive = thd.is_alive()
     if not is_alive:
         purgfiles = r.hgetall(PURG_FILE_KEY)
-        if f in purgfiles:
+        for f in files:
+            if f not in purgfiles:
+                continue
             # failure to remove from purgatory indicates failed conversion
             # so clean up and add to failed queue
             r.rpush(FAILED_FILE_KEY, f)
             r.hdel(PURG_FILE_KEY, f)
-            (f_in, f_meta, f_out), is_diff = match_up_filenames(f, cwd)
-            print(f'Remove {f_out}?')
-            if os.path.exists(f_out):
-                print(f'Removing {f_out}')
-                os.remove(f_out)
+            (f_in, f_meta, f_out), is_diff = match_up_filenames(f, get_file_cwd(scheduler, f))
+            remove_partial_output(f_out)
+        scheduler.forget(files)
     return is_alive
 
-def process_next(f, cwd, hostname):
-    p = psutil.Process()
-    p.cpu_affinity(CPU_AFFINITY)
-    print(f'Processing {f}')
-    (f_in, f_meta, f_out), is_diff = match_up_filenames(f, cwd)
-    info = make_uvh5_file(f_out, f_meta, f_in, 1000)
-    print(f'Finished {f_in} -> {f_out}')
-    times = np.unique(info['time_array'])
-    starttime = Time(times[0], scale='utc', format='jd')
-    stoptime = Time(times[-1], scale='utc', format='jd')
-    obs_id = int(np.floor(starttime.gps))
-    int_jd = int(np.floor(starttime.jd))
+def flush_mc_records(r, mc_writer):
+    # atomically take everything the workers have queued
+    pipe = r.pipeline()
+    pipe.lrange(MC_PENDING_KEY, 0, -1)
+    pipe.delete(MC_PENDING_KEY)
+    pending, _ = pipe.execute()
+    for rec_str in pending:
+        mc_writer.add(record_from_json(rec_str))
+    if len(mc_writer.pending) == 0:
+        return
+    try:
+        result = mc_writer.flush()
+    except Exception as e:
+        # records stay in the writer and are retried on the next flush
+        print(f'M&C write of {len(mc_writer.pending)} records failed: {e}')
+        return
+    for rec in result['new_obs']:
+        print(f'Inserted {rec.obsid} for file {rec.filename} in M&C')
+    for rec in result['new_rtp']:
+        print(f'Inserted {rec.obsid} for file {rec.filename} in RTP')
+        r.hset(JD_KEY, rec.jd, 0)  # put this jd on a list for later rtp launch
+    for obsid in result['resubmitted']:
+        print(f'Updated RTP launch record for {obsid}')
+
+def return_mc_records(r, mc_writer):
+    for rec in mc_writer.pending:
+        r.rpush(MC_PENDING_KEY, record_to_json(rec))
+    mc_writer.pending = []
+
+def finish_file(f, f_in, f_out, info, is_diff, cwd, owner, timing):
+    # only announce the output, and delete the raw file, if the converted
+    # visdata match the checksum computed while reading it
+    if not (os.path.exists(f_out) and verify_visdata_checksum(f_out, nproc=VERIFY_NPROC)):
+        print(f'Checksum mismatch for {f_out}; keeping {f_in}')
+        r.rpush(FAILED_FILE_KEY, f)
+        r.hdel(PURG_FILE_KEY, f)
+        if os.path.exists(f_out):
+            os.remove(f_out)
+        return
+    record = make_obs_record(info['time_array'], info['tag'], os.path.split(f_out)[-1])
+    int_jd = record.jd
     if int_jd % 2 == 1:
         # odd JD
         data_dir = "/data1"
     else:
         # even JD
         data_dir = "/data2"
-    if "hera-sn1" in hostname:
-        prefix = os.path.join(f"/mnt/sn1{data_dir}", f"{int_jd:d}")
-    elif "hera-sn2" in hostname:
-        prefix = os.path.join(f"/mnt/sn2{data_dir}", f"{int_jd:d}")
-    # only add sum files (and not 'junk' or 'delete' tags) to M&C
+    # the file stays on the host that caught it, even if it was converted
+    # on another one
+    mount = get_mount(owner)
+    if mount is None:
+        print(f'No mount point known for {owner}; using the local path for M&C')
+        mount = ''
+    prefix = os.path.join(f"{mount}{data_dir}", f"{int_jd:d}")
+    # only add sum files (and not 'junk' or 'delete' tags) to M&C; the parent
+    # process writes them in batches
     if not is_diff and info['tag'] not in DELETE_TAGS:
-        db = mc.connect_to_mc_db(None)
-        with db.sessionmaker() as session:
-            obs = session.get_obs(obs_id)
-            if len(obs) > 0:
-                print(f'observation {obs_id} for file {f} already in M&C, skipping')
-            else:
-                print(f'Inserting {obs_id} for file {f} in M&C')
-                session.add_obs(starttime, stoptime, obs_id, info['tag'])
-                session.commit()
-            result = session.get_rtp_launch_record(obs_id)
-            if len(result) == 0:
-                print(f'Inserting {obs_id} for file {f_out} in RTP')
-                session.add_rtp_launch_record(obs_id, int_jd, info['tag'],
-                                              os.path.split(f_out)[-1], prefix)
-                r.hset(JD_KEY, int_jd, 0)  # put this jd on a list for later rtp launch
-            else:
-                t0 = Time.now()
-                session.update_rtp_launch_record(obs_id, t0)
-                session.commit()
+        print(f'Queueing {record.obsid} for file {f} for M&C')
+        record = record._replace(prefix=prefix)
+        r.rpush(MC_PENDING_KEY, record_to_json(record))
+    # add to the JD directory's manifest before announcing the file
+    raw_bytes = os.path.getsize(f_in)
+    entry = make_manifest_entry(f_out, info, raw_bytes, *timing)
+    if owner == hostname:
+        record_conversion(os.path.dirname(f_out), entry)
+    else:
+        # the manifest must not be written over the mount, so the owner
+        # adds entries for the files we stole to its own manifest
+        jd_dir = os.path.join(get_cwd_from_filename(f), os.path.dirname(f))
+        queue_conversion(r, owner, jd_dir, entry)
     r.rpush(CONV_FILE_KEY, os.path.relpath(f_out, cwd))  # document we finished it
     r.hdel(PURG_FILE_KEY, f)
-    if os.path.exists(f_out):
-        # check that size of f_out is reasonable
-        if os.path.getsize(f_out) > MINIMUM_UVH5_RELATIVE_SIZE * os.path.getsize(f_in):
-            print(f'Deleting {f_in}')
-            os.remove(f_in)
+    print(f'Deleting {f_in}')
+    os.remove(f_in)
+
+def process_next(files, cwd, owner, profile=None):
+    p = psutil.Process()
+    p.cpu_affinity(CPU_AFFINITY)
+    print(f'Processing {", ".join(files)}')
+    # profile the whole worker when PAPER_GPU_PROFILE or the corr:profiling
+    # redis flag is set, writing one profile per file
+    with profiled('convert', os.path.basename(files[0]), profile):
+        convert_files(files, cwd, owner)
     print(f'Finished')
 
+def convert_files(files, cwd, owner):
+    matched = [match_up_filenames(f, cwd) for f in files]
+    f_ins = [f_in for (f_in, f_meta, f_out), is_diff in matched]
+    f_outs = [f_out for (f_in, f_meta, f_out), is_diff in matched]
+    f_meta = matched[0][0][1]
+    t0 = time.time()
+    if len(files) == 1:
+        infos = [make_uvh5_file(
+            f_outs[0], f_meta, f_ins[0], 1000, codec=VISDATA_CODEC, resume=True
+        )]
+    else:
+        # sum and diff share a metadata file, so build the header once
+        infos = make_uvh5_file_pair(
+            f_outs, f_meta, f_ins, 1000, codec=VISDATA_CODEC, resume=True
+        )
+    timing = (t0, time.time() - t0)
+    for f, ((f_in, _, f_out), is_diff), info in zip(files, matched, infos):
+        if isinstance(info, Exception):
+            # left in purgatory, so the parent moves it to the failed queue
+            print(f'Failed to convert {f_in}: {info}')
+            continue
+        print(f'Finished {f_in} -> {f_out}')
+        finish_file(f, f_in, f_out, info, is_diff, cwd, owner, timing)
 
 if __name__ == '__main__':
     import multiprocessing as mp
     import redis
-    import time
     import sys
     import socket
 
@@ -144,27 +298,85 @@ if __name__ == '__main__':
     assert psutil.cpu_count() == 12, "if this errors, you're not on hera-sn1"
 
     r = redis.Redis(REDISHOST, decode_responses=True)
-    hostname = socket.gethostname()
+    hostname = socket.gethostname().split('.')[0]
     qlen = r.llen(RAW_FILE_KEY)
-    print(f'Starting conversion. Queue length={qlen}. N workers={len(CPU_AFFINITY)}')
+    print(f'Starting conversion. Queue length={qlen}. N workers={len(CPU_AFFINITY)}-{len(CPU_AFFINITY) * 2}')
     children = {}
-    nworkers = len(CPU_AFFINITY) * 2
+    policy = SchedulingPolicy(
+        min_workers=len(CPU_AFFINITY),
+        max_workers=len(CPU_AFFINITY) * 2,
+        delete_tags=DELETE_TAGS,
+    )
+    monitor = VolumeMonitor(VOLUMES)
+    drain = DrainTracker()
+    # convert files on our volumes first, and steal the other hosts' files
+    # over their mounts when we have nothing to do
+    scheduler = LocalityScheduler(r, hostname, VOLUMES, CATCHER_MOUNTS)
+    started = {}
+    # one long-lived M&C connection pool for all batched writes
+    mc_writer = MCBatchWriter(HeraMCBackend())
+    last_mc_flush = time.time()
     try:
         while True:
-            qlen = r.llen(RAW_FILE_KEY)
-            children = {f: thd for f, thd in children.items()
-                        if filter_done(f, thd)}
+            if time.time() - last_mc_flush > MC_FLUSH_INTERVAL:
+                flush_mc_records(r, mc_writer)
+                last_mc_flush = time.time()
+            nfiles = sum(len(files) for files in children)
+            children = {files: thd for files, thd in children.items()
+                        if filter_done(files, thd, scheduler)}
+            for files in set(started) - set(children):
+                # refine the cost model from the finished conversion
+                t0, nbytes, remote = started.pop(files)
+                scheduler.cost_model.record(nbytes, time.time() - t0, remote=remote)
+            drain.record(nfiles - sum(len(files) for files in children))
+            # manifest entries for our files that other hosts converted; they
+            # stay queued if they cannot be written
+            try:
+                record_queued_conversions(r, hostname)
+            except Exception as e:
+                print(f'Recording queued manifest entries failed: {e}')
+            order, nworkers = plan_queue(r, policy, monitor, drain, scheduler)
+            qlen = len(order)
+            scheduler.publish(nworkers, len(children), qlen)
             print(f'Queue length={qlen}, N workers={len(children)}/{nworkers}')
+            steal = None
+            if qlen == 0 and len(children) < nworkers:
+                # look on the other hosts' mounts too, for files whose owner
+                # is down and never recorded where they are
+                steal = scheduler.choose_steal()
             if qlen > 0 and len(children) < nworkers:
-                # once we get a key, we commit to finish it or return it; no dropping
-                f = r.rpop(RAW_FILE_KEY)  # process most recent first (LIFO)
-                cwd = get_cwd_from_filename(f)
-                r.hset(PURG_FILE_KEY, f, 0)
-                print(f'Starting worker on {f}')
-                thd = mp.Process(target=process_next, args=(f, cwd, hostname))
+                qf, action = order[0]
+                if action == 'discard':
+                    discard_file(r, qf, scheduler)
+                    continue
+                # read the profiling mode before claiming, so nothing between
+                # the claim and the worker starting can fail
+                profile = get_profile_mode('convert', r)
+                files = claim_files(r, qf.name, hostname)
+                if len(files) == 0:
+                    continue
+                cwd = get_cwd_from_filename(files[0])
+                print(f'Starting worker on {", ".join(files)}')
+                thd = mp.Process(target=process_next, args=(files, cwd, hostname, profile))
+                thd.start()
+                children[files] = thd
+                started[files] = (time.time(), get_files_nbytes(files, cwd), False)
+            elif steal is not None:
+                profile = get_profile_mode('convert', r)
+                files = claim_files(r, steal.name, hostname)
+                if len(files) == 0:
+                    continue
+                owner = steal.location.host
+                print(f'Stealing {", ".join(files)} from {owner}: '
+                      f'{steal.remote_time:.0f} s over the mount vs {steal.owner_wait:.0f} s wait')
+                thd = mp.Process(target=process_next, args=(files, steal.cwd, owner, profile))
                 thd.start()
-                children[f] = thd
+                children[files] = thd
+                started[files] = (time.time(), get_files_nbytes(files, steal.cwd), True)
             elif qlen == 0 and len(children) == 0:
+                # make sure every JD we converted files for is in JD_KEY
+                flush_mc_records(r, mc_writer)
+                last_mc_flush = time.time()
                 # caught up and queue is empty so check if we are done for the day
                 endofday = int(r.hget('corr:files', 'ENDOFDAY'))
                 if endofday:
@@ -182,10 +394,11 @@ if __name__ == '__main__':
                 time.sleep(2)
     except Exception as e:
         print(f'Closing down {len(children)} threads')
-        for f, thd in children.items():
+        for thd in children.values():
             thd.terminate()
         for thd in children.values():
             thd.join()
     finally:
         print('Cleanup')
-        return_purgatory_files(r)
+        return_mc_records(r, mc_writer)
+        return_purgatory_files(r, scheduler)
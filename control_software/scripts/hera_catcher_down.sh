@@ -18,6 +18,7 @@ redis-cli -h redishost publish hashpipe://$catcherhost/gateway quit
 echo "killing any remaining hashpipe-redis gateways"
 ssh root@$catcherhost pkill -f hashpipe_redis_gateway.rb
 ssh root@$catcherhost pkill -f -9 hashpipe_redis_gateway.rb
+ssh root@$catcherhost pkill -f hera_status_gateway.py
 
 #Kill any redis loggers
 echo "killing any redis loggers"
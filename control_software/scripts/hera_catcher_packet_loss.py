@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+import argparse
+import redis
+from paper_gpu import bda, packet_loss
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report packet loss, duplicates and reordering of catcher packets "
+                    "per X-engine and per BDA tier",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--pcap", default=None,
+        help="pcap capture of catcher packets to analyze instead of listening",
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=10000, help="port to listen on")
+    parser.add_argument("-n", "--npackets", type=int, default=None, help="packets to capture")
+    parser.add_argument("-t", "--duration", type=float, default=10.0, help="seconds to capture")
+    parser.add_argument("--redishost", default="redishost", help="redis host with the BDA config")
+    parser.add_argument(
+        "--mcnt-step", type=int, default=None,
+        help="mcnts between integrations; inferred from the packets if not given",
+    )
+    parser.add_argument(
+        "--write-redis", action="store_true",
+        help=f"write the report to the {packet_loss.PACKET_LOSS_KEY} redis hash",
+    )
+    args = parser.parse_args()
+
+    bl_pairs = bda.read_bda_config_from_redis(args.redishost)
+    if args.pcap is not None:
+        headers = packet_loss.read_pcap_headers(args.pcap)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 800000000)
+        sock.bind((args.host, args.port))
+        headers = packet_loss.capture_headers(
+            sock, npackets=args.npackets, duration=args.duration
+        )
+
+    report = packet_loss.analyze_packets(headers, bl_pairs, mcnt_step=args.mcnt_step)
+    print(packet_loss.format_summary(report))
+    if args.write_redis:
+        r = redis.Redis(args.redishost, decode_responses=True)
+        packet_loss.write_report_to_redis(r, report)
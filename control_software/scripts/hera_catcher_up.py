@@ -27,6 +27,9 @@ parser.add_argument('--pypath', dest='pypath', type=str,
     help='The path to a python virtual environment which will be' +
          'activated prior to running paper_init. Only relevant if using' +
          ' the --redislog flag, which uses a python redis interface')
+parser.add_argument('--pygateway', dest='pygateway',
+    action='store_true', default=False,
+    help='Use hera_status_gateway.py instead of hashpipe_redis_gateway.rb')
 
 args = parser.parse_args()
 
@@ -58,7 +61,10 @@ run_on_hosts(
 
 # Start hashpipe<->redis gateways
 cpu_mask = '0x0004'
-procs = run_on_hosts([args.host], ['taskset', cpu_mask, 'hashpipe_redis_gateway.rb', '-g', args.host, '-i', '0'], wait=True)
+if args.pygateway:
+    procs = run_on_hosts([args.host], python_source_cmd + ['taskset', cpu_mask, 'hera_status_gateway.py', '-g', args.host, '-s', args.redishost, '-i', '0'], wait=False)
+else:
+    procs = run_on_hosts([args.host], ['taskset', cpu_mask, 'hashpipe_redis_gateway.rb', '-g', args.host, '-i', '0'], wait=True)
 
 catcher.wait_for_catcher_boot(args.redishost)
 catcher.clear_redis_keys(redishost=args.redishost)
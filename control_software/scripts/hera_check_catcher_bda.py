@@ -6,6 +6,7 @@ import struct
 import socket
 import argparse 
 from paper_gpu import bda
+from paper_gpu.bl_order import get_bda_bcnt_layout
 
 N_ANTS_DATA = 192       # antennas
 N_bl_per_block = 256    # baselines within each block
@@ -88,10 +89,16 @@ for n in range(N_BDABUF_BINS):
     #int_bin['data'][n][1::2] = -2*(2**n)
 
 conf = bda.read_bda_config_from_redis(REDISHOST)
-for a0,a1,t in conf:
-    if (t!=0):
-        n = int(np.log2(t))
-        int_bin['baselines'][n].append((a0, a1))
+layout = get_bda_bcnt_layout(conf)
+for n in range(N_BDABUF_BINS):
+    in_tier = (layout['tier'] == n) & (layout['sample'] == 0)
+    int_bin['baselines'][n] = list(zip(layout['ant_0_array'][in_tier],
+                                       layout['ant_1_array'][in_tier]))
+
+# (ant0, ant1) -> integration bin lookup table
+nants_conf = int(conf[:, :2].max()) + 1
+tier_lookup = np.full((nants_conf, nants_conf), -1, dtype=int)
+tier_lookup[layout['ant_0_array'], layout['ant_1_array']] = layout['tier']
 
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 sock.bind((args.host, args.port))
@@ -123,7 +130,7 @@ while True:
                     print(a0, a1, o, np.all(tspec.real[o*128:(o+1)*128] == data[:,0,0]//4))
        
            else:
-              n = [y for y,v in list(int_bin['baselines'].items()) if (a0,a1) in v][0]
+              n = tier_lookup[a0, a1]
               if not (np.all(data == int_bin['data'][n][o*1024:(o+1)*1024])):
                  print("Error!", int_bin['data'][n][:32:8], o, n, data[:32:8])
                  errors += 1
@@ -25,6 +25,22 @@ if __name__ == "__main__":
         type=int,
         help="size of blt chunks to use",
     )
+    parser.add_argument(
+        "--data_chunks",
+        required=False,
+        default=None,
+        type=int,
+        nargs=3,
+        help="HDF5 chunk shape of the data arrays (-1 for a full axis); "
+        "default is the saved chunk profile",
+    )
+    parser.add_argument(
+        "--strip_shift",
+        action="store_true",
+        default=False,
+        help="losslessly divide visdata by its common power-of-two factor; "
+        "read the output with paper_gpu.file_conversion.read_visdata",
+    )
 
     args = parser.parse_args()
 
@@ -34,4 +50,6 @@ if __name__ == "__main__":
             args.meta_file,
             args.input_file,
             args.chunksize,
+            data_chunks=args.data_chunks,
+            strip_shift=args.strip_shift,
         )
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import tempfile
+import argparse
+import contextlib
+import redis
+from paper_gpu import loopback
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run packets -> catcher files -> UVH5 -> checks over loopback "
+                    "and report the throughput, loss and latency of each stage",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-d", "--outdir", default=None,
+        help="directory to write files to; default is a temporary directory",
+    )
+    parser.add_argument("--nants", type=int, default=8, help="number of antennas")
+    parser.add_argument(
+        "--nfiles", type=int, default=2, help="number of raw files, of 8 integrations each"
+    )
+    parser.add_argument("--nchan", type=int, default=1536, help="channels sent per baseline")
+    parser.add_argument("--nxeng", type=int, default=4, help="X-engines per time sample")
+    parser.add_argument(
+        "--rate", type=float, default=None,
+        help="packets per second; default is as fast as possible",
+    )
+    parser.add_argument(
+        "--redishost", default=None,
+        help="a local redis server to queue files in (never the site redis); "
+             "default is an in-process stand-in",
+    )
+    parser.add_argument("--codec", default="lzf", help="visdata codec")
+    args = parser.parse_args()
+
+    r = None
+    if args.redishost is not None:
+        r = redis.Redis(args.redishost, decode_responses=True)
+
+    # only use (and clean up) a temporary directory if no --outdir is given
+    if args.outdir is None:
+        outdir_context = tempfile.TemporaryDirectory()
+    else:
+        outdir_context = contextlib.nullcontext(args.outdir)
+
+    with outdir_context as outdir:
+        stats, outputs, _ = loopback.run_loopback(
+            outdir, nants=args.nants, nfiles=args.nfiles, nchan=args.nchan,
+            n_xeng=args.nxeng, rate=args.rate, r=r, codec=args.codec,
+        )
+
+        # report while the files still exist
+        print(f"{'stage':>10} {'items':>7} {'lost':>6} {'failed':>6} {'MB/s':>9} "
+              f"{'items/s':>10} {'lat mean ms':>11} {'lat p99 ms':>10}")
+        for name, s in stats.items():
+            print(f"{name:>10} {s['items']:7d} {s['lost']:6d} {s['failed']:6d} "
+                  f"{s['MBps']:9.2f} {s['items_per_s']:10.1f} "
+                  f"{s['latency_mean'] * 1e3:11.2f} {s['latency_p99'] * 1e3:10.2f}")
+        print(f"Wrote {len(outputs)} UVH5 files to {outdir}")
+        if args.outdir is not None:
+            for f_out in outputs:
+                print(f"  {f_out}")
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+from paper_gpu import profiling
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the per-file profiles of the converter and uploader into "
+                    "collapsed stacks for flamegraph.pl or speedscope, and summarize "
+                    "each stage",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "directory", nargs="?", default=profiling.get_profile_dir(), help="profile directory"
+    )
+    parser.add_argument(
+        "-s", "--stages", nargs="+", default=None,
+        help="stages to report; default is every stage in the directory",
+    )
+    parser.add_argument(
+        "-o", "--output", default=None,
+        help="file to write the collapsed stacks to; default is stdout",
+    )
+    parser.add_argument(
+        "-n", "--top", type=int, default=15, help="functions listed per stage in the summary"
+    )
+    args = parser.parse_args()
+
+    profiles = profiling.load_profiles(args.directory, stages=args.stages)
+    collapsed = profiling.format_collapsed(profiling.merge_collapsed(profiles))
+    if args.output is None:
+        sys.stdout.write(collapsed)
+    else:
+        with open(args.output, "w") as fh:
+            fh.write(collapsed)
+
+    # the summary goes to stderr, so stdout can be piped to flamegraph.pl
+    for stage, profile in profiles.items():
+        nsamples = sum(profile["samples"].values())
+        print(f"{stage}: {profile['nprofiles']} profiles, {nsamples} samples", file=sys.stderr)
+        for frame, count in profiling.top_frames(profile["samples"], args.top):
+            print(f"  {100.0 * count / nsamples:5.1f}%  {frame}", file=sys.stderr)
+        if profile["stats"] is not None:
+            profile["stats"].stream = sys.stderr
+            profile["stats"].sort_stats("cumulative").print_stats(args.top)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import threading
+import redis
+from paper_gpu import status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Collect the hashpipe status of the correlator and serve it at /metrics",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--redishost", default="redishost", help="redis host")
+    parser.add_argument(
+        "--hosts", nargs="+", default=None,
+        help="hosts to poll; default is every status buffer in redis",
+    )
+    parser.add_argument(
+        "-i", "--instances", nargs="+", type=int, default=[0, 1],
+        help="instances of each host, with --hosts",
+    )
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between polls")
+    parser.add_argument(
+        "--history", type=int, default=status.DEFAULT_HISTORY, help="polls kept per instance"
+    )
+    parser.add_argument("--bind", default="127.0.0.1", help="address to serve on")
+    parser.add_argument("--port", type=int, default=9110, help="port to serve on")
+    args = parser.parse_args()
+
+    r = redis.Redis(args.redishost, decode_responses=True)
+    agg = status.StatusAggregator(
+        r, hosts=args.hosts, instances=args.instances if args.hosts else None,
+        history=args.history,
+    )
+    server = agg.serve(args.bind, args.port)
+    print("Serving http://%s:%d/metrics" % server.server_address)
+    stop = threading.Event()
+    try:
+        agg.run(args.interval, stop)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        server.shutdown()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+import asyncio
+import logging
+import argparse
+import redis.asyncio
+from paper_gpu import gateway
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the status buffers of all the hashpipe instances on this host "
+                    "to redis, replacing one hashpipe_redis_gateway.rb per instance",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-g", "--gwname", default=socket.gethostname().split(".")[0],
+        help="gateway name, used in the redis channel and key names",
+    )
+    parser.add_argument(
+        "-i", "--instances", type=int, nargs="+", default=[0], help="hashpipe instances"
+    )
+    parser.add_argument("-s", "--redishost", default="redishost", help="redis host")
+    parser.add_argument(
+        "-d", "--interval", type=float, default=gateway.DEFAULT_INTERVAL,
+        help="seconds between status pushes",
+    )
+    parser.add_argument(
+        "--coalesce", type=float, default=gateway.DEFAULT_COALESCE,
+        help="seconds to collect set messages before applying them",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    buffers = {i: gateway.ShmStatusBuffer(i) for i in args.instances}
+
+    async def main():
+        r = redis.asyncio.Redis(host=args.redishost, decode_responses=True)
+        gw = gateway.Gateway(
+            r, args.gwname, buffers, interval=args.interval, coalesce=args.coalesce
+        )
+        try:
+            await gw.run()
+        finally:
+            await r.aclose()
+
+    asyncio.run(main())
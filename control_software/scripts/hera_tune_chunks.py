@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+from paper_gpu import chunk_tuning
+from paper_gpu.file_conversion import save_chunk_profile, get_chunk_profile_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark HDF5 chunk shapes for UVH5 visdata on synthetic BDA catcher data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-d", "--tmpdir", default=None,
+        help="directory for test files; use the disk the converter writes to",
+    )
+    parser.add_argument(
+        "--nbls", type=int, default=None,
+        help="number of baselines; None makes enough for several of the longest chunks",
+    )
+    parser.add_argument("--nfiles", type=int, default=2, help="number of catcher files")
+    parser.add_argument("--nfreq", type=int, default=1536, help="number of channels")
+    parser.add_argument("--nreads", type=int, default=5, help="reads per access pattern")
+    parser.add_argument(
+        "--save", action="store_true", default=False,
+        help="save the best chunk shape as this deployment's profile",
+    )
+    parser.add_argument(
+        "--profile", default=None,
+        help=f"profile file to save to (default {get_chunk_profile_path()})",
+    )
+    args = parser.parse_args()
+
+    results = chunk_tuning.autotune_chunks(
+        nbls=args.nbls, nfiles=args.nfiles, nfreq=args.nfreq,
+        tmpdir=args.tmpdir, nreads=args.nreads,
+    )
+
+    print(f"{'chunks':>18} {'score':>6} {'write MB/s':>10} {'ratio':>6} "
+          + " ".join(f"{p + ' ms':>18}" for p in chunk_tuning.ACCESS_PATTERNS))
+    for res in results:
+        print(f"{str(res['candidate']):>18} {res['score']:6.2f} {res['write_MBps']:10.1f} "
+              f"{res['compression_ratio']:6.2f} "
+              + " ".join(f"{res[p] * 1e3:18.2f}" for p in chunk_tuning.ACCESS_PATTERNS))
+
+    best = results[0]
+    print(f"Recommended chunk shape: {best['candidate']}")
+    if args.save:
+        info = {k: v for k, v in best.items() if k not in ("chunks", "candidate")}
+        save_chunk_profile(best["candidate"], filename=args.profile, benchmark=info)
+        print(f"Saved to {args.profile or get_chunk_profile_path()}")
@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import re
 import os
-import subprocess
 import logging
 import psutil
-from hera_librarian import LibrarianClient
+from paper_gpu.librarian import (
+    LibrarianUploader,
+    make_librarian_client,
+    get_jd_from_filename,
+)
+from paper_gpu.profiling import get_profile_mode
 
 logger = logging.getLogger(__file__)
 
@@ -20,45 +23,36 @@ JD_KEY = 'corr:files:jds'
 CONN_NAME = 'local-rtp'
 CPU_AFFINITY = [3, 4, 5, 6]
 ADD_DIFF_TO_LIBRARIAN = False
+INDEX_TTL = 600  # seconds before re-querying the librarian for a JD's files
+MAX_BYTES_PER_S = None  # optional cap on upload bandwidth
 
-def filter_done(f, thd):
-    is_alive = thd.is_alive()
-    if not is_alive:
-        purgfiles = r.hgetall(PURG_FILE_KEY)
-        if f in purgfiles:
-            # failure to remove from purgatory indicates failed upload
-            # so clean up and add to failed queue
-            r.rpush(FAILED_FILE_KEY, f)
-            r.hdel(PURG_FILE_KEY, f)
-    return is_alive
-
+def get_full_path(f):
+    int_jd = get_jd_from_filename(f)
+    # for /mnt/sn1 we have even days in /data2 and odd days in /data1
+    if int_jd % 2 == 1:
+        ddir = "data1"
+    else:
+        ddir = "data2"
+    return os.path.join(DATA_DIR, ddir, f)
 
-def process_next(f):
-    p = psutil.Process()
-    p.cpu_affinity(CPU_AFFINITY)
-    print(f'Processing {f}')
-    client = LibrarianClient(CONN_NAME)
-    query = f'{{"name-matches": "{os.path.split(f)[-1]}"}}'
-    instances = client.search_instances(query)  # takes a long time
-    if len(instances['results']) == 0:
-        # this file is not in the librarian, so add it
-        int_jd = int(re.findall(r'\d{7}', f)[0])
-        # for /mnt/sn1 we have even days in /data2 and odd days in /data1
-        if int_jd % 2 == 1:
-            ddir = "data1"
-        else:
-            ddir = "data2"
-        full_path = os.path.join(DATA_DIR, ddir, f)
-        print(f'Uploading {f}')
-        client.upload_file(full_path, f, 'infer', rec_info={})
+def filter_done(f, fut):
+    if not fut.done():
+        return True
+    exc = fut.exception()
+    if exc is not None:
+        # failed upload, so clean up and add to failed queue
+        print(f'Failed to upload {f}: {exc}')
+        r.rpush(FAILED_FILE_KEY, f)
     else:
-        print(f'Librarian already has {f}')
-    r.rpush(LIB_FILE_KEY, f)  # document we finished it
+        if fut.result():
+            print(f'Uploaded {f}')
+        else:
+            print(f'Librarian already has {f}')
+        r.rpush(LIB_FILE_KEY, f)  # document we finished it
     r.hdel(PURG_FILE_KEY, f)
-    print(f'Finished {f}')
+    return False
 
 if __name__ == '__main__':
-    import multiprocessing as mp
     import redis
     import time
 
@@ -70,26 +64,30 @@ if __name__ == '__main__':
     r = redis.Redis(REDISHOST, decode_responses=True)
     qlen = r.llen(CONV_FILE_KEY)
     nworkers = 3 * len(CPU_AFFINITY)
+    # one client and one librarian index shared by all upload threads
+    uploader = LibrarianUploader(make_librarian_client(CONN_NAME), nworkers=nworkers,
+                                 ttl=INDEX_TTL, max_bytes_per_s=MAX_BYTES_PER_S)
     print(f'Starting librarian upload.')
     children = {}
     try:
         while True:
             qlen = r.llen(CONV_FILE_KEY)
             children = {
-                f: thd for f, thd in children.items()
-                if filter_done(f, thd)
+                f: fut for f, fut in children.items()
+                if filter_done(f, fut)
             }
             print(f'Queue length={qlen}, N workers={len(children)}/{nworkers}')
             if qlen > 0 and len(children) < nworkers:
+                # read the profiling mode first, so nothing between popping
+                # the key and putting it in purgatory can fail
+                profile = get_profile_mode('upload', r)
                 # once we get a key, we commit to finish it or return it; no dropping
                 f = r.rpop(CONV_FILE_KEY)  # process most recent first (LIFO)
                 if (not ADD_DIFF_TO_LIBRARIAN) and ("diff" in f):
                     continue
                 r.hset(PURG_FILE_KEY, f, 0)
-                print(f'Starting worker on {f}')
-                thd = mp.Process(target=process_next, args=(f,))
-                thd.start()
-                children[f] = thd
+                print(f'Starting upload of {f}')
+                children[f] = uploader.submit(f, get_full_path(f), profile=profile)
             elif qlen == 0 and len(children) == 0:
                 # caught up and queue is empty, so check if we finished any days
                 jds = r.hgetall(JD_KEY)
@@ -101,11 +99,10 @@ if __name__ == '__main__':
                 # we are still working and should wait for jobs to complete
                 time.sleep(2)
     except Exception as e:
-        print(f'Closing down {len(children)} threads')
-        for f, thd in children.items():
-            thd.terminate()
-        for thd in children.values():
-            thd.join()
+        print(f'Closing down {len(children)} uploads')
+        for fut in children.values():
+            fut.cancel()
+        uploader.shutdown(wait=True)
     finally:
         print('Cleanup')
         purgfiles = r.hgetall(PURG_FILE_KEY)
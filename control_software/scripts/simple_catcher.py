@@ -1,64 +1,52 @@
-import socket
-import numpy as np
-import struct
-import time
-import pickle as pickle
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
+import socket
+import argparse
+from paper_gpu import capture
 
 NANTS = 192
-NCHANS = 8192 / 4 * 3 / 4
+NCHANS = 8192 // 4 * 3 // 4
 NXENG = 16
-NWORDS = 2 * NANTS * (NANTS+1) / 2 * 4 * NCHANS
-NWORDS_PER_XENG = NWORDS / NXENG
-
-PAYLOAD_LEN = 4096
-BYTES_PER_PACKET = PAYLOAD_LEN + 16
-max_offset = NWORDS*8 / NXENG - PAYLOAD_LEN
-print("Max offset:", max_offset)
-
-NPACKETS = NWORDS * 8 / PAYLOAD_LEN
-print("Expecting %d packets" % NPACKETS)
-
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 800000000)
-print(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
-
-sock.bind(("10.80.40.251", 10000))
-
-dout = np.ones([NXENG*2, NWORDS_PER_XENG], dtype=np.int32) * -1
-
-n = 0
-wait = True
-start = time.time()
-while True:
-    data = sock.recv(BYTES_PER_PACKET)
-    unpacked = struct.unpack('!QLH', data[0:14])
-    #time_demux = (unpacked[0] % 4) >> 1
-    timestamp = unpacked[0] & 0xfffffffffffffffc
-    xeng_id = unpacked[2]
-    offset = unpacked[1]
-    if wait: 
-        start = time.time()
-        this_window = timestamp
-    if (not wait) or (offset == 0):
-        if  (timestamp != this_window):
-            print(timestamp, this_window)
-            stop = time.time()
-            print("%d packets received in %.2f seconds" % (n, stop - start))
-            print("Missing %d packets" % (NPACKETS - n))
-            n = 0
-            start = stop
-            break
-        n += 1
-        wait = False
-        #print timestamp, offset, xeng_id, payload_len
-        #print dout[256*packet_num:256*(packet_num+1)].shape
-        #print len(data[16:])
-        #print dout.shape, offset/4, (offset+PAYLOAD_LEN)/4, dout[offset/4:(offset+PAYLOAD_LEN)/4].shape, np.fromstring(data[16:], dtype='>i').shape
-        dout[xeng_id, offset>>2:(offset+PAYLOAD_LEN)>>2] = np.fromstring(data[16:], dtype='>i')
-
-
-print("Dumping packet to disk")
-with open("/tmp/packet.bin", "w") as fh:
-    fh.write(dout.flatten().tostring()) #This is native (probably little) endian!!
-
+NWORDS = 2 * NANTS * (NANTS + 1) // 2 * 4 * NCHANS
+NWORDS_PER_XENG = NWORDS // NXENG
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Capture one integration of X-engine output packets and dump it to disk",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--host", default="10.80.40.251", help="address to listen on")
+    parser.add_argument("--port", type=int, default=10000, help="port to listen on")
+    parser.add_argument("-o", "--output", default="/tmp/packet.bin", help="file to dump to")
+    parser.add_argument(
+        "--batch", type=int, default=capture.DEFAULT_BATCH_SIZE,
+        help="maximum packets received per batch",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None,
+        help="give up after this many seconds without a packet; default is to wait forever",
+    )
+    args = parser.parse_args()
+
+    max_offset = NWORDS * 8 // NXENG - capture.PAYLOAD_LEN
+    print("Max offset:", max_offset)
+    print("Expecting %d packets" % (NWORDS * 8 // capture.PAYLOAD_LEN))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 800000000)
+    print(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+    sock.bind((args.host, args.port))
+
+    dout, stats = capture.capture_window(
+        sock, (NXENG * 2, NWORDS_PER_XENG), batch_size=args.batch, timeout=args.timeout
+    )
+    print("Window %s" % stats["window"])
+    print("%d packets received in %.2f seconds (%.0f packets/s)"
+          % (stats["received"], stats["elapsed"], stats["packets_per_s"]))
+    print("Missing %d packets" % stats["missing"])
+
+    print("Dumping packet to disk")
+    # This is native (probably little) endian!!
+    dout.tofile(args.output)
@@ -96,6 +96,7 @@ redis-cli -h redishost publish hashpipe:///gateway quit
 echo "killing any remaining hashpipe-redis gateways"
 for x; do ssh root@px$x pkill    -f hashpipe_redis_gateway.rb; done
 for x; do ssh root@px$x pkill -9 -f hashpipe_redis_gateway.rb; done
+for x; do ssh root@px$x pkill    -f hera_status_gateway.py; done
 
 #Kill any redis loggers
 echo "killing any redis loggers"
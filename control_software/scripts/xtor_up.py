@@ -34,6 +34,9 @@ parser.add_argument('-n', dest='n_ants_data', type=int, default=256,
 parser.add_argument('--pypath', dest='pypath', type=str, default="/home/hera/miniforge3",
                     help='The path to a python virtual environment which will be activated prior to running paper_init. ' +
                          'Only relevant if using the --redislog flag, which uses a python redis interface')
+parser.add_argument('--pygateway', dest='pygateway', action='store_true', default=False,
+                    help='Serve all instances of a host from one hera_status_gateway.py process ' +
+                         'instead of one hashpipe_redis_gateway.rb per instance')
 
 args = parser.parse_args()
 hosts = args.hosts
@@ -71,6 +74,12 @@ else:
 # Start hashpipe<->redis gateways
 cpu_masks = ['0x0080', '0x8000']
 for host in hosts:
+    if args.pygateway:
+        instances = ['%d' % i for i in range(args.ninstances)]
+        run_on_hosts([host], python_source_cmd + ['taskset', cpu_masks[0], 'hera_status_gateway.py',
+                                                  '-g', host, '-s', args.redishost, '-i'] + instances,
+                     wait=False)
+        continue
     for i in range(args.ninstances):
         run_on_hosts([host], ['taskset', cpu_masks[i], 'hashpipe_redis_gateway.rb', '-g', host, '-i', '%d' % i])
 
@@ -11,6 +11,23 @@ except DistributionNotFound:
     pass
 
 from . import bda
+from . import bl_order
+from . import capture
+from . import chunk_tuning
+from . import databuf
 from . import file_conversion
+from . import gateway
+from . import librarian
+from . import loopback
+from . import manifest
+from . import mc_records
+from . import packet_loss
+from . import profiling
+from . import readers
+from . import scheduling
+from . import status
+from . import sum_diff
+from . import timing
 from . import utils
+from . import work_stealing
 from . import catcher
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""Baseline ordering lookup tables for raw X-engine and catcher output."""
+
+import os
+import functools
+import numpy as np
+
+# the longest baselines are collected for 8 time samples (see paper_databuf.h)
+N_MAX_INTTIME = 8
+N_BDABUF_BINS = 4
+
+# location of the on-disk lookup table cache
+CACHE_DIR_ENV = "PAPER_GPU_CACHE_DIR"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "paper_gpu")
+
+
+def get_cache_dir():
+    """
+    Get the directory used to cache lookup tables on disk.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str
+        The value of the `PAPER_GPU_CACHE_DIR` environment variable if set,
+        otherwise `~/.cache/paper_gpu`.
+    """
+    return os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR)
+
+
+def _load_or_compute(name, n_ants, func):
+    """
+    Load a lookup table from the on-disk cache, computing it if necessary.
+
+    Parameters
+    ----------
+    name : str
+        The name of the table, used to build the cache filename.
+    n_ants : int
+        The number of antennas the table was computed for.
+    func : callable
+        Function of `n_ants` which computes the table.
+
+    Returns
+    -------
+    table : ndarray
+        The lookup table. It is marked read-only, since it is shared between
+        all callers.
+    """
+    filename = os.path.join(get_cache_dir(), f"{name}_{n_ants:d}.npy")
+    try:
+        table = np.load(filename)
+    except (OSError, ValueError):
+        table = func(n_ants)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # write to a temporary file first so readers never see a partial table
+            tmp_filename = f"{filename}.{os.getpid()}.tmp"
+            with open(tmp_filename, "wb") as fh:
+                np.save(fh, table)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            # a read-only or missing cache directory is not fatal
+            pass
+    table.setflags(write=False)
+    return table
+
+
+def _compute_casper_bl_order(n_ants):
+    """Compute the CASPER baseline order; see `get_bl_order`."""
+    i = np.arange(n_ants)[:, None]
+    j = np.arange(n_ants // 2, -1, -1)[None, :]
+    i, j = np.broadcast_arrays(i, j)
+    k = (i - j) % n_ants
+
+    # baselines where the "lagging" antenna comes first are output in the
+    # first half; everything else is output afterwards, minus duplicates
+    first = i >= k
+    order1 = np.stack([k[first], i[first]], axis=-1)
+    order2 = np.stack([i[~first], k[~first]], axis=-1)
+    code1 = order1[:, 0] * n_ants + order1[:, 1]
+    code2 = order2[:, 0] * n_ants + order2[:, 1]
+    order2 = order2[~np.isin(code2, code1)]
+
+    return np.concatenate([order1, order2], axis=0).astype(np.int32)
+
+
+def _compute_casper_bl_index(n_ants):
+    """Compute the inverse CASPER baseline order; see `get_bl_index`."""
+    order = get_bl_order(n_ants)
+    index = np.full((n_ants, n_ants), -1, dtype=np.int32)
+    bl_nums = np.arange(order.shape[0], dtype=np.int32)
+    index[order[:, 0], order[:, 1]] = bl_nums
+    index[order[:, 1], order[:, 0]] = bl_nums
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def get_bl_order(n_ants):
+    """
+    Get the order of baseline data output by a CASPER correlator X-engine.
+
+    This is a vectorised version of the algorithm in the corr package
+    (https://github.com/ska-sa/corr). Tables are memoised per antenna count
+    in memory and as .npy files in the directory given by `get_cache_dir`.
+
+    Parameters
+    ----------
+    n_ants : int
+        The number of antennas in the correlator.
+
+    Returns
+    -------
+    bl_order : ndarray of int32
+        Read-only array of shape (Nbls, 2). Row `n` contains the antenna pair
+        for the `n`-th baseline output by the X-engine.
+    """
+    return _load_or_compute("casper_bl_order", int(n_ants), _compute_casper_bl_order)
+
+
+@functools.lru_cache(maxsize=None)
+def get_bl_index(n_ants):
+    """
+    Get the inverse of the CASPER baseline order.
+
+    Parameters
+    ----------
+    n_ants : int
+        The number of antennas in the correlator.
+
+    Returns
+    -------
+    bl_index : ndarray of int32
+        Read-only array of shape (n_ants, n_ants). Entry `[a0, a1]` is the
+        position of baseline (a0, a1) in the X-engine output. The table is
+        symmetric, so either antenna may be given first.
+    """
+    return _load_or_compute("casper_bl_index", int(n_ants), _compute_casper_bl_index)
+
+
+def get_bda_bcnt_layout(bl_pairs):
+    """
+    Get the baseline counter (bcnt) layout of baseline-dependent averaged data.
+
+    This mirrors `init_bda_info` in hera_gpu_bda_thread.c: baselines are
+    grouped by integration tier, keep their configuration order within a
+    tier, and every baseline is allotted one bcnt per output sample.
+
+    Parameters
+    ----------
+    bl_pairs : array_like of int
+        The BDA configuration, as returned by `bda.assign_bl_pair_tier` or
+        `bda.read_bda_config_from_redis`. Shape (Npairs, 3), where the columns
+        are ant0, ant1 and the number of samples to integrate.
+
+    Returns
+    -------
+    layout : dict
+        A dict of 1-d arrays of length `bcnts_per_file` indexed by bcnt modulo
+        `bcnts_per_file`: ant_0_array and ant_1_array (the antenna pair),
+        inttime (samples integrated), tier (BDA buffer bin index) and sample
+        (output sample within the file).
+
+    Raises
+    ------
+    ValueError
+        Raised if an integration time is not zero or a power of two.
+    """
+    bl_pairs = np.asarray(bl_pairs, dtype=np.int64).reshape(-1, 3)
+    bl_pairs = bl_pairs[bl_pairs[:, 2] != 0]
+    inttime = bl_pairs[:, 2]
+    if np.any((inttime < 0) | ((inttime & (inttime - 1)) != 0)):
+        raise ValueError("integration times must be zero or a power of 2")
+
+    # stable sort keeps the configuration order within each tier
+    tier = np.minimum(np.log2(inttime).astype(np.int64), N_BDABUF_BINS - 1)
+    idx = np.argsort(tier, kind="stable")
+    bl_pairs = bl_pairs[idx]
+    tier = tier[idx]
+    nsamples = N_MAX_INTTIME >> tier
+
+    # repeat each baseline once per output sample
+    rows = np.repeat(np.arange(bl_pairs.shape[0]), nsamples)
+    starts = np.cumsum(nsamples) - nsamples
+    sample = np.arange(rows.size) - np.repeat(starts, nsamples)
+
+    return {
+        "ant_0_array": bl_pairs[rows, 0],
+        "ant_1_array": bl_pairs[rows, 1],
+        "inttime": bl_pairs[rows, 2],
+        "tier": tier[rows],
+        "sample": sample,
+    }
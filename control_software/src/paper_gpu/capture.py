@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+Batched capture of X-engine output packets.
+
+Packets are received with `recv_into` straight into a preallocated ring of
+packet slots, their headers are decoded a batch at a time as a numpy
+structured array, and their payloads are scattered into the output array
+with one fancy-indexed assignment per batch.
+"""
+
+import time
+import socket
+import numpy as np
+
+# header of the X-engine output packets: mcnt, byte offset, xeng_id, payload_len
+XENG_PACKET_HEADER_DTYPE = np.dtype(
+    [("mcnt", ">u8"), ("offset", ">u4"), ("xeng_id", ">u2"), ("payload_len", ">u2")]
+)
+PAYLOAD_LEN = 4096
+
+# packets received per batch, and slots in the ring
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_RING_SLOTS = 4096
+
+
+class PacketRing(object):
+    """
+    A ring of fixed-size packet slots that sockets receive into directly.
+
+    Parameters
+    ----------
+    nslots : int
+        The number of slots.
+    slot_size : int
+        The size of each slot, in bytes; longer packets are truncated.
+    """
+
+    def __init__(self, nslots, slot_size):
+        self.nslots = nslots
+        self.slot_size = slot_size
+        self.buffer = np.zeros((nslots, slot_size), dtype=np.uint8)
+        self.lengths = np.zeros(nslots, dtype=np.int64)
+        # one writable view per slot, made once so receiving allocates nothing
+        self.views = [memoryview(row) for row in self.buffer]
+        self.head = 0
+
+    def recv_batch(self, sock, batch_size):
+        """
+        Receive up to `batch_size` packets into consecutive slots.
+
+        The first receive blocks (subject to the socket timeout); the rest
+        only take packets that are already queued.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The socket.
+        batch_size : int
+            The maximum number of packets; at most the slots left before the
+            end of the ring are used, so a batch is contiguous.
+
+        Returns
+        -------
+        slice
+            The slots filled, possibly empty if the first receive timed out.
+        """
+        start = self.head
+        stop = min(start + batch_size, self.nslots)
+        i = start
+        try:
+            self.lengths[i] = sock.recv_into(self.views[i])
+            i += 1
+            while i < stop:
+                self.lengths[i] = sock.recv_into(self.views[i], 0, socket.MSG_DONTWAIT)
+                i += 1
+        except (BlockingIOError, socket.timeout):
+            pass
+        self.head = 0 if i == self.nslots else i
+        return slice(start, i)
+
+
+def decode_headers(ring, slots, header_dtype=XENG_PACKET_HEADER_DTYPE):
+    """
+    Decode the headers of a batch of packets.
+
+    Parameters
+    ----------
+    ring : PacketRing
+        The ring holding the packets.
+    slots : slice
+        The slots of the batch.
+    header_dtype : numpy.dtype, optional
+        The packet header dtype.
+
+    Returns
+    -------
+    ndarray
+        The headers, a structured array with one entry per packet.
+    """
+    raw = ring.buffer[slots, :header_dtype.itemsize]
+    return np.ascontiguousarray(raw).view(header_dtype)[:, 0]
+
+
+def scatter_payloads(dout, ring, slots, headers, mask=None, payload_len=PAYLOAD_LEN):
+    """
+    Copy a batch of payloads into the output array.
+
+    Parameters
+    ----------
+    dout : ndarray of int32
+        The output, of shape (Nxeng_ids, words per xeng_id); each payload
+        is written at row xeng_id and column offset / 4.
+    ring : PacketRing
+        The ring holding the packets.
+    slots : slice
+        The slots of the batch.
+    headers : ndarray
+        The decoded headers of the batch.
+    mask : ndarray of bool, optional
+        Which packets of the batch to copy. Default is all of them.
+    payload_len : int, optional
+        The payload size, in bytes.
+    """
+    start = XENG_PACKET_HEADER_DTYPE.itemsize
+    payloads = ring.buffer[slots, start:start + payload_len].view(">i4")
+    rows = headers["xeng_id"].astype(np.intp)
+    cols = (headers["offset"] >> 2).astype(np.intp)
+    if mask is not None:
+        payloads = payloads[mask]
+        rows = rows[mask]
+        cols = cols[mask]
+    words = np.arange(payload_len // 4)
+    dout[rows[:, np.newaxis], cols[:, np.newaxis] + words] = payloads
+
+
+def capture_window(sock, dout_shape, batch_size=DEFAULT_BATCH_SIZE,
+                   ring_slots=DEFAULT_RING_SLOTS, payload_len=PAYLOAD_LEN, timeout=None):
+    """
+    Capture one full integration window of X-engine packets.
+
+    Capture starts at the first packet with offset 0, and its window is the
+    packet's mcnt with the time demux bits cleared. It ends at the first
+    packet from a different window, or when no packet arrives for
+    `timeout` seconds.
+
+    Parameters
+    ----------
+    sock : socket.socket
+        A bound UDP socket.
+    dout_shape : tuple of int
+        The shape of the output, (Nxeng_ids, words per xeng_id).
+    batch_size : int, optional
+        The maximum number of packets received per batch.
+    ring_slots : int, optional
+        The number of packet slots in the ring.
+    payload_len : int, optional
+        The payload size, in bytes.
+    timeout : float, optional
+        Stop if no packet arrives for this long, in seconds. Default is to
+        wait forever.
+
+    Returns
+    -------
+    dout : ndarray of int32
+        The data, -1 where no packet arrived.
+    stats : dict
+        The window, the number of packets received in it and expected, the
+        number missing, the number of packets before the window started
+        (skipped), the capture time in seconds, and the packets per second
+        received.
+    """
+    dout = np.full(dout_shape, -1, dtype=np.int32)
+    expected = dout.size * 4 // payload_len
+    ring = PacketRing(ring_slots, XENG_PACKET_HEADER_DTYPE.itemsize + payload_len)
+    sock.settimeout(timeout)
+    window = None
+    npackets = 0
+    nskipped = 0
+    start = stop = time.time()
+    while True:
+        slots = ring.recv_batch(sock, batch_size)
+        if slots.stop == slots.start:
+            break
+        headers = decode_headers(ring, slots)
+        timestamps = headers["mcnt"] & ~np.uint64(3)
+        if window is None:
+            first = np.flatnonzero(headers["offset"] == 0)
+            if len(first) == 0:
+                nskipped += len(headers)
+                continue
+            start = time.time()
+            window = timestamps[first[0]]
+            nskipped += first[0]
+            headers = headers[first[0]:]
+            timestamps = timestamps[first[0]:]
+            slots = slice(slots.start + first[0], slots.stop)
+        in_window = timestamps == window
+        done = not in_window.all()
+        if done:
+            # stop at the first packet of the next window
+            in_window[np.argmin(in_window):] = False
+        scatter_payloads(dout, ring, slots, headers, mask=in_window, payload_len=payload_len)
+        npackets += int(in_window.sum())
+        stop = time.time()
+        if done:
+            break
+    elapsed = stop - start
+    stats = {
+        "window": None if window is None else int(window),
+        "received": npackets,
+        "expected": expected,
+        "missing": expected - npackets,
+        "skipped": nskipped,
+        "elapsed": elapsed,
+        "packets_per_s": npackets / elapsed if elapsed > 0 else np.nan,
+    }
+    return dout, stats
@@ -4,11 +4,10 @@ import numpy as np
 import redis
 import yaml
 import time
-from astropy.time import Time, TimeDelta
-from astropy import units
-from hera_mc.utils import LSTScheduler
 from hera_corr_cm.handlers import add_default_log_handlers
 from . import bda
+from . import timing
+from .timing import mcnts_per_second
 
 logger = add_default_log_handlers(logging.getLogger(__file__))
 
@@ -17,22 +16,6 @@ DEFAULT_CATCHER_HOST = 'hera-sn1'
 DEFAULT_REDISHOST = 'redishost'
 DEFAULT_ACCLEN = 147456 // 4  # XXX figure out where magic 4 comes from
 
-def mcnts_per_second(sample_rate, nchan):
-    """ 
-    Calculate number of MCNTs in 1 second. For HERA, but not in general,
-    this is the same as the number of spectra in 1 second.
-
-    Parameters
-    ----------
-      sample_rate: ADC clock rate in MHz
-      nchan : Number of frequency channels in 1 F-Engine spectra (prior to subselecting)
-
-    Returns
-    -------
-    mcnts_per_s, Number of MCNTs in 1 second
-    """
-    return sample_rate / (nchan * 2)
-
 def wait_for_catcher_boot(redishost=DEFAULT_REDISHOST, catcher_host=DEFAULT_CATCHER_HOST,
                           maxwait=60):
     r = redis.Redis(redishost, decode_responses=True)
@@ -104,15 +87,14 @@ def set_observation(feng_sync_time_ms, start_delay=60,
     assert acclen % mcnt_xgpu_block_size == 0, 'acc_len must be divisible by xgpu block size'
     file_duration_ms = int(2 * 2 * (acclen * 2) * xpipes * 2 * nchan / sample_rate * 1000)
     file_duration_s = file_duration_ms / 1000
-    t = Time.now() + TimeDelta(start_delay * units.second)
-    lst_time = LSTScheduler(t, file_duration_s)
-    start_time = int(np.round(lst_time[0].unix)) # s
+    lst_time = timing.next_lst_boundary(time.time() + start_delay, file_duration_s)
+    start_time = int(np.round(lst_time[0])) # s
     t0 = feng_sync_time_ms / 1000 # s
     mcnt_per_s = mcnts_per_second(sample_rate, nchan)
-    mcnt_delay = int((start_time - t0) * mcnt_per_s)
     # round to granularity of an integration in xGPU
-    trig_mcnt = mcnt_delay - int(mcnt_delay % int(mcnt_xgpu_block_size * slices))
-    trig_time = trig_mcnt / mcnt_per_s + t0
+    trig_mcnt, trig_time = timing.trigger_mcnt(
+        start_time, feng_sync_time_ms, mcnt_xgpu_block_size * slices, sample_rate, nchan
+    )
     int_time = acclen * slices * mcnt_per_s
     
     logger.debug(f'On redishost={redishost} setting:')
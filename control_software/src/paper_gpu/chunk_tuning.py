@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""Benchmark-driven selection of the HDF5 chunk shape of UVH5 data arrays."""
+
+import os
+import time
+import tempfile
+import h5py
+import numpy as np
+
+from .bl_order import N_MAX_INTTIME, get_bda_bcnt_layout
+from .file_conversion import (
+    _hera_corr_dtype,
+    get_visdata_codec_kwargs,
+    resolve_chunks,
+    DEFAULT_VISDATA_CODEC,
+)
+
+# chunk shapes tried by default; -1 means the full axis
+DEFAULT_CANDIDATES = (
+    (128, -1, 1),
+    (32, -1, 1),
+    (512, -1, 1),
+    (128, -1, -1),
+    (32, -1, -1),
+    (1024, 256, 1),
+    (4096, 64, -1),
+)
+
+# fraction of baselines integrating 1, 2, 4 and 8 samples in the synthetic
+# BDA data; long baselines need short integrations, and most are short
+DEFAULT_TIER_FRACTIONS = (0.1, 0.2, 0.3, 0.4)
+
+# the synthetic data set holds at least this many of the longest candidate
+# chunks, so no candidate covers the whole file
+MIN_CHUNKS_PER_DATASET = 4
+
+# baseline-times of synthetic data generated at a time, to bound memory use
+SYNTHETIC_BLOCK = 1024
+
+# read access patterns benchmarked for each candidate
+ACCESS_PATTERNS = ("single_baseline", "single_time", "full_frequency")
+
+# relative importance of each metric when ranking candidates
+DEFAULT_WEIGHTS = {
+    "write_time": 1.0,
+    "stored_bytes": 1.0,
+    "single_baseline": 1.0,
+    "single_time": 1.0,
+    "full_frequency": 1.0,
+}
+
+
+def make_synthetic_visdata(nbls=128, ntimes=8, nfreq=1536, nstokes=4, seed=0):
+    """
+    Make synthetic data with the layout and statistics of catcher output.
+
+    Visibilities are Gaussian noise whose amplitude varies across baselines
+    and frequencies, scaled by a power of two as the correlator does. Rows
+    are ordered time-major, as in catcher files.
+
+    Parameters
+    ----------
+    nbls : int, optional
+        The number of baselines.
+    ntimes : int, optional
+        The number of times.
+    nfreq : int, optional
+        The number of frequency channels.
+    nstokes : int, optional
+        The number of polarizations.
+    seed : int, optional
+        The random seed.
+
+    Returns
+    -------
+    data : ndarray
+        Compound numpy datatype with a "r" field and "i" field, of shape
+        (nbls * ntimes, nfreq, nstokes).
+    ant_0_array, ant_1_array : ndarray of int
+        The antennas of each baseline-time.
+    time_index : ndarray of int
+        The time index of each baseline-time.
+    """
+    rng = np.random.default_rng(seed)
+    ant_0, ant_1 = _synthetic_baselines(nbls)
+    bl_amp = np.tile(rng.uniform(10, 1000, size=nbls), ntimes)
+    data = _synthetic_noise(rng, bl_amp, nfreq, nstokes)
+
+    return (
+        data,
+        np.tile(ant_0, ntimes),
+        np.tile(ant_1, ntimes),
+        np.repeat(np.arange(ntimes), nbls),
+    )
+
+
+def make_bda_synthetic_visdata(nbls=128, nfiles=2, nfreq=1536, nstokes=4,
+                               tier_fractions=DEFAULT_TIER_FRACTIONS, seed=0):
+    """
+    Make synthetic baseline-dependent averaged data, laid out as catcher files.
+
+    Baselines are split among the integration tiers in proportion to
+    `tier_fractions`, and each file holds the rows of
+    `bl_order.get_bda_bcnt_layout`: the baselines of each tier in turn, with
+    one row per output sample. Visibilities are as in
+    `make_synthetic_visdata`.
+
+    Parameters
+    ----------
+    nbls : int, optional
+        The number of baselines.
+    nfiles : int, optional
+        The number of catcher files.
+    nfreq : int, optional
+        The number of frequency channels.
+    nstokes : int, optional
+        The number of polarizations.
+    tier_fractions : sequence of float, optional
+        The relative number of baselines integrating 1, 2, 4, ... samples.
+    seed : int, optional
+        The random seed.
+
+    Returns
+    -------
+    data : ndarray
+        Compound numpy datatype with a "r" field and "i" field, of shape
+        (Nblts, nfreq, nstokes).
+    ant_0_array, ant_1_array : ndarray of int
+        The antennas of each baseline-time.
+    time_index : ndarray of int
+        The first sample integrated in each baseline-time, counted from the
+        start of the first file.
+    """
+    rng = np.random.default_rng(seed)
+    ant_0, ant_1 = _synthetic_baselines(nbls)
+    tier = rng.permutation(_split_tiers(nbls, tier_fractions))
+    bl_pairs = np.stack([ant_0, ant_1, 2**tier], axis=-1)
+    layout = get_bda_bcnt_layout(bl_pairs)
+
+    nants = ant_1.max() + 1
+    amp = rng.uniform(10, 1000, size=(nants, nants))
+    row_amp = amp[layout["ant_0_array"], layout["ant_1_array"]]
+    data = _synthetic_noise(rng, np.tile(row_amp, nfiles), nfreq, nstokes)
+    time_index = layout["sample"] * layout["inttime"]
+
+    return (
+        data,
+        np.tile(layout["ant_0_array"], nfiles),
+        np.tile(layout["ant_1_array"], nfiles),
+        np.concatenate([i * N_MAX_INTTIME + time_index for i in range(nfiles)]),
+    )
+
+
+def get_synthetic_nbls(candidates, nfiles=2, tier_fractions=DEFAULT_TIER_FRACTIONS):
+    """
+    Get the number of baselines of a synthetic BDA data set for benchmarking.
+
+    Parameters
+    ----------
+    candidates : list of tuple of int
+        The chunk shapes to be benchmarked; -1 means the full axis.
+    nfiles : int, optional
+        The number of catcher files.
+    tier_fractions : sequence of float, optional
+        The relative number of baselines in each integration tier.
+
+    Returns
+    -------
+    int
+        The number of baselines for which `make_bda_synthetic_visdata`
+        holds at least `MIN_CHUNKS_PER_DATASET` of the longest candidate
+        chunks.
+    """
+    longest = max([c[0] for c in candidates if c[0] > 0], default=1)
+    fractions = np.asarray(tier_fractions, dtype=float)
+    samples = N_MAX_INTTIME >> np.arange(fractions.size)
+    rows_per_bl = nfiles * np.sum(fractions * samples) / fractions.sum()
+    return int(np.ceil(MIN_CHUNKS_PER_DATASET * longest / rows_per_bl))
+
+
+def _synthetic_baselines(nbls):
+    """Get the antennas of the first `nbls` baselines, autos included."""
+    nants = int(np.ceil((np.sqrt(8 * nbls + 1) - 1) / 2))
+    ant_0, ant_1 = np.triu_indices(nants)
+    return ant_0[:nbls], ant_1[:nbls]
+
+
+def _split_tiers(nbls, tier_fractions):
+    """Get the tier of each baseline, split in proportion to `tier_fractions`."""
+    edges = np.cumsum(tier_fractions) / np.sum(tier_fractions)
+    counts = np.diff(np.round(edges * nbls).astype(int), prepend=0)
+    return np.repeat(np.arange(len(counts)), counts)
+
+
+def _synthetic_noise(rng, amp, nfreq, nstokes):
+    """Make noise visibilities with an amplitude per baseline-time."""
+    shape = (amp.size, nfreq, nstokes)
+    bandpass = 1 + np.sin(np.linspace(0, np.pi, nfreq))[None, :, None]
+    scale = 2**11
+    data = np.empty(shape, dtype=_hera_corr_dtype)
+    for i0 in range(0, amp.size, SYNTHETIC_BLOCK):
+        i1 = min(i0 + SYNTHETIC_BLOCK, amp.size)
+        block_shape = (i1 - i0,) + shape[1:]
+        sigma = amp[i0:i1, None, None] * bandpass
+        data["r"][i0:i1] = np.round(sigma * rng.standard_normal(block_shape)) * scale
+        data["i"][i0:i1] = np.round(sigma * rng.standard_normal(block_shape)) * scale
+    return data
+
+
+def benchmark_chunk_shape(data, ant_0_array, ant_1_array, time_index, chunks,
+                          tmpdir=None, nreads=5, seed=0, codec=DEFAULT_VISDATA_CODEC):
+    """
+    Measure write, storage and read performance of one chunk shape.
+
+    Parameters
+    ----------
+    data : ndarray
+        Visibilities of shape (Nblts, Nfreqs, Npols), e.g. from
+        `make_synthetic_visdata`.
+    ant_0_array, ant_1_array : ndarray of int
+        The antennas of each baseline-time.
+    time_index : ndarray of int
+        The time index of each baseline-time.
+    chunks : tuple of int
+        The chunk shape to test; -1 means the full axis.
+    tmpdir : str, optional
+        Directory for the test file. Default is the system temporary directory.
+    nreads : int, optional
+        The number of reads averaged for each access pattern.
+    seed : int, optional
+        The random seed used to pick what to read.
+    codec : str, optional
+        The visdata compression codec; see `file_conversion.VISDATA_CODECS`.
+
+    Returns
+    -------
+    dict
+        A dict containing: chunks (the resolved chunk shape), write_time
+        (seconds), write_MBps, stored_bytes, compression_ratio, and the mean
+        read time in seconds of each pattern in `ACCESS_PATTERNS`.
+    """
+    rng = np.random.default_rng(seed)
+    chunks = resolve_chunks(chunks, data.shape)
+    _, codec_kwargs = get_visdata_codec_kwargs(codec)
+    fd, filename = tempfile.mkstemp(suffix=".uvh5", dir=tmpdir)
+    os.close(fd)
+    try:
+        t0 = time.perf_counter()
+        with h5py.File(filename, "w") as h5f:
+            dset = h5f.create_dataset(
+                "visdata", data=data, chunks=chunks, dtype=_hera_corr_dtype,
+                **codec_kwargs
+            )
+            stored_bytes = dset.id.get_storage_size()
+        write_time = time.perf_counter() - t0
+
+        pairs = np.stack([ant_0_array, ant_1_array], axis=-1)
+        read_times = {pattern: 0.0 for pattern in ACCESS_PATTERNS}
+        for _ in range(nreads):
+            bl = pairs[rng.integers(pairs.shape[0])]
+            selections = {
+                "single_baseline": np.flatnonzero(np.all(pairs == bl, axis=1)),
+                "single_time": np.flatnonzero(time_index == rng.choice(time_index)),
+                "full_frequency": int(rng.integers(data.shape[0])),
+            }
+            for pattern, rows in selections.items():
+                # disable the chunk cache so every read decompresses from disk
+                with h5py.File(filename, "r", rdcc_nbytes=0) as h5f:
+                    t0 = time.perf_counter()
+                    if isinstance(rows, int):
+                        h5f["visdata"][rows, :, 0]
+                    else:
+                        h5f["visdata"][rows]
+                    read_times[pattern] += time.perf_counter() - t0
+    finally:
+        os.remove(filename)
+
+    result = {
+        "chunks": chunks,
+        "write_time": write_time,
+        "write_MBps": data.nbytes / write_time / 1e6,
+        "stored_bytes": int(stored_bytes),
+        "compression_ratio": data.nbytes / max(stored_bytes, 1),
+    }
+    for pattern, total in read_times.items():
+        result[pattern] = total / nreads
+
+    return result
+
+
+def rank_results(results, weights=None):
+    """
+    Rank benchmark results by a weighted score.
+
+    Each metric is divided by the best value of that metric over all
+    candidates, so a candidate that is best at everything scores the sum of
+    the weights.
+
+    Parameters
+    ----------
+    results : list of dict
+        Results from `benchmark_chunk_shape`.
+    weights : dict, optional
+        Weight of each metric. Default is `DEFAULT_WEIGHTS`.
+
+    Returns
+    -------
+    list of dict
+        The results, each with an added "score" entry, best (lowest) first.
+    """
+    if weights is None:
+        weights = DEFAULT_WEIGHTS
+    best = {
+        metric: min(max(res[metric], 1e-12) for res in results) for metric in weights
+    }
+    ranked = []
+    for res in results:
+        score = sum(
+            w * max(res[metric], 1e-12) / best[metric] for metric, w in weights.items()
+        )
+        ranked.append(dict(res, score=score))
+    return sorted(ranked, key=lambda res: res["score"])
+
+
+def autotune_chunks(candidates=DEFAULT_CANDIDATES, nbls=None, nfiles=2, nfreq=1536,
+                    nstokes=4, tier_fractions=DEFAULT_TIER_FRACTIONS, weights=None,
+                    tmpdir=None, nreads=5, seed=0):
+    """
+    Benchmark candidate chunk shapes on synthetic BDA catcher data.
+
+    Parameters
+    ----------
+    candidates : list of tuple of int, optional
+        The chunk shapes to try; -1 means the full axis.
+    nbls : int, optional
+        The number of baselines. Default is enough for several of the
+        longest candidate chunks; see `get_synthetic_nbls`.
+    nfiles, nfreq, nstokes : int, optional
+        The size of the synthetic data set.
+    tier_fractions : sequence of float, optional
+        The relative number of baselines in each integration tier.
+    weights : dict, optional
+        Weight of each metric when ranking. Default is `DEFAULT_WEIGHTS`.
+    tmpdir : str, optional
+        Directory for test files. This should be on the same kind of storage
+        the converter writes to.
+    nreads : int, optional
+        The number of reads averaged for each access pattern.
+    seed : int, optional
+        The random seed.
+
+    Returns
+    -------
+    list of dict
+        Benchmark results with scores, best first; see `rank_results`. Each
+        result also has a "candidate" entry holding the unresolved chunk shape,
+        suitable for `file_conversion.save_chunk_profile`.
+    """
+    if nbls is None:
+        nbls = get_synthetic_nbls(candidates, nfiles=nfiles, tier_fractions=tier_fractions)
+    data, ant_0_array, ant_1_array, time_index = make_bda_synthetic_visdata(
+        nbls=nbls, nfiles=nfiles, nfreq=nfreq, nstokes=nstokes,
+        tier_fractions=tier_fractions, seed=seed,
+    )
+    results = []
+    for candidate in candidates:
+        res = benchmark_chunk_shape(
+            data, ant_0_array, ant_1_array, time_index, candidate,
+            tmpdir=tmpdir, nreads=nreads, seed=seed,
+        )
+        res["candidate"] = tuple(candidate)
+        results.append(res)
+    return rank_results(results, weights=weights)
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+Layouts of the X-engine hashpipe databufs, and verification of their dumps.
+
+The net, fluff and GPU output databufs of paper_databuf.h are described as
+numpy dtypes and shapes, so a dump can be memory-mapped rather than read,
+and checked against the test vector generated by the F-engines in chunks.
+"""
+
+import os
+from collections import namedtuple
+import numpy as np
+
+# from paper_databuf.h and hashpipe_databuf.h
+CACHE_ALIGNMENT = 128
+# sizeof(hashpipe_databuf_t): char data_type[64], size_t header_size,
+# size_t block_size, int n_block, int shmid, int semid, padded to 8 bytes
+HASHPIPE_DATABUF_HEADER_SIZE = 96
+N_TIME_PER_PACKET = 2
+N_INPUT_BLOCKS = 8
+N_GPU_INPUT_BLOCKS = 4
+N_OUTPUT_BLOCKS = 2
+
+# xGPU sizing of the HERA X-engines
+XGPU_NSTATION = 192
+XGPU_NTIME = 2048
+XGPU_NFREQUENCY = 384
+
+# bytes of data compared at a time when verifying a dump
+DEFAULT_CHUNK_BYTES = 64 * 2**20
+
+DatabufLayout = namedtuple(
+    "DatabufLayout",
+    ["name", "header_dtype", "data_dtype", "data_shape", "ant_axis", "n_blocks"],
+)
+DatabufLayout.__doc__ = """
+The layout of a hashpipe databuf.
+
+Parameters
+----------
+name : str
+    The name of the databuf.
+header_dtype : numpy.dtype
+    The dtype of the block header.
+data_dtype : numpy.dtype
+    The dtype of the block data.
+data_shape : tuple of int
+    The shape of the data of one block.
+ant_axis : int or None
+    The antenna axis of the data, if it has one.
+n_blocks : int
+    The number of blocks in the databuf.
+"""
+
+VerifyResult = namedtuple(
+    "VerifyResult", ["ok", "antenna_ok", "nmismatch", "first_mismatch"]
+)
+VerifyResult.__doc__ = """
+The result of verifying a dump.
+
+Parameters
+----------
+ok : bool
+    Whether every value matched.
+antenna_ok : ndarray of bool
+    Whether every value of each antenna matched.
+nmismatch : int
+    The number of values that did not match.
+first_mismatch : tuple of int or None
+    The index of the first value that did not match, in the shape of the
+    dump, or None.
+"""
+
+
+def _cache_padding(size):
+    """The padding the C structs add after `size` bytes to keep cache alignment."""
+    return CACHE_ALIGNMENT - size % CACHE_ALIGNMENT
+
+
+def block_dtype(layout):
+    """
+    Get the dtype of a block of a databuf.
+
+    Parameters
+    ----------
+    layout : DatabufLayout
+        The layout of the databuf.
+
+    Returns
+    -------
+    numpy.dtype
+        A structured dtype with "header" and "data" fields, with the padding
+        of the C struct between them.
+    """
+    header = np.dtype(layout.header_dtype)
+    padding = _cache_padding(header.itemsize)
+    return np.dtype(
+        {
+            "names": ["header", "data"],
+            "formats": [header, (layout.data_dtype, layout.data_shape)],
+            "offsets": [0, header.itemsize + padding],
+        },
+        align=True,
+    )
+
+
+def net_layout(ntime=XGPU_NTIME, nchan=XGPU_NFREQUENCY, nants=XGPU_NSTATION):
+    """
+    Get the layout of `paper_input_databuf_t`, the net thread output.
+
+    The data are (mcnt, antenna, channel, time, pol) bytes, each a 4+4 bit
+    complex value.
+    """
+    return DatabufLayout(
+        name="paper_input_databuf",
+        header_dtype=np.dtype([("good_data", "<i8"), ("mcnt", "<u8")]),
+        data_dtype=np.dtype("u1"),
+        data_shape=(ntime // N_TIME_PER_PACKET, nants, nchan, N_TIME_PER_PACKET, 2),
+        ant_axis=1,
+        n_blocks=N_INPUT_BLOCKS,
+    )
+
+
+def fluff_layout(ntime=XGPU_NTIME, nchan=XGPU_NFREQUENCY, nants=XGPU_NSTATION):
+    """
+    Get the layout of `paper_gpu_input_databuf_t`, the fluffer output.
+
+    The data are (time / 4, channel, antenna, pol, complexity, time % 4)
+    signed bytes.
+    """
+    return DatabufLayout(
+        name="paper_gpu_input_databuf",
+        header_dtype=np.dtype([("good_data", "<i8"), ("mcnt", "<u8")]),
+        data_dtype=np.dtype("i1"),
+        data_shape=(ntime // 4, nchan, nants, 2, 2, 4),
+        ant_axis=2,
+        n_blocks=N_GPU_INPUT_BLOCKS,
+    )
+
+
+def gpu_output_layout(nchan=XGPU_NFREQUENCY, nants=XGPU_NSTATION):
+    """
+    Get the layout of `paper_output_databuf_t`, the GPU thread output.
+
+    The data are xGPU's register tile order output matrix of int32.
+    """
+    ninputs = 2 * nants
+    return DatabufLayout(
+        name="paper_output_databuf",
+        header_dtype=np.dtype([("mcnt", "<u8"), ("flags", "<u8", ((nchan + 63) // 64,))]),
+        data_dtype=np.dtype("<i4"),
+        data_shape=(2 * nchan * (ninputs // 2 + 2) * ninputs,),
+        ant_axis=None,
+        n_blocks=N_OUTPUT_BLOCKS,
+    )
+
+
+def open_databuf(filename, layout, mode="r", n_blocks=None):
+    """
+    Memory-map a dump of a whole databuf, or its shared memory segment.
+
+    Parameters
+    ----------
+    filename : str
+        The file holding the databuf.
+    layout : DatabufLayout
+        The layout of the databuf.
+    mode : str, optional
+        The numpy.memmap mode.
+    n_blocks : int, optional
+        The number of blocks. Default is `layout.n_blocks`.
+
+    Returns
+    -------
+    numpy.memmap
+        Array of blocks with the dtype of `block_dtype`.
+    """
+    if n_blocks is None:
+        n_blocks = layout.n_blocks
+    offset = HASHPIPE_DATABUF_HEADER_SIZE + _cache_padding(HASHPIPE_DATABUF_HEADER_SIZE)
+    return np.memmap(
+        filename, dtype=block_dtype(layout), mode=mode, offset=offset, shape=(n_blocks,)
+    )
+
+
+def open_data_dump(filename, layout):
+    """
+    Memory-map a dump of the data of one or more blocks, without headers.
+
+    Parameters
+    ----------
+    filename : str
+        The dump.
+    layout : DatabufLayout
+        The layout of the databuf the data came from.
+
+    Returns
+    -------
+    numpy.memmap
+        The data, of shape `layout.data_shape` with the leading (time) axis
+        extended to cover every block in the file.
+
+    Raises
+    ------
+    ValueError
+        Raised if the file is not a whole number of blocks.
+    """
+    block_bytes = int(np.prod(layout.data_shape)) * np.dtype(layout.data_dtype).itemsize
+    nbytes = os.path.getsize(filename)
+    if nbytes == 0 or nbytes % block_bytes != 0:
+        raise ValueError(
+            f"{filename} is {nbytes} bytes, not a whole number of "
+            f"{layout.name} blocks of {block_bytes} bytes"
+        )
+    shape = (layout.data_shape[0] * (nbytes // block_bytes),) + layout.data_shape[1:]
+    return np.memmap(filename, dtype=layout.data_dtype, mode="r", shape=shape)
+
+
+def _chan_ramp(nchan, nants):
+    # the F-engine test vector: a channel ramp offset by input, (nants, pol, nchan)
+    a = np.arange(nants)[:, np.newaxis, np.newaxis]
+    p = np.arange(2)[np.newaxis, :, np.newaxis]
+    c = np.arange(nchan)[np.newaxis, np.newaxis, :]
+    return ((c + 2 * (a % 3) + p) % 256).astype(np.uint8)
+
+
+def net_test_vector(layout):
+    """
+    Get the expected net databuf data for the F-engine test vector.
+
+    Parameters
+    ----------
+    layout : DatabufLayout
+        The net databuf layout, from `net_layout`.
+
+    Returns
+    -------
+    ndarray of uint8
+        Of shape (1, nants, nchan, 1, 2), to broadcast against the data.
+    """
+    _, nants, nchan, _, _ = layout.data_shape
+    ramp = _chan_ramp(nchan, nants)  # (ant, pol, chan)
+    return ramp.transpose(0, 2, 1)[np.newaxis, :, :, np.newaxis, :]
+
+
+def fluff_test_vector(layout):
+    """
+    Get the expected fluffed databuf data for the F-engine test vector.
+
+    Each byte of the net databuf is split into two signed 4-bit values; as in
+    check_fluff_output_databuf.py the high nibble is complexity index 1 and
+    the low nibble complexity index 0.
+
+    Parameters
+    ----------
+    layout : DatabufLayout
+        The fluffed databuf layout, from `fluff_layout`.
+
+    Returns
+    -------
+    ndarray of int8
+        Of shape (1, nchan, nants, 2, 2, 1), to broadcast against the data.
+    """
+    _, nchan, nants, _, _, _ = layout.data_shape
+    ramp = _chan_ramp(nchan, nants).transpose(2, 0, 1)  # (chan, ant, pol)
+    nibbles = np.stack([ramp & 0xF, ramp >> 4], axis=-1).astype(np.int8)
+    nibbles[nibbles > 7] -= 16
+    return nibbles[np.newaxis, ..., np.newaxis]
+
+
+def _chunk_rows(data, chunk_bytes):
+    row_bytes = data[:1].nbytes
+    return max(1, chunk_bytes // max(row_bytes, 1))
+
+
+def verify_data(data, expected, ant_axis, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Compare data with an expected array, a chunk of the leading axis at a time.
+
+    Parameters
+    ----------
+    data : ndarray
+        The data, e.g. from `open_data_dump`.
+    expected : ndarray
+        The expected values, broadcastable against any chunk of `data`.
+    ant_axis : int
+        The antenna axis of the data; must not be 0.
+    chunk_bytes : int, optional
+        The number of bytes of data compared at a time.
+
+    Returns
+    -------
+    VerifyResult
+        The result.
+    """
+    nrows = data.shape[0]
+    step = _chunk_rows(data, chunk_bytes)
+    other_axes = tuple(i for i in range(data.ndim) if i != ant_axis)
+    antenna_ok = np.ones(data.shape[ant_axis], dtype=bool)
+    nmismatch = 0
+    first_mismatch = None
+    for row0 in range(0, nrows, step):
+        match = np.equal(data[row0:row0 + step], expected)
+        chunk_ok = match.all(axis=other_axes)
+        if chunk_ok.all():
+            continue
+        antenna_ok &= chunk_ok
+        nmismatch += match.size - np.count_nonzero(match)
+        if first_mismatch is None:
+            index = np.unravel_index(np.argmin(match), match.shape)
+            first_mismatch = (int(index[0]) + row0,) + tuple(int(i) for i in index[1:])
+    return VerifyResult(
+        ok=bool(antenna_ok.all()),
+        antenna_ok=antenna_ok,
+        nmismatch=nmismatch,
+        first_mismatch=first_mismatch,
+    )
+
+
+def verify_net_dump(filename, layout=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Verify a dump of net databuf data against the F-engine test vector.
+
+    Parameters
+    ----------
+    filename : str
+        The dump of the data of one or more blocks.
+    layout : DatabufLayout, optional
+        The layout. Default is `net_layout()`.
+    chunk_bytes : int, optional
+        The number of bytes compared at a time.
+
+    Returns
+    -------
+    VerifyResult
+        The result.
+    """
+    if layout is None:
+        layout = net_layout()
+    data = open_data_dump(filename, layout)
+    return verify_data(data, net_test_vector(layout), layout.ant_axis, chunk_bytes)
+
+
+def verify_fluff_dump(filename, layout=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Verify a dump of fluffed databuf data against the F-engine test vector.
+
+    Parameters
+    ----------
+    filename : str
+        The dump of the data of one or more blocks.
+    layout : DatabufLayout, optional
+        The layout. Default is `fluff_layout()`.
+    chunk_bytes : int, optional
+        The number of bytes compared at a time.
+
+    Returns
+    -------
+    VerifyResult
+        The result.
+    """
+    if layout is None:
+        layout = fluff_layout()
+    data = open_data_dump(filename, layout)
+    return verify_data(data, fluff_test_vector(layout), layout.ant_axis, chunk_bytes)
+
+
+def check_gpu_output_dump(filename, layout=None, divisors=(2048, 262144),
+                          chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Summarize a dump of GPU output databuf data.
+
+    Parameters
+    ----------
+    filename : str
+        The dump of the data of one or more blocks.
+    layout : DatabufLayout, optional
+        The layout. Default is `gpu_output_layout()`.
+    divisors : tuple of int, optional
+        Check whether every value is divisible by each of these.
+    chunk_bytes : int, optional
+        The number of bytes checked at a time.
+
+    Returns
+    -------
+    dict
+        "all_zero" and, for each divisor d, "divisible_by_d": whether the
+        check passed. "first_nonzero" and "first_not_divisible_by_d" hold the
+        flat index of the first failing value, or None.
+    """
+    if layout is None:
+        layout = gpu_output_layout()
+    data = open_data_dump(filename, layout).reshape(-1)
+    step = max(1, chunk_bytes // data.itemsize)
+    first = {0: None}
+    first.update({d: None for d in divisors})
+    for i0 in range(0, data.size, step):
+        chunk = data[i0:i0 + step]
+        for d in first:
+            if first[d] is not None:
+                continue
+            bad = np.flatnonzero(chunk if d == 0 else chunk % d)
+            if len(bad) > 0:
+                first[d] = int(bad[0]) + i0
+    result = {"all_zero": first[0] is None, "first_nonzero": first[0]}
+    for d in divisors:
+        result[f"divisible_by_{d}"] = first[d] is None
+        result[f"first_not_divisible_by_{d}"] = first[d]
+    return result
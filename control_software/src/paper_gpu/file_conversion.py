@@ -2,11 +2,15 @@
 # Copyright (c) 2022 The HERA Collaboration
 # Licensed under the 2-clause BSD License
 
+import os
+import json
 import time
+import zlib
 import h5py
 import redis
 import warnings
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import cartopy.crs as ccrs
 import pyuvdata.utils as uvutils
 from hera_mc import geo_sysdef
@@ -26,11 +30,84 @@ except ImportError:
 # define correlator type
 _hera_corr_dtype = np.dtype([("r", "<i4"), ("i", "<i4")])
 
+# attributes of the visdata dataset holding the power-of-two shift of each
+# block of baseline-times, when the shift has been stripped
+VISDATA_SHIFT_ATTR = "shift"
+VISDATA_SHIFT_BLOCK_ATTR = "shift_block"
+
+# attributes of the visdata dataset of a partly written file: the number of
+# baseline-times written so far, and the CRC-32 of their raw visdata
+CHECKPOINT_ATTR = "checkpoint_blt"
+CHECKPOINT_CRC_ATTR = "checkpoint_crc32"
+# attributes of the visdata dataset of a partly written aggregate: the files
+# appended so far, and the number of baseline-times after each
+CHECKPOINT_FILES_ATTR = "checkpoint_files"
+CHECKPOINT_FILE_ENDS_ATTR = "checkpoint_file_ends"
+
+# number of read chunks between checkpoints of a chunked conversion
+DEFAULT_CHECKPOINT_INTERVAL = 10
+
+# header arrays with one entry per baseline-time, which grow as files are
+# appended to an aggregated file
+BLT_HEADER_KEYS = ("time_array", "integration_time", "uvw_array", "ant_1_array", "ant_2_array")
+
+# default time span of an aggregated file, in seconds
+DEFAULT_AGGREGATE_SPAN = 3600.0
+
 # define Easting/Northing magic numbers
 # HERA is in Zone 34J; corresponds to latitude 10000000 in northings
 UTM_TILE = 34
 LAT_CORR = 10000000
 
+# extra_keywords entry holding the CRC-32 of the raw visdata bytes
+CHECKSUM_KEY = "visdata_crc32"
+
+# bitshuffle filter number, and its options: let bitshuffle decide the block
+# size, then use LZ4 compression
+BITSHUFFLE_FILTER = 32008
+BITSHUFFLE_LZ4_OPTS = (0, 2)
+
+# extra_keywords entry recording the compression codec used for visdata
+CODEC_KEY = "visdata_codec"
+
+# visdata compression codecs; each entry makes the create_dataset keywords.
+# All but lzf and none need the filters registered by hdf5plugin.
+VISDATA_CODECS = {
+    "bitshuffle-lz4": lambda: {
+        "compression": BITSHUFFLE_FILTER,
+        "compression_opts": BITSHUFFLE_LZ4_OPTS,
+    },
+    "bitshuffle-zstd": lambda: hdf5plugin.Bitshuffle(nelems=0, cname="zstd", clevel=3),
+    "blosc-lz4": lambda: hdf5plugin.Blosc(
+        cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.BITSHUFFLE
+    ),
+    "blosc-zstd": lambda: hdf5plugin.Blosc(
+        cname="zstd", clevel=3, shuffle=hdf5plugin.Blosc.BITSHUFFLE
+    ),
+    "zstd": lambda: hdf5plugin.Zstd(clevel=3),
+    "lzf": lambda: {"compression": "lzf"},
+    "none": lambda: {},
+}
+BUILTIN_CODECS = ("lzf", "none")
+DEFAULT_VISDATA_CODEC = "bitshuffle-lz4"
+# codecs considered when choosing one automatically; lzf and none are left
+# out, so a busy host never picks them just for being the fastest
+AUTO_CODECS = tuple(c for c in VISDATA_CODECS if c not in BUILTIN_CODECS)
+
+# minimum compression throughput when choosing a codec automatically. At
+# this rate a worker compresses a ~4 GB file in ~20 s, the file cadence
+DEFAULT_CODEC_MIN_MBPS = 200.0
+
+# default chunk shape of the data arrays; -1 means the full axis. With
+# Nfreq = 1536, chunks are ~1 MB in size
+DEFAULT_DATA_CHUNKS = (128, -1, 1)
+
+# per-deployment chunk shape profile written by hera_tune_chunks.py
+CHUNK_PROFILE_ENV = "PAPER_GPU_CHUNK_PROFILE"
+DEFAULT_CHUNK_PROFILE = os.path.join(
+    os.path.expanduser("~"), ".config", "paper_gpu", "chunk_profile.json"
+)
+
 
 def read_header_data(filename):
     """
@@ -199,46 +276,658 @@ def get_antpos_info():
     return antpos_xyz, ant_names
 
 
-def make_uvh5_file(filename, metadata_file, data_file, chunksize=-1):
+def _gf2_matrix_times(mat, vec):
+    """Multiply a 32x32 GF(2) matrix by a 32-bit vector."""
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(mat):
+    """Square a 32x32 GF(2) matrix."""
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32_combine(crc1, crc2, len2):
     """
-    Make a UVH5 file from a metdata + raw binary data file.
+    Combine the CRC-32 checksums of two consecutive blocks of data.
+
+    This is a port of `crc32_combine` from zlib, which Python does not expose.
+
+    Parameters
+    ----------
+    crc1 : int
+        The CRC-32 of the first block.
+    crc2 : int
+        The CRC-32 of the second block.
+    len2 : int
+        The length of the second block in bytes.
+
+    Returns
+    -------
+    int
+        The CRC-32 of the first block followed by the second block.
+    """
+    if len2 == 0:
+        return crc1
+
+    # operator for one zero bit, then two and four zero bits
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+
+    # apply len2 zero bytes to crc1
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+
+    return crc1 ^ crc2
 
-    This function creates a valid UVH5 file from the specified metadata and
-    binary data files. It adds the flags and nsample datasets, and applies
-    bitshuffle compression to the data.
+
+def _visdata_range_crc32(filename, idx0, idx1):
+    """
+    Compute the CRC-32 of a range of baseline-times of a UVH5 visdata dataset.
 
     Parameters
     ----------
     filename : str
-        The name of the output file to write.
-    metadata_file : str
-        The name of the metadata file written by the correlator.
+        The name of the UVH5 file.
+    idx0, idx1 : int
+        The first and one-past-last baseline-time rows to checksum.
+
+    Returns
+    -------
+    crc : int
+        The CRC-32 of the decompressed visdata bytes in the range.
+    nbytes : int
+        The number of bytes in the range.
+    """
+    with h5py.File(filename, "r") as h5f:
+        return _dataset_range_crc32(h5f["Data"]["visdata"], idx0, idx1)
+
+
+def _dataset_range_crc32(visdata, idx0, idx1):
+    """Compute the CRC-32 of rows of an open visdata dataset; see `_visdata_range_crc32`."""
+    crc = 0
+    nbytes = 0
+    # read whole HDF5 chunks at a time to avoid decompressing twice
+    step = visdata.chunks[0] if visdata.chunks is not None else idx1 - idx0
+    for i in range(idx0, idx1, max(step, 1)):
+        data = _read_visdata_range(visdata, i, min(i + step, idx1))
+        crc = zlib.crc32(data, crc)
+        nbytes += data.nbytes
+    return crc, nbytes
+
+
+def compute_visdata_checksum(filename, nproc=1):
+    """
+    Compute the CRC-32 of the visdata in a UVH5 file.
+
+    The checksum is computed over the decompressed visdata in C order, after
+    undoing any power-of-two shift, so it matches the checksum of the raw
+    .dat file the UVH5 file was made from.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the UVH5 file.
+    nproc : int, optional
+        The number of processes used to decompress and checksum the data.
+
+    Returns
+    -------
+    int
+        The CRC-32 checksum of the visdata.
+    """
+    with h5py.File(filename, "r") as h5f:
+        visdata = h5f["Data"]["visdata"]
+        nblts = visdata.shape[0]
+        rows_per_chunk = visdata.chunks[0] if visdata.chunks is not None else nblts
+
+    # split into ranges aligned to HDF5 chunk boundaries
+    nproc = max(min(nproc, nblts // max(rows_per_chunk, 1)), 1)
+    if nproc == 1:
+        return _visdata_range_crc32(filename, 0, nblts)[0]
+    nchunks = -(-nblts // rows_per_chunk)
+    bounds = [min(i * nchunks // nproc * rows_per_chunk, nblts) for i in range(nproc + 1)]
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        results = pool.map(
+            _visdata_range_crc32, [filename] * nproc, bounds[:-1], bounds[1:]
+        )
+        crc = 0
+        for crc_range, nbytes in results:
+            crc = crc32_combine(crc, crc_range, nbytes)
+    return crc
+
+
+def verify_visdata_checksum(filename, nproc=1):
+    """
+    Verify the visdata of a UVH5 file against the checksum stored in it.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the UVH5 file, as written by `make_uvh5_file`.
+    nproc : int, optional
+        The number of processes used to decompress and checksum the data.
+
+    Returns
+    -------
+    bool
+        True if the file has a stored checksum and the visdata matches it.
+        False if the checksum is missing or does not match.
+    """
+    with h5py.File(filename, "r") as h5f:
+        extra_keywords = h5f["Header"]["extra_keywords"]
+        if CHECKSUM_KEY not in extra_keywords:
+            return False
+        expected = int(extra_keywords[CHECKSUM_KEY][()])
+    return compute_visdata_checksum(filename, nproc=nproc) == expected
+
+
+def get_blt_info(ant_0_array, ant_1_array, time_array, Nants_telescope):
+    """
+    Summarize the baseline-time axis of correlator metadata.
+
+    The antenna pairs are sorted once; the baseline numbers, number of
+    baselines, antennas with data and the baseline-time -> baseline mapping all
+    come from that single sort. The number of unique times needs a separate
+    sort of the times, since with BDA the baselines do not share one set of
+    times.
+
+    Parameters
+    ----------
+    ant_0_array : ndarray of int
+        The first antenna of each baseline-time, length Nblts.
+    ant_1_array : ndarray of int
+        The second antenna of each baseline-time, length Nblts.
+    time_array : ndarray of float
+        The JD of each baseline-time, length Nblts.
+    Nants_telescope : int
+        The number of antennas in the telescope.
+
+    Returns
+    -------
+    dict
+        A dict containing: baseline_array (pyuvdata baseline number of each
+        baseline-time; 1-d array of ints of length Nblts), unique_ant_0 and
+        unique_ant_1 (antennas of each unique baseline; 1-d arrays of ints of
+        length Nbls), bl_inverse (index into the unique baselines of each
+        baseline-time; 1-d array of ints of length Nblts), Nbls, Ntimes and
+        Nants_data (ints).
+    """
+    ant_0_array = np.asarray(ant_0_array, dtype=np.int64)
+    ant_1_array = np.asarray(ant_1_array, dtype=np.int64)
+    nants = max(int(Nants_telescope), int(ant_0_array.max(initial=0)) + 1,
+                int(ant_1_array.max(initial=0)) + 1)
+    pair_keys = ant_0_array * nants + ant_1_array
+    unique_keys, bl_inverse = np.unique(pair_keys, return_inverse=True)
+    bl_inverse = bl_inverse.reshape(-1)
+    unique_ant_0 = unique_keys // nants
+    unique_ant_1 = unique_keys % nants
+
+    # antennas with data, from the unique baselines without another sort
+    has_data = np.zeros(nants, dtype=bool)
+    has_data[unique_ant_0] = True
+    has_data[unique_ant_1] = True
+
+    unique_bls = uvutils.antnums_to_baseline(
+        unique_ant_0, unique_ant_1, Nants_telescope=Nants_telescope
+    )
+
+    return {
+        "baseline_array": np.asarray(unique_bls)[bl_inverse],
+        "unique_ant_0": unique_ant_0,
+        "unique_ant_1": unique_ant_1,
+        "bl_inverse": bl_inverse,
+        "Nbls": unique_keys.size,
+        "Ntimes": np.unique(time_array).size,
+        "Nants_data": int(np.count_nonzero(has_data)),
+    }
+
+
+def get_chunk_profile_path():
+    """
+    Get the path of the chunk shape profile.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str
+        The value of the `PAPER_GPU_CHUNK_PROFILE` environment variable if set,
+        otherwise `~/.config/paper_gpu/chunk_profile.json`.
+    """
+    return os.environ.get(CHUNK_PROFILE_ENV, DEFAULT_CHUNK_PROFILE)
+
+
+def save_chunk_profile(data_chunks, filename=None, **info):
+    """
+    Save the chunk shape to use for the data arrays of this deployment.
+
+    Parameters
+    ----------
+    data_chunks : tuple of int
+        The chunk shape, with -1 meaning the full axis.
+    filename : str, optional
+        The file to write. Default is `get_chunk_profile_path()`.
+    **info
+        Any other JSON-serializable information to save, e.g. benchmarks.
+
+    Returns
+    -------
+    None
+    """
+    if filename is None:
+        filename = get_chunk_profile_path()
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    profile = dict(info, data_chunks=[int(c) for c in data_chunks])
+    with open(filename, "w") as fh:
+        json.dump(profile, fh, indent=2)
+
+
+def load_chunk_profile(filename=None):
+    """
+    Load the chunk shape to use for the data arrays of this deployment.
+
+    Parameters
+    ----------
+    filename : str, optional
+        The file to read. Default is `get_chunk_profile_path()`.
+
+    Returns
+    -------
+    tuple of int
+        The saved chunk shape, or `DEFAULT_DATA_CHUNKS` if there is no profile.
+    """
+    if filename is None:
+        filename = get_chunk_profile_path()
+    if not os.path.exists(filename):
+        return DEFAULT_DATA_CHUNKS
+    with open(filename, "r") as fh:
+        profile = json.load(fh)
+    return tuple(profile["data_chunks"])
+
+
+def resolve_chunks(chunks, data_shape):
+    """
+    Turn a chunk shape specification into a valid chunk shape for a dataset.
+
+    Parameters
+    ----------
+    chunks : tuple of int
+        The requested chunk shape. Entries of -1 mean the full axis.
+    data_shape : tuple of int
+        The shape of the dataset.
+
+    Returns
+    -------
+    tuple of int
+        The chunk shape, with every entry between 1 and the axis length.
+
+    Raises
+    ------
+    ValueError
+        Raised if the chunk shape and data shape have different lengths.
+    """
+    if len(chunks) != len(data_shape):
+        raise ValueError(
+            f"chunk shape {chunks} does not match data shape {data_shape}"
+        )
+    return tuple(
+        max(1, int(n) if c == -1 else min(int(c), int(n)))
+        for c, n in zip(chunks, data_shape)
+    )
+
+
+def get_visdata_codec_kwargs(codec):
+    """
+    Get the create_dataset keywords for a visdata compression codec.
+
+    Parameters
+    ----------
+    codec : str
+        A key of `VISDATA_CODECS`.
+
+    Returns
+    -------
+    codec : str
+        The codec that will actually be used. This is "none" if the requested
+        codec needs hdf5plugin and it is not installed.
+    kwargs : dict
+        The compression keywords to pass to create_dataset.
+
+    Raises
+    ------
+    ValueError
+        Raised if the codec is not known.
+    """
+    if codec not in VISDATA_CODECS:
+        raise ValueError(
+            f"unknown codec {codec}; options are {list(VISDATA_CODECS.keys())}"
+        )
+    if codec not in BUILTIN_CODECS and not have_bitshuffle:
+        warnings.warn(no_bitshuffle_message)
+        return "none", {}
+    return codec, dict(VISDATA_CODECS[codec]())
+
+
+def _sample_starts(nblts, rows_per_sample, nsamples=4):
+    """Get the first rows of evenly spaced blocks of baseline-times."""
+    rows_per_sample = max(min(int(rows_per_sample), nblts), 1)
+    return np.unique(np.linspace(0, nblts - rows_per_sample, nsamples).astype(int))
+
+
+def sample_data_file(data_file, data_shape, rows_per_sample, nsamples=4):
+    """
+    Read a few evenly spaced blocks of baseline-times from a raw data file.
+
+    Parameters
+    ----------
     data_file : str
         The name of the data file written by the correlator.
-    chunksize : int, optional
-        The size of chunks to use when reading in data, in units of the number
-        of baseline-time elements. Default is -1, to read the whole file.
+    data_shape : tuple of int
+        The shape of the data in the file, (Nblts, Nfreqs, Npols).
+    rows_per_sample : int
+        The number of baseline-times in each block, e.g. the chunk length.
+    nsamples : int, optional
+        The number of blocks to read.
 
     Returns
     -------
-    metadata : dict
-        Metadata read from the meta hdf5 file
+    ndarray
+        The blocks concatenated along the baseline-time axis.
+    """
+    nblts, nfreq, nstokes = data_shape
+    rows_per_sample = max(min(int(rows_per_sample), nblts), 1)
+    starts = _sample_starts(nblts, rows_per_sample, nsamples)
+    blocks = [
+        read_data_file_chunk(
+            data_file, (rows_per_sample, nfreq, nstokes), int(start) * nfreq * nstokes
+        )
+        for start in starts
+    ]
+    return np.concatenate(blocks, axis=0)
+
+
+def benchmark_visdata_codecs(sample, data_chunks, candidates=None):
+    """
+    Measure compression throughput and ratio of visdata codecs on sample data.
+
+    Parameters
+    ----------
+    sample : ndarray
+        Visibilities of shape (N, Nfreqs, Npols), e.g. from `sample_data_file`.
+    data_chunks : tuple of int
+        The chunk shape to use; -1 means the full axis.
+    candidates : list of str, optional
+        The codecs to test. Default is every codec available.
+
+    Returns
+    -------
+    dict
+        Keys are codec names, values are dicts with MBps (compression
+        throughput in MB of raw data per second) and ratio (compression ratio).
+    """
+    if candidates is None:
+        candidates = [
+            c for c in VISDATA_CODECS if have_bitshuffle or c in BUILTIN_CODECS
+        ]
+    data_chunks = resolve_chunks(data_chunks, sample.shape)
+    results = {}
+    for codec in candidates:
+        codec, kwargs = get_visdata_codec_kwargs(codec)
+        # write to an in-memory file so only compression is timed
+        with h5py.File(f"{codec}.h5", "w", driver="core", backing_store=False) as h5f:
+            t0 = time.perf_counter()
+            dset = h5f.create_dataset(
+                "visdata", data=sample, chunks=data_chunks, dtype=_hera_corr_dtype, **kwargs
+            )
+            h5f.flush()
+            elapsed = time.perf_counter() - t0
+            stored_bytes = dset.id.get_storage_size()
+        results[codec] = {
+            "MBps": sample.nbytes / max(elapsed, 1e-9) / 1e6,
+            "ratio": sample.nbytes / max(stored_bytes, 1),
+        }
+    return results
+
+
+def select_visdata_codec(sample, data_chunks, candidates=None,
+                         min_MBps=DEFAULT_CODEC_MIN_MBPS):
+    """
+    Choose the visdata codec with the best ratio that is fast enough.
+
+    Parameters
+    ----------
+    sample : ndarray
+        Visibilities of shape (N, Nfreqs, Npols), e.g. from `sample_data_file`.
+    data_chunks : tuple of int
+        The chunk shape to use; -1 means the full axis.
+    candidates : list of str, optional
+        The codecs to consider. Default is `AUTO_CODECS`, if hdf5plugin is
+        installed.
+    min_MBps : float, optional
+        The throughput floor, in MB of raw data per second.
+
+    Returns
+    -------
+    codec : str
+        The chosen codec. If no codec reaches the floor, or there are no
+        candidates, `DEFAULT_VISDATA_CODEC`.
+    results : dict
+        The benchmark results, see `benchmark_visdata_codecs`.
+    """
+    if candidates is None:
+        candidates = AUTO_CODECS if have_bitshuffle else []
+    results = benchmark_visdata_codecs(sample, data_chunks, candidates=candidates)
+    fast_enough = [c for c, res in results.items() if res["MBps"] >= min_MBps]
+    if len(fast_enough) > 0:
+        codec = max(fast_enough, key=lambda c: results[c]["ratio"])
+    else:
+        codec = DEFAULT_VISDATA_CODEC
+    return codec, results
+
+
+def get_visdata_shifts(data, block):
+    """
+    Find the common power-of-two factor of each block of baseline-times.
+
+    Correlator outputs are integer multiples of a large power of two, so the
+    low bits of every value are zero. The shift of a block is the number of
+    trailing zero bits shared by all real and imaginary parts in it.
+
+    Parameters
+    ----------
+    data : ndarray
+        Compound numpy datatype with a "r" field and "i" field, of shape
+        (N, Nfreqs, Npols).
+    block : int
+        The number of baseline-times in each block.
+
+    Returns
+    -------
+    ndarray of uint8
+        The shift of each block, of length ceil(N / block). Blocks that are
+        all zero have a shift of 0.
+    """
+    nrows = data.shape[0]
+    if nrows == 0:
+        return np.zeros(0, dtype=np.uint8)
+    ints = np.ascontiguousarray(data).view(np.int32).reshape(nrows, -1)
+    row_or = np.bitwise_or.reduce(ints, axis=1)
+    block_or = np.bitwise_or.reduceat(row_or, np.arange(0, nrows, block))
+    # isolate the lowest set bit; it is a power of two, so log2 is exact
+    block_or = block_or.astype(np.int64) & 0xFFFFFFFF
+    low_bit = block_or & -block_or
+    shifts = np.zeros(block_or.shape, dtype=np.uint8)
+    nonzero = low_bit > 0
+    shifts[nonzero] = np.log2(low_bit[nonzero]).astype(np.uint8)
+    return shifts
+
+
+def _row_shifts(shifts, block, idx0, idx1):
+    """Expand per-block shifts to the rows idx0:idx1, for broadcasting."""
+    rows = np.arange(idx0, idx1) // block
+    return shifts[rows].astype(np.int32)[:, None, None]
+
+
+def strip_visdata_shift(data, shifts, block, idx0=0):
+    """
+    Divide each block of baseline-times by its power-of-two factor.
+
+    Parameters
+    ----------
+    data : ndarray
+        Compound numpy datatype with a "r" field and "i" field, of shape
+        (N, Nfreqs, Npols), starting at baseline-time `idx0`.
+    shifts : ndarray of uint8
+        The shift of each block, from `get_visdata_shifts`.
+    block : int
+        The number of baseline-times in each block.
+    idx0 : int, optional
+        The baseline-time of the first row of `data`.
+
+    Returns
+    -------
+    ndarray
+        The shifted data. The input is not modified.
+    """
+    row_shifts = _row_shifts(shifts, block, idx0, idx0 + data.shape[0])
+    out = np.empty_like(data)
+    out["r"] = data["r"] >> row_shifts
+    out["i"] = data["i"] >> row_shifts
+    return out
+
+
+def restore_visdata_shift(data, shifts, block, idx0=0):
+    """
+    Undo `strip_visdata_shift`, in place.
+
+    Parameters
+    ----------
+    data : ndarray
+        Shifted visibilities of shape (N, Nfreqs, Npols), starting at
+        baseline-time `idx0`.
+    shifts : ndarray of uint8
+        The shift of each block.
+    block : int
+        The number of baseline-times in each block.
+    idx0 : int, optional
+        The baseline-time of the first row of `data`.
+
+    Returns
+    -------
+    ndarray
+        `data`, multiplied back up by the power-of-two factors.
+    """
+    row_shifts = _row_shifts(shifts, block, idx0, idx0 + data.shape[0])
+    data["r"] <<= row_shifts
+    data["i"] <<= row_shifts
+    return data
+
+
+def read_visdata(filename, idx0=0, idx1=None):
+    """
+    Read visdata from a UVH5 file, undoing any power-of-two shift.
+
+    Files written with `make_uvh5_file(..., strip_shift=True)` hold the
+    visdata divided by a power of two per block of baseline-times, with the
+    shifts stored as attributes of the visdata dataset. Use this function
+    rather than reading the dataset directly to get the original values;
+    files without shifts are returned unchanged.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the UVH5 file.
+    idx0 : int, optional
+        The first baseline-time to read.
+    idx1 : int, optional
+        One past the last baseline-time to read. Default is Nblts.
+
+    Returns
+    -------
+    ndarray
+        Compound numpy datatype with a "r" field and "i" field, of shape
+        (idx1 - idx0, Nfreqs, Npols).
+    """
+    with h5py.File(filename, "r") as h5f:
+        return _read_visdata_range(h5f["Data"]["visdata"], idx0, idx1)
+
+
+def _read_visdata_range(visdata, idx0=0, idx1=None):
+    """Read rows of an open visdata dataset, undoing any power-of-two shift."""
+    if idx1 is None:
+        idx1 = visdata.shape[0]
+    data = visdata[idx0:idx1]
+    if VISDATA_SHIFT_ATTR in visdata.attrs:
+        shifts = visdata.attrs[VISDATA_SHIFT_ATTR]
+        block = int(visdata.attrs[VISDATA_SHIFT_BLOCK_ATTR])
+        restore_visdata_shift(data, shifts, block, idx0)
+    return data
+
+
+def get_uvh5_header(metadata_file, cminfo=None, antpos_info=None, rd=None):
+    """
+    Read a metadata file and compute the header products of a UVH5 file.
+
+    The sum and diff files of an observation share a metadata file, so the
+    header computed here can be used to write both.
+
+    Parameters
+    ----------
+    metadata_file : str
+        The name of the metadata file written by the correlator.
+    cminfo : dict, optional
+        The configuration management info. Default is to read it from redis.
+    antpos_info : tuple, optional
+        The antenna positions and names, as returned by `get_antpos_info`.
+        Default is to read them from M&C.
+    rd : redis.Redis, optional
+        The redis connection to read the F-engine parameters from. Default is
+        to connect to redishost.
+
+    Returns
+    -------
+    header : dict
+        The metadata read from the file (see `read_header_data`), plus:
+        metadata (the dict returned by `read_header_data` itself), cminfo,
+        ant_names, ant_nums, antpos_xyz, antenna_diameters, blt_info (see
+        `get_blt_info`), uvw_array, freqs and channel_width.
     """
     # get cminfo from redis
-    cminfo = redis_cm.read_cminfo_from_redis(return_as="dict")
+    if cminfo is None:
+        cminfo = redis_cm.read_cminfo_from_redis(return_as="dict")
 
     # get antennas positions and names from mc
-    antpos_xyz, ant_names = get_antpos_info()
+    if antpos_info is None:
+        antpos_info = get_antpos_info()
+    antpos_xyz, ant_names = antpos_info
+    antpos_xyz = np.array(antpos_xyz, dtype=np.float64)
     Nants_telescope = len(ant_names)
 
     # read in metadata
     metadata = read_header_data(metadata_file)
-    t0 = metadata["t0"]
-    mcnt = metadata["mcnt"]
-    nfreq = metadata["nfreq"]
-    nstokes = metadata["nstokes"]
-    corr_ver = metadata["corr_ver"]
-    tag = metadata["tag"]
     ant_0_array = metadata["ant_0_array"]
     ant_1_array = metadata["ant_1_array"]
     time_array = metadata["time_array"]
@@ -255,10 +944,7 @@ def make_uvh5_file(filename, metadata_file, data_file, chunksize=-1):
         )
 
     # compute other necessary metadata
-    baseline_array = uvutils.antnums_to_baseline(
-        ant_0_array, ant_1_array, Nants_telescope=Nants_telescope
-    )
-    nbls = len(np.unique(baseline_array))
+    blt_info = get_blt_info(ant_0_array, ant_1_array, time_array, Nants_telescope)
     ant_nums = np.asarray([int(name[2:]) for name in ant_names])
     antenna_diameters = 14.0 * np.ones((len(ant_names),), dtype=np.float64)
     cofa_lat_rad = cminfo["cofa_lat"] * np.pi / 180.0
@@ -266,20 +952,24 @@ def make_uvh5_file(filename, metadata_file, data_file, chunksize=-1):
     altitude = cminfo["cofa_alt"]
     cofa_xyz = uvutils.XYZ_from_LatLonAlt(cofa_lat_rad, cofa_lon_rad, altitude)
     antpos_xyz -= cofa_xyz
-    # the uvw calculation will have to change when we turn fringe stopping on
-    uvw_array = uvutils.phasing.calc_uvw(
+    # the uvw calculation will have to change when we turn fringe stopping on;
+    # until then uvws only depend on the antenna pair, so compute them once per
+    # baseline and broadcast back to baseline-times
+    uvw_unique = uvutils.phasing.calc_uvw(
         use_ant_pos=True,
         antenna_positions=antpos_xyz,
         antenna_numbers=ant_nums,
-        ant_1_array=ant_0_array,
-        ant_2_array=ant_1_array,
+        ant_1_array=blt_info["unique_ant_0"],
+        ant_2_array=blt_info["unique_ant_1"],
         telescope_lat=cofa_lat_rad,
         telescope_lon=cofa_lon_rad,
         to_enu=True,
     )
+    uvw_array = uvw_unique[blt_info["bl_inverse"]]
 
     # build frequency information from redis
-    rd = redis.Redis("redishost", decode_responses=True)
+    if rd is None:
+        rd = redis.Redis("redishost", decode_responses=True)
     sample_freq = float(rd["feng:sample_freq"])
     nchans_f = int(rd["feng:samples_per_mcnt"]) // 2
     bandwidth = sample_freq / 2.0
@@ -292,167 +982,788 @@ def make_uvh5_file(filename, metadata_file, data_file, chunksize=-1):
     freqs = freqs.reshape(nchans, nchan_sum).sum(axis=1) / nchan_sum
     channel_width = channel_width * np.ones_like(freqs)  # need an array
 
-    # define the size of the data array
-    data_shape = (nblts, nfreq, nstokes)
-
-    if chunksize == -1:
-        # read in all raw data
-        data = read_data_file(data_file, data_shape)
-
-    # save in UVH5 file
-    with h5py.File(filename, "w") as h5f:
-        # make datagroups
-        header_dgrp = h5f.create_group("Header")
-        eq_dgrp = header_dgrp.create_group("extra_keywords")
-        data_dgrp = h5f.create_group("Data")
-
-        # write header info
-        # telescope + phasing info
-        header_dgrp["latitude"] = cminfo["cofa_lat"]
-        header_dgrp["longitude"] = cminfo["cofa_lon"]
-        header_dgrp["altitude"] = cminfo["cofa_alt"]
-        header_dgrp["telescope_name"] = np.bytes_("HERA")
-        header_dgrp["instrument"] = np.bytes_("HERA")
-        header_dgrp["object_name"] = np.bytes_("zenith")
-        header_dgrp["phase_type"] = np.bytes_("drift")
-
-        # required UVParameters
-        header_dgrp["Nants_data"] = len(np.unique(ant_0_array))
-        header_dgrp["Nants_telescope"] = len(ant_names)
-        header_dgrp["Nbls"] = nbls
-        header_dgrp["Nblts"] = nblts
-        header_dgrp["Nfreqs"] = nfreq
-        header_dgrp["Npols"] = nstokes
-        header_dgrp["Nspws"] = 1  # might change when doing polarization transpose
-        header_dgrp["Ntimes"] = len(np.unique(time_array))
-        header_dgrp["antenna_numbers"] = ant_nums
-        header_dgrp["uvw_array"] = uvw_array
-        header_dgrp["vis_units"] = np.bytes_("uncalib")
-        header_dgrp["channel_width"] = channel_width
-        header_dgrp["time_array"] = time_array
-        header_dgrp["freq_array"] = freqs
-        header_dgrp["integration_time"] = integration_time
-        header_dgrp["polarization_array"] = np.asarray([-5, -6, -7, -8])
-        header_dgrp["spw_array"] = np.asarray([0])
-        header_dgrp["ant_1_array"] = ant_0_array
-        header_dgrp["ant_2_array"] = ant_1_array
-        header_dgrp["antenna_positions"] = antpos_xyz
-        header_dgrp["flex_spw"] = False  # might change with polarization transpose
-        header_dgrp["multi_phase_center"] = False  # will change with fringe stopping
-        header_dgrp["antenna_names"] = np.asarray(ant_names, dtype="bytes")
-        header_dgrp["history"] = np.bytes_(
-            "Written by the HERA Correlator on " + time.ctime() + "."
-        )
+    header = dict(metadata)
+    header.update(
+        metadata=metadata,
+        cminfo=cminfo,
+        ant_names=ant_names,
+        ant_nums=ant_nums,
+        antpos_xyz=antpos_xyz,
+        antenna_diameters=antenna_diameters,
+        blt_info=blt_info,
+        uvw_array=uvw_array,
+        freqs=freqs,
+        channel_width=channel_width,
+    )
+    return header
+
+
+def _write_uvh5_header(h5f, header):
+    """Write the Header group of a UVH5 file; returns the extra_keywords group."""
+    cminfo = header["cminfo"]
+    blt_info = header["blt_info"]
+
+    header_dgrp = h5f.create_group("Header")
+    eq_dgrp = header_dgrp.create_group("extra_keywords")
+
+    # write header info
+    # telescope + phasing info
+    header_dgrp["latitude"] = cminfo["cofa_lat"]
+    header_dgrp["longitude"] = cminfo["cofa_lon"]
+    header_dgrp["altitude"] = cminfo["cofa_alt"]
+    header_dgrp["telescope_name"] = np.bytes_("HERA")
+    header_dgrp["instrument"] = np.bytes_("HERA")
+    header_dgrp["object_name"] = np.bytes_("zenith")
+    header_dgrp["phase_type"] = np.bytes_("drift")
+
+    # required UVParameters
+    header_dgrp["Nants_data"] = blt_info["Nants_data"]
+    header_dgrp["Nants_telescope"] = len(header["ant_names"])
+    header_dgrp["Nbls"] = blt_info["Nbls"]
+    header_dgrp["Nblts"] = header["ant_0_array"].shape[0]
+    header_dgrp["Nfreqs"] = header["nfreq"]
+    header_dgrp["Npols"] = header["nstokes"]
+    header_dgrp["Nspws"] = 1  # might change when doing polarization transpose
+    header_dgrp["Ntimes"] = blt_info["Ntimes"]
+    header_dgrp["antenna_numbers"] = header["ant_nums"]
+    header_dgrp["uvw_array"] = header["uvw_array"]
+    header_dgrp["vis_units"] = np.bytes_("uncalib")
+    header_dgrp["channel_width"] = header["channel_width"]
+    header_dgrp["time_array"] = header["time_array"]
+    header_dgrp["freq_array"] = header["freqs"]
+    header_dgrp["integration_time"] = header["integration_time"]
+    header_dgrp["polarization_array"] = np.asarray([-5, -6, -7, -8])
+    header_dgrp["spw_array"] = np.asarray([0])
+    header_dgrp["ant_1_array"] = header["ant_0_array"]
+    header_dgrp["ant_2_array"] = header["ant_1_array"]
+    header_dgrp["antenna_positions"] = header["antpos_xyz"]
+    header_dgrp["flex_spw"] = False  # might change with polarization transpose
+    header_dgrp["multi_phase_center"] = False  # will change with fringe stopping
+    header_dgrp["antenna_names"] = np.asarray(header["ant_names"], dtype="bytes")
+    header_dgrp["history"] = np.bytes_(
+        "Written by the HERA Correlator on " + time.ctime() + "."
+    )
+
+    # optional parameters
+    header_dgrp["x_orientation"] = np.bytes_("north")
+    header_dgrp["antenna_diameters"] = header["antenna_diameters"]
+
+    # extra keywords
+    eq_dgrp["t0"] = header["t0"]
+    eq_dgrp["mcnt"] = header["mcnt"]
+    eq_dgrp["corr_ver"] = np.bytes_(header["corr_ver"])
+    eq_dgrp["tag"] = np.bytes_(header["tag"])
 
-        # optional parameters
-        header_dgrp["x_orientation"] = np.bytes_("north")
-        header_dgrp["antenna_diameters"] = antenna_diameters
+    return eq_dgrp
+
+
+class _UVH5Writer(object):
+    """
+    Write one UVH5 file from a raw data file, one block of baseline-times at
+    a time.
 
-        # extra keywords
-        eq_dgrp["t0"] = t0
-        eq_dgrp["mcnt"] = mcnt
-        eq_dgrp["corr_ver"] = np.bytes_(corr_ver)
-        eq_dgrp["tag"] = np.bytes_(tag)
+    The output file is open from construction until `close`. See
+    `make_uvh5_file` for the parameters.
+    """
 
-        # write data
-        data_chunks = (128, nfreq, 1)  # assuming Nfreq = 1536, chunks are ~1 MB in size
-        compression_filter = 32008  # bitshuffle filter number
-        block_size = 0  # let bitshuffle decide
-        compression_opts = (block_size, 2)  # use LZ4 compression after bitshuffle
+    def __init__(self, filename, header, data_file, chunksize=-1, data_chunks=None,
+                 codec=DEFAULT_VISDATA_CODEC, codec_min_MBps=DEFAULT_CODEC_MIN_MBPS,
+                 strip_shift=False, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+                 resume=False):
+        self.filename = filename
+        self.data_file = data_file
+        self.data_shape = (header["ant_0_array"].shape[0], header["nfreq"], header["nstokes"])
+        nblts = self.data_shape[0]
+        if data_chunks is None:
+            data_chunks = load_chunk_profile()
+        data_chunks = resolve_chunks(data_chunks, self.data_shape)
 
+        self.data = None
         if chunksize == -1:
-            if have_bitshuffle:
-                visdata_dset = data_dgrp.create_dataset(
-                    "visdata",
-                    chunks=data_chunks,
-                    data=data,
-                    compression=compression_filter,
-                    compression_opts=compression_opts,
-                    dtype=_hera_corr_dtype,
-                )
+            # read in all raw data
+            self.data = read_data_file(data_file, self.data_shape)
+            chunksize = max(nblts, 1)
+        self.chunksize = chunksize
+        self.strip_shift = strip_shift
+        # one shift per HDF5 chunk when the whole file is in memory,
+        # otherwise one per read chunk
+        self.shift_block = data_chunks[0] if self.data is not None else chunksize
+        self.shifts = []
+        # checkpoints are only useful when reading in chunks
+        self.checkpoint_interval = checkpoint_interval if self.data is None else 0
+        self.visdata_crc32 = 0
+        self.next_idx = 0
+        self.metadata = header["metadata"]
+
+        if resume and self.checkpoint_interval > 0 and self._resume():
+            return
+
+        if codec == "auto":
+            if self.data is not None:
+                starts = _sample_starts(nblts, data_chunks[0])
+                sample = np.concatenate([self.data[i:i + data_chunks[0]] for i in starts])
             else:
-                warnings.warn(no_bitshuffle_message)
-                visdata_dset = data_dgrp.create_dataset(
-                    "visdata",
-                    chunks=data_chunks,
-                    data=data,
-                    dtype=_hera_corr_dtype,
-                )
+                sample = sample_data_file(data_file, self.data_shape, data_chunks[0])
+            if strip_shift:
+                sample_shifts = get_visdata_shifts(sample, data_chunks[0])
+                sample = strip_visdata_shift(sample, sample_shifts, data_chunks[0])
+            codec, _ = select_visdata_codec(sample, data_chunks, min_MBps=codec_min_MBps)
+        codec, codec_kwargs = get_visdata_codec_kwargs(codec)
+
+        # save in UVH5 file
+        self.h5f = h5py.File(filename, "w")
+        self.eq_dgrp = _write_uvh5_header(self.h5f, header)
+        self.eq_dgrp[CODEC_KEY] = np.bytes_(codec)
+        data_dgrp = self.h5f.create_group("Data")
+        self.visdata_dset = data_dgrp.create_dataset(
+            "visdata",
+            self.data_shape,
+            chunks=data_chunks,
+            dtype=_hera_corr_dtype,
+            **codec_kwargs,
+        )
+        # also create flags and nsamples
+        self.flags_dset = data_dgrp.create_dataset(
+            "flags",
+            self.data_shape,
+            chunks=data_chunks,
+            dtype="b1",
+            compression="lzf",
+        )
+        self.nsamples_dset = data_dgrp.create_dataset(
+            "nsamples",
+            self.data_shape,
+            chunks=data_chunks,
+            dtype=np.float32,
+            compression="lzf",
+        )
 
-            # also write flags and nsamples
-            flags = np.zeros_like(data, dtype=np.bool_)
-            flags_dset = data_dgrp.create_dataset(
-                "flags",
-                chunks=data_chunks,
-                data=flags,
-                dtype="b1",
-                compression="lzf",
+    def _resume(self):
+        """
+        Reopen a partly written output file at its last checkpoint.
+
+        The visdata written before the checkpoint are read back and checked
+        against the checkpoint checksum, so a file damaged when its writer
+        died is not resumed.
+
+        Returns
+        -------
+        bool
+            True if the file was reopened, False if it must be written anew.
+        """
+        if not os.path.exists(self.filename):
+            return False
+        try:
+            h5f = h5py.File(self.filename, "r+")
+        except OSError:
+            return False
+        try:
+            visdata = h5f["Data"]["visdata"]
+            attrs = visdata.attrs
+            valid = (
+                CHECKPOINT_ATTR in attrs
+                and visdata.shape == self.data_shape
+                and (VISDATA_SHIFT_ATTR in attrs) == self.strip_shift
+                and int(attrs.get(VISDATA_SHIFT_BLOCK_ATTR, self.shift_block))
+                == self.shift_block
             )
-            nsamples = np.ones_like(data, dtype=np.float32)
-            nsamples_dset = data_dgrp.create_dataset(
-                "nsamples",
-                chunks=data_chunks,
-                data=nsamples,
-                dtype=np.float32,
-                compression="lzf",
+            if valid:
+                next_idx = int(attrs[CHECKPOINT_ATTR])
+                crc, _ = _dataset_range_crc32(visdata, 0, next_idx)
+                valid = crc == int(attrs[CHECKPOINT_CRC_ATTR])
+        except Exception:
+            valid = False
+        if not valid:
+            h5f.close()
+            return False
+
+        self.h5f = h5f
+        self.eq_dgrp = h5f["Header"]["extra_keywords"]
+        self.visdata_dset = visdata
+        self.flags_dset = h5f["Data"]["flags"]
+        self.nsamples_dset = h5f["Data"]["nsamples"]
+        self.next_idx = next_idx
+        self.visdata_crc32 = int(attrs[CHECKPOINT_CRC_ATTR])
+        if self.strip_shift:
+            self.shifts = [np.asarray(attrs[VISDATA_SHIFT_ATTR], dtype=np.uint8)]
+        return True
+
+    def _write_shifts(self):
+        """Store the shifts of the blocks written so far."""
+        self.visdata_dset.attrs[VISDATA_SHIFT_ATTR] = np.concatenate(
+            self.shifts + [np.zeros(0, dtype=np.uint8)]
+        )
+        self.visdata_dset.attrs[VISDATA_SHIFT_BLOCK_ATTR] = self.shift_block
+
+    def checkpoint(self):
+        """Record how far the conversion has got, and flush the file to disk."""
+        if self.strip_shift:
+            self._write_shifts()
+        self.visdata_dset.attrs[CHECKPOINT_CRC_ATTR] = np.uint32(self.visdata_crc32)
+        self.visdata_dset.attrs[CHECKPOINT_ATTR] = self.next_idx
+        self.h5f.flush()
+
+    def write_next(self):
+        """
+        Read and write the next block of baseline-times, checksumming as we go.
+
+        Returns
+        -------
+        bool
+            True if a block was written, False if the file is complete.
+        """
+        nblts, nfreq, nstokes = self.data_shape
+        idx0 = self.next_idx
+        if idx0 >= nblts:
+            return False
+        idx1 = min(idx0 + self.chunksize, nblts)
+        if self.data is not None:
+            data = self.data[idx0:idx1]
+        else:
+            offset = int(idx0) * int(nfreq) * int(nstokes)
+            data = read_data_file_chunk(self.data_file, (idx1 - idx0, nfreq, nstokes), offset)
+        self.visdata_crc32 = zlib.crc32(data, self.visdata_crc32)
+        if self.strip_shift:
+            # shift blocks start at idx0: either the whole file is one read, or
+            # each read is one shift block
+            block_shifts = get_visdata_shifts(data, self.shift_block)
+            self.shifts.append(block_shifts)
+            self.visdata_dset[idx0:idx1] = strip_visdata_shift(
+                data, block_shifts, self.shift_block
             )
         else:
-            # create datasets
-            if have_bitshuffle:
-                visdata_dset = data_dgrp.create_dataset(
-                    "visdata",
-                    data_shape,
-                    chunks=data_chunks,
-                    compression=compression_filter,
-                    compression_opts=compression_opts,
-                    dtype=_hera_corr_dtype,
-                )
-            else:
-                warnings.warn(no_bitshuffle_message)
-                visdata_dset = data_grp.create_dataset(
-                    "visdata",
-                    data_shape,
-                    chunks=data_chunks,
-                    dtype=_hera_corr_dtype,
-                )
+            self.visdata_dset[idx0:idx1] = data
 
-            # also create flags and nsamples
-            flags_dset = data_dgrp.create_dataset(
-                "flags",
-                data_shape,
-                chunks=data_chunks,
-                dtype="b1",
-                compression="lzf",
-            )
-            nsamples_dset = data_dgrp.create_dataset(
-                "nsamples",
-                data_shape,
-                chunks=data_chunks,
-                dtype=np.float32,
-                compression="lzf",
-            )
+        # also fill in flags and nsamples
+        self.flags_dset[idx0:idx1] = np.zeros(data.shape, dtype=np.bool_)
+        self.nsamples_dset[idx0:idx1] = np.ones(data.shape, dtype=np.float32)
+
+        self.next_idx = idx1
+        nblocks = idx1 // self.chunksize
+        if self.checkpoint_interval > 0 and nblocks % self.checkpoint_interval == 0:
+            self.checkpoint()
+        return True
 
-            # now read the data in chunks
-            nchunks = nblts // chunksize + 1
-            for i in range(nchunks):
-                idx0 = i * chunksize
-                idx1 = min((i + 1) * chunksize, nblts)
-                chunk_shape = (idx1 - idx0, nfreq, nstokes)
-                offset = int(idx0) * int(nfreq) * int(nstokes)
+    def close(self):
+        """
+        Record the checksum and shifts, and close the file.
 
-                data = read_data_file_chunk(data_file, chunk_shape, offset)
-                visdata_dset[idx0:idx1, :, :] = data
+        The checksum is only recorded if every block has been written, so an
+        incomplete file never verifies; its last checkpoint is kept so the
+        conversion can be resumed.
 
-                # also fill in flags and nsamples
-                flags = np.zeros_like(data, dtype=np.bool_)
-                flags_dset[idx0:idx1, :, :] = flags
+        Returns
+        -------
+        metadata : dict
+            Metadata read from the meta hdf5 file, plus the `visdata_crc32`
+            checksum of the raw data.
+        """
+        if self.next_idx >= self.data_shape[0]:
+            if self.strip_shift:
+                self._write_shifts()
+            for key in (CHECKPOINT_ATTR, CHECKPOINT_CRC_ATTR):
+                if key in self.visdata_dset.attrs:
+                    del self.visdata_dset.attrs[key]
+            self.eq_dgrp[CHECKSUM_KEY] = np.uint32(self.visdata_crc32)
+        elif self.checkpoint_interval > 0:
+            self.checkpoint()
+        self.h5f.close()
 
-                nsamples = np.ones_like(data, dtype=np.float32)
-                nsamples_dset[idx0:idx1, :, :] = nsamples
+        metadata = dict(self.metadata)
+        metadata[CHECKSUM_KEY] = self.visdata_crc32
+        return metadata
+
+
+def make_uvh5_file(filename, metadata_file, data_file, chunksize=-1, data_chunks=None,
+                   codec=DEFAULT_VISDATA_CODEC, codec_min_MBps=DEFAULT_CODEC_MIN_MBPS,
+                   strip_shift=False, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+                   resume=False, header=None):
+    """
+    Make a UVH5 file from a metdata + raw binary data file.
+
+    This function creates a valid UVH5 file from the specified metadata and
+    binary data files. It adds the flags and nsample datasets, and compresses
+    the data (with bitshuffle + LZ4 by default). A CRC-32 of the raw visdata
+    is computed as the data are read and stored in the `visdata_crc32` extra
+    keyword, so the output can later be checked with `verify_visdata_checksum`.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the output file to write.
+    metadata_file : str
+        The name of the metadata file written by the correlator.
+    data_file : str
+        The name of the data file written by the correlator.
+    chunksize : int, optional
+        The size of chunks to use when reading in data, in units of the number
+        of baseline-time elements. Default is -1, to read the whole file.
+    data_chunks : tuple of int, optional
+        The HDF5 chunk shape of the data arrays, with -1 meaning the full
+        axis. Default is the profile saved by `save_chunk_profile` if there is
+        one, otherwise `DEFAULT_DATA_CHUNKS`.
+    codec : str, optional
+        The compression codec for visdata, a key of `VISDATA_CODECS`, or
+        "auto" to benchmark `AUTO_CODECS` on a few chunks of this file and use
+        the best ratio that reaches `codec_min_MBps`, or
+        `DEFAULT_VISDATA_CODEC` if none does. The codec used is recorded in
+        the `visdata_codec` extra keyword.
+    codec_min_MBps : float, optional
+        The throughput floor used when `codec` is "auto", in MB/s.
+    strip_shift : bool, optional
+        If True, divide each block of baseline-times of visdata by the
+        largest power of two common to all its values before compressing.
+        This is lossless, and the shifts are stored as attributes of the
+        visdata dataset, but the file must then be read with `read_visdata`
+        to recover the original values; generic UVH5 readers will see
+        rescaled data.
+    checkpoint_interval : int, optional
+        When reading in chunks, record the number of baseline-times written
+        every this many chunks, and flush the file. 0 disables checkpoints.
+    resume : bool, optional
+        If True and `filename` is a partly written file with a checkpoint
+        (see `get_checkpoint`), check the data written so far and continue
+        from the checkpoint. Otherwise the file is written from the start.
+    header : dict, optional
+        The header computed by `get_uvh5_header` for `metadata_file`, if it
+        is already known. Default is to compute it.
+
+    Returns
+    -------
+    metadata : dict
+        Metadata read from the meta hdf5 file, plus the `visdata_crc32`
+        checksum of the raw data.
+    """
+    if header is None:
+        header = get_uvh5_header(metadata_file)
+    writer = _UVH5Writer(
+        filename, header, data_file, chunksize=chunksize, data_chunks=data_chunks,
+        codec=codec, codec_min_MBps=codec_min_MBps, strip_shift=strip_shift,
+        checkpoint_interval=checkpoint_interval, resume=resume,
+    )
+    try:
+        while writer.write_next():
+            pass
+    finally:
+        metadata = writer.close()
 
     # we're done!
     return metadata
 
+
+def make_uvh5_file_pair(filenames, metadata_file, data_files, chunksize=-1,
+                        data_chunks=None, codec=DEFAULT_VISDATA_CODEC,
+                        codec_min_MBps=DEFAULT_CODEC_MIN_MBPS, strip_shift=False,
+                        checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, resume=False):
+    """
+    Make the sum and diff UVH5 files of an observation together.
+
+    The sum and diff data files share a metadata file, so the header (antenna
+    positions, uvws, frequencies, ...) is computed once. Both output files
+    are then open at once, and blocks of the two data files are converted in
+    turn. The files succeed or fail independently: an error in one, like a
+    truncated data file, does not stop the other being written.
+
+    Parameters
+    ----------
+    filenames : tuple of str
+        The names of the output files to write.
+    metadata_file : str
+        The name of the metadata file shared by the data files.
+    data_files : tuple of str
+        The names of the data files written by the correlator, in the same
+        order as `filenames`.
+    chunksize, data_chunks, codec, codec_min_MBps, strip_shift : optional
+        See `make_uvh5_file`. The codec is chosen separately for each file
+        when `codec` is "auto".
+    checkpoint_interval, resume : optional
+        See `make_uvh5_file`. Each file is checkpointed and resumed
+        separately.
+
+    Returns
+    -------
+    list of dict or Exception
+        For each output file, its metadata (see `make_uvh5_file`) if it was
+        written, or the exception that stopped it.
+    """
+    if len(filenames) != len(data_files):
+        raise ValueError(
+            f"got {len(filenames)} output files for {len(data_files)} data files"
+        )
+    header = get_uvh5_header(metadata_file)
+    results = [None] * len(filenames)
+    writers = {}
+    try:
+        for i, (filename, data_file) in enumerate(zip(filenames, data_files)):
+            try:
+                writers[i] = _UVH5Writer(
+                    filename, header, data_file, chunksize=chunksize,
+                    data_chunks=data_chunks, codec=codec,
+                    codec_min_MBps=codec_min_MBps, strip_shift=strip_shift,
+                    checkpoint_interval=checkpoint_interval, resume=resume,
+                )
+            except Exception as e:
+                results[i] = e
+        active = list(writers)
+        while len(active) > 0:
+            still_active = []
+            for i in active:
+                try:
+                    if writers[i].write_next():
+                        still_active.append(i)
+                except Exception as e:
+                    results[i] = e
+            active = still_active
+    finally:
+        for i, writer in writers.items():
+            try:
+                metadata = writer.close()
+            except Exception as e:
+                metadata = e
+            if results[i] is None:
+                results[i] = metadata
+
+    return results
+
+
+def _antenna_names(names):
+    """Get antenna names as str, whether they are stored as bytes or str."""
+    return [name.decode("utf-8") if isinstance(name, bytes) else str(name) for name in names]
+
+
+class UVH5Aggregator(object):
+    """
+    Append consecutive correlator files into one growing UVH5 file.
+
+    The data arrays and the baseline-time header arrays are resizable, and
+    are extended as each file is appended. Files can be appended while they
+    have the same integer JD, tag, frequency and polarization axes and
+    antennas as the first file, and the aggregate spans at most `span`
+    seconds. Until `finalize` is called the file is incomplete: it has no
+    visdata checksum, and a checkpoint (see `get_checkpoint`) records how
+    many baseline-times, and which files, it holds. An incomplete file left
+    by a dead process is reopened and checked if an aggregator is created
+    for it again; a file that was being appended when the process died is
+    truncated back to its checkpoint, and is not in `files`.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the output file.
+    span : float, optional
+        The longest time, in seconds, from the first to the last time in
+        the file.
+    data_chunks : tuple of int, optional
+        The HDF5 chunk shape of the data arrays; see `make_uvh5_file`. A
+        full baseline-time axis (-1) is not allowed, since that axis grows.
+    codec : str, optional
+        The compression codec for visdata, a key of `VISDATA_CODECS`.
+    """
+
+    def __init__(self, filename, span=DEFAULT_AGGREGATE_SPAN, data_chunks=None,
+                 codec=DEFAULT_VISDATA_CODEC):
+        self.filename = filename
+        self.span = span
+        if data_chunks is None:
+            data_chunks = load_chunk_profile()
+        if data_chunks[0] == -1:
+            raise ValueError("the baseline-time chunk length of an aggregate must be set")
+        self.data_chunks = tuple(data_chunks)
+        self.codec = codec
+        self.h5f = None
+        self.header = None
+        self.files = []
+        self.visdata_crc32 = 0
+        self._file_ends = []
+        if get_checkpoint(filename) is not None:
+            self._reopen()
+
+    @property
+    def nfiles(self):
+        """The number of files appended."""
+        return len(self.files)
+
+    @property
+    def nblts(self):
+        """The number of baseline-times in the file."""
+        if self.h5f is None:
+            return 0
+        return self.h5f["Data"]["visdata"].shape[0]
+
+    @property
+    def first_time(self):
+        """The JD of the first time in the file, or None if it is empty."""
+        if self.nblts == 0:
+            return None
+        return self.h5f["Header"]["time_array"][0]
+
+    def _reopen(self):
+        """Reopen an incomplete aggregate, if its data match its checkpoint."""
+        h5f = h5py.File(self.filename, "r+")
+        truncated = False
+        try:
+            visdata = h5f["Data"]["visdata"]
+            nblts = int(visdata.attrs[CHECKPOINT_ATTR])
+            dsets = [h5f["Data"][name] for name in ("visdata", "flags", "nsamples")]
+            dsets += [h5f["Header"][key] for key in BLT_HEADER_KEYS]
+            valid = all(dset.shape[0] >= nblts for dset in dsets)
+            if valid:
+                # an append that did not reach its checkpoint leaves longer arrays
+                for dset in dsets:
+                    if dset.shape[0] > nblts:
+                        dset.resize(nblts, axis=0)
+                        truncated = True
+                crc, _ = _dataset_range_crc32(visdata, 0, nblts)
+                valid = crc == int(visdata.attrs[CHECKPOINT_CRC_ATTR])
+            if valid:
+                # the file list is written before the checkpoint, so it may
+                # name a file whose append did not finish
+                files = [
+                    f.decode("utf-8") if isinstance(f, bytes) else str(f)
+                    for f in visdata.attrs[CHECKPOINT_FILES_ATTR]
+                ]
+                ends = [int(end) for end in visdata.attrs[CHECKPOINT_FILE_ENDS_ATTR]]
+                nkeep = sum(end <= nblts for end in ends)
+                valid = nkeep > 0 and ends[nkeep - 1] == nblts
+        except Exception:
+            valid = False
+        if not valid:
+            h5f.close()
+            warnings.warn(f"{self.filename} does not match its checkpoint; starting over")
+            return
+
+        hdr = h5f["Header"]
+        eq_dgrp = hdr["extra_keywords"]
+        self.h5f = h5f
+        self.visdata_crc32 = crc
+        self.files = files[:nkeep]
+        self._file_ends = ends[:nkeep]
+        self.header = {
+            "nfreq": hdr["Nfreqs"][()],
+            "nstokes": hdr["Npols"][()],
+            "tag": eq_dgrp["tag"][()].decode("utf-8"),
+            "ant_names": _antenna_names(hdr["antenna_names"][()]),
+            "metadata": {
+                "t0": eq_dgrp["t0"][()],
+                "mcnt": eq_dgrp["mcnt"][()],
+                "corr_ver": eq_dgrp["corr_ver"][()].decode("utf-8"),
+            },
+        }
+        if truncated:
+            self._update_blt_header()
+            h5f.flush()
+
+    def accepts(self, header):
+        """
+        Check whether a file can be appended.
+
+        Parameters
+        ----------
+        header : dict
+            The header of the file, from `get_uvh5_header`.
+
+        Returns
+        -------
+        bool
+            True if the file can be appended to this aggregate.
+        """
+        if self.h5f is None:
+            return True
+        times = self.h5f["Header"]["time_array"]
+        first_time = min(times[0], header["time_array"].min())
+        last_time = max(times[-1], header["time_array"].max())
+        return (
+            int(np.floor(first_time)) == int(np.floor(last_time))
+            and (last_time - first_time) * 86400.0 <= self.span
+            and header["tag"] == self.header["tag"]
+            and header["nfreq"] == self.header["nfreq"]
+            and header["nstokes"] == self.header["nstokes"]
+            and _antenna_names(header["ant_names"]) == _antenna_names(self.header["ant_names"])
+        )
+
+    def _create(self, header):
+        """Create the output file from the header of its first file."""
+        data_shape = (0, header["nfreq"], header["nstokes"])
+        data_chunks = resolve_chunks(self.data_chunks, (1,) + data_shape[1:])
+        data_chunks = (self.data_chunks[0],) + data_chunks[1:]
+        codec, codec_kwargs = get_visdata_codec_kwargs(self.codec)
+
+        self.h5f = h5py.File(self.filename, "w")
+        eq_dgrp = _write_uvh5_header(self.h5f, header)
+        eq_dgrp[CODEC_KEY] = np.bytes_(codec)
+        header_dgrp = self.h5f["Header"]
+        for key in BLT_HEADER_KEYS:
+            arr = header_dgrp[key][()]
+            del header_dgrp[key]
+            header_dgrp.create_dataset(
+                key, data=arr[:0], maxshape=(None,) + arr.shape[1:], chunks=True
+            )
+
+        data_dgrp = self.h5f.create_group("Data")
+        maxshape = (None,) + data_shape[1:]
+        data_dgrp.create_dataset(
+            "visdata", data_shape, maxshape=maxshape, chunks=data_chunks,
+            dtype=_hera_corr_dtype, **codec_kwargs,
+        )
+        data_dgrp.create_dataset(
+            "flags", data_shape, maxshape=maxshape, chunks=data_chunks,
+            dtype="b1", compression="lzf",
+        )
+        data_dgrp.create_dataset(
+            "nsamples", data_shape, maxshape=maxshape, chunks=data_chunks,
+            dtype=np.float32, compression="lzf",
+        )
+        self.header = header
+
+    def append(self, header, data_file, chunksize=-1, name=None):
+        """
+        Append a correlator file.
+
+        Parameters
+        ----------
+        header : dict
+            The header of the file, from `get_uvh5_header`.
+        data_file : str
+            The name of the data file written by the correlator.
+        chunksize : int, optional
+            The number of baseline-times to read at a time. Default is -1, to
+            read the whole file.
+        name : str, optional
+            The name to record in `files`. Default is `data_file`.
+
+        Raises
+        ------
+        ValueError
+            Raised if the file cannot be appended; see `accepts`.
+        """
+        if not self.accepts(header):
+            raise ValueError(f"{data_file} cannot be appended to {self.filename}")
+        files = self.files + [data_file if name is None else name]
+        if self.h5f is None:
+            self._create(header)
+        header_dgrp = self.h5f["Header"]
+        data_dgrp = self.h5f["Data"]
+        idx0 = self.nblts
+        nblts = header["ant_0_array"].shape[0]
+        nfreq = header["nfreq"]
+        nstokes = header["nstokes"]
+        idx1 = idx0 + nblts
+
+        # extend the baseline-time arrays
+        blt_arrays = {
+            "time_array": header["time_array"],
+            "integration_time": header["integration_time"],
+            "uvw_array": header["uvw_array"],
+            "ant_1_array": header["ant_0_array"],
+            "ant_2_array": header["ant_1_array"],
+        }
+        for key, arr in blt_arrays.items():
+            dset = header_dgrp[key]
+            dset.resize(idx1, axis=0)
+            dset[idx0:idx1] = arr
+        for name in ("visdata", "flags", "nsamples"):
+            data_dgrp[name].resize(idx1, axis=0)
+
+        # copy the data in, checksumming as we go
+        if chunksize == -1:
+            chunksize = max(nblts, 1)
+        for i0 in range(0, nblts, chunksize):
+            i1 = min(i0 + chunksize, nblts)
+            offset = int(i0) * int(nfreq) * int(nstokes)
+            data = read_data_file_chunk(data_file, (i1 - i0, nfreq, nstokes), offset)
+            self.visdata_crc32 = zlib.crc32(data, self.visdata_crc32)
+            data_dgrp["visdata"][idx0 + i0:idx0 + i1] = data
+            data_dgrp["flags"][idx0 + i0:idx0 + i1] = np.zeros(data.shape, dtype=np.bool_)
+            data_dgrp["nsamples"][idx0 + i0:idx0 + i1] = np.ones(data.shape, dtype=np.float32)
+
+        self._update_blt_header()
+
+        # the checkpoint goes last, so a file that dies before it is
+        # truncated back to the previous one when reopened
+        file_ends = self._file_ends + [idx1]
+        visdata = data_dgrp["visdata"]
+        visdata.attrs[CHECKPOINT_FILES_ATTR] = np.array([f.encode("utf-8") for f in files])
+        visdata.attrs[CHECKPOINT_FILE_ENDS_ATTR] = np.array(file_ends, dtype=np.int64)
+        visdata.attrs[CHECKPOINT_CRC_ATTR] = np.uint32(self.visdata_crc32)
+        visdata.attrs[CHECKPOINT_ATTR] = idx1
+        self.h5f.flush()
+        self.files = files
+        self._file_ends = file_ends
+
+    def _update_blt_header(self):
+        """Update the header to describe all the baseline-times in the file."""
+        header_dgrp = self.h5f["Header"]
+        Nants_telescope = header_dgrp["Nants_telescope"][()]
+        blt_info = get_blt_info(
+            header_dgrp["ant_1_array"][()],
+            header_dgrp["ant_2_array"][()],
+            header_dgrp["time_array"][()],
+            Nants_telescope,
+        )
+        for key, value in [
+            ("Nblts", self.nblts),
+            ("Nbls", blt_info["Nbls"]),
+            ("Ntimes", blt_info["Ntimes"]),
+            ("Nants_data", blt_info["Nants_data"]),
+        ]:
+            del header_dgrp[key]
+            header_dgrp[key] = value
+
+    def finalize(self):
+        """
+        Record the visdata checksum and close the file.
+
+        Returns
+        -------
+        metadata : dict or None
+            The metadata of the first file, with the time_array of the whole
+            file and its `visdata_crc32` checksum; None if no file was
+            appended.
+        """
+        if self.h5f is None:
+            return None
+        visdata = self.h5f["Data"]["visdata"]
+        for key in (CHECKPOINT_ATTR, CHECKPOINT_CRC_ATTR, CHECKPOINT_FILES_ATTR,
+                    CHECKPOINT_FILE_ENDS_ATTR):
+            del visdata.attrs[key]
+        self.h5f["Header"]["extra_keywords"][CHECKSUM_KEY] = np.uint32(self.visdata_crc32)
+        metadata = dict(self.header["metadata"])
+        metadata["time_array"] = self.h5f["Header"]["time_array"][()]
+        metadata["tag"] = self.header["tag"]
+        metadata[CHECKSUM_KEY] = self.visdata_crc32
+        self.h5f.close()
+        self.h5f = None
+        return metadata
+
+
+def get_checkpoint(filename):
+    """
+    Get the checkpoint of a partly written UVH5 file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the UVH5 file.
+
+    Returns
+    -------
+    int or None
+        The number of baseline-times written at the last checkpoint, or None
+        if the file does not exist, is complete, has no checkpoint, or cannot
+        be read.
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        with h5py.File(filename, "r") as h5f:
+            attrs = h5f["Data"]["visdata"].attrs
+            if CHECKPOINT_ATTR not in attrs:
+                return None
+            return int(attrs[CHECKPOINT_ATTR])
+    except (OSError, KeyError):
+        return None
+
+
 def check_file(filename):
     '''Makes sure a converted file and has expected data/flag/nsample arrays
     with the right shapes and types.
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+An asyncio hashpipe <-> redis gateway for all the instances on a host.
+
+This does the job of one `hashpipe_redis_gateway.rb` per instance from a
+single process: the status buffer of every instance is pushed to its
+`hashpipe://<host>/<inst>/status` hash with one pipeline per interval, and
+`KEY=VALUE` messages published to the `set` channels are applied to the
+status buffers. The instance channels are subscribed with one pattern, and
+bursts of messages (like the counter resets of `catcher.clear_redis_keys`)
+are coalesced into one locked update per instance. A `quit` message on the
+`gateway` channels stops the gateway.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+import numpy as np
+
+from .status import STATUS_KEY
+
+have_sysv_ipc = True
+try:
+    import posix_ipc
+    import sysv_ipc
+except ImportError:
+    have_sysv_ipc = False
+
+logger = logging.getLogger(__name__)
+
+# see hashpipe_status.h
+STATUS_RECORD_SIZE = 80
+STATUS_TOTAL_SIZE = 2880 * 64
+DEFAULT_INTERVAL = 1.0
+DEFAULT_COALESCE = 0.05
+STATUS_EXPIRE = 60
+
+_SET_CHANNEL_RE = re.compile(r"^hashpipe://(?P<host>[^/]*)/(?:(?P<inst>\d+)/)?set$")
+
+
+def parse_status_records(buf):
+    """
+    Parse a hashpipe status buffer.
+
+    Parameters
+    ----------
+    buf : bytes
+        The buffer, 80-character FITS-style records up to an END record.
+
+    Returns
+    -------
+    dict
+        The values, as strings with any quotes removed.
+    """
+    nrec = len(buf) // STATUS_RECORD_SIZE
+    records = np.frombuffer(buf, dtype=f"S{STATUS_RECORD_SIZE}", count=nrec)
+    end = np.flatnonzero(np.char.startswith(records, b"END "))
+    records = records[:end[0] if len(end) else nrec]
+    out = {}
+    for rec in records.tolist():
+        rec = rec.decode("ascii", "replace")
+        if rec[8:10] != "= ":
+            continue
+        value = rec[10:].strip()
+        if value.startswith("'"):
+            value = value[1:value.rfind("'")] if value.count("'") > 1 else value[1:]
+            value = value.rstrip().replace("''", "'")
+        out[rec[:8].strip()] = value
+    return out
+
+
+def format_status_record(key, value):
+    """
+    Format a string status record, like `hputs`.
+    """
+    rec = "%-8.8s= '%-8s'" % (key, str(value).replace("'", "''"))
+    return rec[:STATUS_RECORD_SIZE].ljust(STATUS_RECORD_SIZE).encode("ascii", "replace")
+
+
+def parse_set_message(msg):
+    """
+    Parse a `set` message, one or more KEY=VALUE lines.
+
+    Returns
+    -------
+    dict
+        The values, keyed by upper-case key.
+    """
+    out = {}
+    for line in msg.splitlines():
+        key, sep, value = line.partition("=")
+        if sep and key.strip():
+            out[key.strip().upper()] = value
+    return out
+
+
+def update_status_records(buf, updates):
+    """
+    Apply updates to a status buffer.
+
+    Parameters
+    ----------
+    buf : bytes
+        The buffer.
+    updates : dict
+        The new values; keys not in the buffer are added before END.
+
+    Returns
+    -------
+    bytes
+        The new buffer, the same length as `buf`.
+    """
+    nrec = len(buf) // STATUS_RECORD_SIZE
+    records = np.frombuffer(buf, dtype=f"S{STATUS_RECORD_SIZE}", count=nrec).copy()
+    keys = np.char.strip(np.char.ljust(records, 8).astype("S8")).tolist()
+    end = keys.index(b"END") if b"END" in keys else None
+    if end is None:
+        end = next((i for i, rec in enumerate(records) if not rec.strip()), nrec)
+    for key, value in updates.items():
+        bkey = key[:8].encode("ascii")
+        if bkey in keys[:end]:
+            records[keys.index(bkey)] = format_status_record(key, value)
+            continue
+        if end + 1 >= nrec:
+            raise ValueError("status buffer is full")
+        records[end] = format_status_record(key, value)
+        keys[end] = bkey
+        end += 1
+        records[end] = b"END".ljust(STATUS_RECORD_SIZE)
+        keys[end] = b"END"
+    return records.tobytes()
+
+
+class LocalStatusBuffer(object):
+    """
+    An in-process status buffer, for testing without a hashpipe instance.
+
+    Parameters
+    ----------
+    values : dict, optional
+        The initial values.
+    """
+
+    def __init__(self, values=None, size=STATUS_TOTAL_SIZE):
+        self.lock = threading.Lock()
+        self.buf = b"END".ljust(size)
+        if values:
+            self.update(values)
+
+    def read(self):
+        """Get the values."""
+        with self.lock:
+            return parse_status_records(self.buf)
+
+    def update(self, values):
+        """Set values."""
+        with self.lock:
+            self.buf = update_status_records(self.buf, values)
+
+
+class ShmStatusBuffer(object):
+    """
+    The shared memory status buffer of a running hashpipe instance.
+
+    This needs the optional `sysv_ipc` and `posix_ipc` packages.
+
+    Parameters
+    ----------
+    instance : int
+        The hashpipe instance.
+    keyfile : str, optional
+        The hashpipe key file. Default is $HASHPIPE_KEYFILE, $HOME or /tmp,
+        as in `hashpipe_ipckey`.
+    """
+
+    def __init__(self, instance, keyfile=None):
+        if not have_sysv_ipc:
+            raise ImportError(
+                "sysv_ipc and posix_ipc are required to attach to hashpipe status buffers"
+            )
+        if keyfile is None:
+            keyfile = os.environ.get("HASHPIPE_KEYFILE", os.environ.get("HOME", "/tmp"))
+        self.shm = sysv_ipc.SharedMemory(sysv_ipc.ftok(keyfile, (instance & 0x3F) | 0x40))
+        # as hashpipe_status_semname, with all but a leading / made _
+        semname = "%s_hashpipe_status_%d" % (keyfile, instance & 0x3F)
+        semname = semname[:1] + semname[1:].replace("/", "_")
+        self.sem = posix_ipc.Semaphore(semname)
+
+    def read(self):
+        """Get the values, holding the status lock."""
+        with self.sem:
+            buf = self.shm.read(STATUS_TOTAL_SIZE)
+        return parse_status_records(buf)
+
+    def update(self, values):
+        """Set values, holding the status lock."""
+        with self.sem:
+            buf = self.shm.read(STATUS_TOTAL_SIZE)
+            self.shm.write(update_status_records(buf, values))
+
+
+class Gateway(object):
+    """
+    Serve the status buffers of the hashpipe instances of one host.
+
+    Parameters
+    ----------
+    r : redis.asyncio.Redis
+        The redis connection, with `decode_responses=True`.
+    host : str
+        The gateway name, used in the channel and key names.
+    buffers : dict
+        The status buffer of each instance, keyed by instance number; each
+        has `read` and `update` methods.
+    interval : float, optional
+        Seconds between status pushes.
+    coalesce : float, optional
+        Seconds to collect `set` messages before applying them.
+    expire : int, optional
+        Seconds after which the status hashes expire if not refreshed.
+    """
+
+    def __init__(self, r, host, buffers, interval=DEFAULT_INTERVAL, coalesce=DEFAULT_COALESCE,
+                 expire=STATUS_EXPIRE):
+        self.r = r
+        self.host = host
+        self.buffers = buffers
+        self.interval = interval
+        self.coalesce = coalesce
+        self.expire = expire
+        self.pending = {}
+        self.nmessages = 0
+        self.nupdates = 0
+        self.stop = asyncio.Event()
+        self._flush_task = None
+        # held while updates are taken and applied, so flushes never overlap
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def channels(self):
+        """The channels subscribed to directly."""
+        return [
+            f"hashpipe://{self.host}/set", "hashpipe:///set",
+            f"hashpipe://{self.host}/gateway", "hashpipe:///gateway",
+        ]
+
+    @property
+    def patterns(self):
+        """The channel patterns subscribed to."""
+        return [f"hashpipe://{self.host}/*/set"]
+
+    def handle_message(self, channel, data):
+        """
+        Queue the updates of a message.
+
+        Parameters
+        ----------
+        channel : str
+            The channel the message was published to.
+        data : str
+            The message.
+
+        Returns
+        -------
+        bool
+            Whether there are updates waiting to be applied.
+        """
+        if channel.endswith("/gateway"):
+            if data.strip() == "quit":
+                logger.info("Gateway %s quitting", self.host)
+                self.stop.set()
+            return bool(self.pending)
+        match = _SET_CHANNEL_RE.match(channel)
+        if match is None or match["host"] not in ("", self.host):
+            return bool(self.pending)
+        if match["inst"] is None:
+            instances = list(self.buffers)
+        elif int(match["inst"]) in self.buffers:
+            instances = [int(match["inst"])]
+        else:
+            instances = []
+        updates = parse_set_message(data)
+        self.nmessages += 1
+        for inst in instances:
+            self.pending.setdefault(inst, {}).update(updates)
+        return bool(self.pending)
+
+    def take_pending(self):
+        """Take the queued updates, leaving none queued."""
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def flush(self, pending=None):
+        """
+        Apply queued updates, one status buffer update per instance.
+
+        Parameters
+        ----------
+        pending : dict, optional
+            Updates already taken with `take_pending`, for applying them on
+            another thread while `handle_message` queues new ones. Default is
+            to take the queued updates.
+        """
+        if pending is None:
+            pending = self.take_pending()
+        for inst, updates in pending.items():
+            self.buffers[inst].update(updates)
+            self.nupdates += 1
+
+    def status_mappings(self):
+        """Read the status buffers, keyed by status hash name."""
+        return {
+            STATUS_KEY.format(host=self.host, inst=inst): buf.read()
+            for inst, buf in self.buffers.items()
+        }
+
+    async def push_status(self):
+        """Push every status buffer to redis in one pipeline."""
+        mappings = await asyncio.to_thread(self.status_mappings)
+        async with self.r.pipeline(transaction=False) as pipe:
+            for key, mapping in mappings.items():
+                if mapping:
+                    pipe.hset(key, mapping=mapping)
+                if self.expire:
+                    pipe.expire(key, self.expire)
+            await pipe.execute()
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.coalesce)
+        self._flush_task = None
+        # messages arriving from here on schedule another flush, which waits
+        # for this one so older updates are never applied over newer ones
+        async with self._flush_lock:
+            # detach the updates on the event loop, where handle_message runs,
+            # so the thread applying them never sees the dict change
+            pending = self.take_pending()
+            await asyncio.to_thread(self.flush, pending)
+        # push the new values right away rather than waiting for the interval
+        await self.push_status()
+
+    async def listen(self, ready=None):
+        """Apply the messages of the set channels until stopped."""
+        pubsub = self.r.pubsub()
+        await pubsub.subscribe(*self.channels)
+        await pubsub.psubscribe(*self.patterns)
+        if ready is not None:
+            ready.set()
+        try:
+            while not self.stop.is_set():
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+                if msg is None:
+                    continue
+                if self.handle_message(msg["channel"], msg["data"]) and self._flush_task is None:
+                    self._flush_task = asyncio.create_task(self._delayed_flush())
+        finally:
+            if self._flush_task is not None:
+                await self._flush_task
+            # wait for a flush that was already running
+            async with self._flush_lock:
+                pass
+            await pubsub.aclose()
+
+    async def publish_status(self):
+        """Push the status buffers every `interval` seconds until stopped."""
+        while not self.stop.is_set():
+            await self.push_status()
+            try:
+                await asyncio.wait_for(self.stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, ready=None):
+        """
+        Run the gateway until a `quit` message or `stop` is set.
+
+        Parameters
+        ----------
+        ready : asyncio.Event, optional
+            Set once the gateway is subscribed.
+        """
+        await asyncio.gather(self.listen(ready), self.publish_status())
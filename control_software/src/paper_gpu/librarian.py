@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""Batched uploads of converted files to the Librarian."""
+
+import os
+import re
+import json
+import time
+import shutil
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .profiling import profiled
+
+JD_TEMPLATE = re.compile(r"\d{7}")
+
+
+def get_jd_from_filename(filename):
+    """
+    Get the integer JD of a correlator file from its name.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file, e.g. "zen.2459000.12345.sum.uvh5".
+
+    Returns
+    -------
+    int
+        The integer JD.
+
+    Raises
+    ------
+    ValueError
+        Raised if the filename does not contain a 7-digit JD.
+    """
+    match = JD_TEMPLATE.search(os.path.basename(filename))
+    if match is None:
+        raise ValueError(f"no JD found in filename {filename}")
+    return int(match.group())
+
+
+def make_librarian_client(conn_name):
+    """
+    Create a client for the Librarian.
+
+    Parameters
+    ----------
+    conn_name : str
+        The name of the connection in the Librarian configuration file.
+
+    Returns
+    -------
+    hera_librarian.LibrarianClient
+        The client object. Any object with `search_instances` and
+        `upload_file` methods (such as `LocalLibrarianClient`) may be used in
+        its place.
+    """
+    # hera_librarian is only needed on the hosts that upload
+    from hera_librarian import LibrarianClient
+
+    return LibrarianClient(conn_name)
+
+
+class LocalLibrarianClient(object):
+    """
+    A local stand-in for `hera_librarian.LibrarianClient`.
+
+    Only `search_instances` with a "name-matches" query and `upload_file` are
+    implemented. Uploads are recorded by name and, if `store_dir` is given,
+    copied there.
+
+    Parameters
+    ----------
+    store_dir : str, optional
+        A directory to copy uploaded files to.
+    """
+
+    def __init__(self, store_dir=None):
+        self.store_dir = store_dir
+        self.names = set()
+        self.n_searches = 0
+        self.n_uploads = 0
+        self._lock = threading.Lock()
+
+    def search_instances(self, query):
+        """Return instances whose name matches a SQL LIKE pattern."""
+        pattern = json.loads(query)["name-matches"]
+        pattern = pattern.replace("%", "*").replace("_", "?")
+        with self._lock:
+            self.n_searches += 1
+            matches = sorted(n for n in self.names if fnmatch.fnmatchcase(n, pattern))
+        return {"results": [{"name": n} for n in matches]}
+
+    def upload_file(self, local_path, dest_store_path, type, rec_info={}):
+        """Record an uploaded file, copying it to `store_dir` if set."""
+        if self.store_dir is not None:
+            dest = os.path.join(self.store_dir, dest_store_path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(local_path, dest)
+        with self._lock:
+            self.n_uploads += 1
+            self.names.add(os.path.basename(dest_store_path))
+
+
+class LibrarianIndex(object):
+    """
+    A cache of the file names the Librarian already has, grouped by JD.
+
+    The Librarian is queried once per JD with a name pattern, rather than once
+    per file. Entries expire after `ttl` seconds so files added by other hosts
+    are eventually seen.
+
+    Parameters
+    ----------
+    client : object
+        A Librarian client, see `make_librarian_client`.
+    ttl : float, optional
+        The number of seconds a JD's listing is trusted before re-querying.
+    """
+
+    def __init__(self, client, ttl=600.0):
+        self.client = client
+        self.ttl = ttl
+        self._names = {}
+        self._fetched = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, jd):
+        """
+        Re-query the Librarian for all file names of a JD.
+
+        Parameters
+        ----------
+        jd : int
+            The integer JD.
+
+        Returns
+        -------
+        set of str
+            The names of the files the Librarian has for this JD.
+        """
+        query = json.dumps({"name-matches": f"zen.{jd:d}.%"})
+        instances = self.client.search_instances(query)
+        names = {inst["name"] for inst in instances["results"]}
+        with self._lock:
+            self._names[jd] = names
+            self._fetched[jd] = time.monotonic()
+        return names
+
+    def names(self, jd):
+        """
+        Get the cached file names for a JD, querying the Librarian if stale.
+
+        Parameters
+        ----------
+        jd : int
+            The integer JD.
+
+        Returns
+        -------
+        set of str
+            The names of the files the Librarian has for this JD.
+        """
+        # only one thread queries the Librarian; the others wait for its answer
+        with self._refresh_lock:
+            with self._lock:
+                fetched = self._fetched.get(jd)
+                if fetched is not None and time.monotonic() - fetched < self.ttl:
+                    return self._names[jd]
+            return self.refresh(jd)
+
+    def add(self, filename):
+        """Record that a file has been added to the Librarian."""
+        name = os.path.basename(filename)
+        jd = get_jd_from_filename(name)
+        with self._lock:
+            self._names.setdefault(jd, set()).add(name)
+
+    def __contains__(self, filename):
+        name = os.path.basename(filename)
+        return name in self.names(get_jd_from_filename(name))
+
+
+class BandwidthLimiter(object):
+    """
+    Limit the average rate of data sent by several threads.
+
+    Parameters
+    ----------
+    max_bytes_per_s : float or None
+        The maximum average rate. None disables the limit.
+    """
+
+    def __init__(self, max_bytes_per_s=None):
+        self.max_bytes_per_s = max_bytes_per_s
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        """
+        Wait until `nbytes` may be sent without exceeding the rate limit.
+
+        Parameters
+        ----------
+        nbytes : int
+            The number of bytes about to be sent.
+
+        Returns
+        -------
+        float
+            The number of seconds spent waiting.
+        """
+        if not self.max_bytes_per_s:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + nbytes / self.max_bytes_per_s
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class LibrarianUploader(object):
+    """
+    Upload files to the Librarian through a bounded thread pool.
+
+    All threads share one client, one `LibrarianIndex` and one
+    `BandwidthLimiter`.
+
+    Parameters
+    ----------
+    client : object
+        A Librarian client, see `make_librarian_client`.
+    nworkers : int, optional
+        The maximum number of concurrent uploads.
+    ttl : float, optional
+        The lifetime of cached Librarian listings, in seconds.
+    max_bytes_per_s : float, optional
+        Cap on the average upload bandwidth. Default is no cap.
+    """
+
+    def __init__(self, client, nworkers=4, ttl=600.0, max_bytes_per_s=None):
+        self.client = client
+        self.index = LibrarianIndex(client, ttl=ttl)
+        self.limiter = BandwidthLimiter(max_bytes_per_s)
+        self.pool = ThreadPoolExecutor(max_workers=nworkers)
+
+    def upload(self, filename, full_path):
+        """
+        Upload a file unless the Librarian already has it.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file in the Librarian store.
+        full_path : str
+            The path to the file on local disk.
+
+        Returns
+        -------
+        bool
+            True if the file was uploaded, False if it was already present.
+        """
+        if filename in self.index:
+            return False
+        self.limiter.acquire(os.path.getsize(full_path))
+        self.client.upload_file(full_path, filename, "infer", rec_info={})
+        self.index.add(filename)
+        return True
+
+    def _profiled_upload(self, filename, full_path, profile):
+        with profiled("upload", filename, profile):
+            return self.upload(filename, full_path)
+
+    def submit(self, filename, full_path, profile=None):
+        """
+        Queue a file for upload.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file in the Librarian store.
+        full_path : str
+            The path to the file on local disk.
+        profile : str, optional
+            Profile the upload in the "upload" stage with this mode, one of
+            `profiling.PROFILE_MODES`. Default is not to profile.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            A future whose result is the return value of `upload`.
+        """
+        if profile is None:
+            return self.pool.submit(self.upload, filename, full_path)
+        return self.pool.submit(self._profiled_upload, filename, full_path, profile)
+
+    def shutdown(self, wait=True):
+        """Stop accepting uploads, optionally waiting for queued ones."""
+        self.pool.shutdown(wait=wait)
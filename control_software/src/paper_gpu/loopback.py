@@ -0,0 +1,846 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+End-to-end test of the catcher data path on one machine.
+
+BDA packets are generated and sent over the loopback interface to a Python
+reference catcher, which assembles them into .sum.dat/.diff.dat and
+meta.hdf5 files like the catcher disk thread. The files are queued in a
+local stand-in for the site redis, converted with `make_uvh5_file` and
+checked with `check_file`, and the throughput, loss and latency of each
+stage are reported.
+"""
+
+import os
+import fnmatch
+import time
+import socket
+import struct
+import threading
+from collections import Counter
+import h5py
+import numpy as np
+import pyuvdata.utils as uvutils
+
+from . import file_conversion
+from .bl_order import N_BDABUF_BINS, get_bda_bcnt_layout
+from .packet_loss import get_bcnt_integrations
+from .sum_diff import CATCHER_CHAN_SUM_BDA, N_STOKES, TIME_DEMUX, sum_diff
+from .timing import (
+    FENG_SAMPLE_RATE, N_CHAN_TOTAL_GENERATED, mcnt_to_jd, mcnt_to_unix, unix_to_jd
+)
+
+# parameters from paper_databuf.h and hera_catcher_disk_thread.c
+OUTPUT_BYTES_PER_PACKET = 4096
+CHAN_PER_CATCHER_PKT = OUTPUT_BYTES_PER_PACKET // (N_STOKES * 8)
+N_TIME_PER_PACKET = 2
+TAG_BYTES = 128
+VERSION_BYTES = 32
+
+# mcnt, bcnt, offset, ant0, ant1, xeng_id, payload_len; see hera_catcher_net_thread.c
+PACKET_HEADER = struct.Struct(">QIIHHHH")
+
+RAW_FILE_KEY = "corr:files:raw"
+
+# a site-like array center for the synthetic antenna positions
+LOOPBACK_CMINFO = {"cofa_lat": -30.72152, "cofa_lon": 21.42831, "cofa_alt": 1051.69}
+
+
+def make_packets(mcnt, bcnt, ant0, ant1, data, n_xeng):
+    """
+    Packetize the visibilities of one baseline, as the X-engines send them.
+
+    Parameters
+    ----------
+    mcnt : int
+        The mcnt of the even time sample.
+    bcnt : int
+        The baseline counter.
+    ant0, ant1 : int
+        The correlator antenna numbers.
+    data : ndarray of int32
+        The visibilities, of shape (TIME_DEMUX, Nchan, N_STOKES, 2).
+    n_xeng : int
+        The number of X-engines per time sample.
+
+    Returns
+    -------
+    list of bytes
+        The packets, with the payload in the catcher's native byte order.
+    """
+    nchan = data.shape[1]
+    packets_per_x = nchan // (n_xeng * CHAN_PER_CATCHER_PKT)
+    data = np.ascontiguousarray(data, dtype="<i4")
+    packets = []
+    for t in range(TIME_DEMUX):
+        for x in range(n_xeng):
+            for o in range(packets_per_x):
+                chan0 = (x * packets_per_x + o) * CHAN_PER_CATCHER_PKT
+                header = PACKET_HEADER.pack(
+                    mcnt + N_TIME_PER_PACKET * t, bcnt, o, ant0, ant1,
+                    x + t * n_xeng, OUTPUT_BYTES_PER_PACKET,
+                )
+                packets.append(header + data[t, chan0:chan0 + CHAN_PER_CATCHER_PKT].tobytes())
+    return packets
+
+
+def write_metadata(filename, t0, mcnt, time_array, ant_0_array, ant_1_array,
+                   integration_time, tag, nfreq, corr_ver="loopback"):
+    """
+    Write a metadata file in the layout of the catcher's `write_metadata`.
+
+    Parameters
+    ----------
+    filename : str
+        The file to write.
+    t0 : int
+        The sync time, in ms.
+    mcnt : int
+        The mcnt at the end of the file.
+    time_array, ant_0_array, ant_1_array, integration_time : ndarray
+        The per baseline-time arrays.
+    tag : str
+        The observation tag.
+    nfreq : int
+        The number of channels in the data files.
+    corr_ver : str, optional
+        The correlator version string.
+    """
+    with h5py.File(filename, "w") as h5f:
+        h5f["t0"] = np.uint64(t0)
+        h5f["mcnt"] = np.uint64(mcnt)
+        h5f["nfreq"] = np.uint64(nfreq)
+        h5f["nstokes"] = np.uint64(N_STOKES)
+        h5f["corr_ver"] = np.array(corr_ver.encode("utf-8"), dtype=f"S{VERSION_BYTES}")
+        h5f["tag"] = np.array(tag.encode("utf-8"), dtype=f"S{TAG_BYTES}")
+        h5f["ant_0_array"] = np.asarray(ant_0_array, dtype=np.int32)
+        h5f["ant_1_array"] = np.asarray(ant_1_array, dtype=np.int32)
+        h5f["time_array"] = np.asarray(time_array, dtype=np.float64)
+        h5f["integration_time"] = np.asarray(integration_time, dtype=np.float64)
+
+
+def make_bl_pairs(nants):
+    """
+    Make a BDA configuration for every baseline of `nants` antennas, autos included.
+
+    The antennas are on a line, as in `make_antpos_info`, and shorter
+    baselines are integrated for longer, so antennas separated by n positions
+    integrate 2**(N_BDABUF_BINS - 1 - n) samples, and at least one.
+
+    Returns
+    -------
+    ndarray of int
+        The configuration, of shape (Npairs, 3), in the form of
+        `bda.assign_bl_pair_tier`.
+    """
+    ant_0, ant_1 = np.triu_indices(nants)
+    tier = np.maximum(N_BDABUF_BINS - 1 - (ant_1 - ant_0), 0)
+    return np.stack([ant_0, ant_1, 2**tier], axis=1)
+
+
+def make_antpos_info(nants, cminfo=LOOPBACK_CMINFO):
+    """
+    Make antenna positions and names in the form of `get_antpos_info`.
+
+    The antennas are on an east-west line with 14.6 m spacing.
+    """
+    cofa_xyz = uvutils.XYZ_from_LatLonAlt(
+        np.radians(cminfo["cofa_lat"]), np.radians(cminfo["cofa_lon"]), cminfo["cofa_alt"]
+    )
+    lon = np.radians(cminfo["cofa_lon"])
+    east = np.array([-np.sin(lon), np.cos(lon), 0.0])
+    antpos_xyz = cofa_xyz + 14.6 * np.arange(nants)[:, np.newaxis] * east
+    ant_names = np.array([f"HH{i}" for i in range(nants)], dtype="S5")
+    return antpos_xyz, ant_names
+
+
+class LocalRedis(object):
+    """
+    A thread-safe, in-process stand-in for the few redis commands the harness
+    uses, for machines without a redis server.
+
+    Values are stored as strings, like a connection with
+    `decode_responses=True`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = str(value)
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def rpush(self, key, *values):
+        with self.lock:
+            lst = self.data.setdefault(key, [])
+            lst.extend(str(value) for value in values)
+            return len(lst)
+
+    def lpop(self, key):
+        with self.lock:
+            lst = self.data.get(key)
+            return lst.pop(0) if lst else None
+
+    def llen(self, key):
+        with self.lock:
+            return len(self.data.get(key, []))
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            lst = self.data.get(key, [])
+            end = len(lst) if end == -1 else end + 1
+            return lst[start:end]
+
+    def ltrim(self, key, start, end):
+        with self.lock:
+            lst = self.data.get(key, [])
+            end = len(lst) if end == -1 else end + 1
+            lst[:] = lst[start:end]
+            return True
+
+    def lrem(self, key, count, value):
+        value = str(value)
+        with self.lock:
+            lst = self.data.get(key, [])
+            index = [i for i, v in enumerate(lst) if v == value]
+            if count < 0:
+                index = index[::-1]
+            if count != 0:
+                index = index[:abs(count)]
+            for i in sorted(index, reverse=True):
+                del lst[i]
+            return len(index)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = {} if mapping is None else dict(mapping)
+        if key is not None:
+            items[key] = value
+        with self.lock:
+            h = self.data.setdefault(name, {})
+            nnew = len(set(items) - set(h))
+            h.update((str(k), str(v)) for k, v in items.items())
+            return nnew
+
+    def hget(self, name, key):
+        with self.lock:
+            return self.data.get(name, {}).get(key)
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self.data.get(name, {}))
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            h = self.data.get(name, {})
+            return sum(h.pop(key, None) is not None for key in keys)
+
+    def delete(self, *names):
+        with self.lock:
+            return sum(self.data.pop(name, None) is not None for name in names)
+
+    def keys(self, pattern="*"):
+        with self.lock:
+            return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+
+class LocalPipeline(object):
+    """
+    A pipeline for `LocalRedis`, which queues commands until `execute`.
+    """
+
+    def __init__(self, r):
+        self.r = r
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.r, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+class StageStats(object):
+    """
+    Throughput, loss and latency of one stage of the harness.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.stop = None
+        self.nitems = 0
+        self.nbytes = 0
+        self.lost = 0
+        self.failed = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def record(self, nbytes, latency=None, nitems=1, now=None):
+        """Record that `nitems` items of `nbytes` in total were handled."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if self.start is None:
+                self.start = now
+            self.stop = now
+            self.nitems += nitems
+            self.nbytes += nbytes
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def begin(self, now=None):
+        """Mark the start of the stage, for stages timed from before their first item."""
+        with self.lock:
+            self.start = time.time() if now is None else now
+
+    def summary(self):
+        """
+        Summarize the stage.
+
+        Returns
+        -------
+        dict
+            The number of items handled, lost and failed, the bytes handled,
+            the duration (s), the throughput in MB/s and items/s, and the
+            mean, median, 99th percentile and maximum latency (s), which are
+            NaN if no latencies were recorded.
+        """
+        with self.lock:
+            duration = 0.0 if self.start is None else self.stop - self.start
+            lat = np.asarray(self.latencies, dtype=np.float64)
+            summary = {
+                "items": self.nitems,
+                "lost": self.lost,
+                "failed": self.failed,
+                "bytes": self.nbytes,
+                "duration": duration,
+                "MBps": self.nbytes / duration / 1e6 if duration > 0 else np.nan,
+                "items_per_s": self.nitems / duration if duration > 0 else np.nan,
+            }
+            if len(lat) > 0:
+                summary.update(
+                    latency_mean=lat.mean(),
+                    latency_p50=np.percentile(lat, 50),
+                    latency_p99=np.percentile(lat, 99),
+                    latency_max=lat.max(),
+                )
+            else:
+                summary.update(
+                    latency_mean=np.nan, latency_p50=np.nan, latency_p99=np.nan,
+                    latency_max=np.nan,
+                )
+        return summary
+
+
+class PacketGenerator(object):
+    """
+    Generate the BDA packets of an observation.
+
+    The bcnts follow `bl_order.get_bda_bcnt_layout`, so each baseline is sent
+    once per `inttime` integrations, stamped with the mcnt of the last
+    integration averaged into it (see `packet_loss.get_bcnt_integrations`).
+    The bcnts are sent in the order the BDA thread completes them: by that
+    integration, then by bcnt. Visibilities are pseudo-random, seeded by the
+    bcnt, so they can be regenerated with `visibilities` to check the output.
+
+    Parameters
+    ----------
+    bl_pairs : array_like of int
+        The BDA configuration, of shape (Npairs, 3), as in
+        `bl_order.get_bda_bcnt_layout`.
+    nfiles : int
+        The number of files of `bcnts_per_file` bcnts.
+    nchan : int, optional
+        The number of channels, a multiple of n_xeng * CHAN_PER_CATCHER_PKT.
+    n_xeng : int, optional
+        The number of X-engines per time sample.
+    integration_time : float, optional
+        The integration time of one input integration, in seconds.
+    sync_time_ms : int, optional
+        The sync time, in ms. Default is now.
+    seed : int, optional
+        The seed of the visibilities.
+    """
+
+    def __init__(self, bl_pairs, nfiles, nchan=384, n_xeng=1, integration_time=2.0,
+                 sync_time_ms=None, seed=0):
+        if nchan % (n_xeng * CHAN_PER_CATCHER_PKT) != 0:
+            raise ValueError(
+                f"nchan must be a multiple of {n_xeng * CHAN_PER_CATCHER_PKT}"
+            )
+        self.layout = get_bda_bcnt_layout(bl_pairs)
+        self.bcnts_per_file = len(self.layout["sample"])
+        self.nfiles = nfiles
+        self.nchan = nchan
+        self.n_xeng = n_xeng
+        self.integration_time = integration_time
+        if sync_time_ms is None:
+            sync_time_ms = int(time.time() * 1000)
+        self.sync_time_ms = sync_time_ms
+        self.seed = seed
+        # even samples are at mcnts where (mcnt / N_TIME_PER_PACKET) % TIME_DEMUX == 0
+        mcnt_align = N_TIME_PER_PACKET * TIME_DEMUX
+        mcnts_per_int = integration_time * FENG_SAMPLE_RATE / (2 * N_CHAN_TOTAL_GENERATED)
+        self.mcnt_step = int(round(mcnts_per_int / mcnt_align)) * mcnt_align
+        self.packets_per_baseline = TIME_DEMUX * nchan // CHAN_PER_CATCHER_PKT
+        self.send_times = {}
+
+    @property
+    def nbcnts(self):
+        """The number of baseline-times in the observation."""
+        return self.nfiles * self.bcnts_per_file
+
+    @property
+    def integration_times(self):
+        """The integration time of each bcnt of a file, in seconds."""
+        return self.layout["inttime"] * self.integration_time
+
+    @property
+    def npackets(self):
+        """The number of packets in the observation."""
+        return self.nbcnts * self.packets_per_baseline
+
+    def visibilities(self, bcnt):
+        """Get the visibilities of a bcnt, of shape (TIME_DEMUX, Nchan, N_STOKES, 2)."""
+        rng = np.random.default_rng((self.seed, bcnt))
+        return rng.integers(
+            -2**15, 2**15, size=(TIME_DEMUX, self.nchan, N_STOKES, 2), dtype=np.int32
+        )
+
+    def packets(self):
+        """Yield (bcnt, packets) for each baseline-time, in the order they are sent."""
+        bcnts = np.arange(self.nbcnts)
+        integration = get_bcnt_integrations(bcnts, self.layout)
+        for bcnt in bcnts[np.argsort(integration, kind="stable")]:
+            pos = bcnt % self.bcnts_per_file
+            yield int(bcnt), make_packets(
+                int(integration[bcnt] + 1) * self.mcnt_step, int(bcnt),
+                int(self.layout["ant_0_array"][pos]), int(self.layout["ant_1_array"][pos]),
+                self.visibilities(bcnt), self.n_xeng,
+            )
+
+    def send(self, sock, address, stats, rate=None):
+        """
+        Send the observation.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            A UDP socket.
+        address : tuple
+            The (host, port) of the catcher.
+        stats : StageStats
+            Records the packets sent.
+        rate : float, optional
+            The packet rate, in packets per second. Default is as fast as
+            possible.
+        """
+        # build packets ahead of time so generation is not timed
+        observation = list(self.packets())
+        stats.begin()
+        t0 = time.time()
+        nsent = 0
+        for bcnt, packets in observation:
+            for pkt in packets:
+                if rate is not None:
+                    ahead = t0 + nsent / rate - time.time()
+                    if ahead > 0:
+                        time.sleep(ahead)
+                sock.sendto(pkt, address)
+                nsent += 1
+            now = time.time()
+            self.send_times[bcnt] = now
+            stats.record(len(packets[0]) * len(packets), nitems=len(packets), now=now)
+
+
+class ReferenceCatcher(object):
+    """
+    Assemble BDA packets into raw data files, like the catcher.
+
+    Packets are placed by bcnt and offset as in the catcher net thread, and
+    each file of one BDA layout's bcnts is summed and differenced with
+    `sum_diff.sum_diff` and written with its metadata when all of its
+    packets have arrived, or when packets for two files later arrive.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write JD directories of files to.
+    nchan : int
+        The number of channels per baseline.
+    n_xeng : int
+        The number of X-engines per time sample.
+    layout : dict
+        The bcnt layout of each file, from `bl_order.get_bda_bcnt_layout`.
+    integration_time : float
+        The integration time of one input integration, in seconds.
+    sync_time_ms : int
+        The sync time, in ms.
+    r : redis.Redis or LocalRedis, optional
+        Written files are pushed to RAW_FILE_KEY, relative to `directory`.
+    tag : str, optional
+        The observation tag.
+    chan_sum : int, optional
+        The number of adjacent channels summed together.
+    send_times : dict, optional
+        The time the last packet of each bcnt was sent, to compute latency.
+    stats : StageStats, optional
+        Records the files written.
+    """
+
+    def __init__(self, directory, nchan, n_xeng, layout, integration_time,
+                 sync_time_ms, r=None, tag="engineering", chan_sum=CATCHER_CHAN_SUM_BDA,
+                 send_times=None, stats=None):
+        self.directory = directory
+        self.nchan = nchan
+        self.n_xeng = n_xeng
+        self.packets_per_x = nchan // (n_xeng * CHAN_PER_CATCHER_PKT)
+        self.packets_per_baseline = TIME_DEMUX * nchan // CHAN_PER_CATCHER_PKT
+        self.bcnts_per_file = len(layout["sample"])
+        self.integration_times = layout["inttime"] * integration_time
+        self.sync_time_ms = sync_time_ms
+        self.r = r
+        self.tag = tag
+        self.chan_sum = chan_sum
+        self.send_times = {} if send_times is None else send_times
+        self.stats = StageStats("catcher") if stats is None else stats
+        self.next_file = 0
+        self.npackets = 0
+        self.nlate = 0
+        self.files = []
+        # the time each file was queued
+        self.closed_times = {}
+        # bcnt -> [data, npackets, mcnt, ant0, ant1]
+        self.bls = {}
+        # file index -> bcnts with every packet
+        self.ncomplete = Counter()
+
+    def add_packet(self, pkt):
+        """
+        Place a packet, writing any files it completes.
+
+        Parameters
+        ----------
+        pkt : bytes
+            The packet.
+        """
+        mcnt, bcnt, offset, ant0, ant1, xeng_id, payload_len = PACKET_HEADER.unpack_from(pkt)
+        if bcnt // self.bcnts_per_file < self.next_file:
+            # the file has been written
+            self.nlate += 1
+            return
+        self.npackets += 1
+        if bcnt not in self.bls:
+            data = np.zeros((TIME_DEMUX, self.nchan, N_STOKES, 2), dtype=np.int32)
+            self.bls[bcnt] = [data, 0, None, ant0, ant1]
+        bl = self.bls[bcnt]
+        t = (mcnt // N_TIME_PER_PACKET) % TIME_DEMUX
+        x = xeng_id % self.n_xeng
+        chan0 = (x * self.packets_per_x + offset) * CHAN_PER_CATCHER_PKT
+        payload = np.frombuffer(pkt, dtype="<i4", offset=PACKET_HEADER.size,
+                                count=payload_len // 4)
+        bl[0][t, chan0:chan0 + CHAN_PER_CATCHER_PKT] = payload.reshape(-1, N_STOKES, 2)
+        bl[1] += 1
+        bl[2] = mcnt - N_TIME_PER_PACKET * t
+
+        file_index = bcnt // self.bcnts_per_file
+        if bl[1] == self.packets_per_baseline:
+            self.ncomplete[file_index] += 1
+        while file_index - self.next_file >= 2 or self._file_complete(self.next_file):
+            self._write_file(self.next_file)
+
+    def _file_bcnts(self, file_index):
+        return range(file_index * self.bcnts_per_file, (file_index + 1) * self.bcnts_per_file)
+
+    def _file_complete(self, file_index):
+        return self.ncomplete[file_index] == self.bcnts_per_file
+
+    def flush(self):
+        """Write every file that has data."""
+        while len(self.bls) > 0:
+            self._write_file(self.next_file)
+
+    def _write_file(self, file_index):
+        bcnts = [bcnt for bcnt in self._file_bcnts(file_index) if bcnt in self.bls]
+        self.next_file = file_index + 1
+        self.ncomplete.pop(file_index, None)
+        if len(bcnts) == 0:
+            return
+        bls = [self.bls.pop(bcnt) for bcnt in bcnts]
+        data = np.stack([bl[0] for bl in bls])
+        mcnts = np.array([bl[2] for bl in bls], dtype=np.uint64)
+        data_sum, data_diff = sum_diff(data, chan_sum=self.chan_sum)
+
+        unix_time = mcnt_to_unix(int(mcnts[0]), self.sync_time_ms)
+        julian_time = float(unix_to_jd(unix_time))
+        jd_dir = f"{int(julian_time):d}"
+        os.makedirs(os.path.join(self.directory, jd_dir), exist_ok=True)
+        prefix = os.path.join(jd_dir, f"zen.{julian_time:7.5f}")
+        sum_fname = f"{prefix}.sum.dat"
+        diff_fname = f"{prefix}.diff.dat"
+        data_sum.tofile(os.path.join(self.directory, sum_fname))
+        data_diff.tofile(os.path.join(self.directory, diff_fname))
+        integration_time = self.integration_times[np.array(bcnts) % self.bcnts_per_file]
+        write_metadata(
+            os.path.join(self.directory, f"{prefix}.meta.hdf5"),
+            self.sync_time_ms,
+            int(mcnts[-1]),
+            mcnt_to_jd(mcnts.astype(np.float64), self.sync_time_ms, integration_time),
+            [bl[3] for bl in bls],
+            [bl[4] for bl in bls],
+            integration_time,
+            self.tag,
+            self.nchan // self.chan_sum,
+        )
+        self.files.extend([sum_fname, diff_fname])
+        now = time.time()
+        self.closed_times[sum_fname] = self.closed_times[diff_fname] = now
+        if self.r is not None:
+            self.r.rpush(RAW_FILE_KEY, sum_fname, diff_fname)
+
+        sent = self.send_times.get(bcnts[-1])
+        self.stats.record(
+            data_sum.nbytes + data_diff.nbytes,
+            latency=None if sent is None else now - sent,
+            nitems=2,
+            now=now,
+        )
+
+    def run(self, sock, stop, net_stats):
+        """
+        Receive packets until `stop` is set and the socket is idle, then flush.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            A bound UDP socket with a timeout.
+        stop : threading.Event
+            Set when no more packets will be sent.
+        net_stats : StageStats
+            Records the packets received.
+        """
+        bufsize = PACKET_HEADER.size + OUTPUT_BYTES_PER_PACKET
+        while True:
+            try:
+                pkt = sock.recv(bufsize)
+            except socket.timeout:
+                if stop.is_set():
+                    break
+                continue
+            net_stats.record(len(pkt))
+            self.add_packet(pkt)
+        self.flush()
+
+
+def convert_queue(r, directory, header_kwargs, done, convert_stats, check_stats,
+                  closed_times=None, codec="lzf"):
+    """
+    Convert and check queued raw files until `done` is set and the queue is empty.
+
+    Parameters
+    ----------
+    r : redis.Redis or LocalRedis
+        The connection holding the RAW_FILE_KEY queue.
+    directory : str
+        The directory queued names are relative to.
+    header_kwargs : dict
+        Keyword arguments of `file_conversion.get_uvh5_header`.
+    done : threading.Event
+        Set when no more files will be queued.
+    convert_stats, check_stats : StageStats
+        Record the conversions and checks. Failed checks are counted.
+    closed_times : dict, optional
+        The time each raw file was queued, to compute conversion latency.
+    codec : str, optional
+        The visdata codec.
+
+    Returns
+    -------
+    list of str
+        The UVH5 files written.
+    """
+    outputs = []
+    headers = {}
+    while True:
+        f = r.lpop(RAW_FILE_KEY)
+        if f is None:
+            if done.is_set() and r.llen(RAW_FILE_KEY) == 0:
+                break
+            time.sleep(0.05)
+            continue
+        now = time.time()
+        queued = now if closed_times is None else closed_times.get(f, now)
+        if convert_stats.start is None:
+            convert_stats.begin(now)
+        f_in = os.path.join(directory, f)
+        f_meta = f_in.rsplit(".", 2)[0] + ".meta.hdf5"
+        f_out = f_in.replace(".dat", ".uvh5")
+        if f_meta not in headers:
+            headers[f_meta] = file_conversion.get_uvh5_header(f_meta, **header_kwargs)
+        file_conversion.make_uvh5_file(
+            f_out, f_meta, f_in, header=headers[f_meta], codec=codec
+        )
+        now = time.time()
+        convert_stats.record(os.path.getsize(f_in), latency=now - queued, now=now)
+        if check_stats.start is None:
+            check_stats.begin(now)
+        try:
+            file_conversion.check_file(f_out)
+        except AssertionError:
+            check_stats.failed += 1
+        check_stats.record(os.path.getsize(f_out), latency=time.time() - now)
+        outputs.append(f_out)
+    return outputs
+
+
+def run_loopback(directory, nants=4, nfiles=2, nchan=384, n_xeng=1, rate=None,
+                 integration_time=2.0, r=None, codec="lzf", host="127.0.0.1",
+                 port=0, seed=0, idle_timeout=0.5):
+    """
+    Run the loopback pipeline: packets -> catcher files -> UVH5 -> checks.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write files to.
+    nants : int, optional
+        The number of antennas; every baseline including autos is sent, with
+        the BDA configuration of `make_bl_pairs`.
+    nfiles : int, optional
+        The number of raw files, each of `bl_order.N_MAX_INTTIME` integrations.
+    nchan : int, optional
+        The number of channels sent per baseline, a multiple of
+        384 * n_xeng so the UVH5 frequency axis can be computed.
+    n_xeng : int, optional
+        The number of X-engines per time sample.
+    rate : float, optional
+        The packet rate, in packets per second. Default is as fast as
+        possible.
+    integration_time : float, optional
+        The integration time of one input integration, in seconds.
+    r : redis.Redis, optional
+        The redis server to queue files in; it must not be the site redis,
+        since F-engine keys are written to it. Default is a `LocalRedis`.
+    codec : str, optional
+        The visdata codec of the UVH5 files.
+    host : str, optional
+        The address the catcher listens on.
+    port : int, optional
+        The port the catcher listens on. Default is any free port.
+    seed : int, optional
+        The seed of the visibilities.
+    idle_timeout : float, optional
+        The catcher stops after the generator finishes and no packet has
+        arrived for this many seconds.
+
+    Returns
+    -------
+    stats : dict
+        The `StageStats.summary` of each stage: "generator" (packets sent),
+        "network" (packets received, with the number lost), "catcher" (raw
+        files written, latency from the last packet of the file being sent),
+        "conversion" (raw bytes converted, latency from the raw file being
+        written) and "check" (UVH5 files checked, with the number failed).
+    outputs : list of str
+        The UVH5 files written.
+    generator : PacketGenerator
+        The generator, to regenerate the visibilities sent.
+    """
+    if nchan % (3 * CHAN_PER_CATCHER_PKT * n_xeng) != 0:
+        raise ValueError(f"nchan must be a multiple of {3 * CHAN_PER_CATCHER_PKT * n_xeng}")
+    if r is None:
+        r = LocalRedis()
+    # F-engine parameters giving the catcher channels after the 3/4 downselect
+    r.set("feng:sample_freq", FENG_SAMPLE_RATE)
+    r.set("feng:samples_per_mcnt", 2 * (nchan * 4 // 3))
+    header_kwargs = {
+        "cminfo": LOOPBACK_CMINFO,
+        "antpos_info": make_antpos_info(nants),
+        "rd": r,
+    }
+
+    generator = PacketGenerator(
+        make_bl_pairs(nants), nfiles, nchan=nchan, n_xeng=n_xeng,
+        integration_time=integration_time, seed=seed,
+    )
+    stats = {name: StageStats(name) for name in
+             ("generator", "network", "catcher", "conversion", "check")}
+    catcher = ReferenceCatcher(
+        directory, nchan, n_xeng, generator.layout, integration_time,
+        generator.sync_time_ms, r=r, send_times=generator.send_times,
+        stats=stats["catcher"],
+    )
+
+    recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 2**20)
+    recv_sock.bind((host, port))
+    recv_sock.settimeout(idle_timeout)
+    send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = threading.Event()
+    written = threading.Event()
+    results = {}
+
+    def run_catcher():
+        try:
+            catcher.run(recv_sock, sent, stats["network"])
+        except Exception as e:
+            results["catcher_error"] = e
+        finally:
+            written.set()
+
+    def run_converter():
+        try:
+            results["outputs"] = convert_queue(
+                r, directory, header_kwargs, written, stats["conversion"],
+                stats["check"], closed_times=catcher.closed_times, codec=codec,
+            )
+        except Exception as e:
+            results["converter_error"] = e
+            # let the catcher finish
+            written.wait()
+
+    threads = [threading.Thread(target=run_catcher), threading.Thread(target=run_converter)]
+    for thread in threads:
+        thread.start()
+    try:
+        generator.send(send_sock, recv_sock.getsockname(), stats["generator"], rate=rate)
+    finally:
+        sent.set()
+        for thread in threads:
+            thread.join()
+        recv_sock.close()
+        send_sock.close()
+
+    for key in ("catcher_error", "converter_error"):
+        if key in results:
+            raise results[key]
+    stats["network"].lost = generator.npackets - catcher.npackets
+    return {name: s.summary() for name, s in stats.items()}, results["outputs"], generator
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""Per-JD SQLite manifest of converted files."""
+
+import os
+import json
+import sqlite3
+from collections import namedtuple
+from urllib.request import pathname2url
+
+from .file_conversion import CHECKSUM_KEY
+from .mc_records import make_obs_record
+
+# name of the manifest file in each JD directory
+MANIFEST_NAME = "manifest.sqlite"
+
+# seconds to wait for another process to finish writing
+BUSY_TIMEOUT = 60.0
+
+# redis list of entries for files converted on another host, which the
+# host holding the files adds to its manifests; NFS file locking is not
+# reliable enough for SQLite writes
+QUEUED_ENTRIES_KEY = "corr:files:manifest:{host}"
+
+ManifestEntry = namedtuple(
+    "ManifestEntry",
+    [
+        "filename",
+        "obsid",
+        "start_jd",
+        "stop_jd",
+        "tag",
+        "nblts",
+        "raw_bytes",
+        "uvh5_bytes",
+        "checksum",
+        "conversion_start",
+        "conversion_time",
+    ],
+)
+ManifestEntry.__doc__ = """
+A converted file in the manifest.
+
+Parameters
+----------
+filename : str
+    The name of the file, relative to the JD directory.
+obsid : int
+    The observation ID (integer GPS second of the start time).
+start_jd, stop_jd : float
+    The JD of the first and last times in the file.
+tag : str
+    The observation tag.
+nblts : int
+    The number of baseline-times in the file.
+raw_bytes : int
+    The size of the raw data file(s) the file was made from.
+uvh5_bytes : int
+    The size of the file.
+checksum : int
+    The CRC-32 of the visdata; see `file_conversion.compute_visdata_checksum`.
+conversion_start : float
+    The unix time the conversion started.
+conversion_time : float
+    The time the conversion took, in seconds.
+"""
+
+_COLUMNS = (
+    "filename TEXT PRIMARY KEY, obsid INTEGER, start_jd REAL, stop_jd REAL, "
+    "tag TEXT, nblts INTEGER, raw_bytes INTEGER, uvh5_bytes INTEGER, "
+    "checksum INTEGER, conversion_start REAL, conversion_time REAL"
+)
+
+
+def get_manifest_path(jd_dir):
+    """Get the name of the manifest file of a JD directory."""
+    return os.path.join(jd_dir, MANIFEST_NAME)
+
+
+def make_manifest_entry(filename, metadata, raw_bytes, conversion_start, conversion_time):
+    """
+    Build a manifest entry for a converted file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the UVH5 file.
+    metadata : dict
+        The metadata returned by `file_conversion.make_uvh5_file`.
+    raw_bytes : int
+        The size of the raw data file(s) the file was made from.
+    conversion_start : float
+        The unix time the conversion started.
+    conversion_time : float
+        The time the conversion took, in seconds.
+
+    Returns
+    -------
+    ManifestEntry
+        The entry.
+    """
+    record = make_obs_record(metadata["time_array"], metadata["tag"], filename)
+    return ManifestEntry(
+        filename=os.path.basename(filename),
+        obsid=record.obsid,
+        start_jd=record.starttime,
+        stop_jd=record.stoptime,
+        tag=metadata["tag"],
+        nblts=len(metadata["time_array"]),
+        raw_bytes=int(raw_bytes),
+        uvh5_bytes=os.path.getsize(filename),
+        checksum=int(metadata[CHECKSUM_KEY]),
+        conversion_start=float(conversion_start),
+        conversion_time=float(conversion_time),
+    )
+
+
+class Manifest(object):
+    """
+    The manifest of converted files in a JD directory.
+
+    Several conversion workers may write to the same manifest at once; each
+    write is a single transaction, and readers never see a partial update.
+    The manifest uses a rollback journal rather than write-ahead logging,
+    which needs memory shared between the readers and writers, so that it
+    can be read over NFS.
+
+    Parameters
+    ----------
+    filename : str
+        The SQLite database file, e.g. from `get_manifest_path`. It is
+        created if it does not exist, unless `read_only` is set.
+    read_only : bool, optional
+        Open the manifest for queries only, without changing the file. This
+        is how consumers on other hosts, such as RTP, should open it.
+    """
+
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        self.read_only = read_only
+        if read_only:
+            uri = f"file:{pathname2url(os.path.abspath(filename))}?mode=ro"
+            self.conn = sqlite3.connect(uri, timeout=BUSY_TIMEOUT, uri=True)
+            return
+        self.conn = sqlite3.connect(filename, timeout=BUSY_TIMEOUT)
+        # also converts manifests written in WAL mode by older versions
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS files ({_COLUMNS})")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS files_start_jd ON files (start_jd)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_tag ON files (tag)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_obsid ON files (obsid)")
+
+    def add(self, entries):
+        """
+        Add or replace entries in one transaction.
+
+        Parameters
+        ----------
+        entries : ManifestEntry or list of ManifestEntry
+            The entries to write.
+        """
+        if isinstance(entries, ManifestEntry):
+            entries = [entries]
+        placeholders = ", ".join("?" * len(ManifestEntry._fields))
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO files VALUES ({placeholders})",
+                [tuple(entry) for entry in entries],
+            )
+
+    def remove(self, filename):
+        """Remove the entry of a file, if there is one."""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM files WHERE filename = ?", (os.path.basename(filename),)
+            )
+
+    def get(self, filename):
+        """
+        Get the entry of a file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file; only the base name is used.
+
+        Returns
+        -------
+        ManifestEntry or None
+            The entry, or None if the file is not in the manifest.
+        """
+        row = self.conn.execute(
+            "SELECT * FROM files WHERE filename = ?", (os.path.basename(filename),)
+        ).fetchone()
+        return None if row is None else ManifestEntry(*row)
+
+    def query(self, tag=None, start_jd=None, stop_jd=None, pattern=None):
+        """
+        List files, in time order.
+
+        Parameters
+        ----------
+        tag : str, optional
+            Only list files with this tag.
+        start_jd, stop_jd : float, optional
+            Only list files with data between these JDs.
+        pattern : str, optional
+            Only list files whose names match this SQL LIKE pattern, e.g.
+            "%.sum.uvh5".
+
+        Returns
+        -------
+        list of ManifestEntry
+            The matching entries, ordered by start JD then filename.
+        """
+        clauses = []
+        params = []
+        if tag is not None:
+            clauses.append("tag = ?")
+            params.append(tag)
+        if start_jd is not None:
+            clauses.append("stop_jd >= ?")
+            params.append(start_jd)
+        if stop_jd is not None:
+            clauses.append("start_jd <= ?")
+            params.append(stop_jd)
+        if pattern is not None:
+            clauses.append("filename LIKE ?")
+            params.append(pattern)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.conn.execute(
+            f"SELECT * FROM files{where} ORDER BY start_jd, filename", params
+        )
+        return [ManifestEntry(*row) for row in rows]
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def record_conversion(jd_dir, entries):
+    """
+    Add entries to the manifest of a JD directory.
+
+    Parameters
+    ----------
+    jd_dir : str
+        The JD directory holding the converted files.
+    entries : ManifestEntry or list of ManifestEntry
+        The entries to write.
+    """
+    with Manifest(get_manifest_path(jd_dir)) as manifest:
+        manifest.add(entries)
+
+
+def query_manifest(jd_dir, tag=None, start_jd=None, stop_jd=None, pattern=None):
+    """
+    List the converted files of a JD directory, opening its manifest read-only.
+
+    Parameters
+    ----------
+    jd_dir : str
+        The JD directory holding the converted files.
+    tag, start_jd, stop_jd, pattern : optional
+        Filters on the files; see `Manifest.query`.
+
+    Returns
+    -------
+    list of ManifestEntry
+        The matching entries, ordered by start JD then filename; empty if
+        the directory has no manifest.
+    """
+    filename = get_manifest_path(jd_dir)
+    if not os.path.exists(filename):
+        return []
+    with Manifest(filename, read_only=True) as manifest:
+        return manifest.query(tag=tag, start_jd=start_jd, stop_jd=stop_jd, pattern=pattern)
+
+
+def queue_conversion(r, host, jd_dir, entries, key=QUEUED_ENTRIES_KEY):
+    """
+    Queue entries for the manifest of a JD directory on another host.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        The redis connection.
+    host : str
+        The host holding the JD directory.
+    jd_dir : str
+        The JD directory, as seen on `host`.
+    entries : ManifestEntry or list of ManifestEntry
+        The entries to write.
+    key : str, optional
+        The redis list, formatted with the host.
+    """
+    if isinstance(entries, ManifestEntry):
+        entries = [entries]
+    r.rpush(
+        key.format(host=host),
+        *[json.dumps({"jd_dir": jd_dir, "entry": entry._asdict()}) for entry in entries],
+    )
+
+
+def record_queued_conversions(r, host, key=QUEUED_ENTRIES_KEY):
+    """
+    Add the entries queued for this host to its manifests.
+
+    Entries are only removed from the queue once they are written, so none
+    are lost if writing fails.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        The redis connection, with `decode_responses=True`.
+    host : str
+        This host.
+    key : str, optional
+        The redis list, formatted with the host.
+
+    Returns
+    -------
+    int
+        The number of entries written.
+    """
+    key = key.format(host=host)
+    queued = r.lrange(key, 0, -1)
+    if len(queued) == 0:
+        return 0
+    by_dir = {}
+    for item in queued:
+        item = json.loads(item)
+        by_dir.setdefault(item["jd_dir"], []).append(ManifestEntry(**item["entry"]))
+    for jd_dir, entries in by_dir.items():
+        record_conversion(jd_dir, entries)
+    # entries queued since the lrange stay queued
+    r.ltrim(key, len(queued), -1)
+    return len(queued)
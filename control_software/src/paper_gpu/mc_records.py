@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""Batched writes of observation and RTP launch records to M&C."""
+
+import json
+import sqlite3
+import numpy as np
+from collections import namedtuple
+from astropy.time import Time
+
+# redis list where converter workers leave records for the batching stage
+MC_PENDING_KEY = "corr:files:mc_pending"
+
+# SQLite limits the number of bound parameters per statement
+MAX_IN_PARAMS = 500
+
+ObsRecord = namedtuple(
+    "ObsRecord", ["obsid", "starttime", "stoptime", "tag", "jd", "filename", "prefix"]
+)
+ObsRecord.__doc__ = """
+An observation to be recorded in M&C, with its RTP launch record.
+
+Parameters
+----------
+obsid : int
+    The observation ID (integer GPS second of the start time).
+starttime, stoptime : float
+    The JD of the first and last times in the file.
+tag : str
+    The observation tag.
+jd : int
+    The integer JD of the observation.
+filename : str
+    The name of the converted file.
+prefix : str
+    The directory RTP should look in for the file.
+"""
+
+
+def make_obs_record(time_array, tag, filename, prefix=None):
+    """
+    Build an observation record for a converted file.
+
+    Parameters
+    ----------
+    time_array : array_like of float
+        The JDs of the baseline-times in the file.
+    tag : str
+        The observation tag.
+    filename : str
+        The name of the converted file.
+    prefix : str, optional
+        The directory RTP should look in for the file.
+
+    Returns
+    -------
+    ObsRecord
+        The record.
+    """
+    times = np.unique(time_array)
+    starttime = Time(times[0], scale="utc", format="jd")
+    return ObsRecord(
+        obsid=int(np.floor(starttime.gps)),
+        starttime=float(times[0]),
+        stoptime=float(times[-1]),
+        tag=tag,
+        jd=int(np.floor(starttime.jd)),
+        filename=filename,
+        prefix=prefix,
+    )
+
+
+def record_to_json(record):
+    """Serialize an `ObsRecord` for a redis queue."""
+    return json.dumps(record._asdict())
+
+
+def record_from_json(record_str):
+    """Deserialize an `ObsRecord` from a redis queue."""
+    return ObsRecord(**json.loads(record_str))
+
+
+def _chunks(items, size=MAX_IN_PARAMS):
+    """Split a list into lists of at most `size` items."""
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class HeraMCBackend(object):
+    """
+    M&C database backend using hera_mc.
+
+    The database object, and so the SQLAlchemy engine and its connection
+    pool, is created once and reused for every batch.
+
+    Parameters
+    ----------
+    db : hera_mc.mc.DB, optional
+        The database to use. Default is to connect with the default M&C
+        configuration.
+    """
+
+    def __init__(self, db=None):
+        from hera_mc import mc
+
+        self.db = mc.connect_to_mc_db(None) if db is None else db
+
+    def existing_obsids(self, obsids):
+        """Get the subset of `obsids` already in the hera_obs table."""
+        from hera_mc.observations import Observation
+
+        found = set()
+        with self.db.sessionmaker() as session:
+            for chunk in _chunks(obsids):
+                rows = session.query(Observation.obsid).filter(Observation.obsid.in_(chunk))
+                found.update(row[0] for row in rows)
+        return found
+
+    def existing_rtp_obsids(self, obsids):
+        """Get the subset of `obsids` already in the rtp_launch_record table."""
+        from hera_mc.rtp import RTPLaunchRecord
+
+        found = set()
+        with self.db.sessionmaker() as session:
+            for chunk in _chunks(obsids):
+                rows = session.query(RTPLaunchRecord.obsid).filter(
+                    RTPLaunchRecord.obsid.in_(chunk)
+                )
+                found.update(row[0] for row in rows)
+        return found
+
+    def write(self, new_obs, new_rtp, resubmit_obsids, submit_time):
+        """
+        Insert and update records in a single transaction.
+
+        Parameters
+        ----------
+        new_obs : list of ObsRecord
+            Records to add to the hera_obs table.
+        new_rtp : list of ObsRecord
+            Records to add to the rtp_launch_record table.
+        resubmit_obsids : list of int
+            Observations whose RTP launch record should be marked resubmitted.
+        submit_time : astropy.time.Time
+            The submission time for resubmitted records.
+        """
+        from hera_mc.observations import Observation
+        from hera_mc.rtp import RTPLaunchRecord
+
+        with self.db.sessionmaker() as session:
+            session.add_all(
+                [
+                    Observation.create(
+                        Time(rec.starttime, scale="utc", format="jd"),
+                        Time(rec.stoptime, scale="utc", format="jd"),
+                        rec.obsid,
+                        rec.tag,
+                    )
+                    for rec in new_obs
+                ]
+            )
+            session.add_all(
+                [
+                    RTPLaunchRecord(
+                        obsid=rec.obsid,
+                        submitted_time=None,
+                        rtp_attempts=0,
+                        jd=rec.jd,
+                        obs_tag=rec.tag,
+                        filename=rec.filename,
+                        prefix=rec.prefix,
+                    )
+                    for rec in new_rtp
+                ]
+            )
+            for chunk in _chunks(resubmit_obsids):
+                session.query(RTPLaunchRecord).filter(
+                    RTPLaunchRecord.obsid.in_(chunk)
+                ).update(
+                    {
+                        RTPLaunchRecord.submitted_time: int(np.floor(submit_time.gps)),
+                        RTPLaunchRecord.rtp_attempts: RTPLaunchRecord.rtp_attempts + 1,
+                    },
+                    synchronize_session=False,
+                )
+            session.commit()
+
+
+class SQLiteBackend(object):
+    """
+    A local SQLite stand-in for the M&C database.
+
+    Only the columns of hera_obs and rtp_launch_record written by the
+    converter are modelled.
+
+    Parameters
+    ----------
+    filename : str, optional
+        The SQLite database file. Default is an in-memory database.
+    """
+
+    def __init__(self, filename=":memory:"):
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS hera_obs ("
+                "obsid INTEGER PRIMARY KEY, starttime REAL, stoptime REAL, "
+                "jd_start REAL, tag TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rtp_launch_record ("
+                "obsid INTEGER PRIMARY KEY, submitted_time INTEGER, "
+                "rtp_attempts INTEGER, jd INTEGER, obs_tag TEXT, filename TEXT, "
+                "prefix TEXT)"
+            )
+
+    def _existing(self, table, obsids):
+        found = set()
+        for chunk in _chunks(obsids):
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT obsid FROM {table} WHERE obsid IN ({placeholders})", chunk
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def existing_obsids(self, obsids):
+        """Get the subset of `obsids` already in the hera_obs table."""
+        return self._existing("hera_obs", obsids)
+
+    def existing_rtp_obsids(self, obsids):
+        """Get the subset of `obsids` already in the rtp_launch_record table."""
+        return self._existing("rtp_launch_record", obsids)
+
+    def write(self, new_obs, new_rtp, resubmit_obsids, submit_time):
+        """Insert and update records in a single transaction; see `HeraMCBackend.write`."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO hera_obs VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        rec.obsid,
+                        Time(rec.starttime, scale="utc", format="jd").gps,
+                        Time(rec.stoptime, scale="utc", format="jd").gps,
+                        rec.starttime,
+                        rec.tag,
+                    )
+                    for rec in new_obs
+                ],
+            )
+            self.conn.executemany(
+                "INSERT INTO rtp_launch_record VALUES (?, NULL, 0, ?, ?, ?, ?)",
+                [(rec.obsid, rec.jd, rec.tag, rec.filename, rec.prefix) for rec in new_rtp],
+            )
+            self.conn.executemany(
+                "UPDATE rtp_launch_record SET submitted_time = ?, "
+                "rtp_attempts = rtp_attempts + 1 WHERE obsid = ?",
+                [(int(np.floor(submit_time.gps)), obsid) for obsid in resubmit_obsids],
+            )
+
+
+class MCBatchWriter(object):
+    """
+    Collect finished observations and write them to M&C in batches.
+
+    Parameters
+    ----------
+    backend : HeraMCBackend or SQLiteBackend
+        The database backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pending = []
+
+    def add(self, record):
+        """Queue an `ObsRecord` for the next flush."""
+        self.pending.append(record)
+
+    def flush(self, submit_time=None):
+        """
+        Write all queued records to M&C.
+
+        Existing observations are looked up with one IN query per table, then
+        new observation and RTP launch records are inserted, and existing RTP
+        launch records updated, in a single transaction. If the write fails
+        the records stay queued.
+
+        Parameters
+        ----------
+        submit_time : astropy.time.Time, optional
+            The submission time for resubmitted RTP launch records. Default is
+            the current time.
+
+        Returns
+        -------
+        dict
+            Lists of the new_obs and new_rtp records written, and the
+            resubmitted obsids.
+        """
+        # keep the first record of each obsid
+        records = []
+        seen = set()
+        for rec in self.pending:
+            if rec.obsid not in seen:
+                seen.add(rec.obsid)
+                records.append(rec)
+        if len(records) == 0:
+            return {"new_obs": [], "new_rtp": [], "resubmitted": []}
+        if submit_time is None:
+            submit_time = Time.now()
+
+        obsids = [rec.obsid for rec in records]
+        existing_obs = self.backend.existing_obsids(obsids)
+        existing_rtp = self.backend.existing_rtp_obsids(obsids)
+        new_obs = [rec for rec in records if rec.obsid not in existing_obs]
+        new_rtp = [rec for rec in records if rec.obsid not in existing_rtp]
+        resubmitted = [rec.obsid for rec in records if rec.obsid in existing_rtp]
+
+        self.backend.write(new_obs, new_rtp, resubmitted, submit_time)
+        self.pending = []
+
+        return {"new_obs": new_obs, "new_rtp": new_rtp, "resubmitted": resubmitted}
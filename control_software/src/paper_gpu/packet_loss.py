@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+Packet loss and ordering analysis of the catcher's BDA input.
+
+Packet headers, captured live or read from a pcap file, are placed in
+per-window bitmaps laid out like the catcher's input blocks (one window is
+`BASELINES_PER_BLOCK` bcnts), and compared with the packets expected from
+the BDA configuration. Missing packets, duplicates, gaps and reordering
+depth are counted per X-engine and per BDA tier.
+"""
+
+import json
+import time
+import numpy as np
+
+from . import capture
+from .bl_order import N_BDABUF_BINS, N_MAX_INTTIME, get_bda_bcnt_layout
+from .sum_diff import BASELINES_PER_BLOCK, N_CHAN_TOTAL, N_STOKES, TIME_DEMUX
+
+# catcher packet layout; see paper_databuf.h and hera_catcher_net_thread.c
+CATCHER_PACKET_HEADER_DTYPE = np.dtype([
+    ("mcnt", ">u8"), ("bcnt", ">u4"), ("offset", ">u4"), ("ant0", ">u2"),
+    ("ant1", ">u2"), ("xeng_id", ">u2"), ("payload_len", ">u2"),
+])
+OUTPUT_BYTES_PER_PACKET = 4096
+CHAN_PER_CATCHER_PKT = OUTPUT_BYTES_PER_PACKET // (N_STOKES * 8)
+N_XENGINES_PER_TIME = 16
+PACKETS_PER_BL_PER_X = N_CHAN_TOTAL // CHAN_PER_CATCHER_PKT // N_XENGINES_PER_TIME
+N_TIME_PER_PACKET = 2
+
+# histogram bin k counts values in [2**k, 2**(k+1))
+N_HIST_BINS = 16
+PACKET_LOSS_KEY = "corr:catcher:packet_loss"
+
+# pcap framing of UDP over IPv4 over ethernet
+PCAP_GLOBAL_HEADER_SIZE = 24
+PCAP_RECORD_HEADER_DTYPE = np.dtype(
+    [("ts_sec", "u4"), ("ts_usec", "u4"), ("incl_len", "u4"), ("orig_len", "u4")]
+)
+UDP_PAYLOAD_OFFSET = 14 + 20 + 8
+
+
+def read_pcap_headers(filename, payload_offset=UDP_PAYLOAD_OFFSET):
+    """
+    Read the catcher packet headers from a pcap capture.
+
+    Parameters
+    ----------
+    filename : str
+        A classic (not pcapng) pcap file, e.g. from `tcpdump -w`.
+    payload_offset : int, optional
+        The offset of the UDP payload in each frame.
+
+    Returns
+    -------
+    ndarray of CATCHER_PACKET_HEADER_DTYPE
+        The headers, in capture order. Frames too short to hold a header are
+        skipped.
+
+    Raises
+    ------
+    ValueError
+        Raised if the file is not a pcap file.
+    """
+    raw = np.memmap(filename, dtype=np.uint8, mode="r")
+    magic = raw[:4].tobytes()
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        record_dtype = PCAP_RECORD_HEADER_DTYPE.newbyteorder("<")
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        record_dtype = PCAP_RECORD_HEADER_DTYPE.newbyteorder(">")
+    else:
+        raise ValueError(f"{filename} is not a pcap file")
+
+    # records are variable length, so walk the record headers first
+    starts = []
+    pos = PCAP_GLOBAL_HEADER_SIZE
+    hsize = record_dtype.itemsize
+    while pos + hsize <= len(raw):
+        incl_len = int(raw[pos:pos + hsize].view(record_dtype)["incl_len"][0])
+        if incl_len >= payload_offset + CATCHER_PACKET_HEADER_DTYPE.itemsize:
+            starts.append(pos + hsize + payload_offset)
+        pos += hsize + incl_len
+    starts = np.asarray(starts, dtype=np.intp)
+
+    index = starts[:, np.newaxis] + np.arange(CATCHER_PACKET_HEADER_DTYPE.itemsize)
+    return np.ascontiguousarray(raw[index]).view(CATCHER_PACKET_HEADER_DTYPE)[:, 0]
+
+
+def capture_headers(sock, npackets=None, duration=None, batch_size=capture.DEFAULT_BATCH_SIZE,
+                    timeout=1.0):
+    """
+    Capture catcher packet headers from a socket.
+
+    Only the headers are received; the payloads are truncated by the kernel.
+
+    Parameters
+    ----------
+    sock : socket.socket
+        A bound UDP socket.
+    npackets : int, optional
+        Stop after this many packets.
+    duration : float, optional
+        Stop after this many seconds.
+    batch_size : int, optional
+        The maximum number of packets received per batch.
+    timeout : float, optional
+        Stop if no packet arrives for this long, in seconds.
+
+    Returns
+    -------
+    ndarray of CATCHER_PACKET_HEADER_DTYPE
+        The headers, in arrival order.
+    """
+    ring = capture.PacketRing(4 * batch_size, CATCHER_PACKET_HEADER_DTYPE.itemsize)
+    sock.settimeout(timeout)
+    batches = []
+    n = 0
+    stop = None if duration is None else time.time() + duration
+    while (npackets is None or n < npackets) and (stop is None or time.time() < stop):
+        nmax = batch_size if npackets is None else min(batch_size, npackets - n)
+        slots = ring.recv_batch(sock, nmax)
+        if slots.stop == slots.start:
+            break
+        batches.append(capture.decode_headers(ring, slots, CATCHER_PACKET_HEADER_DTYPE))
+        n += len(batches[-1])
+    if not batches:
+        return np.zeros(0, dtype=CATCHER_PACKET_HEADER_DTYPE)
+    return np.concatenate(batches)
+
+
+def _log2_hist(values, labels, nlabels):
+    """Histogram `values` >= 1 in power-of-two bins, per label."""
+    hist = np.zeros((nlabels, N_HIST_BINS), dtype=np.int64)
+    bins = np.minimum(np.log2(values).astype(np.int64), N_HIST_BINS - 1)
+    np.add.at(hist, (labels, bins), 1)
+    return hist
+
+
+def _mode(values):
+    """Get the most common value."""
+    unique, counts = np.unique(values, return_counts=True)
+    return unique[np.argmax(counts)]
+
+
+def get_bcnt_integrations(bcnt, layout):
+    """
+    Get the last input integration averaged into each bcnt.
+
+    The BDA thread stamps each output sample with the mcnt of the last
+    integration added to it, so this fixes the mcnt of the bcnt's packets.
+
+    Parameters
+    ----------
+    bcnt : ndarray of int
+        The bcnts.
+    layout : dict
+        The bcnt layout, from `bl_order.get_bda_bcnt_layout`.
+
+    Returns
+    -------
+    ndarray of int
+        The integration index, counted from the first integration of bcnt 0.
+    """
+    nbcnts = len(layout["sample"])
+    pos = bcnt % nbcnts
+    last = (layout["sample"][pos] + 1) * layout["inttime"][pos] - 1
+    return bcnt // nbcnts * N_MAX_INTTIME + last
+
+
+def _infer_mcnt_step(mcnt, integration):
+    """Infer the mcnts per integration from the first and last integrations seen."""
+    if len(integration) == 0 or integration.min() == integration.max():
+        return 0
+    lo = integration.min()
+    hi = integration.max()
+    m_lo = _mode(mcnt[integration == lo])
+    m_hi = _mode(mcnt[integration == hi])
+    return int(np.round((m_hi - m_lo) / (hi - lo)))
+
+
+def analyze_packets(headers, bl_pairs, n_xeng=N_XENGINES_PER_TIME,
+                    packets_per_x=PACKETS_PER_BL_PER_X,
+                    baselines_per_block=BASELINES_PER_BLOCK, mcnt_step=None):
+    """
+    Measure the coverage, loss and ordering of a sequence of catcher packets.
+
+    The BDA configuration fixes what each bcnt carries: its antenna pair, and
+    the integration whose mcnt stamps it (see `get_bcnt_integrations`). The
+    expected packets are every (time demux, X-engine, offset) of every bcnt
+    from the lowest to the highest received, each with that antenna pair and
+    with an mcnt of `mcnt_step` per integration from the most common start.
+    A packet with the wrong antenna pair or mcnt is counted as invalid, and
+    its place as missing. Loss before the first or after the last packet
+    received is not seen.
+
+    Parameters
+    ----------
+    headers : ndarray of CATCHER_PACKET_HEADER_DTYPE
+        The packet headers, in arrival order.
+    bl_pairs : array_like of int
+        The BDA configuration, as returned by
+        `bda.read_bda_config_from_redis`, which gives the antenna pair,
+        integration and tier of each bcnt.
+    n_xeng : int, optional
+        The number of X-engines per time demux sample.
+    packets_per_x : int, optional
+        The number of packets per baseline per X-engine.
+    baselines_per_block : int, optional
+        The number of bcnts in a window.
+    mcnt_step : int, optional
+        The mcnts between consecutive integrations. Default is to infer it
+        from the packets of the first and last integrations received.
+
+    Returns
+    -------
+    dict
+        "received", "expected", "missing", "duplicates" and "invalid" (packets
+        whose offset, xeng_id, antenna pair or mcnt is inconsistent with the
+        layout, which are otherwise ignored), each a total, with
+        "invalid_antpair" and "invalid_mcnt", the invalid packets with
+        otherwise valid offsets and xeng_ids; "mcnt_step", as given or
+        inferred; "missing_per_xeng",
+        "missing_per_tier", "duplicates_per_xeng" and "duplicates_per_tier"
+        counts; "gap_hist" and "reorder_hist", histograms of the length of
+        each gap and of how many positions each late packet arrived behind
+        the newest packet of its X-engine, each a dict with arrays of shape
+        (Nxeng_ids, N_HIST_BINS) and (N_BDABUF_BINS, N_HIST_BINS) under
+        "xeng" and "tier"; "first_window", the window of the first bitmap;
+        and "bitmaps", the packed per-window bitmaps of packets received,
+        indexed like `hera_catcher_bda_input_databuf_pkt_offset`.
+    """
+    layout = get_bda_bcnt_layout(bl_pairs)
+    bcnt_tier = layout["tier"]
+    nxeng_ids = TIME_DEMUX * n_xeng
+    packets_per_bcnt = nxeng_ids * packets_per_x
+    window_size = baselines_per_block * packets_per_bcnt
+
+    bcnt = headers["bcnt"].astype(np.int64)
+    offset = headers["offset"].astype(np.int64)
+    xeng_id = headers["xeng_id"].astype(np.int64)
+    mcnt = headers["mcnt"].astype(np.int64)
+    t = mcnt // N_TIME_PER_PACKET % TIME_DEMUX
+    valid = (offset < packets_per_x) & (xeng_id < nxeng_ids) & (xeng_id // n_xeng == t)
+
+    # the antenna pair and mcnt each bcnt should carry
+    pos = bcnt % len(bcnt_tier)
+    good_antpair = (
+        (headers["ant0"] == layout["ant_0_array"][pos])
+        & (headers["ant1"] == layout["ant_1_array"][pos])
+    )
+    integration = get_bcnt_integrations(bcnt, layout)
+    mcnt_base = mcnt - t * N_TIME_PER_PACKET
+    ref = valid & good_antpair
+    if mcnt_step is None:
+        mcnt_step = _infer_mcnt_step(mcnt_base[ref], integration[ref])
+    mcnt_start = mcnt_base - integration * mcnt_step
+    if np.any(ref):
+        good_mcnt = mcnt_start == _mode(mcnt_start[ref])
+    else:
+        good_mcnt = np.zeros(len(mcnt), dtype=bool)
+
+    keep = valid & good_antpair & good_mcnt
+    bcnt = bcnt[keep]
+    offset = offset[keep]
+    xeng_id = xeng_id[keep]
+    tier = bcnt_tier[bcnt % len(bcnt_tier)]
+
+    out = {
+        "invalid": int(np.count_nonzero(~keep)),
+        "invalid_antpair": int(np.count_nonzero(valid & ~good_antpair)),
+        "invalid_mcnt": int(np.count_nonzero(ref & ~good_mcnt)),
+        "mcnt_step": int(mcnt_step),
+    }
+    if len(bcnt) == 0:
+        bcnt_range = (0, -1)
+    else:
+        bcnt_range = (bcnt.min(), bcnt.max())
+
+    # position of each packet in the window bitmaps, as in the catcher
+    first_window = bcnt_range[0] // baselines_per_block
+    b = bcnt - first_window * baselines_per_block
+    x = xeng_id % n_xeng
+    slot = ((b * TIME_DEMUX + xeng_id // n_xeng) * n_xeng + x) * packets_per_x + offset
+    nwindows = bcnt_range[1] // baselines_per_block - first_window + 1
+
+    received = np.zeros(max(nwindows, 0) * window_size, dtype=bool)
+    received[slot] = True
+    unique_slots, counts = np.unique(slot, return_counts=True)
+    dup_slots = unique_slots[counts > 1]
+    dup_counts = counts[counts > 1] - 1
+
+    # expected packets lie between the first and last bcnt received
+    expected = np.zeros_like(received)
+    lo = (bcnt_range[0] - first_window * baselines_per_block) * packets_per_bcnt
+    hi = (bcnt_range[1] - first_window * baselines_per_block + 1) * packets_per_bcnt
+    expected[lo:hi] = True
+    missing = np.flatnonzero(expected & ~received)
+
+    def slot_labels(slots):
+        """Get the xeng_id and tier of bitmap positions."""
+        sb, rem = np.divmod(slots, packets_per_bcnt)
+        st, sx = np.divmod(rem // packets_per_x, n_xeng)
+        sbcnt = sb + first_window * baselines_per_block
+        return st * n_xeng + sx, bcnt_tier[sbcnt % len(bcnt_tier)]
+
+    miss_xeng, miss_tier = slot_labels(missing)
+    dup_xeng, dup_tier = slot_labels(dup_slots)
+    out.update({
+        "received": int(len(bcnt)),
+        "expected": int(hi - lo),
+        "missing": int(len(missing)),
+        "duplicates": int(dup_counts.sum()),
+        "missing_per_xeng": np.bincount(miss_xeng, minlength=nxeng_ids),
+        "missing_per_tier": np.bincount(miss_tier, minlength=N_BDABUF_BINS),
+        "duplicates_per_xeng": np.bincount(dup_xeng, dup_counts, nxeng_ids).astype(np.int64),
+        "duplicates_per_tier": np.bincount(dup_tier, dup_counts, N_BDABUF_BINS).astype(np.int64),
+    })
+
+    # each X-engine sends its packets in (bcnt, offset) order, so compare
+    # each packet with the newest one before it from the same X-engine
+    seq = bcnt * packets_per_x + offset
+    order = np.argsort(xeng_id, kind="stable")
+    s_xeng = xeng_id[order]
+    s_seq = seq[order]
+    s_tier = tier[order]
+    # a running max within each X-engine, by offsetting each X-engine's values
+    span = (s_seq.max() - s_seq.min() + 2) if len(s_seq) else 1
+    shifted = s_seq - (s_seq.min() if len(s_seq) else 0) + s_xeng * span
+    newest = np.maximum.accumulate(shifted) - s_xeng * span + (s_seq.min() if len(s_seq) else 0)
+    same = np.zeros(len(s_seq), dtype=bool)
+    same[1:] = s_xeng[1:] == s_xeng[:-1]
+    prev_newest = np.roll(newest, 1)
+    step = s_seq - prev_newest
+    is_gap = same & (step > 1)
+    is_late = same & (step < 0)
+    out["gap_hist"] = {
+        "xeng": _log2_hist(step[is_gap] - 1, s_xeng[is_gap], nxeng_ids),
+        "tier": _log2_hist(step[is_gap] - 1, s_tier[is_gap], N_BDABUF_BINS),
+    }
+    out["reorder_hist"] = {
+        "xeng": _log2_hist(-step[is_late], s_xeng[is_late], nxeng_ids),
+        "tier": _log2_hist(-step[is_late], s_tier[is_late], N_BDABUF_BINS),
+    }
+    out["first_window"] = int(first_window)
+    out["bitmaps"] = np.packbits(received.reshape(max(nwindows, 0), window_size), axis=1)
+    return out
+
+
+def format_summary(report):
+    """
+    Format the totals of `analyze_packets` as a few lines of text.
+    """
+    lines = [
+        "received %d of %d expected packets: %d missing, %d duplicates, %d invalid"
+        % (report["received"], report["expected"], report["missing"],
+           report["duplicates"], report["invalid"]),
+    ]
+    if report["invalid_antpair"] > 0 or report["invalid_mcnt"] > 0:
+        lines.append(
+            "  %d with the wrong antenna pair, %d with the wrong mcnt (%d per integration)"
+            % (report["invalid_antpair"], report["invalid_mcnt"], report["mcnt_step"])
+        )
+    for label in ("xeng", "tier"):
+        name = "xeng_id" if label == "xeng" else "tier"
+        missing = report[f"missing_per_{label}"]
+        ngaps = report["gap_hist"][label].sum(axis=1)
+        nlate = report["reorder_hist"][label].sum(axis=1)
+        for i in np.flatnonzero((missing > 0) | (ngaps > 0) | (nlate > 0)):
+            lines.append(
+                "  %s %2d: %d missing in %d gaps, %d duplicates, %d late"
+                % (name, i, missing[i], ngaps[i], report[f"duplicates_per_{label}"][i], nlate[i])
+            )
+    return "\n".join(lines)
+
+
+def write_report_to_redis(r, report, key=PACKET_LOSS_KEY):
+    """
+    Write the counts of `analyze_packets` to a redis hash.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        The redis connection.
+    report : dict
+        The output of `analyze_packets`.
+    key : str, optional
+        The hash to write; the totals are integers and the per X-engine and
+        per tier counts and histograms are JSON lists. The bitmaps are not
+        written.
+    """
+    mapping = {"time": time.time()}
+    for name, value in report.items():
+        if name == "bitmaps":
+            continue
+        if isinstance(value, dict):
+            for label, hist in value.items():
+                mapping[f"{name}_{label}"] = json.dumps(hist.tolist())
+        elif isinstance(value, np.ndarray):
+            mapping[name] = json.dumps(value.tolist())
+        else:
+            mapping[name] = value
+    r.hset(key, mapping=mapping)
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+Opt-in profiling of the per-file work of the long-running daemons.
+
+Profiling is switched on for a stage ("convert" or "upload") with the
+PAPER_GPU_PROFILE environment variable, or while the stage's field of the
+PROFILE_KEY redis hash is set, to either "sample" or "cprofile". Each file
+is then profiled on its own, with a low-overhead stack sampler or with
+cProfile, and the profile is written to a per-stage directory which keeps
+only the newest profiles. `load_profiles` and `merge_collapsed` combine the
+profiles of both modes into collapsed stacks (one "frame;frame;... count"
+line per stack) rooted at their stage, ready for flamegraph.pl or
+speedscope.
+"""
+
+import os
+import re
+import sys
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import contextlib
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = "PAPER_GPU_PROFILE"
+PROFILE_DIR_ENV = "PAPER_GPU_PROFILE_DIR"
+# redis hash of stage -> profiling mode
+PROFILE_KEY = "corr:profiling"
+DEFAULT_PROFILE_DIR = "/tmp/paper_gpu_profiles"
+PROFILE_MODES = ("sample", "cprofile")
+# profiles kept per stage
+DEFAULT_MAX_PROFILES = 500
+# seconds between stack samples
+DEFAULT_INTERVAL = 0.005
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def get_profile_mode(stage, r=None):
+    """
+    Get whether, and how, to profile a stage.
+
+    Parameters
+    ----------
+    stage : str
+        The stage, e.g. "convert" or "upload".
+    r : redis.Redis, optional
+        The redis connection, with `decode_responses=True`. The stage's field
+        of PROFILE_KEY is used if the environment variable is not set.
+
+    Returns
+    -------
+    str or None
+        One of PROFILE_MODES, or None if profiling is off. An unknown mode
+        is logged and treated as off, so a typo cannot stop the daemons.
+    """
+    mode = os.environ.get(PROFILE_ENV)
+    if mode is None and r is not None:
+        mode = r.hget(PROFILE_KEY, stage)
+    if mode is None:
+        return None
+    mode = mode.strip().lower()
+    if mode in ("", "0", "off", "false"):
+        return None
+    if mode in ("1", "on", "true"):
+        return PROFILE_MODES[0]
+    if mode not in PROFILE_MODES:
+        logger.warning(
+            "Unknown profiling mode %r for %s; must be one of %s", mode, stage, PROFILE_MODES
+        )
+        return None
+    return mode
+
+
+def get_profile_dir():
+    """Get the profile directory, $PAPER_GPU_PROFILE_DIR or DEFAULT_PROFILE_DIR."""
+    return os.environ.get(PROFILE_DIR_ENV, DEFAULT_PROFILE_DIR)
+
+
+def frame_label(frame):
+    """Label a stack frame as "file.py:function"."""
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def get_stack(frame):
+    """Get the labels of a frame and its callers, outermost first."""
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    return tuple(stack[::-1])
+
+
+class StackSampler(object):
+    """
+    Count the stacks of one thread, sampled from a background thread.
+
+    Sampling wall-clock time from a thread, rather than CPU time with a
+    signal, also counts time spent waiting on disk and network reads, and
+    works on the worker threads of the uploader.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Seconds between samples.
+    thread_id : int, optional
+        The thread to sample. Default is the thread calling `start`.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.counts = Counter()
+        self.nsamples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """Record the current stack of the thread."""
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.counts[get_stack(frame)] += 1
+        self.nsamples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """Start sampling."""
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def format_collapsed(counts):
+    """
+    Format stack counts as collapsed stacks.
+
+    Parameters
+    ----------
+    counts : dict
+        The number of samples of each stack, keyed by tuples of frame labels
+        or by ";"-joined strings.
+
+    Returns
+    -------
+    str
+        One "frame;frame;... count" line per stack, sorted by stack.
+    """
+    lines = []
+    for stack, count in counts.items():
+        if not isinstance(stack, str):
+            stack = ";".join(stack)
+        lines.append(f"{stack} {count}")
+    return "".join(line + "\n" for line in sorted(lines))
+
+
+def parse_collapsed(text):
+    """
+    Parse collapsed stacks.
+
+    Parameters
+    ----------
+    text : str
+        "frame;frame;... count" lines.
+
+    Returns
+    -------
+    Counter
+        The number of samples of each stack, keyed by tuples of frame labels.
+    """
+    counts = Counter()
+    for line in text.splitlines():
+        stack, _, count = line.rpartition(" ")
+        if stack:
+            counts[tuple(stack.split(";"))] += int(count)
+    return counts
+
+
+class ProfileWriter(object):
+    """
+    Write the profiles of one stage to a directory, keeping the newest.
+
+    Parameters
+    ----------
+    stage : str
+        The stage; profiles go to a subdirectory of that name.
+    directory : str, optional
+        The profile directory. Default is `get_profile_dir()`.
+    max_files : int, optional
+        The number of profiles to keep.
+    """
+
+    def __init__(self, stage, directory=None, max_files=DEFAULT_MAX_PROFILES):
+        if directory is None:
+            directory = get_profile_dir()
+        self.stage = stage
+        self.directory = os.path.join(directory, stage)
+        self.max_files = max_files
+
+    def path(self, name, ext):
+        """Get a new profile file name, with the time, pid and file name."""
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        name = _UNSAFE_CHARS.sub("_", os.path.basename(name))
+        return os.path.join(self.directory, f"{stamp}.{os.getpid()}.{name}{ext}")
+
+    def rotate(self):
+        """Remove all but the newest `max_files` profiles."""
+        mtimes = []
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            try:
+                mtimes.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # another process rotated it first
+                continue
+        mtimes.sort(reverse=True)
+        for _, path in mtimes[self.max_files:]:
+            try:
+                os.remove(path)
+            except OSError:
+                # another process rotated it first
+                pass
+
+    def save_samples(self, name, counts):
+        """Write the stack counts of a file as collapsed stacks."""
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.path(name, ".collapsed")
+        with open(filename, "w") as fh:
+            fh.write(format_collapsed(counts))
+        self.rotate()
+        return filename
+
+    def save_stats(self, name, profiler):
+        """Write the cProfile stats of a file."""
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.path(name, ".prof")
+        profiler.dump_stats(filename)
+        self.rotate()
+        return filename
+
+
+@contextlib.contextmanager
+def profiled(stage, name, mode, directory=None, max_files=DEFAULT_MAX_PROFILES,
+             interval=DEFAULT_INTERVAL):
+    """
+    Profile the work on one file in the calling thread.
+
+    Parameters
+    ----------
+    stage : str
+        The stage, e.g. "convert".
+    name : str
+        The file being worked on, used in the profile name.
+    mode : str or None
+        One of PROFILE_MODES, or None to not profile.
+    directory : str, optional
+        The profile directory. Default is `get_profile_dir()`.
+    max_files : int, optional
+        The number of profiles to keep for the stage.
+    interval : float, optional
+        Seconds between samples, for the "sample" mode.
+
+    Notes
+    -----
+    Profiling never fails the work: an unknown mode is logged and the file
+    is not profiled, and errors writing the profile are logged.
+    """
+    if mode is not None and mode not in PROFILE_MODES:
+        logger.warning("Unknown profiling mode %r; not profiling %s", mode, name)
+        mode = None
+    if mode is None:
+        yield
+        return
+    writer = ProfileWriter(stage, directory=directory, max_files=max_files)
+    if mode == "sample":
+        sampler = StackSampler(interval=interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            _save(writer.save_samples, name, sampler.counts)
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            _save(writer.save_stats, name, profiler)
+
+
+def _save(save, name, profile):
+    # called from a finally block, so it must not raise over the work's own
+    # exception, or in place of its result
+    try:
+        save(name, profile)
+    except Exception as e:
+        logger.warning("Failed to save the profile of %s: %s", name, e)
+
+
+def load_profiles(directory=None, stages=None):
+    """
+    Read the profiles of each stage.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The profile directory. Default is `get_profile_dir()`.
+    stages : list of str, optional
+        The stages to read. Default is every subdirectory.
+
+    Returns
+    -------
+    dict
+        For each stage, a dict of the sampled stack counts ("samples", a
+        Counter), the combined cProfile stats ("stats", a pstats.Stats or
+        None) and the number of profiles read ("nprofiles").
+    """
+    if directory is None:
+        directory = get_profile_dir()
+    if stages is None:
+        stages = sorted(
+            d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))
+        )
+    out = {}
+    for stage in stages:
+        stage_dir = os.path.join(directory, stage)
+        samples = Counter()
+        stats = None
+        nprofiles = 0
+        for f in sorted(os.listdir(stage_dir)):
+            path = os.path.join(stage_dir, f)
+            if f.endswith(".collapsed"):
+                with open(path, "r") as fh:
+                    samples.update(parse_collapsed(fh.read()))
+            elif f.endswith(".prof"):
+                if stats is None:
+                    stats = pstats.Stats(path)
+                else:
+                    stats.add(path)
+            else:
+                continue
+            nprofiles += 1
+        out[stage] = {"samples": samples, "stats": stats, "nprofiles": nprofiles}
+    return out
+
+
+def stats_to_collapsed(stats, interval=DEFAULT_INTERVAL):
+    """
+    Convert cProfile stats to collapsed stacks.
+
+    cProfile records the time spent in each call from caller to callee, not
+    whole stacks, so each function's time is split among the stacks of its
+    callers in proportion to the time spent in it from each one. Recursive
+    calls are folded into the outermost call.
+
+    Parameters
+    ----------
+    stats : pstats.Stats
+        The stats.
+    interval : float, optional
+        The seconds counted as one sample, so the stacks can be merged with
+        sampled ones.
+
+    Returns
+    -------
+    Counter
+        The number of samples of each stack, keyed by tuples of frame labels.
+    """
+    callees = {}
+    roots = []
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if len(callers) == 0:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    def label(func):
+        filename, _, name = func
+        return f"{os.path.basename(filename)}:{name}"
+
+    times = Counter()
+    # (the functions of a stack, the fraction of the last one's time spent
+    # in that stack)
+    todo = [((func,), 1.0) for func in roots]
+    while todo:
+        funcs, fraction = todo.pop()
+        tt = stats.stats[funcs[-1]][2]
+        times[tuple(label(func) for func in funcs)] += tt * fraction
+        for callee, edge_time in callees.get(funcs[-1], []):
+            # skip recursion, and branches too short to be counted
+            if callee in funcs or edge_time * fraction < interval / 2:
+                continue
+            callee_time = stats.stats[callee][3]
+            todo.append((funcs + (callee,), fraction * edge_time / callee_time))
+
+    counts = Counter()
+    for stack, seconds in times.items():
+        nsamples = int(round(seconds / interval))
+        if nsamples > 0:
+            counts[stack] = nsamples
+    return counts
+
+
+def merge_collapsed(profiles, interval=DEFAULT_INTERVAL):
+    """
+    Merge the stacks of every stage, each rooted at its stage.
+
+    The cProfile stats of a stage are converted with `stats_to_collapsed`
+    and merged with its sampled stacks.
+
+    Parameters
+    ----------
+    profiles : dict
+        The profiles, from `load_profiles`.
+    interval : float, optional
+        The seconds of cProfile time counted as one sample.
+
+    Returns
+    -------
+    Counter
+        The number of samples of each stack, keyed by tuples of frame labels.
+    """
+    merged = Counter()
+    for stage, profile in profiles.items():
+        counts = Counter(profile["samples"])
+        if profile["stats"] is not None:
+            counts.update(stats_to_collapsed(profile["stats"], interval=interval))
+        for stack, count in counts.items():
+            merged[(stage,) + stack] += count
+    return merged
+
+
+def top_frames(counts, n=10):
+    """
+    Get the frames with the most samples at the top of the stack.
+
+    Parameters
+    ----------
+    counts : dict
+        The number of samples of each stack, keyed by tuples of frame labels.
+    n : int, optional
+        The number of frames to return.
+
+    Returns
+    -------
+    list of tuple
+        (frame, samples) pairs, most first.
+    """
+    leaves = Counter()
+    for stack, count in counts.items():
+        leaves[stack[-1]] += count
+    return leaves.most_common(n)
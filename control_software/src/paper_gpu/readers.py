@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""Fast readers for quick-look access to correlator output."""
+
+import os
+import h5py
+import numpy as np
+
+from .file_conversion import read_header_data, _hera_corr_dtype, _read_visdata_range
+
+
+def build_baseline_index(ant_0_array, ant_1_array):
+    """
+    Build a mapping from antenna pair to baseline-time rows.
+
+    Parameters
+    ----------
+    ant_0_array : array_like of int
+        The first antenna of each baseline-time row, length Nblts.
+    ant_1_array : array_like of int
+        The second antenna of each baseline-time row, length Nblts.
+
+    Returns
+    -------
+    bl_index : dict
+        Keys are (ant0, ant1) tuples, values are sorted 1-d arrays of the rows
+        that contain that antenna pair.
+    """
+    ant_0_array = np.asarray(ant_0_array, dtype=np.int64)
+    ant_1_array = np.asarray(ant_1_array, dtype=np.int64)
+    keys = ant_0_array * (int(ant_1_array.max(initial=0)) + 1) + ant_1_array
+
+    # a stable sort keeps the rows of each baseline in file order
+    order = np.argsort(keys, kind="stable")
+    _, starts = np.unique(keys[order], return_index=True)
+    rows = np.split(order, starts[1:])
+
+    return {
+        (int(ant_0_array[r[0]]), int(ant_1_array[r[0]])): r for r in rows if r.size
+    }
+
+
+def conjugate(data):
+    """
+    Complex-conjugate correlator data in place.
+
+    Parameters
+    ----------
+    data : ndarray
+        Compound numpy datatype with a "r" field and "i" field.
+
+    Returns
+    -------
+    data : ndarray
+        The same array, with the sign of the "i" field flipped.
+    """
+    np.negative(data["i"], out=data["i"])
+    return data
+
+
+def to_complex(data):
+    """
+    Convert correlator data to a complex array.
+
+    Parameters
+    ----------
+    data : ndarray
+        Compound numpy datatype with a "r" field and "i" field.
+
+    Returns
+    -------
+    ndarray of complex128
+        The data as complex numbers, with the same shape as `data`.
+    """
+    out = np.empty(data.shape, dtype=np.complex128)
+    out.real = data["r"]
+    out.imag = data["i"]
+    return out
+
+
+class _BaselineReader(object):
+    """
+    Shared baseline lookup and gather for the readers in this module.
+
+    Subclasses set `data_file`, `nfreq`, `nstokes`, `time_array` and
+    `bl_index`, and implement `_read_rows`.
+    """
+
+    def _read_rows(self, rows):
+        """Read sorted baseline-time rows as a (len(rows), Nfreqs, Npols) array."""
+        raise NotImplementedError
+
+    @property
+    def antpairs(self):
+        """The list of antenna pairs in the file."""
+        return list(self.bl_index.keys())
+
+    def get_rows(self, antpair):
+        """
+        Get the baseline-time rows for an antenna pair.
+
+        Parameters
+        ----------
+        antpair : tuple of int
+            The antenna pair (ant0, ant1). The reversed pair is also accepted.
+
+        Returns
+        -------
+        rows : ndarray of int
+            The rows for this baseline, in time order.
+        conj : bool
+            True if the pair is stored reversed in the file, so data must be
+            conjugated.
+
+        Raises
+        ------
+        KeyError
+            Raised if the antenna pair is not present in the file.
+        """
+        ant0, ant1 = (int(a) for a in antpair)
+        if (ant0, ant1) in self.bl_index:
+            return self.bl_index[(ant0, ant1)], False
+        if (ant1, ant0) in self.bl_index:
+            return self.bl_index[(ant1, ant0)], True
+        raise KeyError(f"antenna pair {antpair} not found in {self.data_file}")
+
+    def get_waterfall(self, antpair):
+        """
+        Read the waterfall of a single baseline.
+
+        Parameters
+        ----------
+        antpair : tuple of int
+            The antenna pair (ant0, ant1).
+
+        Returns
+        -------
+        data : ndarray
+            Compound numpy datatype with a "r" field and "i" field, of shape
+            (Ntimes, Nfreqs, Npols).
+        times : ndarray of float
+            The JD of each time in the waterfall.
+        """
+        return self.get_waterfalls([antpair])[tuple(antpair)]
+
+    def get_waterfalls(self, antpairs):
+        """
+        Read the waterfalls of several baselines with a single gather.
+
+        Parameters
+        ----------
+        antpairs : list of tuple of int
+            The antenna pairs to read.
+
+        Returns
+        -------
+        waterfalls : dict
+            Keys are the requested antenna pairs, values are (data, times)
+            tuples as returned by `get_waterfall`.
+        """
+        antpairs = [tuple(int(a) for a in ap) for ap in antpairs]
+        lookups = [self.get_rows(ap) for ap in antpairs]
+        if len(lookups) == 0:
+            return {}
+        all_rows = np.concatenate([rows for rows, _ in lookups])
+
+        # read rows in ascending order so the file is walked forwards
+        order = np.argsort(all_rows, kind="stable")
+        gathered = np.empty((all_rows.size, self.nfreq, self.nstokes), dtype=_hera_corr_dtype)
+        gathered[order] = self._read_rows(all_rows[order])
+
+        waterfalls = {}
+        start = 0
+        for ap, (rows, conj) in zip(antpairs, lookups):
+            data = gathered[start:start + rows.size]
+            if conj:
+                conjugate(data)
+            waterfalls[ap] = (data, self.time_array[rows])
+            start += rows.size
+
+        return waterfalls
+
+
+class RawWaterfallReader(_BaselineReader):
+    """
+    Random-access reader for raw catcher data files.
+
+    The catcher writes visibilities as a flat binary file of shape
+    (Nblts, Nfreqs, Npols) next to a metadata HDF5 file. This class builds a
+    baseline -> row index from the metadata once and memory-maps the binary
+    file, so individual baselines can be read without converting (or even
+    reading) the rest of the file.
+
+    Parameters
+    ----------
+    metadata_file : str
+        The name of the metadata file written by the correlator.
+    data_file : str
+        The name of the .sum.dat or .diff.dat file written by the correlator.
+
+    Raises
+    ------
+    ValueError
+        Raised if the size of the data file does not match the metadata.
+    """
+
+    def __init__(self, metadata_file, data_file):
+        self.metadata_file = metadata_file
+        self.data_file = data_file
+        self.metadata = read_header_data(metadata_file)
+        self.nblts = self.metadata["ant_0_array"].shape[0]
+        self.nfreq = int(self.metadata["nfreq"])
+        self.nstokes = int(self.metadata["nstokes"])
+        self.time_array = self.metadata["time_array"]
+
+        data_shape = (self.nblts, self.nfreq, self.nstokes)
+        expected_size = int(np.prod(data_shape)) * _hera_corr_dtype.itemsize
+        actual_size = os.path.getsize(data_file)
+        if actual_size != expected_size:
+            raise ValueError(
+                f"data file is {actual_size} bytes, expected {expected_size} "
+                f"bytes for data of shape {data_shape}"
+            )
+        self.data = np.memmap(data_file, dtype=_hera_corr_dtype, mode="r", shape=data_shape)
+
+        self.bl_index = build_baseline_index(
+            self.metadata["ant_0_array"], self.metadata["ant_1_array"]
+        )
+
+    def _read_rows(self, rows):
+        return self.data[rows]
+
+
+def coalesce_rows(rows, max_gap=0):
+    """
+    Group sorted rows into contiguous runs to read with single slices.
+
+    Parameters
+    ----------
+    rows : array_like of int
+        Sorted row indices; duplicates are allowed.
+    max_gap : int, optional
+        Runs separated by at most this many unwanted rows are merged, so the
+        rows in between are read and discarded. Setting this to the HDF5
+        chunk length avoids decompressing a chunk once per run.
+
+    Returns
+    -------
+    list of tuple of int
+        (start, stop) slices covering every row, in ascending order.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if rows.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) > max_gap + 1)
+    starts = np.concatenate([[rows[0]], rows[breaks + 1]])
+    stops = np.concatenate([rows[breaks], [rows[-1]]]) + 1
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+
+class UVH5BaselineReader(_BaselineReader):
+    """
+    Random-access baseline reader for UVH5 files written by the converter.
+
+    Only the antenna and time arrays of the header are read, once, to build
+    a baseline -> row index; the rest of the header is not parsed or
+    validated. Requested rows are read with one hyperslab per run of nearby
+    rows. Power-of-two shifts stored by `make_uvh5_file(..., strip_shift=True)`
+    are undone. The file stays open until `close` is called, or the reader
+    is used as a context manager.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the UVH5 file.
+    """
+
+    def __init__(self, filename):
+        self.data_file = filename
+        self.h5f = h5py.File(filename, "r")
+        header = self.h5f["Header"]
+        self.time_array = header["time_array"][()]
+        self.freq_array = np.ravel(header["freq_array"][()])
+        self.visdata = self.h5f["Data"]["visdata"]
+        self.nblts, self.nfreq, self.nstokes = self.visdata.shape
+        chunks = self.visdata.chunks
+        self.max_gap = chunks[0] if chunks is not None else 0
+
+        self.bl_index = build_baseline_index(
+            header["ant_1_array"][()], header["ant_2_array"][()]
+        )
+
+    def _read_rows(self, rows):
+        out = np.empty((rows.size, self.nfreq, self.nstokes), dtype=_hera_corr_dtype)
+        start = 0
+        for idx0, idx1 in coalesce_rows(rows, self.max_gap):
+            block = _read_visdata_range(self.visdata, idx0, idx1)
+            nrows = np.searchsorted(rows, idx1) - start
+            out[start:start + nrows] = block[rows[start:start + nrows] - idx0]
+            start += nrows
+        return out
+
+    def close(self):
+        """Close the file."""
+        self.h5f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
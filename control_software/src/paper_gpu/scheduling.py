@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""Disk-pressure-aware scheduling of the raw file conversion queue."""
+
+import os
+import re
+import time
+import shutil
+import h5py
+import numpy as np
+from collections import deque, namedtuple
+
+from .timing import UNIX_EPOCH_JD
+
+# redis hash the scheduler publishes its metrics to
+SCHEDULER_KEY = "corr:files:scheduler"
+
+FILE_TEMPLATE = re.compile(r"zen\.(\d+\.\d+)\.(sum|diff)\.dat")
+
+# tags read from metadata files, which do not change once written; only
+# successful reads are kept, so a file still being written is read again
+TAG_CACHE_SIZE = 4096
+_tag_cache = {}
+
+# pressure levels, in increasing order of urgency
+PRESSURE_LEVELS = ("normal", "high", "critical")
+
+QueuedFile = namedtuple(
+    "QueuedFile", ["name", "volume", "nbytes", "age", "is_diff", "tag"]
+)
+QueuedFile.__doc__ = """
+A raw data file waiting to be converted.
+
+Parameters
+----------
+name : str
+    The name of the file as queued, relative to its volume.
+volume : str
+    The volume (mount point) holding the file.
+nbytes : int
+    The size of the file in bytes.
+age : float
+    The time since the start of the observation, in seconds.
+is_diff : bool
+    Whether this is a diff file.
+tag : str or None
+    The observation tag, if the metadata file could be read.
+"""
+
+
+def read_tag(metadata_file):
+    """
+    Read the observation tag from a metadata file.
+
+    Parameters
+    ----------
+    metadata_file : str
+        The name of the metadata file written by the correlator.
+
+    Returns
+    -------
+    str or None
+        The tag, or None if the file cannot be read.
+    """
+    if metadata_file in _tag_cache:
+        return _tag_cache[metadata_file]
+    try:
+        with h5py.File(metadata_file, "r") as h5f:
+            tag = h5f["tag"][()].decode("utf-8")
+    except (OSError, KeyError):
+        return None
+    if len(_tag_cache) >= TAG_CACHE_SIZE:
+        # drop the oldest entry
+        del _tag_cache[next(iter(_tag_cache))]
+    _tag_cache[metadata_file] = tag
+    return tag
+
+
+def make_queued_file(name, volume, now=None):
+    """
+    Describe a queued raw data file for the scheduler.
+
+    Parameters
+    ----------
+    name : str
+        The name of the file as queued, e.g. "2459000/zen.2459000.12345.sum.dat".
+    volume : str
+        The volume the name is relative to.
+    now : float, optional
+        The current unix time. Default is `time.time()`.
+
+    Returns
+    -------
+    QueuedFile
+        The description. Files that no longer exist have a size of 0.
+    """
+    if now is None:
+        now = time.time()
+    path = os.path.join(volume, name)
+    jd, sum_diff = FILE_TEMPLATE.search(os.path.basename(name)).groups()
+    try:
+        nbytes = os.path.getsize(path)
+    except OSError:
+        nbytes = 0
+    age = (now / 86400.0 + UNIX_EPOCH_JD - float(jd)) * 86400.0
+    meta_file = os.path.join(os.path.dirname(path), f"zen.{jd}.meta.hdf5")
+    return QueuedFile(
+        name=name,
+        volume=volume,
+        nbytes=nbytes,
+        age=age,
+        is_diff=(sum_diff == "diff"),
+        tag=read_tag(meta_file),
+    )
+
+
+class VolumeMonitor(object):
+    """
+    Track the free space of volumes and estimate how fast they are filling.
+
+    Parameters
+    ----------
+    volumes : list of str
+        The mount points to monitor.
+    window : float, optional
+        The length of history used to estimate fill rates, in seconds.
+    """
+
+    def __init__(self, volumes, window=600.0):
+        self.volumes = list(volumes)
+        self.window = window
+        self.history = {volume: deque() for volume in self.volumes}
+
+    def update(self, now=None, free_bytes=None):
+        """
+        Record the current free space of each volume.
+
+        Parameters
+        ----------
+        now : float, optional
+            The current unix time. Default is `time.time()`.
+        free_bytes : dict, optional
+            The free space of each volume. Default is to measure it.
+        """
+        if now is None:
+            now = time.time()
+        for volume in self.volumes:
+            if free_bytes is None:
+                free = shutil.disk_usage(volume).free
+            else:
+                free = free_bytes[volume]
+            history = self.history[volume]
+            history.append((now, free))
+            while len(history) > 2 and now - history[0][0] > self.window:
+                history.popleft()
+
+    def free_bytes(self):
+        """Get the latest free space of each volume, in bytes."""
+        return {
+            volume: history[-1][1] for volume, history in self.history.items()
+            if len(history) > 0
+        }
+
+    def fill_rate(self, volume):
+        """
+        Estimate how fast a volume is filling.
+
+        Parameters
+        ----------
+        volume : str
+            The volume.
+
+        Returns
+        -------
+        float
+            The rate free space is being used, in bytes per second; negative
+            if the volume is emptying. 0 until there are two measurements.
+        """
+        history = self.history[volume]
+        if len(history) < 2:
+            return 0.0
+        times, free = np.asarray(history, dtype=np.float64).T
+        if times[-1] == times[0]:
+            return 0.0
+        return -np.polyfit(times - times[0], free, 1)[0]
+
+    def time_to_full(self):
+        """
+        Project when each volume will be full at its current fill rate.
+
+        Returns
+        -------
+        dict
+            The time in seconds until each volume is full, or inf if it is
+            not filling.
+        """
+        ttf = {}
+        for volume, free in self.free_bytes().items():
+            rate = self.fill_rate(volume)
+            ttf[volume] = free / rate if rate > 0 else np.inf
+        return ttf
+
+
+class DrainTracker(object):
+    """
+    Track how fast queued files are being converted.
+
+    Parameters
+    ----------
+    window : float, optional
+        The length of history used to estimate the drain rate, in seconds.
+    """
+
+    def __init__(self, window=600.0):
+        self.window = window
+        self.start = None
+        self.events = deque()
+
+    def record(self, nfiles=1, now=None):
+        """Record that `nfiles` files were finished at unix time `now`."""
+        if now is None:
+            now = time.time()
+        if self.start is None:
+            self.start = now
+        if nfiles > 0:
+            self.events.append((now, nfiles))
+        while len(self.events) > 0 and now - self.events[0][0] > self.window:
+            self.events.popleft()
+
+    def rate(self, now=None):
+        """Get the number of files finished per second over the window."""
+        if now is None:
+            now = time.time()
+        if self.start is None or now <= self.start:
+            return 0.0
+        elapsed = min(now - self.start, self.window)
+        nfiles = sum(n for t, n in self.events if now - t <= self.window)
+        return nfiles / elapsed
+
+
+class SchedulingPolicy(object):
+    """
+    Choose the order and concurrency of conversions from disk pressure.
+
+    Without disk pressure the newest file is converted first, as the
+    converter always has. When a volume is projected to fill within
+    `horizon`, its files are moved to the front of the queue, with files
+    whose tag means they are not kept first, then the largest files, which
+    free the most space, then sums before diffs. When a volume's free space
+    falls below `critical_free_bytes`, files with those tags are discarded
+    without conversion.
+
+    Parameters
+    ----------
+    min_workers : int, optional
+        The number of conversion workers without disk pressure.
+    max_workers : int, optional
+        The number of conversion workers under disk pressure, or for a long
+        queue.
+    horizon : float, optional
+        A volume projected to fill within this many seconds is under high
+        pressure.
+    critical_free_bytes : int, optional
+        A volume with less free space than this is under critical pressure.
+    delete_tags : tuple of str, optional
+        Tags of observations that are not kept.
+    """
+
+    def __init__(self, min_workers=4, max_workers=8, horizon=4 * 3600.0,
+                 critical_free_bytes=200 * 2**30, delete_tags=("delete", "junk")):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.horizon = horizon
+        self.critical_free_bytes = critical_free_bytes
+        self.delete_tags = tuple(delete_tags)
+
+    def pressure(self, free_bytes, time_to_full):
+        """
+        Get the pressure level of a volume.
+
+        Parameters
+        ----------
+        free_bytes : int
+            The free space of the volume.
+        time_to_full : float
+            The projected time until the volume is full, in seconds.
+
+        Returns
+        -------
+        str
+            One of `PRESSURE_LEVELS`.
+        """
+        if free_bytes < self.critical_free_bytes:
+            return "critical"
+        if time_to_full < self.horizon:
+            return "high"
+        return "normal"
+
+    def plan(self, files, free_bytes, time_to_full):
+        """
+        Order the queue and choose how many workers to run.
+
+        Parameters
+        ----------
+        files : list of QueuedFile
+            The queued files.
+        free_bytes : dict
+            The free space of each volume.
+        time_to_full : dict
+            The projected time until each volume is full, in seconds.
+
+        Returns
+        -------
+        order : list of tuple
+            (QueuedFile, action) pairs in the order they should be handled,
+            where action is "convert" or "discard".
+        nworkers : int
+            The number of conversion workers to run.
+        """
+        levels = {
+            volume: PRESSURE_LEVELS.index(
+                self.pressure(free_bytes[volume], time_to_full.get(volume, np.inf))
+            )
+            for volume in free_bytes
+        }
+
+        def key(qf):
+            level = levels.get(qf.volume, 0)
+            if level == 0:
+                return (0, qf.age)
+            return (-level, qf.tag not in self.delete_tags, -qf.nbytes, qf.is_diff, -qf.age)
+
+        order = []
+        for qf in sorted(files, key=key):
+            critical = levels.get(qf.volume, 0) == PRESSURE_LEVELS.index("critical")
+            discard = critical and qf.tag in self.delete_tags
+            order.append((qf, "discard" if discard else "convert"))
+
+        if any(level > 0 for level in levels.values()):
+            nworkers = self.max_workers
+        else:
+            nworkers = min(max(len(files), self.min_workers), self.max_workers)
+        return order, nworkers
+
+
+def get_metrics(queue_depth, drain_tracker, volume_monitor, now=None):
+    """
+    Collect the scheduler metrics.
+
+    Parameters
+    ----------
+    queue_depth : int
+        The number of files in the conversion queue.
+    drain_tracker : DrainTracker
+        The tracker of finished conversions.
+    volume_monitor : VolumeMonitor
+        The monitor of the data volumes.
+    now : float, optional
+        The current unix time. Default is `time.time()`.
+
+    Returns
+    -------
+    dict
+        The queue_depth, drain_rate (files per second), queue_drain_time
+        (seconds to empty the queue at that rate), and for each volume its
+        free_bytes, fill_rate (bytes per second) and time_to_full (seconds),
+        with keys like "time_to_full:/data1". Infinite times are reported as
+        -1.
+    """
+    drain_rate = drain_tracker.rate(now=now)
+    metrics = {
+        "queue_depth": queue_depth,
+        "drain_rate": drain_rate,
+        "queue_drain_time": queue_depth / drain_rate if drain_rate > 0 else -1,
+    }
+    for volume, ttf in volume_monitor.time_to_full().items():
+        metrics[f"free_bytes:{volume}"] = volume_monitor.free_bytes()[volume]
+        metrics[f"fill_rate:{volume}"] = volume_monitor.fill_rate(volume)
+        metrics[f"time_to_full:{volume}"] = ttf if np.isfinite(ttf) else -1
+    return metrics
+
+
+def export_metrics(r, metrics, key=SCHEDULER_KEY):
+    """
+    Publish scheduler metrics to redis.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        The redis connection.
+    metrics : dict
+        The metrics, from `get_metrics`.
+    key : str, optional
+        The redis hash to write to.
+    """
+    mapping = {name: float(value) for name, value in metrics.items()}
+    mapping["time"] = time.time()
+    r.hset(key, mapping=mapping)
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+Collect the hashpipe status buffers of the correlator into time series.
+
+Every `hashpipe://<host>/<inst>/status` hash is read with one pipelined batch
+of HGETALLs per poll, the status keys are converted to typed numpy columns
+and appended to a fixed-size ring buffer per instance, and rates such as
+packets/s, file lag and net thread utilisation are derived from the
+histories. The latest values are available as text in the Prometheus
+exposition format, optionally served over HTTP.
+"""
+
+import re
+import time
+import threading
+import http.server
+import numpy as np
+
+STATUS_KEY = "hashpipe://{host}/{inst}/status"
+STATUS_PATTERN = "hashpipe://*/*/status"
+DEFAULT_HISTORY = 720
+METRIC_PREFIX = "paper_gpu"
+
+# the status keys collected, and their types; integer keys missing from a
+# status buffer are stored as -1, floating point keys as NaN
+STATUS_COLUMNS = [
+    ("NETWATNS", "f8"),
+    ("NETRECNS", "f8"),
+    ("NETPRCNS", "f8"),
+    ("NETWATMN", "i8"),
+    ("NETWATMX", "i8"),
+    ("NETRECMN", "i8"),
+    ("NETRECMX", "i8"),
+    ("NETPRCMN", "i8"),
+    ("NETPRCMX", "i8"),
+    ("NETGBPS", "f8"),
+    ("NETPKTTL", "i8"),
+    ("NETDRPTL", "i8"),
+    ("MISSEDPK", "i8"),
+    ("NETMCNT", "i8"),
+    ("DISKMCNT", "i8"),
+    ("FILESEC", "f8"),
+    ("NDONEFIL", "i8"),
+    ("CNETSTAT", "U16"),
+]
+STATUS_DTYPE = np.dtype([("time", "f8")] + STATUS_COLUMNS)
+
+# derived rates: the counter each is the time derivative of
+COUNTER_RATES = {
+    "packets_per_s": "NETPKTTL",
+    "drops_per_s": "NETDRPTL",
+    "missed_per_s": "MISSEDPK",
+    "files_per_s": "NDONEFIL",
+}
+
+_KEY_RE = re.compile(r"^hashpipe://(?P<host>[^/]+)/(?P<inst>[^/]+)/status$")
+
+
+def parse_status(hashes, now):
+    """
+    Convert status hashes into typed columns.
+
+    Parameters
+    ----------
+    hashes : list of dict
+        The status buffers, as returned by HGETALL with
+        `decode_responses=True`.
+    now : float
+        The unix time the hashes were read.
+
+    Returns
+    -------
+    ndarray of STATUS_DTYPE
+        One row per hash.
+    """
+    rows = np.zeros(len(hashes), dtype=STATUS_DTYPE)
+    rows["time"] = now
+    for name, dtype in STATUS_COLUMNS:
+        kind = np.dtype(dtype).kind
+        missing = {"i": "-1", "f": "nan"}.get(kind, "")
+        values = np.array([h.get(name) or missing for h in hashes])
+        if kind == "i":
+            # counters are written by hputi8/hputu8, but tolerate a float
+            try:
+                rows[name] = values.astype(np.int64)
+            except ValueError:
+                rows[name] = values.astype(np.float64)
+        else:
+            rows[name] = values
+    return rows
+
+
+class RingBuffer(object):
+    """
+    A fixed-size history of structured rows, overwriting the oldest.
+
+    Parameters
+    ----------
+    size : int
+        The number of rows kept.
+    dtype : numpy.dtype
+        The row dtype.
+    """
+
+    def __init__(self, size, dtype):
+        self.size = size
+        self.rows = np.zeros(size, dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, row):
+        self.rows[self.count % self.size] = row
+        self.count += 1
+
+    def values(self):
+        """Get the rows, oldest first."""
+        if self.count <= self.size:
+            return self.rows[:self.count].copy()
+        return np.roll(self.rows, -(self.count % self.size))
+
+
+def derived_rates(history):
+    """
+    Derive rates from a status history.
+
+    Parameters
+    ----------
+    history : ndarray of STATUS_DTYPE
+        The status rows, oldest first.
+
+    Returns
+    -------
+    dict of ndarray
+        The rate of each counter in `COUNTER_RATES` between consecutive rows
+        (NaN where the counter is missing or was reset); "file_lag", the
+        seconds since NDONEFIL last changed; and "net_utilisation", the
+        fraction of its time the net thread spends receiving and processing
+        rather than waiting.
+    """
+    out = {"time": history["time"]}
+    dt = np.diff(history["time"])
+    for rate, counter in COUNTER_RATES.items():
+        diff = np.diff(history[counter]).astype(np.float64)
+        bad = (history[counter][:-1] < 0) | (diff < 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.where(bad, np.nan, diff / dt)
+        out[rate] = np.concatenate([[np.nan], values]) if len(history) else values
+
+    # the time of the last change of NDONEFIL at or before each row
+    nfiles = history["NDONEFIL"]
+    changed = np.ones(len(history), dtype=bool)
+    changed[1:] = nfiles[1:] != nfiles[:-1]
+    last_change = np.maximum.accumulate(np.where(changed, np.arange(len(history)), 0))
+    out["file_lag"] = history["time"] - history["time"][last_change]
+    if len(history):
+        # the first row could be the middle of a file
+        out["file_lag"][last_change == 0] = np.nan
+
+    busy = history["NETRECNS"] + history["NETPRCNS"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out["net_utilisation"] = busy / (busy + history["NETWATNS"])
+    return out
+
+
+class StatusAggregator(object):
+    """
+    Poll the hashpipe status buffers and keep their histories.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        The redis connection, with `decode_responses=True`.
+    hosts : list of str, optional
+        The hosts to poll. Default is every status buffer in redis.
+    instances : list of int, optional
+        The instances of each host. Required with `hosts`.
+    history : int, optional
+        The number of polls kept per instance.
+    """
+
+    def __init__(self, r, hosts=None, instances=None, history=DEFAULT_HISTORY):
+        if hosts is not None and instances is None:
+            raise ValueError("instances must be given with hosts")
+        self.r = r
+        self.hosts = hosts
+        self.instances = instances
+        self.history_size = history
+        self.histories = {}
+        self.lock = threading.Lock()
+
+    def status_keys(self):
+        """Get the status buffer keys to poll."""
+        if self.hosts is None:
+            return sorted(self.r.keys(STATUS_PATTERN))
+        return [
+            STATUS_KEY.format(host=host, inst=inst)
+            for host in self.hosts for inst in self.instances
+        ]
+
+    def poll(self, now=None):
+        """
+        Read every status buffer and add it to the histories.
+
+        Parameters
+        ----------
+        now : float, optional
+            The unix time to record. Default is the current time.
+
+        Returns
+        -------
+        dict
+            The new row of each status key; buffers that do not exist are
+            skipped.
+        """
+        keys = self.status_keys()
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        hashes = pipe.execute()
+        if now is None:
+            now = time.time()
+        present = [i for i, h in enumerate(hashes) if h]
+        rows = parse_status([hashes[i] for i in present], now)
+        with self.lock:
+            for row, i in zip(rows, present):
+                if keys[i] not in self.histories:
+                    self.histories[keys[i]] = RingBuffer(self.history_size, STATUS_DTYPE)
+                self.histories[keys[i]].append(row)
+        return {keys[i]: row for row, i in zip(rows, present)}
+
+    def history(self, key):
+        """Get the history of a status key, oldest first."""
+        with self.lock:
+            return self.histories[key].values()
+
+    def rates(self, key):
+        """Get the derived rates of a status key; see `derived_rates`."""
+        return derived_rates(self.history(key))
+
+    def summary(self):
+        """
+        Get the latest values and rates of every instance.
+
+        Returns
+        -------
+        dict
+            For each status key, a dict of the latest status values and
+            derived rates.
+        """
+        with self.lock:
+            keys = sorted(self.histories)
+        out = {}
+        for key in keys:
+            hist = self.history(key)
+            latest = {name: hist[name][-1].item() for name in STATUS_DTYPE.names}
+            latest.update({k: v[-1].item() for k, v in derived_rates(hist).items()})
+            out[key] = latest
+        return out
+
+    def exposition(self):
+        """
+        Get the latest values and rates in the Prometheus text format.
+
+        Returns
+        -------
+        str
+            One gauge per numeric status key and rate, labelled with the host
+            and instance; CNETSTAT is a label of the `net_state` gauge.
+        """
+        summary = self.summary()
+        names = [n for n, dtype in STATUS_COLUMNS if np.dtype(dtype).kind != "U"]
+        names += list(COUNTER_RATES) + ["file_lag", "net_utilisation"]
+        lines = []
+        for name in names + ["net_state"]:
+            metric = f"{METRIC_PREFIX}_{name.lower()}"
+            lines.append(f"# TYPE {metric} gauge")
+            for key, latest in summary.items():
+                match = _KEY_RE.match(key)
+                labels = f'host="{match["host"]}",instance="{match["inst"]}"'
+                if name == "net_state":
+                    labels += f',state="{latest["CNETSTAT"]}"'
+                    value = 1
+                else:
+                    value = latest[name]
+                lines.append(f"{metric}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def run(self, interval, stop):
+        """
+        Poll every `interval` seconds until the `stop` event is set.
+        """
+        while not stop.is_set():
+            start = time.time()
+            self.poll(now=start)
+            stop.wait(max(interval - (time.time() - start), 0))
+
+    def serve(self, host="127.0.0.1", port=0):
+        """
+        Serve `exposition` over HTTP at /metrics from a background thread.
+
+        Parameters
+        ----------
+        host : str, optional
+            The address to listen on.
+        port : int, optional
+            The port to listen on. Default is any free port.
+
+        Returns
+        -------
+        http.server.ThreadingHTTPServer
+            The server; its `server_address` is the address bound, and
+            `shutdown` stops it.
+        """
+        aggregator = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = aggregator.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+NumPy implementation of the catcher's sum/diff and channel-summing stage.
+
+This reproduces `compute_sum_diff` in hera_catcher_disk_thread.c bit for bit:
+for each baseline the even and odd time samples are each summed over
+`CATCHER_CHAN_SUM_BDA` adjacent channels, and the sum and difference of the
+two are written out, all in wrapping 32-bit integer arithmetic.
+"""
+
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from . import databuf
+from .file_conversion import _hera_corr_dtype
+
+# parameters from paper_databuf.h and hera_catcher_disk_thread.c
+TIME_DEMUX = 2
+N_CHAN_TOTAL = 6144
+N_STOKES = 4
+CATCHER_CHAN_SUM_BDA = 4
+N_CHAN_PROCESSED = N_CHAN_TOTAL // CATCHER_CHAN_SUM_BDA
+N_BL_PER_WRITE = 32
+BASELINES_PER_BLOCK = 4096
+CATCHER_N_BLOCKS = 16
+
+
+def bda_input_header_dtype(baselines_per_block=BASELINES_PER_BLOCK):
+    """
+    Get the numpy dtype of `hera_catcher_bda_input_header_t`.
+
+    Parameters
+    ----------
+    baselines_per_block : int, optional
+        The number of baseline slots (bcnts) in a block.
+
+    Returns
+    -------
+    numpy.dtype
+        An aligned structured dtype with the same layout as the C struct.
+    """
+    return np.dtype(
+        [
+            ("good_data", "<u8"),
+            ("bcnt", "<u4", (baselines_per_block,)),
+            ("mcnt", "<u8", (baselines_per_block,)),
+            ("ant_pair_0", "<u2", (baselines_per_block,)),
+            ("ant_pair_1", "<u2", (baselines_per_block,)),
+        ],
+        align=True,
+    )
+
+
+def bda_input_block_dtype(baselines_per_block=BASELINES_PER_BLOCK, nchan=N_CHAN_TOTAL):
+    """
+    Get the numpy dtype of `hera_catcher_bda_input_block_t`.
+
+    Parameters
+    ----------
+    baselines_per_block : int, optional
+        The number of baseline slots (bcnts) in a block.
+    nchan : int, optional
+        The number of frequency channels per baseline.
+
+    Returns
+    -------
+    numpy.dtype
+        A structured dtype with "header" and "data" fields. The data field is
+        int32 of shape (baselines_per_block, TIME_DEMUX, nchan, N_STOKES, 2),
+        the last axis being real and imaginary parts.
+    """
+    return databuf.block_dtype(bda_input_layout(baselines_per_block, nchan))
+
+
+def bda_input_layout(baselines_per_block=BASELINES_PER_BLOCK, nchan=N_CHAN_TOTAL):
+    """
+    Get the layout of `hera_catcher_bda_input_databuf_t`.
+
+    Parameters
+    ----------
+    baselines_per_block : int, optional
+        The number of baseline slots (bcnts) in a block.
+    nchan : int, optional
+        The number of frequency channels per baseline.
+
+    Returns
+    -------
+    databuf.DatabufLayout
+        The layout.
+    """
+    return databuf.DatabufLayout(
+        name="hera_catcher_bda_input_databuf",
+        header_dtype=bda_input_header_dtype(baselines_per_block),
+        data_dtype=np.dtype("<i4"),
+        data_shape=(baselines_per_block, TIME_DEMUX, nchan, N_STOKES, 2),
+        ant_axis=None,
+        n_blocks=CATCHER_N_BLOCKS,
+    )
+
+
+def open_bda_input_databuf(filename, mode="r", n_blocks=CATCHER_N_BLOCKS,
+                           baselines_per_block=BASELINES_PER_BLOCK, nchan=N_CHAN_TOTAL):
+    """
+    Memory-map a `hera_catcher_bda_input_databuf_t`.
+
+    The file can be the shared memory segment of a running catcher, a dump
+    of it, or a file made with `mode="w+"`.
+
+    Parameters
+    ----------
+    filename : str
+        The file holding the databuf.
+    mode : str, optional
+        The numpy.memmap mode.
+    n_blocks : int, optional
+        The number of blocks in the databuf.
+    baselines_per_block : int, optional
+        The number of baseline slots (bcnts) in a block.
+    nchan : int, optional
+        The number of frequency channels per baseline.
+
+    Returns
+    -------
+    numpy.memmap
+        Array of `n_blocks` blocks with the dtype of `bda_input_block_dtype`.
+    """
+    layout = bda_input_layout(baselines_per_block, nchan)
+    return databuf.open_databuf(filename, layout, mode=mode, n_blocks=n_blocks)
+
+
+def sum_diff_baselines(data, out_sum, out_diff, chan_sum=CATCHER_CHAN_SUM_BDA):
+    """
+    Compute the sum and diff of a group of baselines.
+
+    Parameters
+    ----------
+    data : ndarray of int32
+        Input of shape (Nbl, TIME_DEMUX, Nchan, N_STOKES, 2), e.g. a slice of
+        the data field of a databuf block.
+    out_sum, out_diff : ndarray of int32
+        Outputs of shape (Nbl, Nchan // chan_sum, N_STOKES, 2).
+    chan_sum : int, optional
+        The number of adjacent channels summed together.
+    """
+    nbl, _, nchan, nstokes, _ = data.shape
+    shape = (nbl, nchan // chan_sum, chan_sum, nstokes, 2)
+    if chan_sum == 1:
+        even = data[:, 0]
+        odd = data[:, 1]
+    else:
+        # int32 accumulation wraps like the AVX2 epi32 adds
+        even = np.add.reduce(data[:, 0].reshape(shape), axis=2, dtype=np.int32)
+        odd = np.add.reduce(data[:, 1].reshape(shape), axis=2, dtype=np.int32)
+    np.add(even, odd, out=out_sum)
+    np.subtract(even, odd, out=out_diff)
+
+
+def sum_diff(data, nbl=None, bl_per_write=N_BL_PER_WRITE, chan_sum=CATCHER_CHAN_SUM_BDA,
+             nthreads=1):
+    """
+    Compute the sum and diff of the baselines of a databuf block.
+
+    Baselines are processed in groups of `bl_per_write`, as the catcher
+    does; with `nthreads` > 1 groups are processed in a thread pool, since
+    numpy releases the GIL.
+
+    Parameters
+    ----------
+    data : ndarray of int32
+        The data field of a databuf block, of shape
+        (Nbl, TIME_DEMUX, Nchan, N_STOKES, 2).
+    nbl : int, optional
+        The number of baselines to process. Default is all of them.
+    bl_per_write : int, optional
+        The number of baselines per group.
+    chan_sum : int, optional
+        The number of adjacent channels summed together.
+    nthreads : int, optional
+        The number of threads.
+
+    Returns
+    -------
+    data_sum, data_diff : ndarray
+        Compound numpy datatype with a "r" field and "i" field, of shape
+        (nbl, Nchan // chan_sum, N_STOKES): the rows the catcher writes to
+        the .sum.dat and .diff.dat files.
+    """
+    if nbl is None:
+        nbl = data.shape[0]
+    nchan_out = data.shape[2] // chan_sum
+    out_shape = (nbl, nchan_out, N_STOKES, 2)
+    out_sum = np.empty(out_shape, dtype=np.int32)
+    out_diff = np.empty(out_shape, dtype=np.int32)
+
+    def process(bl0):
+        bl1 = min(bl0 + bl_per_write, nbl)
+        sum_diff_baselines(
+            data[bl0:bl1], out_sum[bl0:bl1], out_diff[bl0:bl1], chan_sum=chan_sum
+        )
+
+    starts = range(0, nbl, bl_per_write)
+    if nthreads > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            list(pool.map(process, starts))
+    else:
+        for bl0 in starts:
+            process(bl0)
+
+    return (
+        out_sum.view(_hera_corr_dtype).reshape(out_shape[:-1]),
+        out_diff.view(_hera_corr_dtype).reshape(out_shape[:-1]),
+    )
+
+
+def benchmark_sum_diff(nbl=1024, nchan=N_CHAN_TOTAL, nthreads=(1, 2, 4), repeat=3,
+                       seed=0):
+    """
+    Measure the throughput of `sum_diff` on random data.
+
+    Parameters
+    ----------
+    nbl : int, optional
+        The number of baselines in the test block.
+    nchan : int, optional
+        The number of channels per baseline.
+    nthreads : list of int, optional
+        The thread counts to test.
+    repeat : int, optional
+        The number of runs per thread count; the fastest is reported.
+    seed : int, optional
+        The random seed.
+
+    Returns
+    -------
+    dict
+        Keys are thread counts, values are dicts with the best run time in
+        seconds and GBps, the input bytes processed per second in units of
+        1e9 bytes, comparable with the catcher's rate.
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.integers(
+        -2**20, 2**20, size=(nbl, TIME_DEMUX, nchan, N_STOKES, 2), dtype=np.int32
+    )
+    results = {}
+    for n in nthreads:
+        best = np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            sum_diff(data, nthreads=n)
+            best = min(best, time.perf_counter() - t0)
+        results[n] = {"time": best, "GBps": data.nbytes / best / 1e9}
+    return results
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import bl_order
+import pytest
+import numpy as np
+
+
+def _reference_bl_order(n_ants):
+    # loop-based implementation from the corr package
+    order1, order2 = [], []
+    for i in range(n_ants):
+        for j in range(int(n_ants / 2), -1, -1):
+            k = (i - j) % n_ants
+            if i >= k:
+                order1.append((k, i))
+            else:
+                order2.append((i, k))
+    order2 = [o for o in order2 if o not in order1]
+    return order1 + order2
+
+
+@pytest.fixture(scope="function")
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(bl_order.CACHE_DIR_ENV, str(tmp_path))
+    bl_order.get_bl_order.cache_clear()
+    bl_order.get_bl_index.cache_clear()
+
+    yield tmp_path
+
+    bl_order.get_bl_order.cache_clear()
+    bl_order.get_bl_index.cache_clear()
+
+    return
+
+@pytest.mark.parametrize("n_ants", [1, 2, 7, 16, 33])
+def test_bl_order_matches_reference(cache_dir, n_ants):
+    order = bl_order.get_bl_order(n_ants)
+    assert order.shape == (n_ants * (n_ants + 1) // 2, 2)
+    assert np.array_equal(order, np.asarray(_reference_bl_order(n_ants)))
+
+    return
+
+def test_bl_index_inverts_order(cache_dir):
+    n_ants = 12
+    order = bl_order.get_bl_order(n_ants)
+    index = bl_order.get_bl_index(n_ants)
+    assert np.array_equal(index[order[:, 0], order[:, 1]], np.arange(order.shape[0]))
+    assert np.array_equal(index, index.T)
+    assert np.all(index >= 0)
+
+    return
+
+def test_tables_are_cached_on_disk(cache_dir):
+    order = bl_order.get_bl_order(10)
+    assert (cache_dir / "casper_bl_order_10.npy").exists()
+    assert not order.flags.writeable
+
+    # a fresh process-level cache should load the same table from disk
+    bl_order.get_bl_order.cache_clear()
+    assert np.array_equal(bl_order.get_bl_order(10), order)
+
+    return
+
+def test_bda_bcnt_layout():
+    bl_pairs = [[0, 0, 8], [0, 1, 1], [1, 1, 0], [0, 2, 2], [1, 2, 1]]
+    layout = bl_order.get_bda_bcnt_layout(bl_pairs)
+
+    # 8 + 8 samples for tier 0, 4 for tier 1, 1 for tier 3
+    assert layout["tier"].tolist() == [0] * 16 + [1] * 4 + [3]
+    assert layout["ant_1_array"].tolist() == [1] * 8 + [2] * 8 + [2] * 4 + [0]
+    assert layout["sample"].tolist() == list(range(8)) * 2 + list(range(4)) + [0]
+
+    with pytest.raises(ValueError):
+        bl_order.get_bda_bcnt_layout([[0, 1, 3]])
+
+    return
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import capture
+import socket
+import numpy as np
+
+
+def make_packet(mcnt, offset, xeng_id, payload):
+    header = np.zeros(1, dtype=capture.XENG_PACKET_HEADER_DTYPE)
+    header["mcnt"] = mcnt
+    header["offset"] = offset
+    header["xeng_id"] = xeng_id
+    header["payload_len"] = payload.nbytes
+    return header.tobytes() + payload.astype(">i4").tobytes()
+
+
+def test_capture_window():
+    nwords = capture.PAYLOAD_LEN // 4
+    shape = (3, 4 * nwords)
+    expected = np.arange(np.prod(shape), dtype=np.int32).reshape(shape) - 1000
+
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    rx.bind(("127.0.0.1", 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = rx.getsockname()
+
+    # the tail of a previous window, which is skipped
+    tx.sendto(make_packet(4, 4 * capture.PAYLOAD_LEN, 0, expected[0, :nwords]), address)
+    dropped = (2, 3)
+    for xeng_id in range(shape[0]):
+        for i in range(4):
+            if (xeng_id, i) == dropped:
+                continue
+            payload = expected[xeng_id, i * nwords:(i + 1) * nwords]
+            # the time demux bits vary within a window
+            tx.sendto(make_packet(9 + i % 2, i * capture.PAYLOAD_LEN, xeng_id, payload), address)
+    # the start of the next window ends the capture
+    tx.sendto(make_packet(12, 0, 0, expected[0, :nwords]), address)
+
+    # small batches that do not divide the ring
+    dout, stats = capture.capture_window(rx, shape, batch_size=5, ring_slots=7, timeout=1)
+    assert stats["window"] == 8
+    assert stats["expected"] == 12
+    assert stats["received"] == 11
+    assert stats["missing"] == 1
+    assert stats["skipped"] == 1
+    assert stats["packets_per_s"] > 0
+    missing = np.zeros(shape, dtype=bool)
+    missing[dropped[0], dropped[1] * nwords:(dropped[1] + 1) * nwords] = True
+    assert np.array_equal(dout[~missing], expected[~missing])
+    assert np.all(dout[missing] == -1)
+
+    # nothing arrives
+    dout, stats = capture.capture_window(rx, shape, timeout=0.05)
+    assert stats["window"] is None
+    assert stats["received"] == 0
+    assert np.all(dout == -1)
+
+    rx.close()
+    tx.close()
+
+    return
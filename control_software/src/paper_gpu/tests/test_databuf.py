@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import databuf
+import pytest
+import numpy as np
+
+
+def test_layouts():
+    # the full-size blocks match the C structs
+    net = databuf.net_layout()
+    assert databuf.block_dtype(net).fields["data"][1] == 128
+    assert databuf.block_dtype(net).itemsize == 128 + 2048 * 384 * 192 * 2
+    fluff = databuf.fluff_layout()
+    assert databuf.block_dtype(fluff).itemsize == 128 + 2 * 2048 * 384 * 192 * 2
+    gpu = databuf.gpu_output_layout()
+    assert databuf.block_dtype(gpu).fields["data"][1] == 128
+    assert gpu.data_shape == (2 * 384 * (192 + 2) * 384,)
+
+    return
+
+
+def test_test_vectors():
+    net = databuf.net_layout(ntime=8, nchan=300, nants=5)
+    net_tvg = databuf.net_test_vector(net)
+    fluff_tvg = databuf.fluff_test_vector(databuf.fluff_layout(ntime=8, nchan=300, nants=5))
+    # the loops of the original check scripts
+    for a in range(5):
+        for p in range(2):
+            ramp = (np.arange(300) + 2 * (a % 3) + p) % 256
+            assert np.array_equal(net_tvg[0, a, :, 0, p], ramp)
+            ramp_r = ramp >> 4
+            ramp_i = ramp & 0xF
+            ramp_r[ramp_r > 7] -= 16
+            ramp_i[ramp_i > 7] -= 16
+            assert np.array_equal(fluff_tvg[0, :, a, p, 1, 0], ramp_r)
+            assert np.array_equal(fluff_tvg[0, :, a, p, 0, 0], ramp_i)
+    assert net_tvg.dtype == np.uint8
+    assert fluff_tvg.dtype == np.int8
+
+    return
+
+
+@pytest.mark.parametrize("kind", ["net", "fluff"])
+def test_verify_dump(tmp_path, kind):
+    layout_func = getattr(databuf, f"{kind}_layout")
+    layout = layout_func(ntime=16, nchan=24, nants=6)
+    expected = getattr(databuf, f"{kind}_test_vector")(layout)
+    verify = getattr(databuf, f"verify_{kind}_dump")
+    # two blocks of data
+    shape = (2 * layout.data_shape[0],) + layout.data_shape[1:]
+    data = np.array(np.broadcast_to(expected, shape))
+    filename = str(tmp_path / f"{kind}.dat")
+    data.tofile(filename)
+
+    # small chunks so the comparison takes several steps
+    result = verify(filename, layout, chunk_bytes=1000)
+    assert result.ok
+    assert result.antenna_ok.all() and len(result.antenna_ok) == 6
+    assert result.nmismatch == 0
+    assert result.first_mismatch is None
+
+    index = [5, 1, 1, 1, 1, 0][: data.ndim]
+    index[layout.ant_axis] = 4
+    data[tuple(index)] += 1
+    data[-1, 0, 0] += 1
+    data.tofile(filename)
+    result = verify(filename, layout, chunk_bytes=1000)
+    assert not result.ok
+    assert result.nmismatch == 1 + data[-1, 0, 0].size
+    assert result.first_mismatch == tuple(index)
+    assert list(np.flatnonzero(~result.antenna_ok)) == [0, 4]
+
+    with open(filename, "ab") as fh:
+        fh.write(b"\0")
+    with pytest.raises(ValueError, match="not a whole number"):
+        verify(filename, layout)
+
+    return
+
+
+def test_check_gpu_output_dump(tmp_path):
+    layout = databuf.gpu_output_layout(nchan=4, nants=2)
+    data = np.full(layout.data_shape, 262144, dtype=np.int32)
+    filename = str(tmp_path / "gpu.dat")
+    data.tofile(filename)
+    result = databuf.check_gpu_output_dump(filename, layout, chunk_bytes=64)
+    assert not result["all_zero"]
+    assert result["first_nonzero"] == 0
+    assert result["divisible_by_2048"]
+    assert result["divisible_by_262144"]
+    assert result["first_not_divisible_by_262144"] is None
+
+    data[50] = -2048
+    data.tofile(filename)
+    result = databuf.check_gpu_output_dump(filename, layout, chunk_bytes=64)
+    assert result["divisible_by_2048"]
+    assert not result["divisible_by_262144"]
+    assert result["first_not_divisible_by_262144"] == 50
+
+    return
+
+
+def test_open_databuf(tmp_path):
+    layout = databuf.net_layout(ntime=4, nchan=8, nants=3)
+    filename = str(tmp_path / "databuf.dat")
+    blocks = databuf.open_databuf(filename, layout, mode="w+")
+    assert blocks.shape == (databuf.N_INPUT_BLOCKS,)
+    blocks[2]["header"]["mcnt"] = 1234
+    blocks[2]["data"] = databuf.net_test_vector(layout)
+    blocks.flush()
+    del blocks
+
+    raw = np.fromfile(filename, dtype=np.uint8)
+    block_size = databuf.block_dtype(layout).itemsize
+    block_start = 128 + 2 * block_size
+    assert raw[block_start + 8:block_start + 16].view("<u8")[0] == 1234
+    data = raw[block_start + 128:block_start + block_size].reshape(layout.data_shape)
+    assert np.all(data == databuf.net_test_vector(layout))
+
+    return
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import file_conversion
+from .. import chunk_tuning
+import os
+import pytest
+import zlib
+import h5py
+import numpy as np
+
+
+@pytest.fixture(scope="function")
+def uvh5_visdata(tmp_path):
+    rng = np.random.default_rng(0)
+    data = np.zeros((300, 16, 4), dtype=file_conversion._hera_corr_dtype)
+    data["r"] = rng.integers(-2**20, 2**20, size=data.shape)
+    data["i"] = rng.integers(-2**20, 2**20, size=data.shape)
+
+    filename = str(tmp_path / "zen.2459000.00000.sum.uvh5")
+    with h5py.File(filename, "w") as h5f:
+        h5f.create_dataset("Data/visdata", data=data, chunks=(32, 16, 1), compression="lzf")
+        h5f["Header/extra_keywords/" + file_conversion.CHECKSUM_KEY] = np.uint32(zlib.crc32(data))
+
+    yield filename, data
+
+    return
+
+def test_crc32_combine():
+    a = bytes(range(256)) * 3
+    b = b"HERA" * 1001
+    crc = file_conversion.crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b))
+    assert crc == zlib.crc32(a + b)
+    assert file_conversion.crc32_combine(zlib.crc32(a), 0, 0) == zlib.crc32(a)
+
+    return
+
+@pytest.mark.parametrize("nproc", [1, 3])
+def test_verify_visdata_checksum(uvh5_visdata, nproc):
+    filename, data = uvh5_visdata
+    assert file_conversion.compute_visdata_checksum(filename, nproc=nproc) == zlib.crc32(data)
+    assert file_conversion.verify_visdata_checksum(filename, nproc=nproc)
+
+    # corrupt a single value
+    with h5py.File(filename, "r+") as h5f:
+        h5f["Data/visdata"][150, 3, 2] = (0, 0)
+    assert not file_conversion.verify_visdata_checksum(filename, nproc=nproc)
+
+    return
+
+def test_verify_missing_checksum(uvh5_visdata):
+    filename, data = uvh5_visdata
+    with h5py.File(filename, "r+") as h5f:
+        del h5f["Header/extra_keywords/" + file_conversion.CHECKSUM_KEY]
+    assert not file_conversion.verify_visdata_checksum(filename)
+
+    return
+
+def test_get_blt_info():
+    ant_0_array = np.array([0, 0, 1, 0, 0, 0, 1, 2])
+    ant_1_array = np.array([0, 1, 1, 2, 0, 1, 1, 3])
+    time_array = np.array([0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 2.0])
+    blt_info = file_conversion.get_blt_info(ant_0_array, ant_1_array, time_array, 350)
+
+    assert blt_info["Nbls"] == 5
+    assert blt_info["Ntimes"] == 3
+    assert blt_info["Nants_data"] == 4
+    assert np.array_equal(blt_info["unique_ant_0"][blt_info["bl_inverse"]], ant_0_array)
+    assert np.array_equal(blt_info["unique_ant_1"][blt_info["bl_inverse"]], ant_1_array)
+    expected_bls = file_conversion.uvutils.antnums_to_baseline(
+        ant_0_array, ant_1_array, Nants_telescope=350
+    )
+    assert np.array_equal(blt_info["baseline_array"], expected_bls)
+
+    return
+
+def test_resolve_chunks():
+    assert file_conversion.resolve_chunks((128, -1, 1), (1000, 1536, 4)) == (128, 1536, 1)
+    assert file_conversion.resolve_chunks((128, -1, 8), (10, 1536, 4)) == (10, 1536, 4)
+    with pytest.raises(ValueError):
+        file_conversion.resolve_chunks((128, -1), (10, 1536, 4))
+
+    return
+
+def test_chunk_profile(tmp_path, monkeypatch):
+    profile = str(tmp_path / "chunk_profile.json")
+    monkeypatch.setenv(file_conversion.CHUNK_PROFILE_ENV, profile)
+    assert file_conversion.load_chunk_profile() == file_conversion.DEFAULT_DATA_CHUNKS
+
+    file_conversion.save_chunk_profile((32, -1, 1), benchmark={"score": 1.0})
+    assert file_conversion.load_chunk_profile() == (32, -1, 1)
+
+    return
+
+def test_make_bda_synthetic_visdata():
+    data, ant_0_array, ant_1_array, time_index = chunk_tuning.make_bda_synthetic_visdata(
+        nbls=20, nfiles=2, nfreq=8
+    )
+    # 2, 4, 6 and 8 baselines integrating 1, 2, 4 and 8 samples
+    rows_per_file = 2 * 8 + 4 * 4 + 6 * 2 + 8 * 1
+    assert data.shape == (2 * rows_per_file, 8, 4)
+    assert ant_0_array.shape == ant_1_array.shape == time_index.shape == (data.shape[0],)
+    pairs = set(zip(ant_0_array.tolist(), ant_1_array.tolist()))
+    assert len(pairs) == 20
+    nsamples = sorted(
+        np.count_nonzero((ant_0_array == a0) & (ant_1_array == a1)) // 2 for a0, a1 in pairs
+    )
+    assert nsamples == [1] * 8 + [2] * 6 + [4] * 4 + [8] * 2
+    # each baseline's samples are evenly spaced over both files
+    rows = np.flatnonzero((ant_0_array == ant_0_array[0]) & (ant_1_array == ant_1_array[0]))
+    assert np.array_equal(time_index[rows], np.arange(16))
+
+    # enough baselines for several of the longest chunks
+    candidates = [(128, -1, 1), (4096, 64, -1), (-1, -1, 1)]
+    nbls = chunk_tuning.get_synthetic_nbls(candidates)
+    assert nbls * 2 * 2.6 >= chunk_tuning.MIN_CHUNKS_PER_DATASET * 4096
+    assert (nbls - 1) * 2 * 2.6 < chunk_tuning.MIN_CHUNKS_PER_DATASET * 4096
+
+    return
+
+def test_autotune_chunks(tmp_path):
+    candidates = [(16, -1, 1), (64, -1, -1)]
+    results = chunk_tuning.autotune_chunks(
+        candidates, nbls=10, nfiles=2, nfreq=64, tmpdir=str(tmp_path), nreads=1
+    )
+    assert sorted(res["candidate"] for res in results) == sorted(candidates)
+    assert results[0]["score"] <= results[1]["score"]
+    for res in results:
+        assert res["compression_ratio"] > 0
+        for pattern in chunk_tuning.ACCESS_PATTERNS:
+            assert res[pattern] >= 0
+    assert list(tmp_path.iterdir()) == []
+
+    return
+
+def test_select_visdata_codec():
+    data = chunk_tuning.make_synthetic_visdata(nbls=10, ntimes=4, nfreq=64)[0]
+    results = file_conversion.benchmark_visdata_codecs(data, (8, -1, 1))
+    assert "lzf" in results and "none" in results
+    assert results["none"]["ratio"] <= 1.0
+    assert results["lzf"]["ratio"] > 1.0
+
+    # an unreachable throughput floor falls back to the default, not to
+    # the fastest (uncompressed) codec
+    codec, results = file_conversion.select_visdata_codec(
+        data, (8, -1, 1), candidates=["lzf", "none"], min_MBps=1e12
+    )
+    assert codec == file_conversion.DEFAULT_VISDATA_CODEC
+    # which never considers lzf or none
+    codec, results = file_conversion.select_visdata_codec(data, (8, -1, 1), min_MBps=0)
+    assert "lzf" not in results and "none" not in results
+    assert codec in file_conversion.AUTO_CODECS
+    # no floor picks the best ratio
+    codec, _ = file_conversion.select_visdata_codec(
+        data, (8, -1, 1), candidates=["lzf", "none"], min_MBps=0
+    )
+    assert codec == "lzf"
+
+    with pytest.raises(ValueError, match="unknown codec"):
+        file_conversion.get_visdata_codec_kwargs("foo")
+
+    return
+
+def test_sample_data_file(tmp_path):
+    data = chunk_tuning.make_synthetic_visdata(nbls=10, ntimes=4, nfreq=8)[0]
+    data_file = str(tmp_path / "zen.2459000.00000.sum.dat")
+    data.tofile(data_file)
+    sample = file_conversion.sample_data_file(data_file, data.shape, 5, nsamples=3)
+    assert np.array_equal(sample, np.concatenate([data[0:5], data[17:22], data[35:40]]))
+
+    return
+
+def test_visdata_shift(tmp_path):
+    data = chunk_tuning.make_synthetic_visdata(nbls=10, ntimes=4, nfreq=8)[0]
+    data["r"][:10] *= 2**3
+    data["i"][:10] *= 2**3
+    data[20:30] = (0, 0)
+    shifts = file_conversion.get_visdata_shifts(data, 10)
+    assert shifts.tolist() == [14, 11, 0, 11]
+
+    stripped = file_conversion.strip_visdata_shift(data, shifts, 10)
+    assert np.abs(stripped["r"]).max() < np.abs(data["r"]).max()
+    restored = file_conversion.restore_visdata_shift(stripped.copy(), shifts, 10)
+    assert np.array_equal(restored, data)
+    # restoring part of the data
+    part = file_conversion.restore_visdata_shift(stripped[15:35].copy(), shifts, 10, idx0=15)
+    assert np.array_equal(part, data[15:35])
+
+    filename = str(tmp_path / "zen.2459000.00000.sum.uvh5")
+    with h5py.File(filename, "w") as h5f:
+        dset = h5f.create_dataset("Data/visdata", data=stripped, chunks=(8, 8, 1))
+        dset.attrs[file_conversion.VISDATA_SHIFT_ATTR] = shifts
+        dset.attrs[file_conversion.VISDATA_SHIFT_BLOCK_ATTR] = 10
+        h5f["Header/extra_keywords/" + file_conversion.CHECKSUM_KEY] = np.uint32(zlib.crc32(data))
+    assert np.array_equal(file_conversion.read_visdata(filename), data)
+    assert np.array_equal(file_conversion.read_visdata(filename, 5, 25), data[5:25])
+    assert file_conversion.verify_visdata_checksum(filename, nproc=2)
+
+    return
+
+@pytest.fixture(scope="function")
+def sum_diff_files(tmp_path, monkeypatch):
+    data, ant_0_array, ant_1_array, time_index = chunk_tuning.make_synthetic_visdata(
+        nbls=10, ntimes=5, nfreq=16
+    )
+    diff = data.copy()
+    diff["r"] //= 2**11
+    diff["i"] //= 2**11
+    header = {
+        "t0": 0,
+        "mcnt": 0,
+        "nfreq": 16,
+        "nstokes": 4,
+        "corr_ver": "test",
+        "tag": "science",
+        "ant_0_array": ant_0_array,
+        "ant_1_array": ant_1_array,
+        "time_array": 2459000.0 + time_index * 10.0 / 86400,
+        "integration_time": np.full(ant_0_array.shape, 10.0),
+    }
+    header["metadata"] = dict(header)
+    header.update(
+        cminfo={"cofa_lat": -30.7, "cofa_lon": 21.4, "cofa_alt": 1051.7},
+        ant_names=[f"HH{i}" for i in range(5)],
+        ant_nums=np.arange(5),
+        antpos_xyz=np.zeros((5, 3)),
+        antenna_diameters=np.full(5, 14.0),
+        blt_info=file_conversion.get_blt_info(
+            ant_0_array, ant_1_array, header["time_array"], 5
+        ),
+        uvw_array=np.zeros((ant_0_array.size, 3)),
+        freqs=np.linspace(50e6, 250e6, 16),
+        channel_width=np.full(16, 12.5e6),
+    )
+    calls = []
+
+    def get_uvh5_header(metadata_file):
+        calls.append(metadata_file)
+        return header
+
+    monkeypatch.setattr(file_conversion, "get_uvh5_header", get_uvh5_header)
+    data_files = []
+    for name, arr in [("sum", data), ("diff", diff)]:
+        data_files.append(str(tmp_path / f"zen.2459000.00000.{name}.dat"))
+        arr.tofile(data_files[-1])
+
+    yield data_files, (data, diff), calls
+
+    return
+
+@pytest.mark.parametrize("chunksize", [-1, 16])
+def test_make_uvh5_file_pair(tmp_path, sum_diff_files, chunksize):
+    data_files, arrays, calls = sum_diff_files
+    out_files = [f.replace(".dat", ".uvh5") for f in data_files]
+    info = file_conversion.make_uvh5_file_pair(
+        out_files, "zen.2459000.00000.meta.hdf5", data_files, chunksize=chunksize,
+        data_chunks=(8, -1, 1), codec="lzf",
+    )
+    # the header is computed once for both files
+    assert calls == ["zen.2459000.00000.meta.hdf5"]
+    for out_file, data, file_info in zip(out_files, arrays, info):
+        assert file_info["tag"] == "science"
+        assert file_info[file_conversion.CHECKSUM_KEY] == zlib.crc32(data)
+        assert file_conversion.verify_visdata_checksum(out_file)
+        file_conversion.check_file(out_file)
+        assert np.array_equal(file_conversion.read_visdata(out_file), data)
+
+    # a single conversion gives the same result
+    single = str(tmp_path / "single.uvh5")
+    file_conversion.make_uvh5_file(
+        single, "zen.2459000.00000.meta.hdf5", data_files[1], chunksize=chunksize,
+        data_chunks=(8, -1, 1), codec="lzf", strip_shift=True,
+    )
+    assert np.array_equal(file_conversion.read_visdata(single), arrays[1])
+    assert file_conversion.verify_visdata_checksum(single)
+
+    return
+
+@pytest.mark.parametrize("chunksize", [-1, 16])
+def test_make_uvh5_file_pair_failure(tmp_path, sum_diff_files, chunksize):
+    data_files, arrays, _ = sum_diff_files
+    # a truncated diff file
+    with open(data_files[1], "r+b") as fh:
+        fh.truncate(arrays[1].nbytes // 2)
+    out_files = [f.replace(".dat", ".uvh5") for f in data_files]
+    info = file_conversion.make_uvh5_file_pair(
+        out_files, "zen.2459000.00000.meta.hdf5", data_files, chunksize=chunksize,
+        data_chunks=(8, -1, 1), codec="lzf",
+    )
+    # the sum file is still written
+    assert info[0][file_conversion.CHECKSUM_KEY] == zlib.crc32(arrays[0])
+    assert file_conversion.verify_visdata_checksum(out_files[0])
+    assert np.array_equal(file_conversion.read_visdata(out_files[0]), arrays[0])
+    # the diff file fails, either before or while writing its output
+    assert isinstance(info[1], Exception)
+    if os.path.exists(out_files[1]):
+        assert not file_conversion.verify_visdata_checksum(out_files[1])
+
+    return
+
+@pytest.mark.parametrize("strip_shift", [False, True])
+def test_resume_conversion(tmp_path, sum_diff_files, monkeypatch, strip_shift):
+    data_files, arrays, _ = sum_diff_files
+    out_file = str(tmp_path / "zen.2459000.00000.sum.uvh5")
+    kwargs = dict(chunksize=16, data_chunks=(8, -1, 1), codec="lzf", strip_shift=strip_shift)
+    header = file_conversion.get_uvh5_header("meta.hdf5")
+
+    # write two of four chunks, then stop
+    writer = file_conversion._UVH5Writer(
+        out_file, header, data_files[0], checkpoint_interval=1, **kwargs
+    )
+    writer.write_next()
+    writer.write_next()
+    writer.close()
+    assert file_conversion.get_checkpoint(out_file) == 32
+    assert not file_conversion.verify_visdata_checksum(out_file)
+
+    reads = []
+    read_chunk = file_conversion.read_data_file_chunk
+
+    def counting_read(*args):
+        reads.append(args)
+        return read_chunk(*args)
+
+    monkeypatch.setattr(file_conversion, "read_data_file_chunk", counting_read)
+    info = file_conversion.make_uvh5_file(
+        out_file, "meta.hdf5", data_files[0], resume=True, **kwargs
+    )
+    assert len(reads) == 2
+    assert info[file_conversion.CHECKSUM_KEY] == zlib.crc32(arrays[0])
+    assert file_conversion.verify_visdata_checksum(out_file)
+    assert file_conversion.get_checkpoint(out_file) is None
+    assert np.array_equal(file_conversion.read_visdata(out_file), arrays[0])
+
+    return
+
+def test_resume_rejects_damaged_file(tmp_path, sum_diff_files, monkeypatch):
+    data_files, arrays, _ = sum_diff_files
+    out_file = str(tmp_path / "zen.2459000.00000.sum.uvh5")
+    kwargs = dict(chunksize=16, data_chunks=(8, -1, 1), codec="lzf")
+    header = file_conversion.get_uvh5_header("meta.hdf5")
+    writer = file_conversion._UVH5Writer(
+        out_file, header, data_files[0], checkpoint_interval=1, **kwargs
+    )
+    writer.write_next()
+    writer.close()
+    with h5py.File(out_file, "r+") as h5f:
+        h5f["Data/visdata"][3, 2, 1] = (1, 1)
+
+    info = file_conversion.make_uvh5_file(
+        out_file, "meta.hdf5", data_files[0], resume=True, **kwargs
+    )
+    assert info[file_conversion.CHECKSUM_KEY] == zlib.crc32(arrays[0])
+    assert file_conversion.verify_visdata_checksum(out_file)
+
+    # unreadable files are rewritten too
+    with open(out_file, "wb") as f:
+        f.write(b"not hdf5")
+    assert file_conversion.get_checkpoint(out_file) is None
+    file_conversion.make_uvh5_file(out_file, "meta.hdf5", data_files[0], resume=True, **kwargs)
+    assert file_conversion.verify_visdata_checksum(out_file)
+
+    return
+
+def test_uvh5_aggregator(tmp_path, sum_diff_files):
+    data_files, arrays, _ = sum_diff_files
+    header = file_conversion.get_uvh5_header("meta.hdf5")
+    later = dict(header, time_array=header["time_array"] + 60.0 / 86400)
+    out_file = str(tmp_path / "zen.2459000.00000.sum.uvh5")
+
+    agg = file_conversion.UVH5Aggregator(out_file, span=600.0, data_chunks=(8, -1, 1), codec="lzf")
+    agg.append(header, data_files[0], chunksize=16, name="2459000/zen.2459000.00000.sum.dat")
+    assert file_conversion.get_checkpoint(out_file) == 50
+    assert agg.accepts(later)
+    assert not agg.accepts(dict(header, tag="junk"))
+    assert not agg.accepts(dict(header, time_array=header["time_array"] + 0.01))
+    assert not agg.accepts(dict(header, time_array=header["time_array"] + 1.0))
+    with pytest.raises(ValueError, match="cannot be appended"):
+        agg.append(dict(header, tag="junk"), data_files[0])
+    agg.h5f.close()
+
+    # an incomplete aggregate is picked up again
+    agg = file_conversion.UVH5Aggregator(out_file, span=600.0, data_chunks=(8, -1, 1), codec="lzf")
+    assert agg.nblts == 50
+    assert agg.files == ["2459000/zen.2459000.00000.sum.dat"]
+    agg.append(later, data_files[1])
+    assert agg.nfiles == 2
+    info = agg.finalize()
+
+    expected = np.concatenate(arrays)
+    assert info[file_conversion.CHECKSUM_KEY] == zlib.crc32(expected)
+    assert info["time_array"].shape == (100,)
+    assert file_conversion.get_checkpoint(out_file) is None
+    assert file_conversion.verify_visdata_checksum(out_file)
+    file_conversion.check_file(out_file)
+    with h5py.File(out_file, "r") as h5f:
+        assert h5f["Header/Nblts"][()] == 100
+        assert h5f["Header/Ntimes"][()] == 10
+        assert h5f["Header/Nbls"][()] == 10
+        assert h5f["Header/uvw_array"].shape == (100, 3)
+        assert np.array_equal(h5f["Data/visdata"][()], expected)
+
+    return
+
+def test_uvh5_aggregator_reopen(tmp_path, sum_diff_files, monkeypatch):
+    data_files, arrays, _ = sum_diff_files
+    header = file_conversion.get_uvh5_header("meta.hdf5")
+    # antenna names are bytes in production headers, see get_antpos_info
+    header = dict(header, ant_names=np.array([f"HH{i}" for i in range(5)], dtype="S5"))
+    later = dict(header, time_array=header["time_array"] + 60.0 / 86400)
+    out_file = str(tmp_path / "zen.2459000.00000.sum.uvh5")
+
+    agg = file_conversion.UVH5Aggregator(out_file, span=600.0, data_chunks=(8, -1, 1), codec="lzf")
+    agg.append(header, data_files[0], chunksize=16)
+    agg.h5f.close()
+    agg = file_conversion.UVH5Aggregator(out_file, span=600.0, data_chunks=(8, -1, 1), codec="lzf")
+    assert agg.accepts(later)
+
+    # die part way through appending the next file
+    read_data_file_chunk = file_conversion.read_data_file_chunk
+    calls = []
+
+    def failing_read(*args):
+        calls.append(args)
+        if len(calls) > 1:
+            raise OSError("died")
+        return read_data_file_chunk(*args)
+
+    monkeypatch.setattr(file_conversion, "read_data_file_chunk", failing_read)
+    with pytest.raises(OSError, match="died"):
+        agg.append(later, data_files[1], chunksize=16)
+    assert agg.nblts == 100
+    agg.h5f.close()
+    monkeypatch.setattr(file_conversion, "read_data_file_chunk", read_data_file_chunk)
+
+    # the partial append is dropped, and the file can be appended to again
+    agg = file_conversion.UVH5Aggregator(out_file, span=600.0, data_chunks=(8, -1, 1), codec="lzf")
+    assert agg.nblts == 50
+    assert agg.files == [data_files[0]]
+    with h5py.File(out_file, "r") as h5f:
+        assert h5f["Header/Nblts"][()] == 50
+        assert h5f["Header/time_array"].shape == (50,)
+    agg.append(later, data_files[1])
+    info = agg.finalize()
+
+    expected = np.concatenate(arrays)
+    assert info[file_conversion.CHECKSUM_KEY] == zlib.crc32(expected)
+    assert file_conversion.verify_visdata_checksum(out_file)
+    file_conversion.check_file(out_file)
+    with h5py.File(out_file, "r") as h5f:
+        assert h5f["Header/Nblts"][()] == 100
+        assert np.array_equal(h5f["Data/visdata"][()], expected)
+        assert file_conversion.CHECKPOINT_FILES_ATTR not in h5f["Data/visdata"].attrs
+
+    return
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import gateway
+import time
+import asyncio
+import pytest
+import redis
+import redis.asyncio
+
+
+def test_status_records():
+    buf = b"".join([
+        b"NETPKTS =                  123".ljust(80),
+        b"CNETSTAT= 'holding '           / a comment".ljust(80),
+        b"COMMENT  not a value".ljust(80),
+        b"END".ljust(80),
+        b"AFTEREND= 1".ljust(80),
+    ]).ljust(2880)
+    values = gateway.parse_status_records(buf)
+    assert values == {"NETPKTS": "123", "CNETSTAT": "holding"}
+
+    buf = gateway.update_status_records(buf, {"CNETSTAT": "it's up", "NEWKEY": 7})
+    assert len(buf) == 2880
+    values = gateway.parse_status_records(buf)
+    assert values == {"NETPKTS": "123", "CNETSTAT": "it's up", "NEWKEY": "7"}
+
+    with pytest.raises(ValueError, match="full"):
+        gateway.update_status_records(b"END".ljust(160), {"A": 1, "B": 2})
+
+    assert gateway.parse_set_message("NETHOLD=0") == {"NETHOLD": "0"}
+    assert gateway.parse_set_message("tag=a=b\nnovalue\nX=") == {"TAG": "a=b", "X": ""}
+
+    return
+
+
+def test_coalesce_messages():
+    buffers = {0: gateway.LocalStatusBuffer({"MISSEDPK": 10}), 1: gateway.LocalStatusBuffer()}
+    gw = gateway.Gateway(None, "hera-sn1", buffers)
+    chan = "hashpipe://hera-sn1/0/set"
+    # the counter resets of catcher.clear_redis_keys
+    assert gw.handle_message(chan, "HALTOBS=0")
+    for v in ["NETWAT", "NETREC", "NETPRC"]:
+        gw.handle_message(chan, f"{v}MN=99999")
+        gw.handle_message(chan, f"{v}MX=0")
+    gw.handle_message(chan, "MISSEDPK=0")
+    # messages arriving while taken updates are applied are kept for later
+    pending = gw.take_pending()
+    gw.handle_message(chan, "MISSEDPK=0")
+    assert gw.pending == {0: {"MISSEDPK": "0"}}
+    gw.flush(pending)
+    assert gw.nupdates == 1
+    assert gw.pending == {0: {"MISSEDPK": "0"}}
+    gw.handle_message("hashpipe:///set", "TRIGGER=1")
+    gw.handle_message("hashpipe://hera-sn1/set", "HALTOBS=1")
+    # other hosts and instances, and channels that are not set channels
+    gw.handle_message("hashpipe://hera-sn2/0/set", "TRIGGER=2")
+    gw.handle_message("hashpipe://hera-sn1/5/set", "TRIGGER=3")
+    gw.handle_message("hashpipe://hera-sn1/0/status", "TRIGGER=4")
+    assert gw.nmessages == 12
+    gw.flush()
+    # one update per instance
+    assert gw.nupdates == 3
+    assert gw.pending == {}
+    values = buffers[0].read()
+    assert values["MISSEDPK"] == "0"
+    assert values["NETPRCMN"] == "99999"
+    assert values["HALTOBS"] == "1"
+    assert values["TRIGGER"] == "1"
+    assert buffers[1].read() == {"TRIGGER": "1", "HALTOBS": "1"}
+
+    assert not gw.stop.is_set()
+    assert not gw.handle_message("hashpipe:///gateway", "quit")
+    assert gw.stop.is_set()
+
+    mappings = gw.status_mappings()
+    assert sorted(mappings) == ["hashpipe://hera-sn1/0/status", "hashpipe://hera-sn1/1/status"]
+    assert mappings["hashpipe://hera-sn1/1/status"]["HALTOBS"] == "1"
+
+    return
+
+
+def test_flush_order():
+    class SlowStatusBuffer(gateway.LocalStatusBuffer):
+        def update(self, values):
+            # the first update is slow, so the next flush is due before it ends
+            if values.get("NETHOLD") == "1":
+                time.sleep(0.2)
+            super().update(values)
+
+    async def main():
+        buf = SlowStatusBuffer()
+        gw = gateway.Gateway(None, "hera-sn1", {0: buf}, coalesce=0.01)
+
+        async def push_status():
+            return
+
+        gw.push_status = push_status
+        chan = "hashpipe://hera-sn1/0/set"
+        gw.handle_message(chan, "NETHOLD=1")
+        first = asyncio.create_task(gw._delayed_flush())
+        await asyncio.sleep(0.05)
+        gw.handle_message(chan, "NETHOLD=0")
+        second = asyncio.create_task(gw._delayed_flush())
+        await asyncio.gather(first, second)
+        return gw, buf
+
+    gw, buf = asyncio.run(main())
+    assert gw.nupdates == 2
+    assert buf.read()["NETHOLD"] == "0"
+
+    return
+
+
+def test_gateway_redis():
+    # needs a redis server on localhost
+    host = "paper-gpu-gateway-test"
+    buffers = {i: gateway.LocalStatusBuffer({"INSTANCE": i}) for i in range(4)}
+
+    async def main():
+        r = redis.asyncio.Redis(host="localhost", decode_responses=True)
+        try:
+            await r.ping()
+        except redis.exceptions.ConnectionError:
+            await r.aclose()
+            pytest.skip("no redis server on localhost")
+        gw = gateway.Gateway(r, host, buffers, interval=0.1, coalesce=0.05, expire=10)
+        ready = asyncio.Event()
+        task = asyncio.create_task(gw.run(ready))
+        await asyncio.wait_for(ready.wait(), 5)
+        await r.publish(f"hashpipe://{host}/2/set", "NETHOLD=0")
+        for v in ["NETWAT", "NETREC", "NETPRC"]:
+            await r.publish(f"hashpipe://{host}/2/set", f"{v}MN=99999")
+        await r.publish(f"hashpipe://{host}/set", "TRIGGER=1")
+        await asyncio.sleep(0.5)
+        status = await r.hgetall(f"hashpipe://{host}/2/status")
+        status3 = await r.hgetall(f"hashpipe://{host}/3/status")
+        ttl = await r.ttl(f"hashpipe://{host}/0/status")
+        await r.publish(f"hashpipe://{host}/gateway", "quit")
+        await asyncio.wait_for(task, 5)
+        await r.delete(*[f"hashpipe://{host}/{i}/status" for i in buffers])
+        await r.aclose()
+        return gw, status, status3, ttl
+
+    gw, status, status3, ttl = asyncio.run(main())
+    assert status["INSTANCE"] == "2"
+    assert status["NETHOLD"] == "0"
+    assert status["NETRECMN"] == "99999"
+    assert status["TRIGGER"] == "1"
+    assert status3 == {"INSTANCE": "3", "TRIGGER": "1"}
+    assert 0 < ttl <= 10
+    assert gw.nmessages == 5
+    assert gw.nupdates < 5 + 3
+
+    return
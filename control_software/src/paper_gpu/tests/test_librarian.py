@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import librarian
+import pytest
+import time
+
+
+@pytest.fixture(scope="function")
+def local_files(tmp_path):
+    files = {}
+    for frac in ["00000", "00100", "00200", "00300"]:
+        name = f"zen.2459000.{frac}.sum.uvh5"
+        path = tmp_path / name
+        path.write_bytes(b"\0" * 1000)
+        files[name] = str(path)
+
+    yield files
+
+    return
+
+def test_get_jd_from_filename():
+    assert librarian.get_jd_from_filename("2459000/zen.2459001.12345.sum.uvh5") == 2459001
+    with pytest.raises(ValueError):
+        librarian.get_jd_from_filename("zen.sum.uvh5")
+
+    return
+
+def test_index_queries_once_per_jd(local_files):
+    client = librarian.LocalLibrarianClient()
+    client.names = {"zen.2459000.00000.sum.uvh5", "zen.2459001.00000.sum.uvh5"}
+    index = librarian.LibrarianIndex(client, ttl=600)
+
+    assert "zen.2459000.00000.sum.uvh5" in index
+    assert "zen.2459000.00100.sum.uvh5" not in index
+    assert index.names(2459000) == {"zen.2459000.00000.sum.uvh5"}
+    assert client.n_searches == 1
+
+    # expired entries are re-fetched
+    index.ttl = 0
+    assert "zen.2459000.00100.sum.uvh5" not in index
+    assert client.n_searches == 2
+
+    return
+
+def test_uploader_skips_existing_files(local_files, tmp_path):
+    client = librarian.LocalLibrarianClient(store_dir=str(tmp_path / "store"))
+    client.names = {"zen.2459000.00000.sum.uvh5"}
+    uploader = librarian.LibrarianUploader(client, nworkers=2)
+
+    futures = {name: uploader.submit(name, path) for name, path in local_files.items()}
+    uploader.shutdown()
+
+    assert futures["zen.2459000.00000.sum.uvh5"].result() is False
+    assert sum(fut.result() for fut in futures.values()) == 3
+    assert client.n_uploads == 3
+    assert client.n_searches == 1
+    assert (tmp_path / "store" / "zen.2459000.00300.sum.uvh5").exists()
+
+    # uploaded files are added to the index without another query
+    assert all(name in uploader.index for name in local_files)
+    assert client.n_searches == 1
+
+    return
+
+def test_bandwidth_limiter():
+    limiter = librarian.BandwidthLimiter(max_bytes_per_s=10000)
+    t0 = time.monotonic()
+    for _ in range(4):
+        limiter.acquire(500)
+    # the first block goes immediately, the other three wait 0.05 s each
+    assert time.monotonic() - t0 >= 0.14
+
+    assert librarian.BandwidthLimiter(None).acquire(10**12) == 0.0
+
+    return
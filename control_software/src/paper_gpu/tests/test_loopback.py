@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import loopback, sum_diff
+from ..file_conversion import read_data_file, read_header_data, read_visdata
+import pytest
+import numpy as np
+
+
+def test_reference_catcher(tmp_path):
+    # (0, 1) has 4 samples per file, (1, 1) 2 and (0, 0) 1
+    bl_pairs = [(0, 0, 8), (0, 1, 2), (1, 1, 4)]
+    gen = loopback.PacketGenerator(bl_pairs, nfiles=2, nchan=768, n_xeng=2)
+    assert gen.bcnts_per_file == 7
+    r = loopback.LocalRedis()
+    catcher = loopback.ReferenceCatcher(
+        str(tmp_path), gen.nchan, gen.n_xeng, gen.layout,
+        integration_time=gen.integration_time, sync_time_ms=gen.sync_time_ms, r=r,
+    )
+    observation = list(gen.packets())
+    # bcnts are sent when their last integration is done
+    assert [bcnt for bcnt, _ in observation[:7]] == [0, 1, 4, 2, 3, 5, 6]
+    packets = [(bcnt, pkt) for bcnt, pkts in observation for pkt in pkts]
+    # drop one packet of the last baseline, and deliver the rest out of order
+    bcnt_dropped, _ = packets.pop()
+    rng = np.random.default_rng(0)
+    for i in rng.permutation(len(packets)):
+        catcher.add_packet(packets[i][1])
+    # the first file is complete, so it is written before the flush
+    assert len(catcher.files) == 2
+    catcher.flush()
+    assert catcher.files == [r.lpop(loopback.RAW_FILE_KEY) for _ in range(4)]
+    assert catcher.npackets == gen.npackets - 1
+    assert len(catcher.ncomplete) == 0
+
+    vis = np.stack([gen.visibilities(bcnt) for bcnt in range(gen.nbcnts)])
+    # the dropped packet is the last channels of the odd sample
+    vis[bcnt_dropped, 1, -loopback.CHAN_PER_CATCHER_PKT:] = 0
+    ref_sum, ref_diff = sum_diff.sum_diff(vis)
+    for i, f in enumerate(catcher.files[::2]):
+        bls = slice(7 * i, 7 * (i + 1))
+        nfreq = gen.nchan // sum_diff.CATCHER_CHAN_SUM_BDA
+        shape = (len(ref_sum[bls]), nfreq, 4)
+        assert np.array_equal(read_data_file(str(tmp_path / f), shape), ref_sum[bls])
+        diff_file = str(tmp_path / f.replace("sum", "diff"))
+        assert np.array_equal(read_data_file(diff_file, shape), ref_diff[bls])
+        meta = read_header_data(str(tmp_path / f.replace("sum.dat", "meta.hdf5")))
+        assert meta["nfreq"] == nfreq
+        assert meta["tag"] == "engineering"
+        assert np.array_equal(meta["ant_0_array"], [0, 0, 0, 0, 1, 1, 0])
+        assert np.array_equal(meta["ant_1_array"], [1, 1, 1, 1, 1, 1, 0])
+        assert np.array_equal(meta["integration_time"], gen.integration_times)
+        time_array = meta["time_array"] * 86400
+        assert np.allclose(np.diff(time_array[:4]), 2 * gen.integration_time, atol=1e-3)
+        assert np.allclose(np.diff(time_array[4:6]), 4 * gen.integration_time, atol=1e-3)
+        # every tier is centred on the same time
+        assert np.allclose(time_array[:4].mean(), time_array[6], atol=1e-3)
+        assert np.allclose(time_array[4:6].mean(), time_array[6], atol=1e-3)
+
+    return
+
+
+def test_run_loopback(tmp_path):
+    stats, outputs, gen = loopback.run_loopback(
+        str(tmp_path), nants=4, nfiles=2, rate=20000, idle_timeout=0.2
+    )
+    assert len(outputs) == 4
+    assert stats["generator"]["items"] == gen.npackets
+    assert stats["network"]["items"] == gen.npackets
+    assert stats["network"]["lost"] == 0
+    assert stats["catcher"]["items"] == 4
+    assert stats["conversion"]["items"] == 4
+    assert stats["check"]["items"] == 4
+    assert stats["check"]["failed"] == 0
+    assert stats["catcher"]["latency_max"] >= 0
+
+    vis = np.stack([gen.visibilities(bcnt) for bcnt in range(gen.nbcnts)])
+    ref_sum, ref_diff = sum_diff.sum_diff(vis)
+    # every tier is sent
+    assert set(gen.layout["tier"]) == {0, 1, 2, 3}
+    nbcnts = gen.bcnts_per_file
+    for i, (f_sum, f_diff) in enumerate(zip(outputs[::2], outputs[1::2])):
+        bls = slice(nbcnts * i, nbcnts * (i + 1))
+        assert np.array_equal(read_visdata(f_sum), ref_sum[bls])
+        assert np.array_equal(read_visdata(f_diff), ref_diff[bls])
+
+    with pytest.raises(ValueError, match="nchan must be a multiple"):
+        loopback.run_loopback(str(tmp_path), nchan=512)
+
+    return
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import loopback, manifest
+from ..file_conversion import CHECKSUM_KEY
+import os
+import sqlite3
+import pytest
+import numpy as np
+
+
+def _entry(tmp_path, jd_frac, kind="sum", tag="science"):
+    filename = tmp_path / f"zen.{2459000 + jd_frac:.5f}.{kind}.uvh5"
+    filename.write_bytes(b"\0" * 1000)
+    metadata = {
+        "time_array": 2459000.0 + jd_frac + np.repeat(np.arange(3), 4) * 10.0 / 86400,
+        "tag": tag,
+        CHECKSUM_KEY: 1234,
+    }
+    return manifest.make_manifest_entry(str(filename), metadata, 4000, 1.6e9, 12.5)
+
+
+@pytest.fixture(scope="function")
+def jd_dir(tmp_path):
+    with manifest.Manifest(manifest.get_manifest_path(str(tmp_path))) as man:
+        man.add([
+            _entry(tmp_path, 0.3),
+            _entry(tmp_path, 0.1),
+            _entry(tmp_path, 0.1, kind="diff"),
+            _entry(tmp_path, 0.2, tag="junk"),
+        ])
+
+    yield tmp_path
+
+    return
+
+def test_make_manifest_entry(tmp_path):
+    entry = _entry(tmp_path, 0.25)
+    assert entry.filename == "zen.2459000.25000.sum.uvh5"
+    assert entry.start_jd == 2459000.25
+    assert entry.stop_jd == pytest.approx(2459000.25 + 20.0 / 86400)
+    assert entry.nblts == 12
+    assert entry.uvh5_bytes == 1000
+    assert entry.checksum == 1234
+
+    return
+
+def test_query(jd_dir):
+    with manifest.Manifest(manifest.get_manifest_path(str(jd_dir))) as man:
+        names = [entry.filename for entry in man.query()]
+        assert names == [
+            "zen.2459000.10000.diff.uvh5",
+            "zen.2459000.10000.sum.uvh5",
+            "zen.2459000.20000.sum.uvh5",
+            "zen.2459000.30000.sum.uvh5",
+        ]
+        assert len(man.query(tag="science", pattern="%.sum.uvh5")) == 2
+        entries = man.query(start_jd=2459000.15, stop_jd=2459000.25)
+        assert [entry.filename for entry in entries] == ["zen.2459000.20000.sum.uvh5"]
+
+        assert man.get("/data2/2459000/zen.2459000.30000.sum.uvh5").tag == "science"
+        man.remove("zen.2459000.30000.sum.uvh5")
+        assert man.get("zen.2459000.30000.sum.uvh5") is None
+
+    return
+
+def test_query_read_only(jd_dir, tmp_path_factory):
+    # consumers on other hosts open the manifest read-only, without any
+    # files beside it
+    before = sorted(os.listdir(jd_dir))
+    entries = manifest.query_manifest(str(jd_dir), pattern="%.sum.uvh5")
+    assert [entry.filename for entry in entries] == [
+        "zen.2459000.10000.sum.uvh5",
+        "zen.2459000.20000.sum.uvh5",
+        "zen.2459000.30000.sum.uvh5",
+    ]
+    assert sorted(os.listdir(jd_dir)) == before
+    with manifest.Manifest(manifest.get_manifest_path(str(jd_dir)), read_only=True) as man:
+        assert man.conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+        assert man.get("zen.2459000.20000.sum.uvh5").tag == "junk"
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            man.remove("zen.2459000.20000.sum.uvh5")
+    assert manifest.query_manifest(str(tmp_path_factory.mktemp("2459001"))) == []
+
+    return
+
+def test_record_conversion_replaces(jd_dir):
+    entry = _entry(jd_dir, 0.1)._replace(conversion_time=3.0)
+    manifest.record_conversion(str(jd_dir), entry)
+    with manifest.Manifest(manifest.get_manifest_path(str(jd_dir))) as man:
+        assert len(man.query()) == 4
+        assert man.get(entry.filename).conversion_time == 3.0
+
+    return
+
+def test_queued_conversions(jd_dir, tmp_path_factory):
+    # entries for files converted over the mount are written by their host
+    r = loopback.LocalRedis()
+    other_dir = tmp_path_factory.mktemp("2459001")
+    entries = [_entry(jd_dir, 0.4), _entry(jd_dir, 0.4, kind="diff")]
+    manifest.queue_conversion(r, "hera-sn2", str(jd_dir), entries)
+    manifest.queue_conversion(r, "hera-sn2", str(other_dir), _entry(other_dir, 1.1))
+    manifest.queue_conversion(r, "hera-sn1", str(jd_dir), _entry(jd_dir, 0.5))
+    assert manifest.record_queued_conversions(r, "hera-sn2") == 3
+    assert manifest.record_queued_conversions(r, "hera-sn2") == 0
+    assert r.llen(manifest.QUEUED_ENTRIES_KEY.format(host="hera-sn1")) == 1
+
+    with manifest.Manifest(manifest.get_manifest_path(str(jd_dir))) as man:
+        assert len(man.query()) == 6
+        assert man.get("zen.2459000.40000.diff.uvh5") == entries[1]
+        assert man.get("zen.2459000.50000.sum.uvh5") is None
+    with manifest.Manifest(manifest.get_manifest_path(str(other_dir))) as man:
+        assert [entry.filename for entry in man.query()] == ["zen.2459001.10000.sum.uvh5"]
+
+    return
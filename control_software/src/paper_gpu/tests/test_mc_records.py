@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import mc_records
+import pytest
+import numpy as np
+from astropy.time import Time
+
+
+def _record(jd_frac, tag="science"):
+    time_array = 2459000.0 + jd_frac + np.arange(4) * 10.0 / 86400
+    return mc_records.make_obs_record(
+        time_array, tag, f"zen.{2459000 + jd_frac:.5f}.sum.uvh5", "/mnt/sn1/data2/2459000"
+    )
+
+
+@pytest.fixture(scope="function")
+def writer():
+    backend = mc_records.SQLiteBackend()
+
+    yield mc_records.MCBatchWriter(backend)
+
+    backend.conn.close()
+
+    return
+
+def test_make_obs_record():
+    rec = _record(0.25)
+    starttime = Time(2459000.25, format="jd", scale="utc")
+    assert rec.obsid == int(np.floor(starttime.gps))
+    assert rec.jd == 2459000
+    assert rec.stoptime > rec.starttime
+    assert mc_records.record_from_json(mc_records.record_to_json(rec)) == rec
+
+    return
+
+def test_flush_inserts_in_bulk(writer):
+    for frac in [0.1, 0.2, 0.3]:
+        writer.add(_record(frac))
+    # duplicate entries for the same obsid are written once
+    writer.add(_record(0.1))
+    result = writer.flush()
+    assert len(result["new_obs"]) == 3
+    assert len(result["new_rtp"]) == 3
+    assert result["resubmitted"] == []
+    assert writer.pending == []
+
+    conn = writer.backend.conn
+    assert conn.execute("SELECT COUNT(*) FROM hera_obs").fetchone()[0] == 3
+    rows = conn.execute("SELECT rtp_attempts, jd, prefix FROM rtp_launch_record").fetchall()
+    assert rows == [(0, 2459000, "/mnt/sn1/data2/2459000")] * 3
+
+    return
+
+def test_flush_resubmits_existing(writer):
+    writer.add(_record(0.1))
+    writer.flush()
+
+    writer.add(_record(0.1))
+    writer.add(_record(0.4))
+    submit_time = Time(2459001.0, format="jd", scale="utc")
+    result = writer.flush(submit_time=submit_time)
+    assert [rec.obsid for rec in result["new_obs"]] == [_record(0.4).obsid]
+    assert result["resubmitted"] == [_record(0.1).obsid]
+
+    row = writer.backend.conn.execute(
+        "SELECT submitted_time, rtp_attempts FROM rtp_launch_record WHERE obsid = ?",
+        (_record(0.1).obsid,),
+    ).fetchone()
+    assert row == (int(np.floor(submit_time.gps)), 1)
+
+    return
+
+def test_failed_flush_keeps_records(writer):
+    writer.add(_record(0.1))
+    writer.backend.conn.close()
+    with pytest.raises(Exception):
+        writer.flush()
+    assert len(writer.pending) == 1
+
+    # reconnect and try again
+    writer.backend = mc_records.SQLiteBackend()
+    assert len(writer.flush()["new_obs"]) == 1
+
+    return
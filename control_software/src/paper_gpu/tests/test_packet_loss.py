@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import packet_loss
+from ..loopback import LocalRedis
+import json
+import socket
+import struct
+import pytest
+import numpy as np
+
+# 7 bcnts per file of 8 integrations: (0, 1) in tier 1 four times, (1, 1) in
+# tier 2 twice and (0, 0) in tier 3 once
+BL_PAIRS = [[0, 0, 8], [0, 1, 2], [1, 1, 4], [1, 2, 0]]
+BCNT_ANTS = [(0, 1)] * 4 + [(1, 1)] * 2 + [(0, 0)]
+# the last integration averaged into each bcnt of a file
+BCNT_INTEGRATIONS = [1, 3, 5, 7, 3, 7, 7]
+N_XENG = 2
+PPX = 3
+BPB = 8
+MCNT_STEP = 8
+
+
+def make_headers(nbcnts):
+    """Make the headers of each X-engine in sending order, interleaved."""
+    bcnt, t, x, o = np.meshgrid(
+        np.arange(nbcnts), np.arange(2), np.arange(N_XENG), np.arange(PPX), indexing="ij"
+    )
+    headers = np.zeros(bcnt.size, dtype=packet_loss.CATCHER_PACKET_HEADER_DTYPE)
+    headers["bcnt"] = bcnt.ravel()
+    integration = np.array(BCNT_INTEGRATIONS)[bcnt % 7] + bcnt // 7 * 8
+    headers["mcnt"] = (1000 + MCNT_STEP * integration + 2 * t).ravel()
+    headers["ant0"] = np.array(BCNT_ANTS)[bcnt.ravel() % 7, 0]
+    headers["ant1"] = np.array(BCNT_ANTS)[bcnt.ravel() % 7, 1]
+    headers["xeng_id"] = (x + t * N_XENG).ravel()
+    headers["offset"] = o.ravel()
+    headers["payload_len"] = packet_loss.OUTPUT_BYTES_PER_PACKET
+    return headers
+
+
+def analyze(headers):
+    return packet_loss.analyze_packets(
+        headers, BL_PAIRS, n_xeng=N_XENG, packets_per_x=PPX, baselines_per_block=BPB
+    )
+
+
+def test_analyze_packets():
+    headers = make_headers(14)
+    report = analyze(headers)
+    assert report["received"] == report["expected"] == 14 * 12
+    assert report["missing"] == report["duplicates"] == report["invalid"] == 0
+    assert report["mcnt_step"] == MCNT_STEP
+    assert report["gap_hist"]["xeng"].sum() == report["reorder_hist"]["xeng"].sum() == 0
+    assert report["bitmaps"].shape == (2, BPB * 12 // 8)
+    assert np.all(report["bitmaps"][0] == 255)
+    assert np.all(np.unpackbits(report["bitmaps"][1])[:6 * 12] == 1)
+
+    # xeng_id 3, bcnt 2 (tier 1), offsets 0-2 and bcnt 3 offset 0 are lost
+    lost = (headers["xeng_id"] == 3) & (
+        (headers["bcnt"] == 2) | ((headers["bcnt"] == 3) & (headers["offset"] == 0))
+    )
+    # bcnt 5 (tier 2) arrives twice from xeng_id 0
+    dup = np.flatnonzero((headers["bcnt"] == 5) & (headers["xeng_id"] == 0))
+    # offset 0 of xeng_id 1, bcnt 6 (tier 3) arrives after bcnt 7 offset 1
+    late = np.flatnonzero((headers["bcnt"] == 6) & (headers["xeng_id"] == 1))[0]
+    order = list(np.flatnonzero(~lost)) + list(dup)
+    order.remove(late)
+    order.insert(order.index(late + 12 + 1) + 1, late)
+    bad = headers[:1].copy()
+    bad["offset"] = PPX
+    report = analyze(np.concatenate([headers[order], bad]))
+
+    assert report["received"] == 14 * 12 - 4 + 3
+    assert report["expected"] == 14 * 12
+    assert report["missing"] == 4
+    assert report["duplicates"] == 3
+    assert report["invalid"] == 1
+    assert report["invalid_antpair"] == report["invalid_mcnt"] == 0
+    assert list(report["missing_per_xeng"]) == [0, 0, 0, 4]
+    assert list(report["missing_per_tier"]) == [0, 4, 0, 0]
+    assert list(report["duplicates_per_xeng"]) == [3, 0, 0, 0]
+    assert list(report["duplicates_per_tier"]) == [0, 0, 3, 0]
+    # one gap of 4 packets, detected at bcnt 3 (tier 1)
+    assert report["gap_hist"]["xeng"][3, 2] == 1
+    assert report["gap_hist"]["tier"][1, 2] == 1
+    # the late packet leaves a gap of 1 packet, and is 4 positions behind
+    assert report["gap_hist"]["xeng"][1, 0] == 1
+    assert report["gap_hist"]["tier"][3, 0] == 1
+    assert report["gap_hist"]["xeng"].sum() == 2
+    assert report["reorder_hist"]["xeng"][1, 2] == 1
+    assert report["reorder_hist"]["tier"][3, 2] == 1
+    # the duplicates are 24-26 packets behind the newest of xeng_id 0
+    assert report["reorder_hist"]["xeng"][0, 4] == 3
+    assert report["reorder_hist"]["xeng"].sum() == 4
+    assert not np.unpackbits(report["bitmaps"][0])[2 * 12 + 9:2 * 12 + 12].any()
+
+    summary = packet_loss.format_summary(report)
+    assert summary.splitlines()[0] == (
+        "received 167 of 168 expected packets: 4 missing, 3 duplicates, 1 invalid"
+    )
+    assert "xeng_id  3: 4 missing in 1 gaps, 0 duplicates, 0 late" in summary
+
+    r = LocalRedis()
+    packet_loss.write_report_to_redis(r, report)
+    stored = r.hgetall(packet_loss.PACKET_LOSS_KEY)
+    assert stored["missing"] == "4"
+    assert json.loads(stored["missing_per_xeng"]) == [0, 0, 0, 4]
+    assert np.array_equal(json.loads(stored["gap_hist_tier"]), report["gap_hist"]["tier"])
+    assert "bitmaps" not in stored
+
+    # a packet with another bcnt's antenna pair or integration does not fill
+    # its place
+    wrong = headers.copy()
+    wrong["ant1"][12] = 0
+    wrong["mcnt"][24] += MCNT_STEP
+    wrong["mcnt"][36] += 1000
+    for mcnt_step in (None, MCNT_STEP):
+        report = packet_loss.analyze_packets(
+            wrong, BL_PAIRS, n_xeng=N_XENG, packets_per_x=PPX, baselines_per_block=BPB,
+            mcnt_step=mcnt_step,
+        )
+        assert report["mcnt_step"] == MCNT_STEP
+        assert report["invalid"] == 3
+        assert report["invalid_antpair"] == 1
+        assert report["invalid_mcnt"] == 2
+        assert report["missing"] == 3
+        assert list(report["missing_per_tier"]) == [0, 3, 0, 0]
+    assert "1 with the wrong antenna pair, 2 with the wrong mcnt" in (
+        packet_loss.format_summary(report)
+    )
+
+    # nothing received
+    report = analyze(headers[:0])
+    assert report["received"] == report["expected"] == report["missing"] == 0
+
+    return
+
+
+def test_read_pcap_headers(tmp_path):
+    headers = make_headers(2)
+    filename = str(tmp_path / "catcher.pcap")
+    with open(filename, "wb") as fh:
+        fh.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+        for i, h in enumerate(headers):
+            frame = bytes(packet_loss.UDP_PAYLOAD_OFFSET) + h.tobytes() + bytes(64)
+            fh.write(struct.pack("<IIII", i, 0, len(frame), len(frame)))
+            fh.write(frame)
+        # a frame too short to hold a header
+        fh.write(struct.pack("<IIII", 0, 0, 10, 10) + bytes(10))
+    assert np.array_equal(packet_loss.read_pcap_headers(filename), headers)
+
+    with open(filename, "wb") as fh:
+        fh.write(bytes(100))
+    with pytest.raises(ValueError, match="not a pcap file"):
+        packet_loss.read_pcap_headers(filename)
+
+    return
+
+
+def test_capture_headers():
+    headers = make_headers(3)
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    rx.bind(("127.0.0.1", 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for h in headers:
+        tx.sendto(h.tobytes() + bytes(packet_loss.OUTPUT_BYTES_PER_PACKET), rx.getsockname())
+
+    captured = packet_loss.capture_headers(rx, npackets=20, batch_size=8)
+    assert np.array_equal(captured, headers[:20])
+    captured = packet_loss.capture_headers(rx, timeout=0.1)
+    assert np.array_equal(captured, headers[20:])
+    assert len(packet_loss.capture_headers(rx, timeout=0.01)) == 0
+    rx.close()
+    tx.close()
+
+    return
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import librarian, loopback, profiling
+import os
+import time
+import threading
+import types
+import pytest
+
+
+def _busy(seconds):
+    t0 = time.time()
+    while time.time() - t0 < seconds:
+        sum(range(1000))
+
+
+def _convert(seconds):
+    _busy(seconds)
+    time.sleep(seconds)
+
+
+def test_get_profile_mode(monkeypatch):
+    monkeypatch.delenv(profiling.PROFILE_ENV, raising=False)
+    r = loopback.LocalRedis()
+    assert profiling.get_profile_mode("convert") is None
+    assert profiling.get_profile_mode("convert", r) is None
+    r.hset(profiling.PROFILE_KEY, "convert", "cprofile")
+    assert profiling.get_profile_mode("convert", r) == "cprofile"
+    assert profiling.get_profile_mode("upload", r) is None
+
+    # the environment variable wins
+    monkeypatch.setenv(profiling.PROFILE_ENV, "1")
+    assert profiling.get_profile_mode("upload", r) == "sample"
+    monkeypatch.setenv(profiling.PROFILE_ENV, "off")
+    assert profiling.get_profile_mode("convert", r) is None
+    # an unknown mode is off
+    monkeypatch.setenv(profiling.PROFILE_ENV, "perf")
+    assert profiling.get_profile_mode("convert", r) is None
+
+    monkeypatch.setenv(profiling.PROFILE_DIR_ENV, "/tmp/x")
+    assert profiling.get_profile_dir() == "/tmp/x"
+
+    return
+
+
+def test_stack_sampler():
+    with profiling.StackSampler(interval=0.001) as sampler:
+        _convert(0.1)
+    assert sampler.nsamples > 10
+    stacks = list(sampler.counts)
+    assert all(stack[0] == stacks[0][0] for stack in stacks)
+    busy = sum(n for stack, n in sampler.counts.items() if "test_profiling.py:_busy" in stack)
+    assert busy > 0
+    converting = sum(
+        n for stack, n in sampler.counts.items() if "test_profiling.py:_convert" in stack
+    )
+    assert converting > 0.9 * sampler.nsamples
+
+    text = profiling.format_collapsed(sampler.counts)
+    assert profiling.parse_collapsed(text) == sampler.counts
+    assert text.splitlines()[0].rpartition(" ")[0].split(";")[0] == stacks[0][0]
+
+    return
+
+
+def test_profiled(tmp_path):
+    directory = str(tmp_path)
+    with profiling.profiled("convert", "2459000/zen.2459000.1.sum.dat", None, directory):
+        pass
+    assert os.listdir(directory) == []
+
+    for i in range(4):
+        with profiling.profiled(
+            "convert", f"zen.2459000.{i}.sum.dat", "sample", directory, max_files=3,
+            interval=0.001,
+        ):
+            _convert(0.02)
+        # distinct modification times for the rotation
+        time.sleep(0.01)
+    with profiling.profiled("upload", "zen.2459000.0.sum.uvh5", "cprofile", directory):
+        _convert(0.01)
+    with profiling.profiled("upload", "zen.2459000.0.sum.uvh5", "perf", directory):
+        pass
+    # failing to write the profile does not fail the work
+    not_a_dir = tmp_path / "not_a_dir"
+    not_a_dir.write_text("")
+    with profiling.profiled("convert", "zen.2459000.0.sum.dat", "sample", str(not_a_dir)):
+        pass
+    with pytest.raises(RuntimeError, match="conversion"):
+        with profiling.profiled("convert", "zen.2459000.0.sum.dat", "cprofile", str(not_a_dir)):
+            raise RuntimeError("conversion failed")
+
+    names = sorted(os.listdir(tmp_path / "convert"))
+    assert len(names) == 3
+    assert all(name.endswith(".sum.dat.collapsed") for name in names)
+    assert not any("zen.2459000.0.sum" in name for name in names)
+    assert len(os.listdir(tmp_path / "upload")) == 1
+
+    profiles = profiling.load_profiles(directory)
+    assert sorted(profiles) == ["convert", "upload"]
+    assert profiles["convert"]["nprofiles"] == 3
+    assert profiles["convert"]["stats"] is None
+    assert profiles["upload"]["samples"] == {}
+    stats = profiles["upload"]["stats"]
+    assert any(func[2] == "_busy" for func in stats.stats)
+
+    merged = profiling.merge_collapsed(profiles)
+    convert = {stack: n for stack, n in merged.items() if stack[0] == "convert"}
+    assert sum(convert.values()) == sum(profiles["convert"]["samples"].values())
+    # the cProfile profile is merged too
+    upload = [stack for stack in merged if stack[0] == "upload"]
+    assert any("test_profiling.py:_busy" in stack for stack in upload)
+    assert set(stack[0] for stack in merged) == {"convert", "upload"}
+    top = profiling.top_frames(profiles["convert"]["samples"], 3)
+    assert len(top) <= 3
+    assert top[0][1] >= top[-1][1]
+
+    assert list(profiling.load_profiles(directory, stages=["upload"])) == ["upload"]
+
+    return
+
+
+def test_stats_to_collapsed():
+    # main calls work and helper, and work calls helper; (calls, calls,
+    # self time, total time, {caller: the same, for the calls from it})
+    main = ("run.py", 1, "main")
+    work = ("run.py", 5, "work")
+    helper = ("lib.py", 1, "helper")
+    stats = types.SimpleNamespace(stats={
+        main: (1, 1, 0.01, 0.08, {}),
+        work: (1, 1, 0.02, 0.05, {main: (1, 1, 0.02, 0.05)}),
+        helper: (2, 2, 0.04, 0.04, {main: (1, 1, 0.01, 0.01), work: (1, 1, 0.03, 0.03)}),
+    })
+    counts = profiling.stats_to_collapsed(stats, interval=0.01)
+    assert counts == {
+        ("run.py:main",): 1,
+        ("run.py:main", "run.py:work"): 2,
+        ("run.py:main", "lib.py:helper"): 1,
+        ("run.py:main", "run.py:work", "lib.py:helper"): 3,
+    }
+    # a branch shorter than half an interval is dropped
+    counts = profiling.stats_to_collapsed(stats, interval=0.03)
+    assert ("run.py:main", "lib.py:helper") not in counts
+
+    return
+
+
+def test_rotate_concurrent(tmp_path):
+    # writers racing to rotate the same directory must not trip over the
+    # profiles the others remove
+    writer = profiling.ProfileWriter("convert", str(tmp_path), max_files=2)
+    errors = []
+
+    def _save(i):
+        try:
+            for j in range(20):
+                writer.save_samples(f"zen.{i}.{j}.sum.dat", {("a", "b"): 1})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_save, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(os.listdir(tmp_path / "convert")) <= 2
+
+    return
+
+
+def test_profiled_uploads(tmp_path, monkeypatch):
+    monkeypatch.setenv(profiling.PROFILE_DIR_ENV, str(tmp_path / "profiles"))
+    path = tmp_path / "zen.2459000.00000.sum.uvh5"
+    path.write_bytes(b"\0" * 1000)
+    client = librarian.LocalLibrarianClient()
+    uploader = librarian.LibrarianUploader(client, nworkers=2)
+    fut = uploader.submit(path.name, str(path), profile="sample")
+    uploader.shutdown()
+
+    assert fut.result() is True
+    names = os.listdir(tmp_path / "profiles" / "upload")
+    assert len(names) == 1
+    assert names[0].endswith(".zen.2459000.00000.sum.uvh5.collapsed")
+
+    return
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import readers
+from .. import chunk_tuning
+from .. import file_conversion
+from ..file_conversion import _hera_corr_dtype
+import pytest
+import h5py
+import numpy as np
+
+NFREQ = 16
+NSTOKES = 4
+
+
+@pytest.fixture(scope="function")
+def raw_files(tmp_path):
+    # three baselines, with (0, 1) integrated twice as often as the others
+    ant_0_array = np.array([0, 0, 1, 0, 0, 0, 1, 0])
+    ant_1_array = np.array([0, 1, 1, 2, 0, 1, 1, 1])
+    time_array = 2459000.0 + np.array([0, 0, 0, 0, 1, 1, 1, 2]) / 86400.0
+    nblts = ant_0_array.size
+
+    metadata_file = str(tmp_path / "zen.2459000.00000.meta.hdf5")
+    with h5py.File(metadata_file, "w") as h5f:
+        h5f["t0"] = 0
+        h5f["mcnt"] = 0
+        h5f["nfreq"] = NFREQ
+        h5f["nstokes"] = NSTOKES
+        h5f["corr_ver"] = np.bytes_("test")
+        h5f["tag"] = np.bytes_("engineering")
+        h5f["ant_0_array"] = ant_0_array
+        h5f["ant_1_array"] = ant_1_array
+        h5f["time_array"] = time_array
+        h5f["integration_time"] = np.ones(nblts)
+
+    data = np.zeros((nblts, NFREQ, NSTOKES), dtype=_hera_corr_dtype)
+    data["r"] = np.arange(nblts)[:, None, None]
+    data["i"] = -np.arange(nblts)[:, None, None] - 1
+    data_file = str(tmp_path / "zen.2459000.00000.sum.dat")
+    data.tofile(data_file)
+
+    yield metadata_file, data_file, data
+
+    return
+
+def test_build_baseline_index():
+    bl_index = readers.build_baseline_index([0, 1, 0, 1], [1, 1, 1, 1])
+    assert set(bl_index.keys()) == {(0, 1), (1, 1)}
+    assert bl_index[(0, 1)].tolist() == [0, 2]
+    assert bl_index[(1, 1)].tolist() == [1, 3]
+
+    return
+
+def test_get_waterfall(raw_files):
+    metadata_file, data_file, data = raw_files
+    reader = readers.RawWaterfallReader(metadata_file, data_file)
+    assert len(reader.antpairs) == 4
+
+    wf, times = reader.get_waterfall((0, 1))
+    assert wf.shape == (3, NFREQ, NSTOKES)
+    assert np.array_equal(wf, data[[1, 5, 7]])
+    assert np.all(np.diff(times) > 0)
+
+    # reversed pairs come back conjugated
+    wf, _ = reader.get_waterfall((2, 0))
+    assert np.array_equal(wf["r"], data["r"][[3]])
+    assert np.array_equal(wf["i"], -data["i"][[3]])
+
+    with pytest.raises(KeyError):
+        reader.get_waterfall((5, 6))
+
+    return
+
+def test_get_waterfalls(raw_files):
+    metadata_file, data_file, data = raw_files
+    reader = readers.RawWaterfallReader(metadata_file, data_file)
+    waterfalls = reader.get_waterfalls([(1, 1), (0, 0)])
+    assert np.array_equal(waterfalls[(1, 1)][0], data[[2, 6]])
+    assert np.array_equal(waterfalls[(0, 0)][0], data[[0, 4]])
+
+    return
+
+def test_truncated_data_file(raw_files):
+    metadata_file, data_file, data = raw_files
+    data[:-1].tofile(data_file)
+    with pytest.raises(ValueError, match="data file is"):
+        readers.RawWaterfallReader(metadata_file, data_file)
+
+    return
+
+def test_coalesce_rows():
+    assert readers.coalesce_rows([]) == []
+    assert readers.coalesce_rows([1, 2, 3, 7, 8, 20]) == [(1, 4), (7, 9), (20, 21)]
+    assert readers.coalesce_rows([1, 2, 3, 7, 8, 20], max_gap=3) == [(1, 9), (20, 21)]
+    assert readers.coalesce_rows([4, 4, 5]) == [(4, 6)]
+
+    return
+
+@pytest.mark.parametrize("strip_shift", [False, True])
+def test_uvh5_baseline_reader(tmp_path, strip_shift):
+    data, ant_0_array, ant_1_array, time_index = chunk_tuning.make_synthetic_visdata(
+        nbls=10, ntimes=6, nfreq=NFREQ
+    )
+    filename = str(tmp_path / "zen.2459000.00000.sum.uvh5")
+    with h5py.File(filename, "w") as h5f:
+        h5f["Header/ant_1_array"] = ant_0_array
+        h5f["Header/ant_2_array"] = ant_1_array
+        h5f["Header/time_array"] = 2459000.0 + time_index / 8640.0
+        h5f["Header/freq_array"] = np.linspace(50e6, 250e6, NFREQ)
+        visdata = data
+        if strip_shift:
+            shifts = file_conversion.get_visdata_shifts(data, 8)
+            visdata = file_conversion.strip_visdata_shift(data, shifts, 8)
+        dset = h5f.create_dataset("Data/visdata", data=visdata, chunks=(8, NFREQ, 1))
+        if strip_shift:
+            dset.attrs[file_conversion.VISDATA_SHIFT_ATTR] = shifts
+            dset.attrs[file_conversion.VISDATA_SHIFT_BLOCK_ATTR] = 8
+
+    with readers.UVH5BaselineReader(filename) as reader:
+        assert len(reader.antpairs) == 10
+        wf, times = reader.get_waterfall((1, 2))
+        rows = np.flatnonzero((ant_0_array == 1) & (ant_1_array == 2))
+        assert np.array_equal(wf, data[rows])
+        assert np.allclose(times, 2459000.0 + np.arange(6) / 8640.0)
+
+        # reversed pairs are conjugated
+        wf, _ = reader.get_waterfall((2, 1))
+        assert np.array_equal(wf["i"], -data[rows]["i"])
+
+        waterfalls = reader.get_waterfalls(reader.antpairs)
+        for (a0, a1), (wf, _) in waterfalls.items():
+            rows = np.flatnonzero((ant_0_array == a0) & (ant_1_array == a1))
+            assert np.array_equal(wf, data[rows])
+
+        with pytest.raises(KeyError):
+            reader.get_rows((7, 8))
+
+    return
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import scheduling
+import pytest
+import h5py
+import numpy as np
+
+GB = 2**30
+
+
+def _qf(name, volume="/data1", nbytes=GB, age=0.0, tag="science"):
+    return scheduling.QueuedFile(
+        name=name, volume=volume, nbytes=nbytes, age=age,
+        is_diff=name.endswith("diff.dat"), tag=tag,
+    )
+
+
+@pytest.fixture(scope="function")
+def queue():
+    yield [
+        _qf("zen.2459000.1.sum.dat", age=300.0),
+        _qf("zen.2459000.1.diff.dat", age=300.0),
+        _qf("zen.2459000.2.sum.dat", age=100.0, nbytes=2 * GB),
+        _qf("zen.2459000.3.sum.dat", age=200.0, tag="junk"),
+        _qf("zen.2459001.1.sum.dat", volume="/data2", age=50.0),
+    ]
+
+    return
+
+def test_make_queued_file(tmp_path):
+    jd_dir = tmp_path / "2459000"
+    jd_dir.mkdir()
+    (jd_dir / "zen.2459000.50000.diff.dat").write_bytes(b"\0" * 100)
+    with h5py.File(jd_dir / "zen.2459000.50000.meta.hdf5", "w") as h5f:
+        h5f["tag"] = np.bytes_("junk")
+
+    now = (2459000.5 - scheduling.UNIX_EPOCH_JD) * 86400 + 60
+    qf = scheduling.make_queued_file("2459000/zen.2459000.50000.diff.dat", str(tmp_path), now=now)
+    assert qf.nbytes == 100
+    assert qf.age == pytest.approx(60, abs=1e-3)
+    assert qf.is_diff
+    assert qf.tag == "junk"
+
+    qf = scheduling.make_queued_file("2459000/zen.2459000.60000.sum.dat", str(tmp_path))
+    assert qf.nbytes == 0
+    assert qf.tag is None
+    # a metadata file that could not be read yet is read again later
+    with h5py.File(jd_dir / "zen.2459000.60000.meta.hdf5", "w") as h5f:
+        h5f["tag"] = np.bytes_("delete")
+    qf = scheduling.make_queued_file("2459000/zen.2459000.60000.sum.dat", str(tmp_path))
+    assert qf.tag == "delete"
+
+    return
+
+def test_plan_without_pressure(queue):
+    policy = scheduling.SchedulingPolicy(min_workers=2, max_workers=8)
+    free = {"/data1": 10000 * GB, "/data2": 10000 * GB}
+    order, nworkers = policy.plan(queue, free, {})
+    # newest first, as with the old LIFO queue
+    assert [qf.age for qf, _ in order] == [50.0, 100.0, 200.0, 300.0, 300.0]
+    assert all(action == "convert" for _, action in order)
+    assert nworkers == 5
+    assert policy.plan(queue[:1], free, {})[1] == 2
+
+    return
+
+def test_plan_with_pressure(queue):
+    policy = scheduling.SchedulingPolicy(
+        min_workers=2, max_workers=8, horizon=3600.0, critical_free_bytes=100 * GB
+    )
+    free = {"/data1": 1000 * GB, "/data2": 10000 * GB}
+    order, nworkers = policy.plan(queue, free, {"/data1": 600.0, "/data2": np.inf})
+    names = [qf.name for qf, _ in order]
+    assert names == [
+        "zen.2459000.3.sum.dat",
+        "zen.2459000.2.sum.dat",
+        "zen.2459000.1.sum.dat",
+        "zen.2459000.1.diff.dat",
+        "zen.2459001.1.sum.dat",
+    ]
+    assert all(action == "convert" for _, action in order)
+    assert nworkers == 8
+
+    # critical pressure discards files that are not kept
+    free["/data1"] = 10 * GB
+    order, _ = policy.plan(queue, free, {"/data1": 600.0, "/data2": np.inf})
+    assert order[0] == (queue[3], "discard")
+    assert [action for _, action in order[1:]] == ["convert"] * 4
+
+    return
+
+def test_metrics():
+    monitor = scheduling.VolumeMonitor(["/data1", "/data2"], window=100.0)
+    for t in range(0, 200, 10):
+        monitor.update(now=t, free_bytes={"/data1": 1e6 - 100 * t, "/data2": 1e6})
+    assert monitor.fill_rate("/data1") == pytest.approx(100)
+    assert monitor.fill_rate("/data2") == pytest.approx(0, abs=1e-6)
+    ttf = monitor.time_to_full()
+    assert ttf["/data1"] == pytest.approx((1e6 - 100 * 190) / 100)
+    assert ttf["/data2"] == np.inf
+
+    drain = scheduling.DrainTracker(window=100.0)
+    drain.record(0, now=0)
+    drain.record(2, now=50)
+    drain.record(3, now=150)
+    assert drain.rate(now=150) == pytest.approx(5 / 100)
+    assert drain.rate(now=200) == pytest.approx(3 / 100)
+
+    metrics = scheduling.get_metrics(6, drain, monitor, now=150)
+    assert metrics["queue_depth"] == 6
+    assert metrics["queue_drain_time"] == pytest.approx(120)
+    assert metrics["time_to_full:/data2"] == -1
+    assert metrics["free_bytes:/data1"] == 1e6 - 100 * 190
+
+    return
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import status
+from ..loopback import LocalRedis
+import urllib.request
+import pytest
+import numpy as np
+
+
+def test_ring_buffer():
+    ring = status.RingBuffer(3, np.dtype([("x", "i8")]))
+    assert len(ring.values()) == 0
+    for x in range(5):
+        ring.append((x,))
+    assert len(ring) == 3
+    assert list(ring.values()["x"]) == [2, 3, 4]
+
+    return
+
+
+def test_parse_status():
+    hashes = [
+        {"NETWATNS": "1.5E+02", "NETPKTTL": "123", "CNETSTAT": "receiving"},
+        {"NETPKTTL": "4.0", "FILESEC": "2.5"},
+    ]
+    rows = status.parse_status(hashes, 10.0)
+    assert np.all(rows["time"] == 10)
+    assert rows["NETWATNS"][0] == 150
+    assert np.isnan(rows["NETWATNS"][1])
+    assert list(rows["NETPKTTL"]) == [123, 4]
+    assert list(rows["NDONEFIL"]) == [-1, -1]
+    assert list(rows["CNETSTAT"]) == ["receiving", ""]
+
+    return
+
+
+def test_aggregator():
+    r = LocalRedis()
+    key0 = status.STATUS_KEY.format(host="hera-sn1", inst=0)
+    key1 = status.STATUS_KEY.format(host="hera-sn1", inst=1)
+    agg = status.StatusAggregator(r, history=4)
+    for i in range(6):
+        r.hset(key0, mapping={
+            "NETPKTTL": 1000 * i, "MISSEDPK": i, "NDONEFIL": i // 2,
+            "NETWATNS": 25, "NETRECNS": 50, "NETPRCNS": 25, "CNETSTAT": "receiving",
+        })
+        if i >= 4:
+            r.hset(key1, "NETPKTTL", 7)
+        rows = agg.poll(now=100.0 + 2 * i)
+        assert sorted(rows) == ([key0, key1] if i >= 4 else [key0])
+
+    hist = agg.history(key0)
+    assert list(hist["NETPKTTL"]) == [2000, 3000, 4000, 5000]
+    rates = agg.rates(key0)
+    assert np.isnan(rates["packets_per_s"][0])
+    assert np.allclose(rates["packets_per_s"][1:], 500)
+    assert np.allclose(rates["missed_per_s"][1:], 0.5)
+    assert np.allclose(rates["net_utilisation"], 0.75)
+    # NDONEFIL is 1, 1, 2, 2, so the lag is unknown until it changes
+    assert np.all(np.isnan(rates["file_lag"][:2]))
+    assert list(rates["file_lag"][2:]) == [0, 2]
+    assert np.isnan(agg.rates(key1)["drops_per_s"][-1])
+
+    summary = agg.summary()
+    assert summary[key0]["packets_per_s"] == 500
+    assert summary[key0]["CNETSTAT"] == "receiving"
+    assert summary[key1]["NETPKTTL"] == 7
+
+    # an explicit host list, including a buffer that does not exist
+    agg = status.StatusAggregator(r, hosts=["hera-sn1"], instances=[0, 2])
+    assert list(agg.poll()) == [key0]
+    with pytest.raises(ValueError, match="instances must be given"):
+        status.StatusAggregator(r, hosts=["hera-sn1"])
+
+    return
+
+
+def test_exposition():
+    r = LocalRedis()
+    key = status.STATUS_KEY.format(host="hera-sn2", inst=0)
+    r.hset(key, mapping={"NETPKTTL": 10, "CNETSTAT": "holding"})
+    agg = status.StatusAggregator(r)
+    agg.poll(now=1.0)
+    r.hset(key, "NETPKTTL", 30)
+    agg.poll(now=2.0)
+
+    server = agg.serve()
+    try:
+        host, port = server.server_address
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as resp:
+            text = resp.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert text == agg.exposition()
+    labels = 'host="hera-sn2",instance="0"'
+    assert f"paper_gpu_netpkttl{{{labels}}} 30\n" in text
+    assert f"paper_gpu_packets_per_s{{{labels}}} 20.0\n" in text
+    assert f'paper_gpu_net_state{{{labels},state="holding"}} 1\n' in text
+    assert "# TYPE paper_gpu_file_lag gauge\n" in text
+
+    return
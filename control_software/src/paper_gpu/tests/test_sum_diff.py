@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import sum_diff
+import pytest
+import numpy as np
+
+NBL = 40
+NCHAN = 16
+CHAN_SUM = 4
+
+
+def _reference_sum_diff(data, chan_sum):
+    # a loop-for-loop port of compute_sum_diff in hera_catcher_disk_thread.c,
+    # with explicit 32-bit wraparound
+    def wrap(x):
+        return (x + 2**31) % 2**32 - 2**31
+
+    nbl, _, nchan, nstokes, _ = data.shape
+    out_sum = np.zeros((nbl, nchan // chan_sum, nstokes, 2), dtype=np.int64)
+    out_diff = np.zeros_like(out_sum)
+    for bcnt in range(nbl):
+        for xchan in range(0, nchan, chan_sum):
+            chan = xchan // chan_sum
+            for k in range(nstokes):
+                for ri in range(2):
+                    even = odd = 0
+                    for c in range(chan_sum):
+                        even = wrap(even + int(data[bcnt, 0, xchan + c, k, ri]))
+                        odd = wrap(odd + int(data[bcnt, 1, xchan + c, k, ri]))
+                    out_sum[bcnt, chan, k, ri] = wrap(even + odd)
+                    out_diff[bcnt, chan, k, ri] = wrap(even - odd)
+    return out_sum, out_diff
+
+
+@pytest.fixture(scope="module")
+def test_vectors():
+    rng = np.random.default_rng(41)
+    data = rng.integers(
+        -2**31, 2**31, size=(NBL, sum_diff.TIME_DEMUX, NCHAN, sum_diff.N_STOKES, 2),
+        dtype=np.int64,
+    ).astype(np.int32)
+    # include small values that do not overflow
+    data[: NBL // 2] >>= 12
+    out_sum, out_diff = _reference_sum_diff(data, CHAN_SUM)
+
+    yield data, out_sum, out_diff
+
+    # clean up when done
+    del data, out_sum, out_diff
+
+    return
+
+
+@pytest.mark.parametrize("nthreads", [1, 3])
+def test_sum_diff(test_vectors, nthreads):
+    data, ref_sum, ref_diff = test_vectors
+    data_sum, data_diff = sum_diff.sum_diff(data, chan_sum=CHAN_SUM, nthreads=nthreads)
+    assert data_sum.shape == (NBL, NCHAN // CHAN_SUM, sum_diff.N_STOKES)
+    assert np.array_equal(data_sum["r"], ref_sum[..., 0])
+    assert np.array_equal(data_sum["i"], ref_sum[..., 1])
+    assert np.array_equal(data_diff["r"], ref_diff[..., 0])
+    assert np.array_equal(data_diff["i"], ref_diff[..., 1])
+
+    # only the first nbl baselines
+    data_sum, data_diff = sum_diff.sum_diff(
+        data, nbl=20, bl_per_write=8, chan_sum=CHAN_SUM, nthreads=nthreads
+    )
+    assert np.array_equal(data_sum["r"], ref_sum[:20, ..., 0])
+    assert np.array_equal(data_diff["i"], ref_diff[:20, ..., 1])
+
+    # no channel summing
+    data_sum, data_diff = sum_diff.sum_diff(data, chan_sum=1, nthreads=nthreads)
+    ref_sum, ref_diff = _reference_sum_diff(data, 1)
+    assert np.array_equal(data_sum["r"], ref_sum[..., 0])
+    assert np.array_equal(data_diff["i"], ref_diff[..., 1])
+
+    return
+
+
+def test_open_bda_input_databuf(tmp_path, test_vectors):
+    data, ref_sum, ref_diff = test_vectors
+    # the full-size block matches the C struct
+    dtype = sum_diff.bda_input_block_dtype()
+    assert dtype.fields["data"][1] == 65664
+    assert dtype.itemsize == 65664 + 4096 * 2 * 6144 * 4 * 2 * 4
+
+    filename = str(tmp_path / "databuf.dat")
+    blocks = sum_diff.open_bda_input_databuf(
+        filename, mode="w+", n_blocks=2, baselines_per_block=NBL, nchan=NCHAN
+    )
+    blocks[1]["header"]["bcnt"] = np.arange(NBL)
+    blocks[1]["data"] = data
+    blocks.flush()
+    del blocks
+
+    blocks = sum_diff.open_bda_input_databuf(
+        filename, n_blocks=2, baselines_per_block=NBL, nchan=NCHAN
+    )
+    block_size = blocks.dtype.itemsize
+    data_offset = 128 + block_size + blocks.dtype.fields["data"][1]
+    raw = np.fromfile(filename, dtype=np.int32, offset=data_offset)
+    assert np.array_equal(raw[: data.size], data.ravel())
+    assert np.array_equal(blocks[1]["header"]["bcnt"], np.arange(NBL))
+
+    data_sum, data_diff = sum_diff.sum_diff(blocks[1]["data"], chan_sum=CHAN_SUM)
+    assert np.array_equal(data_sum["r"], ref_sum[..., 0])
+    assert np.array_equal(data_diff["r"], ref_diff[..., 0])
+
+    return
+
+
+def test_benchmark_sum_diff():
+    results = sum_diff.benchmark_sum_diff(nbl=8, nchan=NCHAN, nthreads=(1, 2), repeat=1)
+    assert sorted(results) == [1, 2]
+    assert all(res["GBps"] > 0 for res in results.values())
+
+    return
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import timing
+import ctypes
+import shutil
+import subprocess
+import pytest
+import numpy as np
+from astropy import units
+from astropy.coordinates import EarthLocation
+from astropy.time import Time
+
+# mcnt2time and compute_jd_from_mcnt from hera_catcher_disk_thread.c
+C_SOURCE = r"""
+#include <stdint.h>
+#define N_CHAN_TOTAL_GENERATED (8192)
+#define FENG_SAMPLE_RATE (500000000L)
+
+double mcnt2time(uint64_t mcnt, uint64_t sync_time_ms)
+{
+    return (sync_time_ms / 1000.) + (mcnt * (2L * N_CHAN_TOTAL_GENERATED / (double)FENG_SAMPLE_RATE));
+}
+
+double compute_jd_from_mcnt(uint64_t mcnt, uint64_t sync_time_ms, double integration_time)
+{
+   double unix_time = (sync_time_ms / 1000.) + (mcnt * (2L * N_CHAN_TOTAL_GENERATED / (double)FENG_SAMPLE_RATE));
+   unix_time = unix_time - integration_time/2;
+
+   return (2440587.5 + (unix_time / (double)(86400.0)));
+}
+"""
+
+SYNC_TIME_MS = 1650000000123
+
+
+@pytest.fixture(scope="module")
+def c_formulas(tmp_path_factory):
+    cc = shutil.which("cc")
+    if cc is None:
+        pytest.skip("no C compiler")
+    tmpdir = tmp_path_factory.mktemp("timing")
+    src = tmpdir / "timing.c"
+    lib = tmpdir / "libtiming.so"
+    src.write_text(C_SOURCE)
+    subprocess.run([cc, "-O2", "-shared", "-fPIC", "-o", str(lib), str(src)], check=True)
+    clib = ctypes.CDLL(str(lib))
+    clib.mcnt2time.restype = ctypes.c_double
+    clib.mcnt2time.argtypes = [ctypes.c_uint64, ctypes.c_uint64]
+    clib.compute_jd_from_mcnt.restype = ctypes.c_double
+    clib.compute_jd_from_mcnt.argtypes = [ctypes.c_uint64, ctypes.c_uint64, ctypes.c_double]
+    yield clib
+
+
+def test_mcnt_conversions(c_formulas):
+    rng = np.random.default_rng(0)
+    mcnts = np.concatenate([[0, 1, 2**40 + 3], rng.integers(0, 2**44, 1000)]).astype(np.uint64)
+    inttime = rng.choice([2.0, 4.0, 8.0, 16.0], len(mcnts))
+
+    unix = timing.mcnt_to_unix(mcnts, SYNC_TIME_MS)
+    jd = timing.mcnt_to_jd(mcnts, SYNC_TIME_MS, inttime)
+    ref_unix = [c_formulas.mcnt2time(int(m), SYNC_TIME_MS) for m in mcnts]
+    ref_jd = [
+        c_formulas.compute_jd_from_mcnt(int(m), SYNC_TIME_MS, t) for m, t in zip(mcnts, inttime)
+    ]
+    # bit for bit
+    assert np.array_equal(unix, ref_unix)
+    assert np.array_equal(jd, ref_jd)
+    assert timing.mcnt_to_unix(int(mcnts[5]), SYNC_TIME_MS) == ref_unix[5]
+
+    assert np.allclose(timing.jd_to_unix(timing.unix_to_jd(unix)), unix, rtol=0, atol=1e-4)
+    assert timing.mcnt_to_unix(timing.mcnts_per_second(500e6, 8192), 0) == pytest.approx(1)
+
+    return
+
+
+def test_trigger_mcnt():
+    start_time = 1650000600
+    trig_mcnt, trig_time = timing.trigger_mcnt(start_time, SYNC_TIME_MS, 4096)
+    assert trig_mcnt % 4096 == 0
+    assert 0 <= start_time - trig_time < 4096 / timing.mcnts_per_second(500e6, 8192)
+    assert trig_time == pytest.approx(timing.mcnt_to_unix(trig_mcnt, SYNC_TIME_MS))
+
+    return
+
+
+def test_lst():
+    # a night, its edges, and the next night
+    jd = np.concatenate([
+        2459800 + np.linspace(0, 1, 50), [2459800 - 1e-6, 2459801.3]
+    ])
+    unix = timing.jd_to_unix(jd)
+    location = EarthLocation.from_geodetic(
+        timing.HERA_LONGITUDE * units.deg, timing.HERA_LATITUDE * units.deg,
+        timing.HERA_ALTITUDE * units.m,
+    )
+    ref = Time(jd, format="jd", location=location).sidereal_time("apparent").rad
+    lst = timing.unix_to_lst(unix)
+    dlst = np.angle(np.exp(1j * (lst - ref)))
+    # well under 1 ms of LST
+    assert np.max(np.abs(dlst)) < 1e-8
+    assert np.all((lst >= 0) & (lst < 2 * np.pi))
+    # the tables are cached
+    assert timing.get_lst_table(2459800) is timing.get_lst_table(2459800)
+
+    mcnt = (unix[10] - SYNC_TIME_MS / 1000) * timing.mcnts_per_second(500e6, 8192)
+    assert timing.mcnt_to_lst(mcnt, SYNC_TIME_MS) == pytest.approx(lst[10], abs=1e-8)
+
+    return
+
+
+def test_lst_boundaries():
+    table = timing.get_lst_table(2459800, longitude=timing.LST_SCHEDULER_LONGITUDE)
+    bin_size = 600.0
+    times, lsts = table.boundaries(bin_size)
+    assert np.all(np.diff(times) > 0)
+    # LST bins are multiples of the bin size, starting again at 0 each day
+    nbins = np.round(lsts / (2 * np.pi) * 86400 / bin_size)
+    assert np.allclose(lsts / (2 * np.pi) * 86400, nbins * bin_size, atol=1e-6)
+    assert np.any(nbins == 0)
+    # bins are 600 sidereal seconds apart
+    assert np.allclose(np.diff(times), bin_size * 0.99726957, rtol=1e-6)
+    assert np.allclose(np.angle(np.exp(1j * (table.lst(times) - lsts))), 0, atol=1e-8)
+
+    # times in the middle of the night, away from the overlap with other tables
+    start = times[50] - 1
+    boundary, lst = timing.next_lst_boundary(start, bin_size)
+    assert boundary == times[50]
+    assert lst == lsts[50]
+    boundary, _ = timing.next_lst_boundary(times[50], bin_size)
+    assert boundary == times[51]
+    # the next boundary is in the next night's table
+    end = timing.jd_to_unix(2459801) - 1
+    boundary, lst = timing.next_lst_boundary(end, bin_size)
+    assert 0 < boundary - end <= bin_size
+    # a bin size that does not divide a day gives a short last bin
+    times, lsts = table.boundaries(7000.0)
+    assert np.min(np.diff(times)) < 7000.0 * 0.99726957 * 0.9
+
+    return
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+from .. import loopback, work_stealing
+import os
+import time
+import multiprocessing as mp
+from multiprocessing.managers import BaseManager
+import numpy as np
+import pytest
+
+VOLUMES = ("/data1", "/data2")
+NBYTES = 1000
+# 0.1 s per file, and a fast network
+CPU_RATE = 1e4
+NET_BANDWIDTH = 1e6
+
+
+class RedisManager(BaseManager):
+    pass
+
+
+RedisManager.register("LocalRedis", loopback.LocalRedis)
+
+
+def _write_files(root, jd, nfiles, nbytes=NBYTES):
+    names = []
+    volume = VOLUMES[jd % 2 == 0]
+    jd_dir = os.path.join(root + volume, str(jd))
+    os.makedirs(jd_dir, exist_ok=True)
+    for i in range(nfiles):
+        name = f"{jd}/zen.{jd}.{10000 + i}.sum.dat"
+        with open(os.path.join(root + volume, name), "wb") as fh:
+            fh.write(b"\0" * nbytes)
+        names.append(name)
+    return names
+
+
+def _scheduler(r, host, roots, **kwargs):
+    mounts = {h: root for h, root in roots.items() if h != host}
+    cost_model = work_stealing.CostModel(cpu_rate=CPU_RATE, net_bandwidth=NET_BANDWIDTH)
+    return work_stealing.LocalityScheduler(
+        r, host, VOLUMES, mounts, root=roots[host], cost_model=cost_model, **kwargs
+    )
+
+
+def _convert(r, scheduler, name, cwd, host):
+    # a stand-in for process_next: read the file, write its output and delete it
+    f_in = os.path.join(cwd, name)
+    with open(f_in, "rb") as fh:
+        nbytes = len(fh.read())
+    time.sleep(scheduler.cost_model.local_time(nbytes))
+    with open(f_in.replace(".dat", ".uvh5"), "w") as fh:
+        fh.write(host)
+    os.remove(f_in)
+    scheduler.forget([name])
+    r.rpush("converted", f"{host} {name}")
+
+
+def _worker(r, host, roots):
+    scheduler = _scheduler(r, host, roots)
+    while r.llen(work_stealing.RAW_FILE_KEY) > 0:
+        local, remote = scheduler.split_queue()
+        # one worker, busy while there is anything local
+        scheduler.publish(1, int(len(local) > 0), len(local))
+        if len(local) > 0:
+            # newest first, like the SchedulingPolicy
+            name, cwd = local[-1], None
+        else:
+            steal = scheduler.choose_steal()
+            if steal is None:
+                time.sleep(0.01)
+                continue
+            name, cwd = steal.name, steal.cwd
+        if r.lrem(work_stealing.RAW_FILE_KEY, 1, name) == 0:
+            continue
+        if cwd is None:
+            cwd = scheduler.volume_dir(scheduler.locate([name])[name].volume)
+        _convert(r, scheduler, name, cwd, host)
+    scheduler.publish(1, 0, 0)
+
+
+def test_cost_model():
+    cost = work_stealing.CostModel(cpu_rate=100.0, net_bandwidth=1000.0, output_ratio=0.5)
+    assert cost.local_time(1000) == 10.0
+    assert cost.network_time(1000) == 1.5
+    assert cost.remote_time(1000) == 11.5
+    assert cost.owner_wait(4000, 2) == 20.0
+    assert cost.owner_wait(4000, 0) == np.inf
+    # 11.5 * 1.5 = 17.25 s over the mount vs waiting for the owner
+    assert not cost.should_steal(1000, 0.0)
+    assert not cost.should_steal(1000, 7.0)
+    assert cost.should_steal(1000, 7.5)
+    assert cost.should_steal(1000, np.inf)
+    # a fast owner is not worth stealing from
+    assert not cost.should_steal(1000, 7.5, cpu_rate=1000.0)
+
+    cost = work_stealing.CostModel(cpu_rate=100.0, net_bandwidth=1000.0, alpha=0.5)
+    cost.record(1000, 5.0)
+    assert cost.cpu_rate == 150.0
+    cost.record(1500, 10.0 + 1.5 * 1500 / 3000.0, remote=True)
+    assert cost.net_bandwidth == pytest.approx(2000.0)
+    cost.record(0, 1.0)
+    assert cost.cpu_rate == 150.0
+
+    assert work_stealing.get_mount("hera-sn2.hera.pvt") == "/mnt/sn2"
+    assert work_stealing.get_mount("hera-node1") is None
+
+    return
+
+
+def test_split_queue(tmp_path):
+    roots = {"sn1": str(tmp_path / "sn1"), "sn2": str(tmp_path / "sn2")}
+    r = loopback.LocalRedis()
+    sn1_files = _write_files(roots["sn1"], 2459000, 3)
+    sn2_files = _write_files(roots["sn2"], 2459001, 2, nbytes=500)
+    r.rpush(work_stealing.RAW_FILE_KEY, sn2_files[0], *sn1_files, sn2_files[1], "gone.sum.dat")
+    sn1 = _scheduler(r, "sn1", roots)
+    sn2 = _scheduler(r, "sn2", roots)
+
+    local, remote = sn1.split_queue()
+    assert local == sn1_files
+    # sn2's converter is down, so it has not located its files or published
+    # its state
+    assert remote == {}
+    # but an idle sn1 finds them on sn2's mount, and steals the oldest
+    steal = sn1.choose_steal()
+    assert steal.name == sn2_files[0]
+    assert steal.location == work_stealing.FileLocation("sn2", "/data1", 500)
+    assert steal.owner_wait == np.inf
+    local, remote = sn2.split_queue()
+    assert local == sn2_files
+    assert [name for name, _ in remote["sn1"]] == sn1_files
+    loc = remote["sn1"][0][1]
+    assert loc == work_stealing.FileLocation("sn1", "/data2", NBYTES)
+    local, remote = sn1.split_queue()
+    assert [name for name, _ in remote["sn2"]] == sn2_files
+    assert sn1.volume_dir("/data1", "sn2") == roots["sn2"] + "/data1"
+
+    # sn1 is idle and sn2 is down, so its oldest file is stolen over the mount
+    steal = sn1.choose_steal(remote)
+    assert steal.name == sn2_files[0]
+    assert steal.cwd == roots["sn2"] + "/data1"
+    assert os.path.exists(os.path.join(steal.cwd, steal.name))
+    assert steal.owner_wait == np.inf
+    # nothing is stolen from an owner with idle workers
+    sn2.publish(2, 1, 2)
+    assert sn1.choose_steal(remote) is None
+    # or a busy owner that will get to the file soon
+    sn2.publish(2, 2, 2)
+    assert sn1.choose_steal(remote) is None
+    sn2.publish(1, 1, 2)
+    steal = sn1.choose_steal(remote)
+    assert steal.name == sn2_files[0]
+    assert steal.owner_wait == pytest.approx(500 / CPU_RATE)
+    # or an owner that has stopped publishing
+    sn2.publish(1, 0, 2, now=time.time() - 2 * work_stealing.HEARTBEAT_TIMEOUT)
+    assert sn1.choose_steal(remote).owner_wait == np.inf
+
+    sn1.forget(sn2_files)
+    assert sorted(r.hgetall(work_stealing.LOCATION_KEY)) == sorted(sn1_files)
+
+    return
+
+
+def test_work_stealing(tmp_path):
+    roots = {"sn1": str(tmp_path / "sn1"), "sn2": str(tmp_path / "sn2")}
+    os.makedirs(roots["sn2"] + "/data2")
+    files = _write_files(roots["sn1"], 2459000, 12)
+
+    with RedisManager() as manager:
+        r = manager.LocalRedis()
+        r.rpush(work_stealing.RAW_FILE_KEY, *files)
+        # sn1 has one worker, which is busy
+        _scheduler(r, "sn1", roots).publish(1, 1, len(files))
+        procs = [mp.Process(target=_worker, args=(r, host, roots)) for host in roots]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join(60)
+        assert [proc.exitcode for proc in procs] == [0, 0]
+        converted = [line.split() for line in r.lrange("converted", 0, -1)]
+        assert r.hgetall(work_stealing.LOCATION_KEY) == {}
+
+    assert sorted(name for _, name in converted) == files
+    hosts = {name: host for host, name in converted}
+    stolen = [name for name in files if hosts[name] == "sn2"]
+    assert len(stolen) > 0
+    # stolen from the old end of the queue, and not the last file, which sn1
+    # finishes before it could be converted over the mount
+    assert hosts[files[-1]] == "sn1"
+    assert stolen[0] == files[0]
+    # the output is written back to sn1's volume
+    for name in files:
+        f_out = os.path.join(roots["sn1"] + "/data2", name.replace(".dat", ".uvh5"))
+        with open(f_out) as fh:
+            assert fh.read() == hosts[name]
+        assert not os.path.exists(os.path.join(roots["sn1"] + "/data2", name))
+
+    return
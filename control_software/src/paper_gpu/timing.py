@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+Conversions between mcnts, unix times, JDs and LSTs.
+
+The mcnt conversions follow `mcnt2time` and `compute_jd_from_mcnt` in
+hera_catcher_disk_thread.c and work on arrays. LSTs come from a per-night
+table of apparent sidereal times computed once with astropy and
+interpolated, which also gives the times at which the LST crosses the
+boundaries of fixed-size LST bins, as used to schedule files.
+"""
+
+import functools
+import numpy as np
+from astropy import units
+from astropy.coordinates import EarthLocation
+from astropy.time import Time
+
+# see paper_databuf.h and hera_catcher_disk_thread.c
+FENG_SAMPLE_RATE = 500000000
+N_CHAN_TOTAL_GENERATED = 8192
+
+# JD of the unix epoch
+UNIX_EPOCH_JD = 2440587.5
+SECONDS_PER_DAY = 86400.0
+
+# the site, and the longitude hera_mc's LSTScheduler uses by default
+HERA_LATITUDE = -30.72152
+HERA_LONGITUDE = 21.42831
+HERA_ALTITUDE = 1051.69
+LST_SCHEDULER_LONGITUDE = 21.25
+
+# spacing of the LST tables, in seconds, and their overlap with the
+# neighbouring nights, in days
+LST_TABLE_STEP = 600.0
+LST_TABLE_PAD = 0.1
+
+
+def mcnts_per_second(sample_rate, nchan):
+    """
+    Calculate number of MCNTs in 1 second. For HERA, but not in general,
+    this is the same as the number of spectra in 1 second.
+
+    Parameters
+    ----------
+    sample_rate : float or ndarray
+        The ADC sample rate, in Hz.
+    nchan : int or ndarray
+        The number of frequency channels in one F-engine spectrum (prior to
+        subselecting).
+
+    Returns
+    -------
+    float or ndarray
+        The number of mcnts in 1 second.
+    """
+    return sample_rate / (nchan * 2)
+
+
+def mcnt_to_unix(mcnt, sync_time_ms, sample_rate=FENG_SAMPLE_RATE,
+                 nchan=N_CHAN_TOTAL_GENERATED):
+    """
+    Convert mcnts to unix times, like `mcnt2time` in the catcher.
+
+    Parameters
+    ----------
+    mcnt : int or ndarray
+        The mcnts.
+    sync_time_ms : int
+        The F-engine sync time, in ms.
+    sample_rate : float, optional
+        The ADC sample rate, in Hz.
+    nchan : int, optional
+        The number of channels generated by the F-engines.
+
+    Returns
+    -------
+    float or ndarray of float
+        The unix times.
+    """
+    mcnt = np.asarray(mcnt, dtype=np.float64)
+    return sync_time_ms / 1000.0 + mcnt * (2 * nchan / float(sample_rate))
+
+
+def unix_to_jd(unix_time):
+    """Convert unix times to JDs."""
+    return UNIX_EPOCH_JD + np.asarray(unix_time) / SECONDS_PER_DAY
+
+
+def jd_to_unix(jd):
+    """Convert JDs to unix times."""
+    return (np.asarray(jd) - UNIX_EPOCH_JD) * SECONDS_PER_DAY
+
+
+def mcnt_to_jd(mcnt, sync_time_ms, integration_time, sample_rate=FENG_SAMPLE_RATE,
+               nchan=N_CHAN_TOTAL_GENERATED):
+    """
+    Get the JD of the middle of integrations ending at mcnts, like
+    `compute_jd_from_mcnt` in the catcher.
+
+    Parameters
+    ----------
+    mcnt : int or ndarray
+        The mcnts at the end of the integrations.
+    sync_time_ms : int
+        The F-engine sync time, in ms.
+    integration_time : float or ndarray
+        The integration times, in seconds.
+    sample_rate : float, optional
+        The ADC sample rate, in Hz.
+    nchan : int, optional
+        The number of channels generated by the F-engines.
+
+    Returns
+    -------
+    float or ndarray of float
+        The JDs.
+    """
+    unix_time = mcnt_to_unix(mcnt, sync_time_ms, sample_rate, nchan) - integration_time / 2
+    return UNIX_EPOCH_JD + unix_time / SECONDS_PER_DAY
+
+
+def trigger_mcnt(start_time, sync_time_ms, granularity, sample_rate=FENG_SAMPLE_RATE,
+                 nchan=N_CHAN_TOTAL_GENERATED):
+    """
+    Get the mcnt at which to start integrating, as `catcher.set_observation`.
+
+    Parameters
+    ----------
+    start_time : float
+        The unix time to start at.
+    sync_time_ms : int
+        The F-engine sync time, in ms.
+    granularity : int
+        The trigger mcnt is rounded down to a multiple of this, e.g. the xGPU
+        block size times the number of time slices.
+    sample_rate : float, optional
+        The ADC sample rate, in Hz.
+    nchan : int, optional
+        The number of channels generated by the F-engines.
+
+    Returns
+    -------
+    trig_mcnt : int
+        The trigger mcnt.
+    trig_time : float
+        The unix time of the trigger mcnt.
+    """
+    t0 = sync_time_ms / 1000
+    mcnt_per_s = mcnts_per_second(sample_rate, nchan)
+    mcnt_delay = int((start_time - t0) * mcnt_per_s)
+    trig_mcnt = mcnt_delay - int(mcnt_delay % int(granularity))
+    return trig_mcnt, trig_mcnt / mcnt_per_s + t0
+
+
+class LSTTable(object):
+    """
+    A table of apparent LSTs covering one night, for interpolation.
+
+    Parameters
+    ----------
+    night : int
+        The integer JD of the night; the table covers JDs from `night` to
+        `night + 1` with LST_TABLE_PAD days of overlap on either side.
+    longitude, latitude, altitude : float, optional
+        The site, in degrees and meters.
+    step : float, optional
+        The spacing of the table, in seconds.
+    """
+
+    def __init__(self, night, longitude=HERA_LONGITUDE, latitude=HERA_LATITUDE,
+                 altitude=HERA_ALTITUDE, step=LST_TABLE_STEP):
+        self.night = night
+        self.longitude = longitude
+        jd_start = night - LST_TABLE_PAD
+        npoints = int(np.ceil((1 + 2 * LST_TABLE_PAD) * SECONDS_PER_DAY / step)) + 1
+        self.unix = jd_to_unix(jd_start) + step * np.arange(npoints)
+        location = EarthLocation.from_geodetic(
+            longitude * units.deg, latitude * units.deg, altitude * units.m
+        )
+        times = Time(unix_to_jd(self.unix), format="jd", scale="utc", location=location)
+        # unwrapped, so the LST increases monotonically through the table
+        self.lst_unwrapped = np.unwrap(times.sidereal_time("apparent").rad)
+
+    def contains(self, unix_time):
+        """Whether unix times are within the table."""
+        unix_time = np.asarray(unix_time)
+        return (unix_time >= self.unix[0]) & (unix_time <= self.unix[-1])
+
+    def lst(self, unix_time):
+        """
+        Get the LSTs of unix times within the table.
+
+        Returns
+        -------
+        float or ndarray of float
+            The LSTs, in radians from 0 to 2pi.
+        """
+        return np.interp(unix_time, self.unix, self.lst_unwrapped) % (2 * np.pi)
+
+    def boundaries(self, bin_size):
+        """
+        Get the times at which the LST crosses LST bin boundaries.
+
+        Like hera_mc's `LSTScheduler`, bins start at LST 0 every sidereal day
+        and the last bin of each day is cut short at 24h.
+
+        Parameters
+        ----------
+        bin_size : float
+            The size of the bins, in seconds of LST.
+
+        Returns
+        -------
+        unix_time : ndarray of float
+            The unix times of the boundaries in the table, in order.
+        lst : ndarray of float
+            The LSTs of the boundaries, in radians from 0 to 2pi.
+        """
+        return _lst_boundaries(self, bin_size)
+
+    def next_boundary(self, unix_time, bin_size):
+        """
+        Get the first LST bin boundary after a unix time in the table.
+
+        Returns
+        -------
+        unix_time, lst : float
+            The unix time and LST of the boundary, or None and None if it is
+            after the end of the table.
+        """
+        times, lsts = self.boundaries(bin_size)
+        i = np.searchsorted(times, unix_time, side="right")
+        if i == len(times):
+            return None, None
+        return times[i], lsts[i]
+
+
+@functools.lru_cache(maxsize=32)
+def _lst_boundaries(table, bin_size):
+    bin_rad = bin_size / SECONDS_PER_DAY * 2 * np.pi
+    day_bins = np.arange(0, 2 * np.pi, bin_rad)
+    turns = np.arange(
+        np.floor(table.lst_unwrapped[0] / (2 * np.pi)),
+        np.floor(table.lst_unwrapped[-1] / (2 * np.pi)) + 1,
+    )
+    lst = (turns[:, np.newaxis] * 2 * np.pi + day_bins).ravel()
+    lst = lst[(lst > table.lst_unwrapped[0]) & (lst <= table.lst_unwrapped[-1])]
+    unix_time = np.interp(lst, table.lst_unwrapped, table.unix)
+    unix_time.flags.writeable = False
+    lst = lst % (2 * np.pi)
+    lst.flags.writeable = False
+    return unix_time, lst
+
+
+@functools.lru_cache(maxsize=16)
+def get_lst_table(night, longitude=HERA_LONGITUDE, latitude=HERA_LATITUDE,
+                  altitude=HERA_ALTITUDE):
+    """
+    Get the LST table of a night, computing it on first use.
+
+    Parameters
+    ----------
+    night : int
+        The integer JD of the night.
+    longitude, latitude, altitude : float, optional
+        The site, in degrees and meters.
+
+    Returns
+    -------
+    LSTTable
+        The table, shared by every caller.
+    """
+    return LSTTable(int(night), longitude, latitude, altitude)
+
+
+def unix_to_lst(unix_time, longitude=HERA_LONGITUDE, latitude=HERA_LATITUDE,
+                altitude=HERA_ALTITUDE):
+    """
+    Get the apparent LSTs of unix times.
+
+    Parameters
+    ----------
+    unix_time : float or ndarray
+        The unix times.
+    longitude, latitude, altitude : float, optional
+        The site, in degrees and meters.
+
+    Returns
+    -------
+    float or ndarray of float
+        The LSTs, in radians from 0 to 2pi.
+    """
+    unix_time = np.asarray(unix_time, dtype=np.float64)
+    nights = np.floor(unix_to_jd(unix_time)).astype(np.int64)
+    lst = np.empty_like(unix_time)
+    for night in np.unique(nights):
+        table = get_lst_table(night, longitude, latitude, altitude)
+        this_night = nights == night
+        lst[this_night] = table.lst(unix_time[this_night])
+    return lst
+
+
+def mcnt_to_lst(mcnt, sync_time_ms, longitude=HERA_LONGITUDE, latitude=HERA_LATITUDE,
+                altitude=HERA_ALTITUDE, sample_rate=FENG_SAMPLE_RATE,
+                nchan=N_CHAN_TOTAL_GENERATED):
+    """
+    Get the apparent LSTs of mcnts.
+
+    Parameters
+    ----------
+    mcnt : int or ndarray
+        The mcnts.
+    sync_time_ms : int
+        The F-engine sync time, in ms.
+    longitude, latitude, altitude : float, optional
+        The site, in degrees and meters.
+    sample_rate : float, optional
+        The ADC sample rate, in Hz.
+    nchan : int, optional
+        The number of channels generated by the F-engines.
+
+    Returns
+    -------
+    float or ndarray of float
+        The LSTs, in radians from 0 to 2pi.
+    """
+    unix_time = mcnt_to_unix(mcnt, sync_time_ms, sample_rate, nchan)
+    return unix_to_lst(unix_time, longitude, latitude, altitude)
+
+
+def next_lst_boundary(unix_time, bin_size, longitude=LST_SCHEDULER_LONGITUDE):
+    """
+    Get the start of the next LST bin, like hera_mc's `LSTScheduler`.
+
+    Parameters
+    ----------
+    unix_time : float
+        The unix time to start from.
+    bin_size : float
+        The size of the LST bins, in seconds of LST.
+    longitude : float, optional
+        The longitude, in degrees.
+
+    Returns
+    -------
+    unix_time : float
+        The unix time of the next bin boundary.
+    lst : float
+        The LST of the boundary, in radians.
+    """
+    night = int(np.floor(unix_to_jd(unix_time)))
+    while True:
+        table = get_lst_table(night, longitude)
+        boundary, lst = table.next_boundary(unix_time, bin_size)
+        if boundary is not None:
+            return float(boundary), float(lst)
+        night += 1
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 The HERA Collaboration
+# Licensed under the 2-clause BSD License
+
+"""
+Locality-aware sharing of the raw file conversion queue between hosts.
+
+The catchers of every host push the files they write to the one
+RAW_FILE_KEY queue. Each converter records which of the queued files are on
+its local volumes in the LOCATION_KEY hash, and converts those first. A
+converter with nothing local to do steals files from the hosts that are
+behind, reading them over the remote host's mount, when the `CostModel`
+says that reading the file over the network finishes it sooner than waiting
+for its owner to get to it. Owners convert their newest files first, so
+stolen files are taken from the old end of the queue.
+"""
+
+import os
+import json
+import time
+import numpy as np
+from collections import namedtuple
+
+RAW_FILE_KEY = "corr:files:raw"
+# queued file -> host, volume and size, as JSON
+LOCATION_KEY = "corr:files:location"
+# per-converter hash with its workers, queue and rates
+CONVERTER_KEY = "corr:files:converter:{host}"
+
+# mount points of each catcher host's volumes on the others
+CATCHER_MOUNTS = {"hera-sn1": "/mnt/sn1", "hera-sn2": "/mnt/sn2"}
+
+# initial rates, refined from finished conversions
+DEFAULT_CPU_RATE = 50e6  # bytes of raw data converted per second per worker
+DEFAULT_NET_BANDWIDTH = 400e6  # bytes per second read or written over a mount
+# size of the .uvh5 output written back over the mount, as a fraction of the input
+DEFAULT_OUTPUT_RATIO = 0.5
+# a converter that has not published its state for this long is down
+HEARTBEAT_TIMEOUT = 60.0
+
+FileLocation = namedtuple("FileLocation", ["host", "volume", "nbytes"])
+FileLocation.__doc__ = """
+Where a queued raw data file is.
+
+Parameters
+----------
+host : str
+    The host whose volume holds the file.
+volume : str
+    The volume (mount point on `host`) holding the file.
+nbytes : int
+    The size of the file in bytes.
+"""
+
+Steal = namedtuple("Steal", ["name", "location", "cwd", "owner_wait", "remote_time"])
+Steal.__doc__ = """
+A remote file worth converting locally.
+
+Parameters
+----------
+name : str
+    The name of the file as queued.
+location : FileLocation
+    Where the file is.
+cwd : str
+    The directory the name is relative to on this host, through the mount.
+owner_wait : float
+    The estimated time until the owner would finish the file, in seconds.
+remote_time : float
+    The estimated time to convert the file over the mount, in seconds.
+"""
+
+
+def get_mount(hostname, mounts=CATCHER_MOUNTS):
+    """
+    Get the mount point of a catcher host's volumes.
+
+    Parameters
+    ----------
+    hostname : str
+        The host name, which may be fully qualified.
+    mounts : dict, optional
+        The mount point of each host.
+
+    Returns
+    -------
+    str or None
+        The mount point, or None for an unknown host.
+    """
+    for host, mount in mounts.items():
+        if host in hostname:
+            return mount
+    return None
+
+
+class CostModel(object):
+    """
+    Compare converting a file locally with reading it over the network.
+
+    The conversion rate and network bandwidth start from defaults and are
+    updated from finished conversions with an exponentially weighted mean.
+
+    Parameters
+    ----------
+    cpu_rate : float, optional
+        Bytes of raw data one worker converts per second.
+    net_bandwidth : float, optional
+        Bytes per second read or written over a mount.
+    output_ratio : float, optional
+        The size of the output, which is written back over the mount, as a
+        fraction of the input.
+    margin : float, optional
+        A remote conversion must be this many times faster than waiting for
+        the owner before a file is stolen.
+    alpha : float, optional
+        The weight of each new measurement of the rates.
+    """
+
+    def __init__(self, cpu_rate=DEFAULT_CPU_RATE, net_bandwidth=DEFAULT_NET_BANDWIDTH,
+                 output_ratio=DEFAULT_OUTPUT_RATIO, margin=1.5, alpha=0.2):
+        self.cpu_rate = float(cpu_rate)
+        self.net_bandwidth = float(net_bandwidth)
+        self.output_ratio = output_ratio
+        self.margin = margin
+        self.alpha = alpha
+
+    def local_time(self, nbytes, cpu_rate=None):
+        """The time to convert `nbytes` on local disk, in seconds."""
+        return nbytes / (self.cpu_rate if cpu_rate is None else cpu_rate)
+
+    def network_time(self, nbytes):
+        """The time to read `nbytes` and write their output over a mount, in seconds."""
+        return nbytes * (1 + self.output_ratio) / self.net_bandwidth
+
+    def remote_time(self, nbytes):
+        """The time to convert `nbytes` over a mount, in seconds."""
+        return self.local_time(nbytes) + self.network_time(nbytes)
+
+    def owner_wait(self, backlog_bytes, nworkers, cpu_rate=None):
+        """
+        Estimate how long an owner takes to get through its queue.
+
+        Parameters
+        ----------
+        backlog_bytes : int
+            The bytes queued on the owner ahead of a file.
+        nworkers : int
+            The number of conversion workers of the owner; 0 if it is down.
+        cpu_rate : float, optional
+            The conversion rate of the owner's workers. Default is ours.
+
+        Returns
+        -------
+        float
+            The time in seconds, inf if the owner has no workers.
+        """
+        if nworkers <= 0:
+            return np.inf
+        return self.local_time(backlog_bytes, cpu_rate) / nworkers
+
+    def should_steal(self, nbytes, owner_wait, cpu_rate=None):
+        """
+        Whether converting a file over the mount beats waiting for its owner.
+
+        Parameters
+        ----------
+        nbytes : int
+            The size of the file.
+        owner_wait : float
+            The time until the owner starts the file, from `owner_wait`.
+        cpu_rate : float, optional
+            The conversion rate of the owner's workers. Default is ours.
+
+        Returns
+        -------
+        bool
+        """
+        owner_time = owner_wait + self.local_time(nbytes, cpu_rate)
+        return self.remote_time(nbytes) * self.margin < owner_time
+
+    def record(self, nbytes, elapsed, remote=False):
+        """
+        Update the rates from a finished conversion.
+
+        Parameters
+        ----------
+        nbytes : int
+            The size of the converted files.
+        elapsed : float
+            The time the conversion took, in seconds.
+        remote : bool, optional
+            Whether the files were read over a mount, in which case the time
+            beyond the expected local conversion time updates the network
+            bandwidth.
+        """
+        if nbytes <= 0 or elapsed <= 0:
+            return
+        if not remote:
+            self.cpu_rate += self.alpha * (nbytes / elapsed - self.cpu_rate)
+            return
+        net_elapsed = elapsed - self.local_time(nbytes)
+        if net_elapsed > 0:
+            bandwidth = nbytes * (1 + self.output_ratio) / net_elapsed
+            self.net_bandwidth += self.alpha * (bandwidth - self.net_bandwidth)
+
+
+class LocalityScheduler(object):
+    """
+    Split a conversion queue shared between hosts by where the files are.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        The redis connection, with `decode_responses=True`.
+    host : str
+        The name of this host.
+    volumes : list of str
+        The data volumes of every catcher host, e.g. ["/data1", "/data2"].
+    mounts : dict
+        The mount point of each other host's volumes on this host.
+    root : str, optional
+        Prefix of this host's volumes, for testing with fake mounts.
+    cost_model : CostModel, optional
+        The cost model used to decide on steals.
+    queue_key : str, optional
+        The shared queue of raw files.
+    location_key : str, optional
+        The hash of file locations.
+    heartbeat_timeout : float, optional
+        Owners that have not published their state for this many seconds are
+        taken to be down, and all their files may be stolen.
+    """
+
+    def __init__(self, r, host, volumes, mounts, root="", cost_model=None,
+                 queue_key=RAW_FILE_KEY, location_key=LOCATION_KEY,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        self.r = r
+        self.host = host
+        self.volumes = list(volumes)
+        self.mounts = {h: m for h, m in mounts.items() if h != host}
+        self.root = root
+        self.cost_model = CostModel() if cost_model is None else cost_model
+        self.queue_key = queue_key
+        self.location_key = location_key
+        self.heartbeat_timeout = heartbeat_timeout
+
+    def volume_dir(self, volume, host=None):
+        """
+        Get the directory of a volume of a host, as seen from this host.
+
+        Parameters
+        ----------
+        volume : str
+            The volume.
+        host : str, optional
+            The host. Default is this host.
+
+        Returns
+        -------
+        str
+            The directory.
+        """
+        if host is None or host == self.host:
+            prefix = self.root
+        else:
+            prefix = self.mounts[host]
+        return prefix.rstrip("/") + volume
+
+    def _find(self, name, host=None):
+        for volume in self.volumes:
+            try:
+                nbytes = os.path.getsize(os.path.join(self.volume_dir(volume, host), name))
+            except OSError:
+                continue
+            return FileLocation(host or self.host, volume, nbytes)
+        return None
+
+    def locate(self, names, probe_remote=False):
+        """
+        Find where queued files are, recording new locations in redis.
+
+        Parameters
+        ----------
+        names : list of str
+            The queued file names.
+        probe_remote : bool, optional
+            Also look for files not yet located on the mounts of the other
+            hosts, rather than waiting for their owners to record them.
+
+        Returns
+        -------
+        dict
+            The FileLocation of each file found.
+        """
+        known = {
+            name: FileLocation(*json.loads(value))
+            for name, value in self.r.hgetall(self.location_key).items()
+        }
+        out = {}
+        for name in names:
+            loc = known.get(name)
+            if loc is None:
+                loc = self._find(name)
+            if loc is None and probe_remote:
+                for host in self.mounts:
+                    loc = self._find(name, host)
+                    if loc is not None:
+                        break
+            if loc is None:
+                continue
+            if name not in known:
+                self.r.hset(self.location_key, name, json.dumps(list(loc)))
+            out[name] = loc
+        return out
+
+    def forget(self, names):
+        """Remove the locations of files that have left the queue."""
+        if len(names) > 0:
+            self.r.hdel(self.location_key, *names)
+
+    def split_queue(self, probe_remote=False):
+        """
+        Split the queue into this host's files and the other hosts'.
+
+        Parameters
+        ----------
+        probe_remote : bool, optional
+            Look for unlocated files on the other hosts' mounts.
+
+        Returns
+        -------
+        local : list of str
+            The queued files on this host, in queue order.
+        remote : dict
+            The queued files of each other host, in queue order, as lists of
+            (name, FileLocation) pairs.
+        """
+        queue = self.r.lrange(self.queue_key, 0, -1)
+        locations = self.locate(queue, probe_remote=probe_remote)
+        local = []
+        remote = {}
+        for name in queue:
+            loc = locations.get(name)
+            if loc is None:
+                continue
+            if loc.host == self.host:
+                local.append(name)
+            elif loc.host in self.mounts:
+                remote.setdefault(loc.host, []).append((name, loc))
+        return local, remote
+
+    def publish(self, nworkers, nbusy, nqueued, now=None):
+        """
+        Publish the state of this converter for the other hosts.
+
+        Parameters
+        ----------
+        nworkers : int
+            The number of conversion workers this host runs.
+        nbusy : int
+            The number of workers converting files.
+        nqueued : int
+            The number of queued files on this host.
+        now : float, optional
+            The current unix time. Default is `time.time()`.
+        """
+        mapping = {
+            "nworkers": nworkers,
+            "busy": nbusy,
+            "queued": nqueued,
+            "cpu_rate": self.cost_model.cpu_rate,
+            "net_bandwidth": self.cost_model.net_bandwidth,
+            "time": time.time() if now is None else now,
+        }
+        self.r.hset(CONVERTER_KEY.format(host=self.host), mapping=mapping)
+
+    def owner_state(self, host, now=None):
+        """
+        Get the published state of another host's converter.
+
+        Returns
+        -------
+        dict or None
+            The number of workers and busy workers and the conversion rate,
+            or None if the converter is not running.
+        """
+        if now is None:
+            now = time.time()
+        info = self.r.hgetall(CONVERTER_KEY.format(host=host))
+        if not info or now - float(info["time"]) > self.heartbeat_timeout:
+            return None
+        return {
+            "nworkers": int(info["nworkers"]),
+            "busy": int(info["busy"]),
+            "cpu_rate": float(info["cpu_rate"]),
+        }
+
+    def choose_steal(self, remote=None, now=None):
+        """
+        Choose a remote file to convert on this host.
+
+        Only hosts whose workers are all busy, or whose converter is down,
+        are stolen from, and from each the oldest queued file is considered,
+        since owners convert their newest files first. Of the files that the
+        cost model says are worth stealing, the one whose owner is furthest
+        behind is chosen.
+
+        Parameters
+        ----------
+        remote : dict, optional
+            The remote files, from `split_queue`. Default is to read the queue.
+        now : float, optional
+            The current unix time. Default is `time.time()`.
+
+        Returns
+        -------
+        Steal or None
+            The file to steal, or None if nothing is worth stealing.
+        """
+        if remote is None:
+            _, remote = self.split_queue(probe_remote=True)
+        best = None
+        for host, files in remote.items():
+            if len(files) == 0:
+                continue
+            state = self.owner_state(host, now=now)
+            if state is None:
+                nworkers, cpu_rate = 0, None
+            elif state["busy"] < state["nworkers"]:
+                # the owner will start on its files itself
+                continue
+            else:
+                nworkers, cpu_rate = state["nworkers"], state["cpu_rate"]
+            name, loc = files[0]
+            backlog = sum(other.nbytes for _, other in files[1:])
+            wait = self.cost_model.owner_wait(backlog, nworkers, cpu_rate)
+            if not self.cost_model.should_steal(loc.nbytes, wait, cpu_rate):
+                continue
+            if best is None or wait > best.owner_wait:
+                best = Steal(
+                    name=name,
+                    location=loc,
+                    cwd=self.volume_dir(loc.volume, host),
+                    owner_wait=wait,
+                    remote_time=self.cost_model.remote_time(loc.nbytes),
+                )
+        return best
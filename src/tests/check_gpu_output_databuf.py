@@ -1,21 +1,10 @@
 #! /usr/bin/env python
 
 import sys
-import numpy as np
+from paper_gpu import databuf
 
-NTIMES = 2048
-NTIME_FAST = 4
-NCHAN = 384
-NANT  = 192
-NPOL  = 2
-NCPLX = 2
+result = databuf.check_gpu_output_dump(sys.argv[1])
 
-
-with open(sys.argv[1], 'r') as fh:
-    raw = fh.read()
-
-x = np.fromstring(raw, dtype=np.int32)
-
-print("All values equal to 0?:", np.all(x == 0))
-print("All values divisible by 2048?:", np.all((x % 2048) == 0))
-print("All values divisible by 262144?:", np.all((x % 262144) == 0))
+print("All values equal to 0?:", result["all_zero"])
+print("All values divisible by 2048?:", result["divisible_by_2048"])
+print("All values divisible by 262144?:", result["divisible_by_262144"])